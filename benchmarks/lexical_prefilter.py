@@ -0,0 +1,147 @@
+"""キーワード検索(BM25)で候補を絞り込んでからベクトルで検索するハイブリッド検索の、レイテンシとカタログの大きさの関係を計測するベンチマーク
+
+- numpy: NumpyVectorStoreRepository (全件の総当たり)
+- hybrid: HybridVectorStoreRepository (BM25の上位 --prefilter-size 件だけを総当たり)
+
+カタログは2種類で計測する。
+- keyword: 各ドキュメントに --vocabulary-size 語の語彙から3語をキーワードとして付け、質問には2語を含める
+- japanese: テーブルの要約のような日本語の文章。助詞などのひらがなのbigramがほぼ全ドキュメントに含まれる
+candidates は、ベクトルで類似度を計算した行数。
+埋め込みAPIの待ち時間は含めず、ランダムなベクトルで検索のみを計測する。
+
+実行例:
+    python -m benchmarks.lexical_prefilter --num-docs 1000 --num-docs 10000 --num-docs 50000 --dimension 1536
+"""
+
+import itertools
+import statistics
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import typer
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from loguru import logger
+
+from benchmarks.vector_index import TABLE_NAME, measure_latency_ms
+from my_text_to_sql_poc.service.duckdb_connection import close_connection_manager
+from my_text_to_sql_poc.service.hybrid_vector_store import HybridVectorStoreRepository
+from my_text_to_sql_poc.service.numpy_vector_store import NumpyVectorStoreRepository
+from my_text_to_sql_poc.service.repository import DuckDBVectorStoreRepository
+
+app = typer.Typer(pretty_exceptions_enable=False)
+
+
+def prepare_keyword_vector_store(
+    repository: DuckDBVectorStoreRepository, num_docs: int, dimension: int, vocabulary_size: int
+) -> None:
+    """埋め込みAPIを呼ばずに、ランダムなベクトルと語彙から選んだキーワードを持つテーブルを作る"""
+    with repository._connections.write_cursor() as cursor:
+        cursor.execute(
+            f"""
+            CREATE OR REPLACE TABLE {TABLE_NAME} AS
+            SELECT
+                'id_' || range AS id,
+                'keyword' || (range % {vocabulary_size}) || ' keyword' || ((range * 7 + 3) % {vocabulary_size})
+                    || ' keyword' || ((range * 13 + 5) % {vocabulary_size}) AS text,
+                list_transform(range({dimension}), x -> (random() - 0.5)::FLOAT) AS embedding,
+                json_object('doc_id', 'doc_' || range)::VARCHAR AS metadata
+            FROM range({num_docs})
+            """
+        )
+
+
+# 日本語の要約の語彙。ドキュメントごとに行番号から選んで文章にする
+_SUBJECTS = ["注文", "顧客", "商品", "在庫", "配送", "決済", "会員", "店舗", "広告", "記事", "問い合わせ", "クーポン"]
+_EVENTS = ["登録", "変更", "キャンセル", "閲覧", "購入", "返品", "発送", "請求", "集計", "評価", "解約", "更新"]
+_UNITS = ["日別", "月別", "地域別", "カテゴリ別", "担当者別", "時間帯別", "キャンペーン別", "端末別"]
+
+
+def prepare_japanese_vector_store(repository: DuckDBVectorStoreRepository, num_docs: int, dimension: int) -> None:
+    """埋め込みAPIを呼ばずに、ランダムなベクトルと日本語の要約の文章を持つテーブルを作る"""
+    subjects = "[" + ", ".join(f"'{word}'" for word in _SUBJECTS) + "]"
+    events = "[" + ", ".join(f"'{word}'" for word in _EVENTS) + "]"
+    units = "[" + ", ".join(f"'{word}'" for word in _UNITS) + "]"
+    with repository._connections.write_cursor() as cursor:
+        cursor.execute(
+            f"""
+            CREATE OR REPLACE TABLE {TABLE_NAME} AS
+            SELECT
+                'id_' || range AS id,
+                'このテーブルは' || {subjects}[range % {len(_SUBJECTS)} + 1]
+                    || 'の' || {events}[(range // {len(_SUBJECTS)}) % {len(_EVENTS)} + 1]
+                    || 'の履歴を記録しています。' || {units}[(range * 7) % {len(_UNITS)} + 1]
+                    || 'に' || {subjects}[(range * 5 + 3) % {len(_SUBJECTS)} + 1]
+                    || 'の件数を集計するときに使います。システム' || range || 'から毎日連携されます。' AS text,
+                list_transform(range({dimension}), x -> (random() - 0.5)::FLOAT) AS embedding,
+                json_object('doc_id', 'doc_' || range)::VARCHAR AS metadata
+            FROM range({num_docs})
+            """
+        )
+
+
+@app.command()
+def main(
+    num_docs: list[int] = typer.Option([1_000, 10_000, 50_000], help="ドキュメント数。複数指定可"),
+    dimension: int = typer.Option(1536, help="埋め込みの次元数"),
+    k: int = typer.Option(10, help="検索件数"),
+    prefilter_size: int = typer.Option(200, help="キーワード検索で絞り込む候補の最大数"),
+    vocabulary_size: int = typer.Option(500, help="キーワードの語彙数"),
+    repeat: int = typer.Option(20, help="各条件での計測回数"),
+    seed: int = typer.Option(42, help="乱数シード"),
+) -> None:
+    rng = np.random.default_rng(seed)
+    corpora = [
+        (
+            "keyword",
+            "keyword17 keyword42 の件数",
+            lambda repository, num_docs_: prepare_keyword_vector_store(
+                repository, num_docs_, dimension, vocabulary_size
+            ),
+        ),
+        (
+            "japanese",
+            "クーポンの返品の件数を地域別に集計したい",
+            lambda repository, num_docs_: prepare_japanese_vector_store(repository, num_docs_, dimension),
+        ),
+    ]
+    print(f"{'num_docs':>9} {'corpus':>9} {'method':>8} {'candidates':>11} {'p50 (ms)':>10} {'p95 (ms)':>10}")
+    for num_docs_, (corpus, question, prepare) in itertools.product(num_docs, corpora):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = Path(tmp_dir) / "vectorstore.duckdb"
+            duckdb_repository = DuckDBVectorStoreRepository(str(db_path), embeddings=DeterministicFakeEmbedding(size=8))
+            prepare(duckdb_repository, num_docs_)
+            logger.info(f"Prepared {corpus} vector store of {num_docs_} documents: {db_path}")
+            embedding = rng.standard_normal(dimension).astype(np.float32).tolist()
+
+            numpy_repository = NumpyVectorStoreRepository(duckdb_repository)
+            hybrid_repository = HybridVectorStoreRepository(duckdb_repository, prefilter_size=prefilter_size)
+            numpy_repository.index(TABLE_NAME)
+            hybrid_repository.index(TABLE_NAME)
+            candidates = hybrid_repository.candidate_rows(question, TABLE_NAME, k)
+
+            methods = [
+                (
+                    "numpy",
+                    num_docs_,
+                    lambda: numpy_repository.retrieve_relevant_docs_by_vector(embedding, TABLE_NAME, k=k),
+                ),
+                (
+                    "hybrid",
+                    num_docs_ if candidates is None else len(candidates),
+                    lambda: hybrid_repository.retrieve_relevant_docs_hybrid(question, embedding, TABLE_NAME, k=k),
+                ),
+            ]
+            for method, num_candidates, search in methods:
+                latencies = sorted(measure_latency_ms(search, repeat))
+                p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+                print(
+                    f"{num_docs_:>9} {corpus:>9} {method:>8} {num_candidates:>11} "
+                    f"{statistics.median(latencies):>10.2f} {p95:>10.2f}"
+                )
+
+            close_connection_manager(db_path)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,77 @@
+"""テーブルメタデータリポジトリの `get()` のレイテンシを計測するマイクロベンチマーク
+
+1件ずつクエリを発行する従来方式と、名前リストを1回のクエリでまとめて引くバッチ方式を比較する。
+
+実行例:
+    python -m benchmarks.repository_lookup --catalog-size 10000 --k 20 --k 100 --k 1000
+"""
+
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import typer
+from loguru import logger
+
+from my_text_to_sql_poc.service.duckdb_connection import close_connection_manager
+from my_text_to_sql_poc.service.repository import DuckDBTableMetadataRepository
+
+app = typer.Typer(pretty_exceptions_enable=False)
+
+
+def lookup_one_by_one(repository: DuckDBTableMetadataRepository, table_names: list[str]) -> dict[str, str]:
+    """従来方式: テーブル名ごとに1回ずつクエリを発行する"""
+    metadata_by_table = {}
+    with repository._connections.read_cursor() as cursor:
+        for table_name in table_names:
+            result = cursor.execute(
+                "SELECT metadata FROM table_metadata WHERE table_name = ?", (table_name,)
+            ).fetchone()
+            if result:
+                metadata_by_table[table_name] = result[0]
+    return metadata_by_table
+
+
+def measure_latency_ms(func, repeat: int) -> list[float]:
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+@app.command()
+def main(
+    catalog_size: int = typer.Option(10_000, help="カタログに登録するテーブル数"),
+    k: list[int] = typer.Option([20, 100, 1000], help="1回のget()で引くテーブル数。複数指定可"),
+    repeat: int = typer.Option(20, help="各条件での計測回数"),
+    seed: int = typer.Option(42, help="乱数シード"),
+) -> None:
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir) / "table_metadata_store.duckdb"
+        repository = DuckDBTableMetadataRepository(str(db_path))
+        all_table_names = [f"schema_{i % 50}.table_{i}" for i in range(catalog_size)]
+        repository.put_bulk([(name, f"metadata of {name} " * 20) for name in all_table_names])
+        logger.info(f"Prepared catalog of {catalog_size} tables: {db_path}")
+
+        print(f"{'k':>6} {'method':>12} {'p50 (ms)':>10} {'p95 (ms)':>10}")
+        for k_ in k:
+            table_names = rng.sample(all_table_names, min(k_, catalog_size))
+            for method, func in [
+                ("one_by_one", lambda: lookup_one_by_one(repository, table_names)),
+                ("batched", lambda: repository.get(table_names)),
+            ]:
+                func()  # warm up
+                latencies = sorted(measure_latency_ms(func, repeat))
+                p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+                print(f"{k_:>6} {method:>12} {statistics.median(latencies):>10.2f} {p95:>10.2f}")
+
+        close_connection_manager(db_path)
+
+
+if __name__ == "__main__":
+    app()
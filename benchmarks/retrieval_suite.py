@@ -0,0 +1,290 @@
+"""ベクトルストアの全実装(VectorStoreRepositoryInterface)の検索性能を、同じ合成カタログで計測するベンチマークスイート
+
+- カタログ: 乱数シードから決定的に生成した、クラスタ構造を持つ埋め込みと日本語の要約の本文(1k〜1Mドキュメント)
+- 質問: カタログのドキュメントの埋め込みにノイズを足したベクトルと、そのドキュメントの要約の語句を使った日本語の質問
+- 正解: float32 の総当たりで求めた上位k件(recall@k の基準)
+
+バックエンドごとに別プロセス(spawn)で実行し、索引の構築時間(最初の検索の時間)、レイテンシの p50/p95/p99、
+スループット、プロセスのピークRSS、recall@k を計測する。
+結果は1行1条件のJSON Linesで --output に書き出すので、リリース間で `compare` コマンドで比較できる。
+
+実行例:
+    python -m benchmarks.retrieval_suite run --num-docs 1000 --num-docs 10000 --num-docs 100000 \\
+        --output benchmark_results/retrieval.jsonl
+    python -m benchmarks.retrieval_suite compare baseline.jsonl benchmark_results/retrieval.jsonl
+"""
+
+import json
+import platform
+import resource
+import tempfile
+import time
+from collections.abc import Callable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+import duckdb
+import faiss
+import numpy as np
+import typer
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from loguru import logger
+
+from my_text_to_sql_poc.service.duckdb_connection import close_connection_manager
+from my_text_to_sql_poc.service.faiss_vector_store import FaissVectorStoreRepository
+from my_text_to_sql_poc.service.hybrid_vector_store import HybridVectorStoreRepository
+from my_text_to_sql_poc.service.numpy_vector_store import NumpyVectorStoreRepository
+from my_text_to_sql_poc.service.quantized_vector_store import QuantizedVectorStoreRepository
+from my_text_to_sql_poc.service.repository import DuckDBVectorStoreRepository, VectorStoreRepositoryInterface
+
+app = typer.Typer(pretty_exceptions_enable=False)
+
+TABLE_NAME = "table_embeddings"
+# カタログを書き込むときに一度に埋め込みを生成する行数
+_CHUNK_ROWS = 20_000
+# 本文の語彙。クラスタごとに (主題, 出来事) の組を1つ割り当てる
+_SUBJECTS = "注文 顧客 商品 在庫 配送 決済 会員 取引 広告 記事 問い合わせ クーポン ポイント 契約 請求書 予約".split()
+_EVENTS = "登録 変更 キャンセル 閲覧 購入 返品 発送 請求 評価 解約 更新 承認 配信 入金 検品 退会".split()
+_UNITS = "日別 月別 地域別 カテゴリ別 担当者別 時間帯別 キャンペーン別 端末別".split()
+
+BACKENDS: dict[str, Callable[[DuckDBVectorStoreRepository], VectorStoreRepositoryInterface]] = {
+    "duckdb": lambda repository: repository,
+    "numpy": NumpyVectorStoreRepository,
+    "hybrid": HybridVectorStoreRepository,
+    "faiss_flat": lambda repository: FaissVectorStoreRepository(repository, index_type="flat"),
+    "faiss_ivf": lambda repository: FaissVectorStoreRepository(repository, index_type="ivf"),
+    "faiss_hnsw": lambda repository: FaissVectorStoreRepository(repository, index_type="hnsw"),
+    "quantized_float16": lambda repository: QuantizedVectorStoreRepository(repository, precision="float16"),
+    "quantized_int8": lambda repository: QuantizedVectorStoreRepository(repository, precision="int8"),
+}
+
+
+class SyntheticCatalog:
+    """乱数シードから決定的に生成する合成カタログ。
+
+    埋め込みは num_clusters 個の中心の周りに散らばり、本文はテーブルの要約のような日本語の文章にする。
+    本文の主題と出来事は所属するクラスタから、店舗と地域の番号と集計の単位は行番号から決める。
+    同じ引数なら、何度生成しても同じ埋め込みと本文になる。
+    """
+
+    def __init__(self, num_docs: int, dimension: int, seed: int, num_clusters: int = 256) -> None:
+        self.num_docs = num_docs
+        self.dimension = dimension
+        self.seed = seed
+        self.num_clusters = min(num_clusters, num_docs)
+        self._centers = np.random.default_rng(seed).standard_normal((self.num_clusters, dimension)).astype(np.float32)
+
+    def chunks(self) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        """(行番号, 埋め込み) を _CHUNK_ROWS 行ずつ返す"""
+        for start in range(0, self.num_docs, _CHUNK_ROWS):
+            rows = np.arange(start, min(start + _CHUNK_ROWS, self.num_docs))
+            rng = np.random.default_rng([self.seed, start])
+            noise = rng.standard_normal((len(rows), self.dimension)).astype(np.float32)
+            yield rows, self._centers[self.cluster(rows)] + 0.5 * noise
+
+    def cluster(self, rows: np.ndarray) -> np.ndarray:
+        return rows % self.num_clusters
+
+    def text(self, row: int) -> str:
+        subject, event, unit = self._words(row)
+        return (
+            f"table_{row} {subject}の{event}の履歴を記録するテーブルです。"
+            f"店舗{row % 997}と地域{row % 991}の{subject}の件数を{unit}に集計するときに使います。"
+        )
+
+    def question(self, row: int) -> str:
+        subject, event, unit = self._words(row)
+        return f"店舗{row % 997}と地域{row % 991}の{subject}の{event}を{unit}に集計したい"
+
+    def _words(self, row: int) -> tuple[str, str, str]:
+        cluster = int(self.cluster(np.asarray(row)))
+        return (
+            _SUBJECTS[cluster % len(_SUBJECTS)],
+            _EVENTS[(cluster // len(_SUBJECTS)) % len(_EVENTS)],
+            _UNITS[row % len(_UNITS)],
+        )
+
+    def queries(self, num_queries: int) -> tuple[np.ndarray, list[str]]:
+        """カタログのドキュメントの埋め込みにノイズを足した検索ベクトルと、そのドキュメントの語句を使った質問"""
+        rng = np.random.default_rng([self.seed, self.num_docs, 1])
+        source_rows = np.sort(rng.choice(self.num_docs, size=num_queries, replace=False))
+        sources = np.empty((num_queries, self.dimension), dtype=np.float32)
+        for rows, matrix in self.chunks():
+            in_chunk = (source_rows >= rows[0]) & (source_rows <= rows[-1])
+            sources[in_chunk] = matrix[source_rows[in_chunk] - rows[0]]
+        queries = sources + 0.3 * rng.standard_normal(sources.shape).astype(np.float32)
+        questions = [self.question(int(row)) for row in source_rows]
+        return queries, questions
+
+
+def write_catalog(repository: DuckDBVectorStoreRepository, catalog: SyntheticCatalog) -> None:
+    """埋め込みAPIを呼ばずに、合成カタログをベクトルストアに書き込む"""
+    for rows, matrix in catalog.chunks():
+        repository.put_embeddings([(f"doc_{row}", catalog.text(int(row))) for row in rows], matrix, TABLE_NAME)
+
+
+def exact_top_k(catalog: SyntheticCatalog, queries: np.ndarray, k: int) -> np.ndarray:
+    """float32 の総当たりで、検索ベクトルごとのコサイン類似度の上位k件の行番号を求める(recall@k の正解)"""
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+    best_rows = np.empty((len(queries), 0), dtype=np.int64)
+    for rows, matrix in catalog.chunks():
+        scores = queries @ (matrix / np.linalg.norm(matrix, axis=1, keepdims=True)).T
+        best_scores = np.concatenate([best_scores, scores], axis=1)
+        best_rows = np.concatenate([best_rows, np.broadcast_to(rows, scores.shape)], axis=1)
+        top = np.argsort(-best_scores, axis=1)[:, :k]
+        best_scores = np.take_along_axis(best_scores, top, axis=1)
+        best_rows = np.take_along_axis(best_rows, top, axis=1)
+    return best_rows
+
+
+def run_backend(backend: str, db_path: str, queries_path: str, k: int) -> dict:
+    """1つのバックエンドを計測する。ピークRSSをバックエンドごとに測るため、spawnした子プロセスで実行する"""
+    inputs = np.load(queries_path, allow_pickle=False)
+    queries, expected = inputs["queries"], inputs["expected"]
+    questions = json.loads(str(inputs["questions"]))
+    baseline_rss_mb = _peak_rss_mb()
+
+    repository = BACKENDS[backend](
+        DuckDBVectorStoreRepository(db_path, embeddings=DeterministicFakeEmbedding(size=queries.shape[1]))
+    )
+
+    def search(i: int) -> list:
+        return repository.retrieve_relevant_docs_hybrid(questions[i], queries[i].tolist(), TABLE_NAME, k=k)
+
+    # 最初の検索で索引が作られる
+    build_start = time.perf_counter()
+    search(0)
+    build_seconds = time.perf_counter() - build_start
+
+    latencies_ms = []
+    hits = 0
+    total_start = time.perf_counter()
+    for i in range(len(queries)):
+        start = time.perf_counter()
+        docs = search(i)
+        latencies_ms.append((time.perf_counter() - start) * 1000)
+        actual = {int(doc.metadata["doc_id"].removeprefix("doc_")) for doc in docs}
+        hits += len(actual & set(expected[i].tolist()))
+    total_seconds = time.perf_counter() - total_start
+    close = getattr(repository, "close", None)
+    if close is not None:
+        close()
+
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99]).tolist()
+    return {
+        "backend": backend,
+        "build_s": round(build_seconds, 4),
+        "p50_ms": round(p50, 3),
+        "p95_ms": round(p95, 3),
+        "p99_ms": round(p99, 3),
+        "throughput_qps": round(len(queries) / total_seconds, 1),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+        "baseline_rss_mb": round(baseline_rss_mb, 1),
+        f"recall@{k}": round(hits / expected.size, 4),
+    }
+
+
+def environment() -> dict:
+    """結果を比較するときに確認する実行環境"""
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "numpy": np.__version__,
+        "faiss": faiss.__version__,
+        "duckdb": duckdb.__version__,
+    }
+
+
+@app.command()
+def run(
+    num_docs: list[int] = typer.Option([1_000, 10_000, 100_000], help="カタログのドキュメント数。複数指定可"),
+    dimension: int = typer.Option(384, help="埋め込みの次元数"),
+    k: int = typer.Option(10, help="検索件数"),
+    num_queries: int = typer.Option(200, help="計測に使う質問の数"),
+    backend: list[str] = typer.Option(list(BACKENDS), help=f"計測するバックエンド。複数指定可: {', '.join(BACKENDS)}"),
+    output: Path = typer.Option(Path("benchmark_results/retrieval.jsonl"), help="結果のJSON Linesの出力先"),
+    seed: int = typer.Option(42, help="乱数シード"),
+) -> None:
+    unknown = set(backend) - set(BACKENDS)
+    if unknown:
+        raise typer.BadParameter(f"Unknown backends: {sorted(unknown)}")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    results = []
+    print(
+        f"{'num_docs':>9} {'backend':>18} {'build (s)':>10} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9} "
+        f"{'qps':>8} {'rss (MB)':>9} {f'recall@{k}':>10}"
+    )
+    for num_docs_ in num_docs:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = Path(tmp_dir) / "vectorstore.duckdb"
+            catalog = SyntheticCatalog(num_docs_, dimension, seed)
+            write_catalog(
+                DuckDBVectorStoreRepository(str(db_path), embeddings=DeterministicFakeEmbedding(size=8)), catalog
+            )
+            close_connection_manager(db_path)
+            queries, questions = catalog.queries(min(num_queries, num_docs_))
+            queries_path = Path(tmp_dir) / "queries.npz"
+            np.savez(
+                queries_path,
+                queries=queries,
+                questions=np.asarray(json.dumps(questions)),
+                expected=exact_top_k(catalog, queries, k),
+            )
+            logger.info(f"Prepared synthetic catalog of {num_docs_} documents: {db_path}")
+
+            for backend_ in backend:
+                # 別プロセスで開くので、親プロセスのコネクションが閉じていること
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                    result = executor.submit(run_backend, backend_, str(db_path), str(queries_path), k).result()
+                result = {"num_docs": num_docs_, "dimension": dimension, "k": k, **result, **environment()}
+                results.append(result)
+                print(
+                    f"{num_docs_:>9} {backend_:>18} {result['build_s']:>10.2f} {result['p50_ms']:>9.2f} "
+                    f"{result['p95_ms']:>9.2f} {result['p99_ms']:>9.2f} {result['throughput_qps']:>8.1f} "
+                    f"{result['peak_rss_mb']:>9.1f} {result[f'recall@{k}']:>10.3f}"
+                )
+
+    output.write_text("".join(json.dumps(result) + "\n" for result in results))
+    logger.info(f"Wrote {len(results)} results to {output}")
+
+
+@app.command()
+def compare(
+    baseline: Path = typer.Argument(..., help="比較元の結果(JSON Lines)"),
+    current: Path = typer.Argument(..., help="比較先の結果(JSON Lines)"),
+) -> None:
+    """2つの結果を (ドキュメント数, バックエンド) ごとに突き合わせ、比較先/比較元 の比を表示する"""
+    baseline_by_key = {(r["num_docs"], r["backend"]): r for r in _read_results(baseline)}
+    metrics = ["build_s", "p50_ms", "p95_ms", "p99_ms", "throughput_qps", "peak_rss_mb"]
+    print(f"{'num_docs':>9} {'backend':>18} " + " ".join(f"{metric:>14}" for metric in metrics) + f" {'recall':>15}")
+    for result in _read_results(current):
+        before = baseline_by_key.get((result["num_docs"], result["backend"]))
+        if before is None:
+            continue
+        recall_key = f"recall@{result['k']}"
+        ratios = " ".join(
+            f"{result[metric] / before[metric] if before[metric] else float('nan'):>13.2f}x" for metric in metrics
+        )
+        recall = f"{before.get(recall_key, float('nan')):.3f}->{result[recall_key]:.3f}"
+        print(f"{result['num_docs']:>9} {result['backend']:>18} {ratios} {recall:>15}")
+
+
+def _read_results(path: Path) -> list[dict]:
+    return [json.loads(line) for line in path.read_text().splitlines() if line.strip()]
+
+
+def _peak_rss_mb() -> float:
+    """プロセスのピークRSS。ru_maxrss はexec前の親プロセスの値を引き継ぐので、Linuxでは /proc の VmHWM を使う"""
+    status = Path("/proc/self/status")
+    if status.exists():
+        for line in status.read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    # macOSの ru_maxrss はバイト単位
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024**2
+
+
+if __name__ == "__main__":
+    app()
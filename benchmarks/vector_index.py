@@ -0,0 +1,130 @@
+"""ベクトル検索のレイテンシを、DuckDBのベクトルストアとNumPyのインメモリ索引で比較するマイクロベンチマーク
+
+- duckdb: DuckDBVectorStoreRepository (SQLで1行ずつコサイン類似度を計算する)
+- numpy: NumpyVectorStoreRepository (正規化済みの行列とベクトルの積 + argpartition)
+- numpy_batch: NumpyVectorStoreRepository に --batch-size 件の検索ベクトルをまとめて渡した場合の、1クエリあたりのレイテンシ
+- faiss_flat / faiss_ivf / faiss_hnsw: FaissVectorStoreRepository (load列は索引の構築時間)
+
+埋め込みAPIの待ち時間は含めず、ランダムなベクトルで検索のみを計測する。
+
+実行例:
+    python -m benchmarks.vector_index --num-docs 1000 --num-docs 10000 --num-docs 100000
+"""
+
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import typer
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from loguru import logger
+
+from my_text_to_sql_poc.service.duckdb_connection import close_connection_manager
+from my_text_to_sql_poc.service.faiss_vector_store import FaissVectorStoreRepository
+from my_text_to_sql_poc.service.numpy_vector_store import NumpyVectorStoreRepository
+from my_text_to_sql_poc.service.repository import DuckDBVectorStoreRepository
+
+app = typer.Typer(pretty_exceptions_enable=False)
+
+TABLE_NAME = "table_embeddings"
+
+
+def prepare_vector_store(repository: DuckDBVectorStoreRepository, num_docs: int, dimension: int) -> None:
+    """埋め込みAPIを呼ばずに、ランダムなベクトルでlangchainのDuckDBと同じスキーマのテーブルを作る"""
+    with repository._connections.write_cursor() as cursor:
+        cursor.execute(
+            f"""
+            CREATE OR REPLACE TABLE {TABLE_NAME} AS
+            SELECT
+                'id_' || range AS id,
+                'document ' || range AS text,
+                list_transform(range({dimension}), x -> (random() - 0.5)::FLOAT) AS embedding,
+                json_object('doc_id', 'doc_' || range)::VARCHAR AS metadata
+            FROM range({num_docs})
+            """
+        )
+
+
+def measure_latency_ms(func, repeat: int) -> list[float]:
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+@app.command()
+def main(
+    num_docs: list[int] = typer.Option([1_000, 10_000, 100_000], help="ドキュメント数。複数指定可"),
+    dimension: int = typer.Option(1536, help="埋め込みの次元数"),
+    k: int = typer.Option(10, help="検索件数"),
+    batch_size: int = typer.Option(32, help="numpy_batchで1回に渡す検索ベクトルの数"),
+    repeat: int = typer.Option(20, help="各条件での計測回数"),
+    seed: int = typer.Option(42, help="乱数シード"),
+) -> None:
+    rng = np.random.default_rng(seed)
+    print(f"{'num_docs':>9} {'method':>12} {'load (s)':>9} {'p50 (ms)':>10} {'p95 (ms)':>10}")
+    for num_docs_ in num_docs:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = Path(tmp_dir) / "vectorstore.duckdb"
+            duckdb_repository = DuckDBVectorStoreRepository(
+                str(db_path), embeddings=DeterministicFakeEmbedding(size=dimension)
+            )
+            prepare_vector_store(duckdb_repository, num_docs_, dimension)
+            logger.info(f"Prepared vector store of {num_docs_} documents: {db_path}")
+            numpy_repository = NumpyVectorStoreRepository(duckdb_repository)
+            load_start = time.perf_counter()
+            numpy_repository.index(TABLE_NAME)
+            load_seconds = time.perf_counter() - load_start
+
+            faiss_repositories = {}
+            for index_type in ["flat", "ivf", "hnsw"]:
+                faiss_repository = FaissVectorStoreRepository(duckdb_repository, index_type=index_type)
+                build_start = time.perf_counter()
+                faiss_repository.sync(TABLE_NAME)
+                faiss_repositories[index_type] = (faiss_repository, time.perf_counter() - build_start)
+
+            query = rng.standard_normal(dimension).astype(np.float32).tolist()
+            queries = rng.standard_normal((batch_size, dimension)).astype(np.float32).tolist()
+            for method, func, queries_per_call, load in [
+                (
+                    "duckdb",
+                    lambda: duckdb_repository.retrieve_relevant_docs_by_vector(query, TABLE_NAME, k=k),
+                    1,
+                    0.0,
+                ),
+                (
+                    "numpy",
+                    lambda: numpy_repository.retrieve_relevant_docs_by_vector(query, TABLE_NAME, k=k),
+                    1,
+                    load_seconds,
+                ),
+                (
+                    "numpy_batch",
+                    lambda: numpy_repository.retrieve_relevant_docs_by_vectors(queries, TABLE_NAME, k=k),
+                    batch_size,
+                    load_seconds,
+                ),
+            ] + [
+                (
+                    f"faiss_{index_type}",
+                    lambda repository=repository: repository.retrieve_relevant_docs_by_vector(query, TABLE_NAME, k=k),
+                    1,
+                    build_seconds,
+                )
+                for index_type, (repository, build_seconds) in faiss_repositories.items()
+            ]:
+                func()  # warm up
+                latencies = sorted(latency / queries_per_call for latency in measure_latency_ms(func, repeat))
+                p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+                print(f"{num_docs_:>9} {method:>12} {load:>9.2f} {statistics.median(latencies):>10.2f} {p95:>10.2f}")
+
+            numpy_repository.close()
+            close_connection_manager(db_path)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,85 @@
+"""ベクトルストアへのドキュメント登録のスループットを計測するベンチマーク
+
+ドキュメントごとに put() する従来方式(1ドキュメント = 1回の埋め込みリクエスト + 1回のINSERT)と、
+トークン数で区切ったバッチを並行にリクエストして1回のINSERTで登録する put_bulk() を比較する。
+埋め込みAPIの待ち時間は、1リクエストごとに --request-latency-ms だけ待つダミーの埋め込みで再現する。
+
+実行例:
+    python -m benchmarks.vector_ingest --num-docs 2000 --dimension 1536 --request-latency-ms 300
+"""
+
+import tempfile
+import time
+from pathlib import Path
+
+import typer
+from langchain_community.vectorstores import DuckDB
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from my_text_to_sql_poc.service.duckdb_connection import close_connection_manager
+from my_text_to_sql_poc.service.embedding_backend import EmbeddingSettings
+from my_text_to_sql_poc.service.repository import DuckDBVectorStoreRepository
+
+app = typer.Typer(pretty_exceptions_enable=False)
+
+TABLE_NAME = "table_embeddings"
+
+
+class SlowFakeEmbedding(DeterministicFakeEmbedding):
+    """1リクエストごとに一定時間待つダミーの埋め込み"""
+
+    request_latency_seconds: float = 0.0
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        time.sleep(self.request_latency_seconds)
+        return super().embed_documents(texts)
+
+
+def put_one_by_one(repository: DuckDBVectorStoreRepository, docs: list[tuple[str, str]]) -> None:
+    """従来方式: ドキュメントごとにlangchainのDuckDBラッパーで埋め込んで登録する"""
+    for doc_id, text in docs:
+        with repository._connections.write_cursor() as cursor:
+            vectorstore = DuckDB(connection=cursor, embedding=repository.embeddings, table_name=TABLE_NAME)
+            vectorstore.add_texts([text], metadatas=[{"doc_id": doc_id}])
+
+
+@app.command()
+def main(
+    num_docs: int = typer.Option(2000, help="登録するドキュメント数"),
+    dimension: int = typer.Option(1536, help="埋め込みの次元数"),
+    request_latency_ms: float = typer.Option(300, help="埋め込みリクエスト1回あたりの待ち時間"),
+    max_texts_per_request: int = typer.Option(100, help="put_bulk で1リクエストにまとめるテキスト数の上限"),
+    max_concurrent_requests: int = typer.Option(4, help="put_bulk で並行に投げるリクエスト数の上限"),
+    baseline_docs: int = typer.Option(100, help="従来方式で実際に登録するドキュメント数(残りは件数比で推定する)"),
+) -> None:
+    embeddings = SlowFakeEmbedding(size=dimension, request_latency_seconds=request_latency_ms / 1000)
+    settings = EmbeddingSettings(
+        max_texts_per_request=max_texts_per_request, max_concurrent_requests=max_concurrent_requests
+    )
+    # 要約と同程度の長さ(数百文字)のドキュメント
+    docs = [
+        (f"table_{i}", f"テーブル{i}の要約。" + "売上や会員の集計に使うカラムの説明。" * 20) for i in range(num_docs)
+    ]
+
+    print(f"{'method':>12} {'docs':>6} {'seconds':>10} {'docs/s':>10}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for method in ["put", "put_bulk"]:
+            db_path = Path(tmp_dir) / f"{method}.duckdb"
+            repository = DuckDBVectorStoreRepository(str(db_path), embeddings=embeddings, embedding_settings=settings)
+            target_docs = docs[: min(baseline_docs, num_docs)] if method == "put" else docs
+            start = time.perf_counter()
+            if method == "put":
+                put_one_by_one(repository, target_docs)
+            else:
+                repository.put_bulk(target_docs, TABLE_NAME)
+            seconds = time.perf_counter() - start
+            if method == "put":
+                # 従来方式は件数に比例するので、全件分を推定する
+                seconds *= num_docs / len(target_docs)
+            print(f"{method:>12} {num_docs:>6} {seconds:>10.2f} {num_docs / seconds:>10.1f}")
+            repository.close()
+            close_connection_manager(db_path)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,87 @@
+"""量子化した埋め込みによるベクトル検索の、recall@k・メモリ使用量・レイテンシを計測するベンチマーク
+
+- numpy: NumpyVectorStoreRepository (float32 の総当たり。recallの正解とする)
+- float16 / int8: QuantizedVectorStoreRepository。rerank=0 は量子化した埋め込みの類似度のまま返し、
+  rerank=N は上位 k*N 件の候補を元の float32 の埋め込みで並べ替える
+
+埋め込みAPIの待ち時間は含めず、ランダムなベクトルで検索のみを計測する。
+
+実行例:
+    python -m benchmarks.vector_quantization --num-docs 10000 --dimension 1536 --rerank-factor 0 --rerank-factor 4
+"""
+
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import typer
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from loguru import logger
+
+from benchmarks.vector_index import TABLE_NAME, measure_latency_ms, prepare_vector_store
+from my_text_to_sql_poc.service.duckdb_connection import close_connection_manager
+from my_text_to_sql_poc.service.numpy_vector_store import NumpyVectorStoreRepository
+from my_text_to_sql_poc.service.quantized_vector_store import QuantizedVectorStoreRepository
+from my_text_to_sql_poc.service.repository import DuckDBVectorStoreRepository
+
+app = typer.Typer(pretty_exceptions_enable=False)
+
+
+def doc_ids(docs_per_query: list[list]) -> list[list[str]]:
+    return [[doc.metadata["doc_id"] for doc in docs] for docs in docs_per_query]
+
+
+def recall_at_k(actual: list[list[str]], expected: list[list[str]]) -> float:
+    hits = sum(len(set(a) & set(e)) for a, e in zip(actual, expected))
+    return hits / sum(len(e) for e in expected)
+
+
+@app.command()
+def main(
+    num_docs: int = typer.Option(10_000, help="ドキュメント数"),
+    dimension: int = typer.Option(1536, help="埋め込みの次元数"),
+    k: int = typer.Option(10, help="検索件数"),
+    rerank_factor: list[int] = typer.Option([0, 4], help="並べ替える候補数のkに対する倍率。複数指定可"),
+    num_queries: int = typer.Option(100, help="recallの計測に使う検索ベクトルの数"),
+    repeat: int = typer.Option(20, help="レイテンシの計測回数"),
+    seed: int = typer.Option(42, help="乱数シード"),
+) -> None:
+    rng = np.random.default_rng(seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir) / "vectorstore.duckdb"
+        duckdb_repository = DuckDBVectorStoreRepository(str(db_path), embeddings=DeterministicFakeEmbedding(size=8))
+        prepare_vector_store(duckdb_repository, num_docs, dimension)
+        logger.info(f"Prepared vector store of {num_docs} documents: {db_path}")
+
+        queries = rng.standard_normal((num_queries, dimension)).astype(np.float32).tolist()
+        numpy_repository = NumpyVectorStoreRepository(duckdb_repository)
+        expected = doc_ids(numpy_repository.retrieve_relevant_docs_by_vectors(queries, TABLE_NAME, k=k))
+        float32_bytes = numpy_repository.index(TABLE_NAME).matrix.nbytes
+
+        print(f"{'method':>14} {'recall@k':>9} {'memory (MB)':>12} {'ratio':>6} {'p50 (ms)':>10} {'p95 (ms)':>10}")
+        methods = [("numpy", numpy_repository)] + [
+            (f"{precision}/rerank={factor}", QuantizedVectorStoreRepository(duckdb_repository, precision, factor))
+            for precision in ["float16", "int8"]
+            for factor in rerank_factor
+        ]
+        for method, repository in methods:
+            actual = doc_ids(repository.retrieve_relevant_docs_by_vectors(queries, TABLE_NAME, k=k))
+            index = repository.index(TABLE_NAME)
+            memory_bytes = index.matrix.nbytes
+            query = queries[0]
+            latencies = sorted(
+                measure_latency_ms(lambda: repository.retrieve_relevant_docs_by_vector(query, TABLE_NAME, k=k), repeat)
+            )
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            print(
+                f"{method:>14} {recall_at_k(actual, expected):>9.3f} {memory_bytes / 1024**2:>12.1f} "
+                f"{memory_bytes / float32_bytes:>6.2f} {statistics.median(latencies):>10.2f} {p95:>10.2f}"
+            )
+
+        close_connection_manager(db_path)
+
+
+if __name__ == "__main__":
+    app()
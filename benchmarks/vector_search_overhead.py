@@ -0,0 +1,80 @@
+"""ベクトルストア検索の1クエリあたりのオーバーヘッドを計測するマイクロベンチマーク
+
+検索のたびに埋め込みクライアントとlangchainのDuckDBラッパーを作り直す従来方式と、
+リポジトリが保持する長寿命の検索ハンドルを使い回す方式を比較する。
+埋め込みAPIの待ち時間を除いたオーバーヘッドを見るため、埋め込みはローカルのダミー(DeterministicFakeEmbedding)で計算する。
+
+実行例:
+    python -m benchmarks.vector_search_overhead --num-docs 500 --dimension 256 --repeat 50
+"""
+
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import typer
+from langchain_community.vectorstores import DuckDB
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_openai import OpenAIEmbeddings
+from loguru import logger
+
+from my_text_to_sql_poc.service.duckdb_connection import DuckDBConnectionManager
+from my_text_to_sql_poc.service.repository import DuckDBVectorStoreRepository
+
+app = typer.Typer(pretty_exceptions_enable=False)
+
+TABLE_NAME = "table_embeddings"
+
+
+def search_with_fresh_handles(repository: DuckDBVectorStoreRepository, question: str, k: int) -> list:
+    """従来方式: 検索のたびに埋め込みクライアントとDuckDBラッパーを作る"""
+    # クライアントの生成コストだけを計上する(APIキーはダミーで、APIは呼ばない)
+    OpenAIEmbeddings(model=repository.model_name, api_key="sk-benchmark")
+    with repository._connections.cursor() as cursor:
+        vectorstore = DuckDB(connection=cursor, embedding=repository.embeddings, table_name=TABLE_NAME)
+        return vectorstore.similarity_search(question, k=k)
+
+
+def measure_latency_ms(func, repeat: int) -> list[float]:
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+@app.command()
+def main(
+    num_docs: int = typer.Option(500, help="ベクトルストアに登録するドキュメント数"),
+    dimension: int = typer.Option(256, help="埋め込みの次元数"),
+    k: int = typer.Option(5, help="検索件数"),
+    repeat: int = typer.Option(50, help="各方式での計測回数"),
+) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir) / "vectorstore.duckdb"
+        # 従来方式はラッパーの生成時にCREATE TABLEを発行するので、読み書き可能で開いたままのプールを使う
+        connections = DuckDBConnectionManager(db_path)
+        repository = DuckDBVectorStoreRepository(
+            str(db_path), connection_manager=connections, embeddings=DeterministicFakeEmbedding(size=dimension)
+        )
+        repository.put_bulk([(f"table_{i}", f"テーブル{i}の説明") for i in range(num_docs)], table_name=TABLE_NAME)
+        logger.info(f"Prepared vector store of {num_docs} documents: {db_path}")
+
+        print(f"{'method':>16} {'p50 (ms)':>10} {'p95 (ms)':>10}")
+        for method, func in [
+            ("fresh_handles", lambda: search_with_fresh_handles(repository, "テーブル42の説明", k)),
+            ("reused_handle", lambda: repository.retrieve_relevant_docs("テーブル42の説明", TABLE_NAME, k=k)),
+        ]:
+            func()  # warm up
+            latencies = sorted(measure_latency_ms(func, repeat))
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            print(f"{method:>16} {statistics.median(latencies):>10.2f} {p95:>10.2f}")
+
+        repository.close()
+        connections.close()
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,29 @@
+import typer
+from loguru import logger
+
+from my_text_to_sql_poc.service.repository import DEFAULT_VECTOR_DB_PATH, DuckDBVectorStoreRepository
+
+app = typer.Typer(pretty_exceptions_enable=False)
+
+
+@app.command()
+def main(
+    db_path: str = typer.Option(DEFAULT_VECTOR_DB_PATH, help="ベクトルストアのパス(ローカルパス or s3://...)"),
+    table_name: list[str] = typer.Option(
+        ["table_embeddings", "query_embeddings"], help="重複を削除するベクトルテーブル。複数指定可"
+    ),
+) -> None:
+    """ベクトルストアから、同じdoc_idで重複して登録された行を削除し、削減量を表示する"""
+    repository = DuckDBVectorStoreRepository(db_path)
+    results = [repository.compact(name) for name in table_name]
+    repository.upload()
+    for result in results:
+        logger.info(
+            f"{result.table_name}: removed {result.rows_removed} of {result.rows_before} rows, "
+            f"{result.embedding_bytes_removed / 1024**2:.1f} MB of embeddings "
+            f"(file size {result.file_bytes_before / 1024**2:.1f} MB -> {result.file_bytes_after / 1024**2:.1f} MB)"
+        )
+
+
+if __name__ == "__main__":
+    app()
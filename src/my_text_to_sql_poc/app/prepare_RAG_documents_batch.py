@@ -1,18 +1,20 @@
-import re
+import asyncio
 
 import typer
 from loguru import logger
 from pydantic import BaseModel, Field
 
-from my_text_to_sql_poc.service.model_gateway import ModelGateway
+from my_text_to_sql_poc.service.batch_api import BatchAPIRunner
+from my_text_to_sql_poc.service.http_pool import get_http_connection_pool
+from my_text_to_sql_poc.service.model_gateway import ModelGateway, get_model_gateway
+from my_text_to_sql_poc.service.related_table_extractor import extract_related_tables
 from my_text_to_sql_poc.service.repository import (
-    DuckDBSampleQueryRepository,
-    DuckDBTableMetadataRepository,
-    DuckDBVectorStoreRepository,
     SampleQueryRepositoryInterface,
     TableMetadataRepositoryInterface,
     VectorStoreRepositoryInterface,
 )
+from my_text_to_sql_poc.service.repository_factory import RepositoryFactory
+from my_text_to_sql_poc.service.vector_filter import DocumentAttributes
 
 PROMPT_SUMMARIZE_TABLE = """
 あなたはSQLテーブルの要約を手助けするデータアナリストです。
@@ -75,44 +77,127 @@ class SQLQuerySummary(BaseModel):
     detailed_transformation_logics: str = Field(description="クエリ内で行われてるデータ加工の詳細")
 
 
+class DocumentSummaryError(RuntimeError):
+    """一部のドキュメントの要約の生成に失敗した(成功したドキュメントはベクトルストアに登録済み)"""
+
+
 class RAGDocumentPreparer:
     def __init__(
         self,
-        table_metadata_repository: TableMetadataRepositoryInterface = DuckDBTableMetadataRepository(),
-        sample_query_repository: SampleQueryRepositoryInterface = DuckDBSampleQueryRepository(),
-        vector_store_repository: VectorStoreRepositoryInterface = DuckDBVectorStoreRepository(),
+        table_metadata_repository: TableMetadataRepositoryInterface | None = None,
+        sample_query_repository: SampleQueryRepositoryInterface | None = None,
+        vector_store_repository: VectorStoreRepositoryInterface | None = None,
+        attributes: DocumentAttributes | None = None,
+        model_gateway: ModelGateway | None = None,
+        batch_runner: BatchAPIRunner | None = None,
     ):
-        self._table_metadata_repository = table_metadata_repository
-        self._sample_query_repository = sample_query_repository
-        self._repository = vector_store_repository
+        """
+        Args:
+            attributes: ベクトルストアの全ドキュメントに付ける絞り込み検索用の属性(データベース名・方言・タグ)。
+                スキーマ名はテーブル名から取り出す
+            model_gateway: 要約に使う生成AIモデル。要約は同時実行数の上限まで並行に生成する
+            batch_runner: 指定した場合は、要約をリアルタイムのAPIではなくバッチAPIでまとめて生成する
+        """
+        # デフォルト引数でリポジトリを生成すると、モジュールのimport時にS3からのダウンロードが走ってしまうので、ここで生成する
+        repository_factory = RepositoryFactory()
+        self._table_metadata_repository = table_metadata_repository or repository_factory.table_metadata_repository()
+        self._sample_query_repository = sample_query_repository or repository_factory.sample_query_repository()
+        self._repository = vector_store_repository or repository_factory.vector_store_repository()
+        self._attributes = attributes or DocumentAttributes()
+        self._model_gateway = model_gateway or get_model_gateway()
+        self._batch_runner = batch_runner
 
     def register_table_metadata(self) -> None:
         """Text2SQL用のRAGのためにテーブルメタデータを要約し、それをドキュメントとしてベクトルストアに登録する"""
         table_metadata_by_name = self._table_metadata_repository.get_all()
 
+        prompt_by_table = {}
+        attributes_by_doc_id = {}
         for table_name, metadata in table_metadata_by_name.items():
             related_sample_queries = self._sample_query_repository.retrieve_by_table_name(table_name)
-            table_summary = self._generate_table_summary(
+            prompt_by_table[table_name] = self._table_summary_prompt(
                 table_name=table_name,
                 table_metadata=metadata,
                 sample_queries=set(related_sample_queries.values()),
             )
-            self._repository.put(doc_id=table_name, document=table_summary, table_name="table_embeddings")
+            attributes_by_doc_id[table_name] = self._attributes_for_tables({table_name})
+        summary_by_table, failed_tables = self._summarize(prompt_by_table, TableSummary)
+        # 埋め込みと登録は1件ずつではなく、まとめて行う
+        self._repository.put_bulk(
+            list(summary_by_table.items()), table_name="table_embeddings", attributes_by_doc_id=attributes_by_doc_id
+        )
+        _raise_if_failed(failed_tables, len(prompt_by_table))
 
     def register_sample_queries(self) -> None:
         """Text2SQL用のRAGのためにサンプルクエリを要約し、それをドキュメントとしてベクトルストアに登録する"""
         sample_queries = self._sample_query_repository.get_all()
 
+        prompt_by_query_name = {}
+        attributes_by_doc_id = {}
         for query_name, query in sample_queries.items():
-            # サンプルクエリの要約を生成
-            related_tables = self._extract_related_tables(query)
-            query_summary = self._generate_query_summary(
+            related_tables = extract_related_tables(query)
+            prompt_by_query_name[query_name] = self._query_summary_prompt(
                 query=query,
                 related_tables=related_tables,
             )
-            self._repository.put(doc_id=query_name, document=query_summary, table_name="query_embeddings")
-
-    def _generate_table_summary(
+            attributes_by_doc_id[query_name] = self._attributes_for_tables(related_tables)
+        # サンプルクエリの要約を生成
+        summary_by_query_name, failed_query_names = self._summarize(prompt_by_query_name, SQLQuerySummary)
+        self._repository.put_bulk(
+            list(summary_by_query_name.items()),
+            table_name="query_embeddings",
+            attributes_by_doc_id=attributes_by_doc_id,
+        )
+        _raise_if_failed(failed_query_names, len(prompt_by_query_name))
+
+    def _summarize(
+        self, prompt_by_name: dict[str, str], output_schema: type[BaseModel]
+    ) -> tuple[dict[str, str], list[str]]:
+        """プロンプトごとの要約を生成する
+
+        Returns:
+            tuple[dict[str, str], list[str]]: (名前をキー、要約のJSON文字列を値とする辞書, 生成に失敗した名前のリスト)
+        """
+        if self._batch_runner is not None:
+            summary_by_name, failed_names = self._batch_runner.run_partial(prompt_by_name, output_schema)
+            return {name: summary.model_dump_json(indent=2) for name, summary in summary_by_name.items()}, failed_names
+        return asyncio.run(self._asummarize(prompt_by_name, output_schema))
+
+    async def _asummarize(
+        self, prompt_by_name: dict[str, str], output_schema: type[BaseModel]
+    ) -> tuple[dict[str, str], list[str]]:
+        """プロンプトごとの要約を並行に生成する(同時に投げるリクエスト数はModelGatewayが制限する)。
+        失敗したプロンプトがあっても他のプロンプトの生成は止めず、成功した要約だけを返す
+        """
+        logger.info(
+            f"Summarizing {len(prompt_by_name)} documents "
+            f"(concurrency={self._model_gateway.settings.max_concurrent_requests})"
+        )
+        responses = await asyncio.gather(
+            *(
+                # 要約の元になるメタデータとサンプルクエリが変わっていなければ、再実行時はキャッシュの応答を使う
+                self._model_gateway.agenerate_response_with_structured_output(prompt, output_schema, use_cache=True)
+                for prompt in prompt_by_name.values()
+            ),
+            return_exceptions=True,
+        )
+        summary_by_name = {}
+        failed_names = []
+        for name, response in zip(prompt_by_name, responses):
+            if isinstance(response, BaseException):
+                logger.error(f"Failed to summarize {name}: {response!r}")
+                failed_names.append(name)
+            else:
+                summary_by_name[name] = response.model_dump_json(indent=2)
+        return summary_by_name, failed_names
+
+    def _attributes_for_tables(self, table_names: set[str]) -> DocumentAttributes:
+        """テーブル(サンプルクエリの場合は参照するテーブル)のスキーマ名が1つに決まる場合は、属性にスキーマ名を含める"""
+        schema_names = {DocumentAttributes.from_table_name(name).schema_name for name in table_names}
+        schema_name = schema_names.pop() if len(schema_names) == 1 else None
+        return self._attributes.model_copy(update={"schema_name": schema_name})
+
+    def _table_summary_prompt(
         self,
         table_name: str,
         table_metadata: str,
@@ -120,57 +205,71 @@ class RAGDocumentPreparer:
     ) -> str:
         formatted_prompt = PROMPT_SUMMARIZE_TABLE.format(
             table_schema=table_metadata,
-            sample_queries="\n".join(sample_queries),
+            # 応答キャッシュのキーはプロンプトそのものなので、集合の順序(プロセスごとに変わる)に依存しないよう並べる
+            sample_queries="\n".join(sorted(sample_queries)),
         )
         logger.debug(f"Formatted table schema prompt for {table_name}: {formatted_prompt}")
+        return formatted_prompt
 
-        response_obj = ModelGateway().generate_response_with_structured_output(formatted_prompt, TableSummary)
-        return response_obj.model_dump_json(indent=2)
-
-    def _generate_query_summary(self, query: str, related_tables: set[str]) -> str:
-        table_metadata_by_name = self._table_metadata_repository.get(list(related_tables))
-        table_schemas = "\n\n".join([table_metadata for _, table_metadata in table_metadata_by_name.values()])
+    def _query_summary_prompt(self, query: str, related_tables: set[str]) -> str:
+        # 応答キャッシュのキーはプロンプトそのものなので、テーブルの順序を固定する
+        table_metadata_by_name = self._table_metadata_repository.get(sorted(related_tables))
+        table_schemas = "\n\n".join(table_metadata_by_name.values())
 
         formatted_prompt = PROMPT_SUMMARIZE_QUERY.format(
             query=query,
             table_schemas=table_schemas,
         )
         logger.debug(f"Formatted query prompt: {formatted_prompt}")
+        return formatted_prompt
 
-        response_obj = ModelGateway().generate_response_with_structured_output(formatted_prompt, SQLQuerySummary)
-        return response_obj.model_dump_json(indent=2)
-
-    def _extract_related_tables(self, query: str) -> set[str]:
-        """SQLクエリ内で使われてるテーブル名を抽出する"""
-        # FROMもしくはJOIN句の後に続くテーブル名を取得してる
-        table_extract_pattern = re.compile(r"(?:FROM|JOIN)\s+(\w+(?:\.\w+)?)", re.IGNORECASE)
-        extracted_tables = set(table_extract_pattern.findall(query))
-
-        # CTE(Common Table Expression, with句で定義される一時テーブル)が紛らわしいので除外したい
-        cte_extract_pattern = re.compile(r"WITH\s+(\w+)\s+AS", re.IGNORECASE)
-        extracted_ctes = set(cte_extract_pattern.findall(query))
-
-        table_names = set()
-        for match_table in extracted_tables:
-            # CTEに含まれる場合はスキップ
-            if match_table in extracted_ctes:
-                continue
-            table_names.add(match_table.lower())  # 重複テーブル名を避けるために小文字化
 
-        return table_names
+def _raise_if_failed(failed_names: list[str], num_documents: int) -> None:
+    if failed_names:
+        raise DocumentSummaryError(
+            f"Failed to summarize {len(failed_names)} of {num_documents} documents: {failed_names}. "
+            "Re-run to retry them (with the response cache enabled, generated summaries are reused)"
+        )
 
 
 app = typer.Typer(pretty_exceptions_enable=False)
 
 
 @app.command()
-def main() -> None:
-    rag_document_preparer = RAGDocumentPreparer()
+def main(
+    database_name: str | None = typer.Option(None, help="登録するドキュメントに付けるデータベース名"),
+    dialect: str | None = typer.Option(None, help="登録するドキュメントに付けるSQLの方言"),
+    tag: list[str] = typer.Option([], help="登録するドキュメントに付けるタグ。複数指定可"),
+    use_batch_api: bool = typer.Option(
+        False, help="要約をバッチAPIでまとめて生成する。結果が返るまで最大24時間かかるが、料金は半額になる"
+    ),
+    poll_interval_seconds: float = typer.Option(60.0, help="バッチAPIの完了を問い合わせる間隔(秒)"),
+) -> None:
+    batch_runner = (
+        BatchAPIRunner.from_gateway(get_model_gateway(), poll_interval_seconds=poll_interval_seconds)
+        if use_batch_api
+        else None
+    )
+    rag_document_preparer = RAGDocumentPreparer(
+        attributes=DocumentAttributes(database_name=database_name, dialect=dialect, tags=tag),
+        batch_runner=batch_runner,
+    )
 
-    logger.info("Registering table metadata...")
-    rag_document_preparer.register_table_metadata()
-    logger.info("Registering sample queries...")
-    rag_document_preparer.register_sample_queries()
+    failed = False
+    for label, register in [
+        ("table metadata", rag_document_preparer.register_table_metadata),
+        ("sample queries", rag_document_preparer.register_sample_queries),
+    ]:
+        logger.info(f"Registering {label}...")
+        try:
+            register()
+        except DocumentSummaryError as e:
+            # 要約に失敗したドキュメントがあっても、残りの種類のドキュメントは登録する
+            logger.error(e)
+            failed = True
+    get_http_connection_pool().log_stats()
+    if failed:
+        raise typer.Exit(code=1)
     logger.info("Registration completed.")
 
 
@@ -0,0 +1,23 @@
+import typer
+from loguru import logger
+
+from my_text_to_sql_poc.service.repository import DuckDBSampleQueryRepository
+
+app = typer.Typer(pretty_exceptions_enable=False)
+
+
+@app.command()
+def main(
+    db_path: str = typer.Option(
+        "s3://staging-newspicks-datalake-mart/tmp/text2sql_poc/sample_query_store.duckdb",
+        help="サンプルクエリストアのパス(ローカルパス or s3://...)",
+    ),
+) -> None:
+    """既存のサンプルクエリストアに、テーブル名 -> サンプルクエリ の転置インデックス(sample_query_tables)をバックフィルする"""
+    sample_query_repository = DuckDBSampleQueryRepository(db_path)
+    edge_count = sample_query_repository.rebuild_table_index()
+    logger.info(f"Rebuilt table index of {db_path}: {edge_count} edges")
+
+
+if __name__ == "__main__":
+    app()
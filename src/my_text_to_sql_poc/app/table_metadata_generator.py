@@ -3,7 +3,9 @@ from langchain_core.prompts import PromptTemplate
 from loguru import logger
 from pydantic import BaseModel, Field
 
-from my_text_to_sql_poc.service.model_gateway import ModelGateway
+from my_text_to_sql_poc.service.batch_api import BatchAPIRunner
+from my_text_to_sql_poc.service.http_pool import get_http_connection_pool
+from my_text_to_sql_poc.service.model_gateway import get_model_gateway
 from my_text_to_sql_poc.service.repository import (
     DuckDBSampleQueryRepository,
     DuckDBTableMetadataRepository,
@@ -66,15 +68,14 @@ class TableMetadataSchema(BaseModel):
 class TableMetadataGenerator:
     def __init__(
         self,
-        table_metadata_repo: TableMetadataRepositoryInterface = DuckDBTableMetadataRepository(
-            "/tmp/table_metadata_store.duckdb"
-        ),
-        sample_query_repo: SampleQueryRepositoryInterface = DuckDBSampleQueryRepository(
-            "/tmp/sample_query_store.duckdb"
-        ),
+        table_metadata_repo: TableMetadataRepositoryInterface | None = None,
+        sample_query_repo: SampleQueryRepositoryInterface | None = None,
     ):
-        self._table_metadata_repo = table_metadata_repo
-        self._sample_query_repo = sample_query_repo
+        # デフォルト引数でリポジトリを生成すると、モジュールのimport時に評価されてしまうので、ここで生成する
+        self._table_metadata_repo = table_metadata_repo or DuckDBTableMetadataRepository(
+            "/tmp/table_metadata_store.duckdb"
+        )
+        self._sample_query_repo = sample_query_repo or DuckDBSampleQueryRepository("/tmp/sample_query_store.duckdb")
         self._prompt_template = PromptTemplate(
             template=PROMPT_TEMPLATE,
             input_variables=["table_name", "audit_logs", "reffered_doc"],
@@ -88,6 +89,32 @@ class TableMetadataGenerator:
         """
         対象テーブルを利用してるサンプルクエリ達と、関連ドキュメントを元にテーブルのメタデータを生成し、DuckDBに保存する
         """
+        table_metadata = get_model_gateway().generate_response_with_structured_output(
+            self._prompt(table_name, reffered_doc),
+            TableMetadataSchema,
+            # サンプルクエリとドキュメントが変わっていなければ、再実行時はキャッシュの応答を使う
+            use_cache=True,
+        )
+        logger.info(f"Generated table metadata: {table_metadata.model_dump_json(indent=2)}")
+
+        self._table_metadata_repo.put(table_name, table_metadata.model_dump_json(indent=2))
+
+    def generate_table_metadata_in_batch(
+        self,
+        table_names: list[str],
+        batch_runner: BatchAPIRunner,
+        reffered_doc: str | None = None,
+    ) -> None:
+        """
+        generate_table_metadata と同じメタデータを、全テーブル分まとめてバッチAPIで生成し、DuckDBに保存する
+        """
+        prompt_by_table = {table_name: self._prompt(table_name, reffered_doc) for table_name in table_names}
+        table_metadata_by_name = batch_runner.run(prompt_by_table, TableMetadataSchema)
+        for table_name, table_metadata in table_metadata_by_name.items():
+            logger.info(f"Generated table metadata: {table_metadata.model_dump_json(indent=2)}")
+            self._table_metadata_repo.put(table_name, table_metadata.model_dump_json(indent=2))
+
+    def _prompt(self, table_name: str, reffered_doc: str | None) -> str:
         reffered_query_map = self._sample_query_repo.retrieve_by_table_name(table_name)
         logger.info(
             f"""
@@ -97,20 +124,12 @@ class TableMetadataGenerator:
         )
 
         reffered_querys = list(reffered_query_map.values())[0:100]
-        formatted_prompt = self._prompt_template.format(
+        return self._prompt_template.format(
             table_name=table_name,
             audit_logs="\n\n".join(reffered_querys),
             reffered_doc=reffered_doc,
         )
 
-        table_metadata = ModelGateway().generate_response_with_structured_output(
-            formatted_prompt,
-            TableMetadataSchema,
-        )
-        logger.info(f"Generated table metadata: {table_metadata.model_dump_json(indent=2)}")
-
-        self._table_metadata_repo.put(table_name, table_metadata.model_dump_json(indent=2))
-
 
 app = typer.Typer(pretty_exceptions_enable=False)
 
@@ -124,12 +143,22 @@ def main(
         指定方法: --target-table table_name1 --target-table table_name2 --target-table table_name3
         """,
     ),
+    use_batch_api: bool = typer.Option(
+        False, help="メタデータをバッチAPIでまとめて生成する。結果が返るまで最大24時間かかるが、料金は半額になる"
+    ),
+    poll_interval_seconds: float = typer.Option(60.0, help="バッチAPIの完了を問い合わせる間隔(秒)"),
 ):
     table_metadata_generator = TableMetadataGenerator()
+    if use_batch_api:
+        batch_runner = BatchAPIRunner.from_gateway(get_model_gateway(), poll_interval_seconds=poll_interval_seconds)
+        table_metadata_generator.generate_table_metadata_in_batch(target_table, batch_runner)
+        get_http_connection_pool().log_stats()
+        return
     for table_name in target_table:
         logger.info(f"=============={table_name}のテーブルメタデータを生成します=================")
         table_metadata_generator.generate_table_metadata(table_name=table_name)
         logger.info(f"=============={table_name}のテーブルメタデータを生成しました===============")
+    get_http_connection_pool().log_stats()
 
 
 if __name__ == "__main__":
@@ -1,16 +1,19 @@
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from langchain_core.documents import Document
 from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
 from loguru import logger
 from omegaconf import OmegaConf
 from pydantic import BaseModel, Field
 
-from my_text_to_sql_poc.service.model_gateway import ModelGateway
+from my_text_to_sql_poc.service.model_gateway import get_model_gateway
 from my_text_to_sql_poc.service.repository import (
     SampleQueryRepositoryInterface,
     TableMetadataRepositoryInterface,
     VectorStoreRepositoryInterface,
 )
+from my_text_to_sql_poc.service.vector_filter import VectorSearchFilter
 
 PROMPT_CONFIG = OmegaConf.load("src/my_text_to_sql_poc/app/text2sql/generate_sql_prompt_ver2_jp.yaml")
 
@@ -23,6 +26,18 @@ class OutputFormat(BaseModel):
     explanation: str = Field(description="生成されたSQLクエリに関する説明文")
 
 
+def _doc_id(doc: Document) -> str | None:
+    """ベクトルストアのドキュメントから、テーブル名/サンプルクエリ名を取り出す
+    (put時に付けた doc_id か、ファイルから読み込んだドキュメントの source のファイル名)
+    """
+    if "doc_id" in doc.metadata:
+        return doc.metadata["doc_id"]
+    if "source" in doc.metadata:
+        return Path(doc.metadata["source"]).stem
+    logger.warning(f"Document has neither doc_id nor source in metadata: {doc.metadata}")
+    return None
+
+
 class Text2SQLFacade:
     GENERATER_PROMPT_TEMPLATE = Path("src/my_text_to_sql_poc/app/text2sql/generate_sql_prompt_ver2_jp.txt")
     REVIEWER_PROMPT_TEMPLATE = Path("src/my_text_to_sql_poc/app/text2sql/generate_sql_prompt_ver2_jp.yaml")
@@ -36,7 +51,7 @@ class Text2SQLFacade:
         self.vector_store_repo = vector_store_repo
         self.table_metadata_repo = table_metadata_repo
         self.sample_query_repo = sample_query_repo
-        self.model_gateway = ModelGateway()
+        self.model_gateway = get_model_gateway()
 
         prompt_config = OmegaConf.load(self.REVIEWER_PROMPT_TEMPLATE)
         self.reviewer_prompt_template = ChatPromptTemplate(
@@ -47,13 +62,12 @@ class Text2SQLFacade:
         """
         自然言語の質問からSQLクエリと説明文を生成する、一連の処理を実行します
         """
-        # Retrieve relevant tables
-        related_metadata_by_table = self.retrieve_related_tables(question, k=20)
+        # Retrieve relevant tables and related sample queries
+        related_metadata_by_table, related_sql_by_query_name = self.retrieve_context(
+            question, k_tables=20, k_queries=10
+        )
         tables_metadata = "\n\n".join(related_metadata_by_table.values())
         logger.info(f"Retrieved tables: {related_metadata_by_table.keys()}")
-
-        # Retrieve related sample queries
-        related_sql_by_query_name = self.retrieve_related_sample_queries(question, k=10)
         related_sample_queries = "\n\n".join(related_sql_by_query_name.values())
         logger.info(f"Retrieved sample queries: {related_sql_by_query_name.keys()}")
 
@@ -61,25 +75,69 @@ class Text2SQLFacade:
         sql_query, explanation = self.text2sql(question, dialect, tables_metadata, related_sample_queries)
         return sql_query, explanation
 
-    def retrieve_related_tables(self, question: str, k: int = 20) -> dict[str, str]:
+    def retrieve_context(
+        self,
+        question: str,
+        k_tables: int = 20,
+        k_queries: int = 10,
+        search_filter: VectorSearchFilter | None = None,
+    ) -> tuple[dict[str, str], dict[str, str]]:
+        """質問に関連するテーブルとサンプルクエリをまとめてretrieveして返す
+
+        質問の埋め込みは1回だけ計算し、テーブルとサンプルクエリの検索(とメタデータの取得)は並行に行う。
+        search_filter を指定すると、スキーマ名などの属性が一致するテーブルとサンプルクエリだけから検索する。
+
+        Returns:
+            tuple[dict[str, str], dict[str, str]]: ({テーブル名: スキーマ}, {サンプルクエリ名: サンプルクエリ})
+        """
+        embedding = self.vector_store_repo.embed_query(question)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            related_metadata_by_table = executor.submit(
+                lambda: self.table_metadata_repo.get(
+                    self._retrieve_doc_ids(question, embedding, "table_embeddings", k_tables, search_filter)
+                )
+            )
+            related_sql_by_query_name = executor.submit(
+                lambda: self.sample_query_repo.get(
+                    self._retrieve_doc_ids(question, embedding, "query_embeddings", k_queries, search_filter)
+                )
+            )
+            return related_metadata_by_table.result(), related_sql_by_query_name.result()
+
+    def retrieve_related_tables(
+        self, question: str, k: int = 20, search_filter: VectorSearchFilter | None = None
+    ) -> dict[str, str]:
         """質問に関連するテーブルをretrieveして返す
         返り値dictの key はテーブル名、value はテーブルのスキーマ
         """
-        retrieved_table_names = [
-            Path(doc.metadata["source"]).stem
-            for doc in self.vector_store_repo.retrieve_relevant_docs(question, table_name="table_embeddings", k=k)
-        ]
-        return self.table_metadata_repo.get(retrieved_table_names)
+        embedding = self.vector_store_repo.embed_query(question)
+        return self.table_metadata_repo.get(
+            self._retrieve_doc_ids(question, embedding, "table_embeddings", k, search_filter)
+        )
 
-    def retrieve_related_sample_queries(self, question: str, k: int = 20) -> dict[str, str]:
+    def retrieve_related_sample_queries(
+        self, question: str, k: int = 20, search_filter: VectorSearchFilter | None = None
+    ) -> dict[str, str]:
         """質問に関連するサンプルクエリをretrieveして返す
         返り値dictの key はサンプルクエリ名、value はサンプルクエリの内容
         """
-        retrieved_query_names = [
-            Path(doc.metadata["source"]).stem
-            for doc in self.vector_store_repo.retrieve_relevant_docs(question, table_name="query_embeddings", k=k)
-        ]
-        return self.sample_query_repo.get(retrieved_query_names)
+        embedding = self.vector_store_repo.embed_query(question)
+        return self.sample_query_repo.get(
+            self._retrieve_doc_ids(question, embedding, "query_embeddings", k, search_filter)
+        )
+
+    def _retrieve_doc_ids(
+        self,
+        question: str,
+        embedding: list[float],
+        table_name: str,
+        k: int,
+        search_filter: VectorSearchFilter | None = None,
+    ) -> list[str]:
+        docs = self.vector_store_repo.retrieve_relevant_docs_hybrid(
+            question, embedding, table_name=table_name, k=k, search_filter=search_filter
+        )
+        return [doc_id for doc_id in map(_doc_id, docs) if doc_id is not None]
 
     def text2sql(
         self,
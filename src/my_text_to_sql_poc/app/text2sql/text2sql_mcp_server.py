@@ -1,18 +1,19 @@
+import asyncio
+
 from mcp.server.fastmcp import FastMCP
 
 from my_text_to_sql_poc.app.text2sql.text2sql_facade import Text2SQLFacade
-from my_text_to_sql_poc.service.repository import (
-    DuckDBSampleQueryRepository,
-    DuckDBTableMetadataRepository,
-    DuckDBVectorStoreRepository,
-)
+from my_text_to_sql_poc.service.repository_factory import RepositoryConfig, RepositoryFactory
+from my_text_to_sql_poc.service.vector_filter import VectorSearchFilter
 
 # FastMCPサーバーを初期化
 mcp = FastMCP("My Text2SQL Server")
+# テーブルメタデータとサンプルクエリは滅多に更新されないので、インメモリキャッシュ越しに読む
+repository_factory = RepositoryFactory(RepositoryConfig.from_env().model_copy(update={"use_read_cache": True}))
 text2sql_facade = Text2SQLFacade(
-    vector_store_repo=DuckDBVectorStoreRepository(),
-    table_metadata_repo=DuckDBTableMetadataRepository(),
-    sample_query_repo=DuckDBSampleQueryRepository(),
+    vector_store_repo=repository_factory.vector_store_repository(),
+    table_metadata_repo=repository_factory.table_metadata_repository(),
+    sample_query_repo=repository_factory.sample_query_repository(),
 )
 
 
@@ -21,6 +22,10 @@ async def retrieve_related_tables_and_queries(
     user_query: str,
     related_table_cnt: int,
     related_query_cnt: int,
+    schema_name: str | None = None,
+    database_name: str | None = None,
+    dialect: str | None = None,
+    tags: list[str] | None = None,
 ) -> dict[str, dict[str, str]]:
     """
     ユーザ質問に関連しそうなコンテキスト(テーブルメタデータとサンプルクエリ)をretrieveして返す
@@ -28,6 +33,10 @@ async def retrieve_related_tables_and_queries(
         user_query (str): ユーザの質問
         related_table_cnt (int): 関連テーブルの数
         related_query_cnt (int): 関連サンプルクエリの数
+        schema_name (str | None): 指定した場合、このスキーマのテーブルとサンプルクエリだけから検索する
+        database_name (str | None): 指定した場合、このデータベースのテーブルとサンプルクエリだけから検索する
+        dialect (str | None): 指定した場合、このSQLの方言のテーブルとサンプルクエリだけから検索する
+        tags (list[str] | None): 指定した場合、これらのタグをすべて持つテーブルとサンプルクエリだけから検索する
     Returns:
         dict[str, dict[str, str]]: テーブルメタデータとサンプルクエリの辞書。
         {
@@ -35,8 +44,13 @@ async def retrieve_related_tables_and_queries(
             "related_sql_by_query_name": {サンプルクエリ名: サンプルクエリ}
         }
     """
-    related_metadata_by_table = text2sql_facade.retrieve_related_tables(user_query, related_table_cnt)
-    related_sql_by_query_name = text2sql_facade.retrieve_related_sample_queries(user_query, related_query_cnt)
+    search_filter = VectorSearchFilter(
+        schema_name=schema_name, database_name=database_name, dialect=dialect, tags=tags or []
+    )
+    # 埋め込みとDBの検索はブロッキングなので、イベントループを止めないようにスレッドで実行する
+    related_metadata_by_table, related_sql_by_query_name = await asyncio.to_thread(
+        text2sql_facade.retrieve_context, user_query, related_table_cnt, related_query_cnt, search_filter
+    )
     return {
         "related_metadata_by_table": related_metadata_by_table,
         "related_sql_by_query_name": related_sql_by_query_name,
@@ -64,5 +78,7 @@ async def text2sql_prompt(
 
 
 if __name__ == "__main__":
+    # 3つのストアを並行にローカルキャッシュへ取得しておく(更新が無ければダウンロードはスキップされる)
+    repository_factory.prefetch()
     # サーバーを初期化して実行
     mcp.run(transport="stdio")
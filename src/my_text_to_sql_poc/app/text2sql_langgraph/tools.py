@@ -1,3 +1,4 @@
+import functools
 from pathlib import Path
 from typing import Annotated, Any, Callable, Iterator, Literal
 
@@ -6,11 +7,12 @@ from langchain_community.agent_toolkits import SQLDatabaseToolkit
 from langchain_community.docstore.document import Document
 from langchain_community.utilities import SQLDatabase
 from langchain_community.vectorstores import DuckDB
+from langchain_core.embeddings import Embeddings
 from langchain_core.messages import AIMessage, ToolMessage
 from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
 from langchain_core.runnables import RunnableLambda, RunnableWithFallbacks
 from langchain_core.tools import tool
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from langchain_openai import ChatOpenAI
 from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph import END, START, StateGraph
 from langgraph.graph.message import AnyMessage, add_messages
@@ -20,7 +22,9 @@ from omegaconf import OmegaConf
 from pydantic import BaseModel, Field
 from typing_extensions import TypedDict
 
-EMBEDDING_MODEL = "text-embedding-3-small"
+from my_text_to_sql_poc.service.embedding_backend import create_embeddings
+from my_text_to_sql_poc.service.repository_factory import RepositoryConfig
+
 VECTOR_DB_PATH = "sample_vectorstore.duckdb"
 TABLE_METADATA_DIR = Path("data/table_metadata/")
 SAMPLE_QUERY_DIR = Path("data/sample_queries/")
@@ -91,11 +95,9 @@ class Text2SQL:
             message = f"related_tables: {related_tables}, related_sample_queries: {related_sample_queries}"
             return {"messages": [message]}
 
-        return rag
+        return rag_node
 
     def _define_query_generator_node(self) -> Callable[State, State]:
-        query_gen_prompt = ChatPromptTemplate.from_messages(
-
         def query_generator_node(state: State) -> State:
             """query_generatorノードは、メッセージを受け取り、llmを使用して応答を生成する"""
             response = self.llm.invoke(state["messages"])
@@ -167,12 +169,19 @@ def retrieve_related_sample_queries(question: str, k: int) -> dict[str, str]:
 
 def _retrieve_relevant_docs(question: str, table_name: str, k: int = 5) -> list[Document]:
     """ベクトルストアを読み込み、質問に関連するドキュメントをretrieveする"""
-    embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL)
     conn = duckdb.connect(database=VECTOR_DB_PATH)
-    vectorstore = DuckDB(connection=conn, embedding=embeddings, table_name=table_name)
+    vectorstore = DuckDB(connection=conn, embedding=_get_embeddings(), table_name=table_name)
     return vectorstore.similarity_search(question, k=k)
 
 
+@functools.cache
+def _get_embeddings() -> Embeddings:
+    """埋め込みモデルのクライアントは質問ごとに作らず使い回す。
+    バックエンドとモデルは、最初に使う時点の環境変数 TEXT2SQL_EMBEDDING_BACKEND 等で切り替える
+    """
+    return create_embeddings(RepositoryConfig.from_env().embedding_settings)
+
+
 def _load_selected_table_metadata(table_names: list[str]) -> dict[str, str]:
     """テーブルスメタデータを読み込んで、dict形式で返す"""
     metadata_by_table = {}
@@ -1,38 +1,92 @@
 from pathlib import Path
 
-import boto3
+import typer
 from loguru import logger
 
+from my_text_to_sql_poc.service.s3_store import (
+    DEFAULT_MULTIPART_PART_SIZE,
+    DEFAULT_UPLOAD_CONCURRENCY,
+    upload_file_if_changed,
+)
 
-def upload_to_s3(file_path: Path, bucket_name: str, s3_key: str):
+app = typer.Typer(pretty_exceptions_enable=False)
+
+
+def upload_to_s3(
+    file_path: Path,
+    bucket_name: str,
+    s3_key: str,
+    part_size: int = DEFAULT_MULTIPART_PART_SIZE,
+    max_concurrency: int = DEFAULT_UPLOAD_CONCURRENCY,
+    force: bool = False,
+):
     """
-    Upload a file to an S3 bucket.
+    Upload a file to an S3 bucket. The upload is skipped when the object already has the same content.
 
     Args:
         file_path (Path): Local path to the file to upload.
         bucket_name (str): Name of the S3 bucket.
         s3_key (str): Key (path) in the S3 bucket where the file will be stored.
+        part_size (int): Part size in bytes for multipart uploads.
+        max_concurrency (int): Number of parts uploaded in parallel.
+        force (bool): Upload even if the content has not changed.
+
+    Raises:
+        Exception: The upload failed. The error is logged before it is re-raised.
     """
-    s3 = boto3.client("s3")
     try:
-        s3.upload_file(str(file_path), bucket_name, s3_key)
-        logger.info(f"Uploaded {file_path} to s3://{bucket_name}/{s3_key}")
+        upload_file_if_changed(
+            file_path,
+            f"s3://{bucket_name}/{s3_key}",
+            part_size=part_size,
+            max_concurrency=max_concurrency,
+            force=force,
+        )
     except Exception as e:
         logger.error(f"Failed to upload {file_path} to S3: {e}")
+        raise
 
 
-if __name__ == "__main__":
-    bucket_name = "staging-newspicks-datalake-mart"
-    base_s3_path = "tmp/text2sql_poc/"
-
+@app.command()
+def main(
+    bucket_name: str = typer.Option("staging-newspicks-datalake-mart", help="アップロード先のバケット"),
+    base_s3_path: str = typer.Option("tmp/text2sql_poc/", help="アップロード先のキーのプレフィックス"),
+    part_size_mb: int = typer.Option(
+        DEFAULT_MULTIPART_PART_SIZE // 1024 // 1024,
+        min=5,
+        help="マルチパートのパートサイズ(MiB)。S3の最小パートサイズが5MiBなので5以上",
+    ),
+    max_concurrency: int = typer.Option(DEFAULT_UPLOAD_CONCURRENCY, min=1, help="並列にアップロードするパート数"),
+    force: bool = typer.Option(False, help="内容が変わっていなくてもアップロードする"),
+) -> None:
     files_to_upload = [
         Path("data/table_metadata_store.duckdb"),
         Path("data/sample_query_store.duckdb"),
     ]
 
+    failed_files = []
     for file_path in files_to_upload:
         if file_path.exists():
             s3_key = base_s3_path + file_path.name
-            upload_to_s3(file_path, bucket_name, s3_key)
+            try:
+                upload_to_s3(
+                    file_path,
+                    bucket_name,
+                    s3_key,
+                    part_size=part_size_mb * 1024 * 1024,
+                    max_concurrency=max_concurrency,
+                    force=force,
+                )
+            except Exception:
+                # 残りのファイルのアップロードは続け、最後に失敗として終了する
+                failed_files.append(file_path)
         else:
             logger.warning(f"File not found: {file_path}")
+
+    if failed_files:
+        logger.error(f"Failed to upload {len(failed_files)} file(s): {', '.join(map(str, failed_files))}")
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    app()
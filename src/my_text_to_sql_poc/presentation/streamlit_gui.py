@@ -1,6 +1,7 @@
 import streamlit as st
 
 from my_text_to_sql_poc.app.text2sql.text2sql_facade import Text2SQLFacade
+from my_text_to_sql_poc.service.repository_factory import RepositoryConfig, RepositoryFactory
 
 st.title("Text-to-SQL Assistant")
 
@@ -12,7 +13,19 @@ if "chat_history" not in st.session_state:
     st.session_state["chat_history"] = []
 
 
-text2sql_facade = Text2SQLFacade()
+@st.cache_resource
+def get_text2sql_facade() -> Text2SQLFacade:
+    """streamlitは操作のたびにスクリプト全体を再実行するので、ストアの取得やリポジトリの生成は1度だけ行う"""
+    repository_factory = RepositoryFactory(RepositoryConfig.from_env().model_copy(update={"use_read_cache": True}))
+    repository_factory.prefetch()
+    return Text2SQLFacade(
+        vector_store_repo=repository_factory.vector_store_repository(),
+        table_metadata_repo=repository_factory.table_metadata_repository(),
+        sample_query_repo=repository_factory.sample_query_repository(),
+    )
+
+
+text2sql_facade = get_text2sql_facade()
 
 # 💬 過去のチャット履歴を表示（新しい方は下に）
 for msg in st.session_state.chat_history:
@@ -28,8 +41,10 @@ if user_msg:
     with st.chat_message("user"):
         st.write(user_msg)
 
-    # 関連するテーブルをretrieve
-    related_metadata_by_table = text2sql_facade.retrieve_related_tables(user_msg, k=20)
+    # 関連するテーブルとサンプルクエリをまとめてretrieve(質問の埋め込みは1回で済む)
+    related_metadata_by_table, related_sql_by_query_name = text2sql_facade.retrieve_context(
+        user_msg, k_tables=20, k_queries=10
+    )
     with st.chat_message("assistant"):
         st.markdown(f"関連するテーブルを取得しました! {', '.join(list(related_metadata_by_table.keys())[0:3])}, ...")
         with st.expander("取得されたテーブルの詳細を見る"):
@@ -43,8 +58,6 @@ if user_msg:
         }
     )
 
-    # 関連するサンプルクエリをretrieve
-    related_sql_by_query_name = text2sql_facade.retrieve_related_sample_queries(user_msg, k=10)
     with st.chat_message("assistant"):
         st.markdown(
             f"関連するサンプルクエリを取得しました! {', '.join(list(related_sql_by_query_name.keys())[0:3])}, ..."
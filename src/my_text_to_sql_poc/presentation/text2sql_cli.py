@@ -4,6 +4,7 @@ import typer
 from loguru import logger
 
 from my_text_to_sql_poc.app.text2sql.text2sql_facade import Text2SQLFacade
+from my_text_to_sql_poc.service.repository_factory import RepositoryFactory
 
 app = typer.Typer(pretty_exceptions_enable=False)
 
@@ -17,7 +18,12 @@ def main(
     logger.remove()  # デフォルトのログ設定を削除
     logger.add(lambda msg: typer.echo(msg, err=True), level=log_level.upper())
 
-    facade = Text2SQLFacade()
+    repository_factory = RepositoryFactory()
+    facade = Text2SQLFacade(
+        vector_store_repo=repository_factory.vector_store_repository(),
+        table_metadata_repo=repository_factory.table_metadata_repository(),
+        sample_query_repo=repository_factory.sample_query_repository(),
+    )
     sql_query, explanation = facade.all_process(question, dialect)
 
     logger.info(f"\nGenerated SQL Query:\n {sql_query}")
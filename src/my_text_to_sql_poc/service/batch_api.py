@@ -0,0 +1,454 @@
+import json
+import os
+import shutil
+import time
+import uuid
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Callable, Literal, TypeVar
+
+import openai
+from loguru import logger
+from pydantic import BaseModel, ValidationError
+
+from my_text_to_sql_poc.service.http_pool import get_http_connection_pool
+from my_text_to_sql_poc.service.llm_response_cache import LLMResponseCache, response_cache_key
+from my_text_to_sql_poc.service.model_gateway import ModelGateway
+from my_text_to_sql_poc.service.s3_store import DEFAULT_STORE_CACHE_DIR
+
+T = TypeVar("T", bound=BaseModel)
+
+DEFAULT_BATCH_WORK_DIR = DEFAULT_STORE_CACHE_DIR / "batch_api"
+CHAT_COMPLETIONS_ENDPOINT = "/v1/chat/completions"
+
+BatchState = Literal[
+    "validating", "in_progress", "finalizing", "completed", "failed", "expired", "cancelling", "cancelled"
+]
+# 結果が確定した状態。expired でも期限までに終わったリクエストの結果は取得できる
+TERMINAL_BATCH_STATES: set[str] = {"completed", "failed", "expired", "cancelled"}
+# 1つのバッチファイルに含められるリクエスト数とファイルサイズの上限(OpenAIのBatch APIの制限)
+MAX_BATCH_REQUESTS = 50_000
+MAX_BATCH_FILE_BYTES = 200 * 1024**2
+
+
+class BatchAPIError(Exception):
+    """バッチが失敗した、または一部のリクエストの結果が得られなかった"""
+
+
+class BatchManifestEntry(BaseModel):
+    """投入したバッチと、連番の位置ごとのIDと応答キャッシュのキー"""
+
+    batch_id: str
+    ids: list[str]
+    cache_keys: list[str]
+
+
+class BatchManifest(BaseModel):
+    """結果を受け取る前のバッチの一覧。プロセスが途中で止まっても、再実行時に投入し直さずに結果を待つために使う"""
+
+    batches: list[BatchManifestEntry] = []
+
+
+class BatchStatus(BaseModel):
+    batch_id: str
+    state: BatchState
+    total: int = 0
+    completed: int = 0
+    failed: int = 0
+
+
+class BatchAPIBackendInterface(ABC):
+    """JSONLのバッチファイルを受け付けて非同期に処理する、生成AIモデルのバッチAPI"""
+
+    @abstractmethod
+    def submit(self, batch_file: Path) -> str:
+        """バッチファイルを投入してバッチIDを返す"""
+        pass
+
+    @abstractmethod
+    def status(self, batch_id: str) -> BatchStatus:
+        pass
+
+    @abstractmethod
+    def results(self, batch_id: str) -> list[dict[str, Any]]:
+        """結果ファイルとエラーファイルの各行(custom_id, response, error を持つdict)を返す"""
+        pass
+
+
+class OpenAIBatchAPIBackend(BatchAPIBackendInterface):
+    """OpenAIのBatch API。結果は24時間以内に返り、料金は通常の呼び出しの半額"""
+
+    def __init__(self, client: openai.OpenAI | None = None) -> None:
+        self._client = client or openai.OpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"), http_client=get_http_connection_pool().client()
+        )
+
+    def submit(self, batch_file: Path) -> str:
+        with batch_file.open("rb") as f:
+            input_file = self._client.files.create(file=f, purpose="batch")
+        batch = self._client.batches.create(
+            input_file_id=input_file.id, endpoint=CHAT_COMPLETIONS_ENDPOINT, completion_window="24h"
+        )
+        return batch.id
+
+    def status(self, batch_id: str) -> BatchStatus:
+        batch = self._client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        return BatchStatus(
+            batch_id=batch.id,
+            state=batch.status,
+            total=counts.total if counts else 0,
+            completed=counts.completed if counts else 0,
+            failed=counts.failed if counts else 0,
+        )
+
+    def results(self, batch_id: str) -> list[dict[str, Any]]:
+        batch = self._client.batches.retrieve(batch_id)
+        lines = []
+        for file_id in [batch.output_file_id, batch.error_file_id]:
+            if file_id:
+                lines.extend(_read_jsonl(self._client.files.content(file_id).text))
+        return lines
+
+
+class LocalFileBatchAPIBackend(BatchAPIBackendInterface):
+    """ローカルのディレクトリでバッチAPIを模擬するバックエンド(テストやオフラインでの動作確認用)。
+
+    投入したバッチは、最初に状態を問い合わせた時点で、リクエストの本文ごとに respond を呼んで処理する。
+    respond が例外を投げたリクエストは、エラーファイルに書き出す。
+    """
+
+    def __init__(self, work_dir: str | Path, respond: Callable[[dict[str, Any]], dict[str, Any]]) -> None:
+        """
+        Args:
+            respond: Chat Completions APIのリクエストの本文を受け取り、レスポンスの本文を返す関数
+        """
+        self.work_dir = Path(work_dir)
+        self._respond = respond
+
+    def submit(self, batch_file: Path) -> str:
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        batch_dir = self.work_dir / batch_id
+        batch_dir.mkdir(parents=True)
+        shutil.copyfile(batch_file, batch_dir / "input.jsonl")
+        (batch_dir / "status").write_text("in_progress")
+        return batch_id
+
+    def status(self, batch_id: str) -> BatchStatus:
+        batch_dir = self.work_dir / batch_id
+        if (batch_dir / "status").read_text() == "in_progress":
+            self._process(batch_dir)
+        output_lines = _read_jsonl((batch_dir / "output.jsonl").read_text())
+        error_lines = _read_jsonl((batch_dir / "error.jsonl").read_text())
+        return BatchStatus(
+            batch_id=batch_id,
+            state="completed",
+            total=len(output_lines) + len(error_lines),
+            completed=len(output_lines),
+            failed=len(error_lines),
+        )
+
+    def results(self, batch_id: str) -> list[dict[str, Any]]:
+        batch_dir = self.work_dir / batch_id
+        return _read_jsonl((batch_dir / "output.jsonl").read_text()) + _read_jsonl(
+            (batch_dir / "error.jsonl").read_text()
+        )
+
+    def _process(self, batch_dir: Path) -> None:
+        outputs, errors = [], []
+        for request in _read_jsonl((batch_dir / "input.jsonl").read_text()):
+            line = {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"]}
+            try:
+                outputs.append({**line, "response": {"status_code": 200, "body": self._respond(request["body"])}})
+            except Exception as e:
+                errors.append({**line, "response": None, "error": {"code": type(e).__name__, "message": str(e)}})
+        (batch_dir / "output.jsonl").write_text(
+            "".join(json.dumps(line, ensure_ascii=False) + "\n" for line in outputs)
+        )
+        (batch_dir / "error.jsonl").write_text("".join(json.dumps(line, ensure_ascii=False) + "\n" for line in errors))
+        (batch_dir / "status").write_text("completed")
+
+
+class BatchAPIRunner:
+    """プロンプトをJSONLのバッチファイルにまとめてバッチAPIに投入し、完了を待って出力スキーマのインスタンスを返す。
+
+    ModelGatewayと同じキーで応答キャッシュを引くので、キャッシュ済みのプロンプトは投入しない。
+    一部のリクエストが失敗した場合も、成功した分はキャッシュに保存してから BatchAPIError を投げる(run_partial は
+    成功した分と失敗したIDを返す)ので、再実行すると失敗した分だけを投入し直す。
+
+    リクエスト数かファイルサイズがBatch APIの上限を超える場合は、複数のバッチファイルに分けて投入する。
+    投入したバッチのIDは結果を受け取るまで work_dir のマニフェストに記録しておき、完了を待つ間にプロセスが
+    止まった場合は、再実行時に同じプロンプトのバッチを投入し直さずに、記録したバッチの完了を待つ。
+    """
+
+    def __init__(
+        self,
+        backend: BatchAPIBackendInterface,
+        model_name: str = "gpt-4o-mini",
+        temperature: float | None = 0.7,
+        response_cache: LLMResponseCache | None = None,
+        work_dir: str | Path = DEFAULT_BATCH_WORK_DIR,
+        poll_interval_seconds: float = 60.0,
+        timeout_seconds: float = 25 * 60 * 60,
+        sleep: Callable[[float], None] = time.sleep,
+        max_requests_per_batch: int = MAX_BATCH_REQUESTS,
+        max_batch_file_bytes: int = MAX_BATCH_FILE_BYTES,
+    ) -> None:
+        """
+        Args:
+            temperature: リクエストに付けるtemperature。キャッシュのキーにも使うので、ModelGatewayと揃える
+            work_dir: バッチファイルと、投入したバッチのマニフェストを書き出すディレクトリ
+            timeout_seconds: 完了を待つ秒数の上限。Batch APIの完了期限(24時間)より少し長くする
+            max_requests_per_batch: 1つのバッチファイルに含めるリクエスト数の上限
+            max_batch_file_bytes: 1つのバッチファイルのサイズの上限
+        """
+        self._backend = backend
+        self.model_name = model_name
+        self.temperature = temperature
+        self.response_cache = response_cache
+        self.work_dir = Path(work_dir)
+        self.poll_interval_seconds = poll_interval_seconds
+        self.timeout_seconds = timeout_seconds
+        self._sleep = sleep
+        self.max_requests_per_batch = max_requests_per_batch
+        self.max_batch_file_bytes = max_batch_file_bytes
+
+    @classmethod
+    def from_gateway(
+        cls, model_gateway: ModelGateway, backend: BatchAPIBackendInterface | None = None, **kwargs: Any
+    ) -> "BatchAPIRunner":
+        """ModelGatewayと同じモデル・temperature・応答キャッシュを使うランナーを作る(バックエンドの既定はOpenAI)"""
+        return cls(
+            backend or OpenAIBatchAPIBackend(),
+            model_name=model_gateway.model_name,
+            temperature=getattr(model_gateway.llm, "temperature", None),
+            response_cache=model_gateway.response_cache,
+            **kwargs,
+        )
+
+    def run(self, prompt_by_id: dict[str, str], output_schema: type[T]) -> dict[str, T]:
+        """
+        Args:
+            prompt_by_id: ID(テーブル名など)ごとのプロンプト
+
+        Returns:
+            dict[str, T]: IDごとの出力。順序は prompt_by_id と同じ
+
+        Raises:
+            BatchAPIError: バッチが失敗した、または一部のIDの結果が得られなかった場合
+        """
+        results, failed_ids = self.run_partial(prompt_by_id, output_schema)
+        if failed_ids:
+            raise BatchAPIError(f"{len(failed_ids)} of {len(prompt_by_id)} requests failed: {failed_ids}")
+        return results
+
+    def run_partial(self, prompt_by_id: dict[str, str], output_schema: type[T]) -> tuple[dict[str, T], list[str]]:
+        """run と同じだが、一部のIDの結果が得られなくても例外を投げずに、得られた分と失敗したIDを返す
+
+        Returns:
+            tuple[dict[str, T], list[str]]: (IDごとの出力, 結果が得られなかったIDのリスト)。順序は prompt_by_id と同じ
+
+        Raises:
+            BatchAPIError: 完了を待つ時間の上限を過ぎた場合(再実行すると、投入済みのバッチの完了を待ち直す)
+        """
+        results: dict[str, T] = {}
+        pending: dict[str, str] = {}
+        for id_, prompt in prompt_by_id.items():
+            cached = self._cached(prompt, output_schema)
+            if cached is not None:
+                results[id_] = cached
+            else:
+                pending[id_] = prompt
+        logger.info(f"Batch API: {len(results)} prompts cached, submitting {len(pending)} prompts")
+        if pending:
+            results.update(self._run_batch(pending, output_schema))
+        return (
+            {id_: results[id_] for id_ in prompt_by_id if id_ in results},
+            [id_ for id_ in prompt_by_id if id_ not in results],
+        )
+
+    def write_batch_files(
+        self, prompt_by_id: dict[str, str], output_schema: type[BaseModel]
+    ) -> list[tuple[Path, list[str]]]:
+        """プロンプトをChat Completions APIのリクエストとしてJSONLに書き出す。
+
+        リクエスト数が max_requests_per_batch を、ファイルサイズが max_batch_file_bytes を超える場合は複数のファイルに分ける。
+        custom_id は長さに上限があるので、IDではなくファイルの中での連番を使う。
+
+        Returns:
+            list[tuple[Path, list[str]]]: バッチファイルと、連番の位置ごとのIDの組のリスト
+
+        Raises:
+            BatchAPIError: 1件のリクエストだけで max_batch_file_bytes を超える場合
+        """
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        response_format = {
+            "type": "json_schema",
+            "json_schema": {"name": output_schema.__name__, "schema": output_schema.model_json_schema()},
+        }
+        batch_files: list[tuple[Path, list[str]]] = []
+        lines: list[bytes] = []
+        ids: list[str] = []
+        file_bytes = 0
+        for id_, prompt in prompt_by_id.items():
+            body: dict[str, Any] = {
+                "model": self.model_name,
+                "messages": [{"role": "user", "content": prompt}],
+                "response_format": response_format,
+            }
+            if self.temperature is not None:
+                body["temperature"] = self.temperature
+            # サイズは、custom_id を最も桁数の多い連番にして見積もる
+            request = {
+                "custom_id": f"request-{self.max_requests_per_batch}",
+                "method": "POST",
+                "url": CHAT_COMPLETIONS_ENDPOINT,
+                "body": body,
+            }
+            request_bytes = len((json.dumps(request, ensure_ascii=False) + "\n").encode())
+            if request_bytes > self.max_batch_file_bytes:
+                raise BatchAPIError(
+                    f"Request for {id_} ({request_bytes} bytes) exceeds the batch file size limit "
+                    f"({self.max_batch_file_bytes} bytes)"
+                )
+            if len(ids) >= self.max_requests_per_batch or file_bytes + request_bytes > self.max_batch_file_bytes:
+                batch_files.append((self._write_batch_file(lines, output_schema), ids))
+                lines, ids, file_bytes = [], [], 0
+            request["custom_id"] = f"request-{len(ids)}"
+            lines.append((json.dumps(request, ensure_ascii=False) + "\n").encode())
+            ids.append(id_)
+            file_bytes += request_bytes
+        if ids:
+            batch_files.append((self._write_batch_file(lines, output_schema), ids))
+        return batch_files
+
+    def _write_batch_file(self, lines: list[bytes], output_schema: type[BaseModel]) -> Path:
+        batch_file = self.work_dir / f"{output_schema.__name__}_{uuid.uuid4().hex}.jsonl"
+        batch_file.write_bytes(b"".join(lines))
+        return batch_file
+
+    def manifest_path(self, output_schema: type[BaseModel]) -> Path:
+        return self.work_dir / f"{output_schema.__name__}.manifest.json"
+
+    def _run_batch(self, prompt_by_id: dict[str, str], output_schema: type[T]) -> dict[str, T]:
+        """プロンプトをバッチで処理し、結果が得られたIDの出力を返す(失敗したIDはログに出す)"""
+        cache_key_by_id = {
+            id_: response_cache_key(self.model_name, self.temperature, prompt, output_schema)
+            for id_, prompt in prompt_by_id.items()
+        }
+        manifest = self._load_manifest(output_schema)
+        # 前回のプロセスが投入して結果を受け取っていないバッチのうち、同じプロンプトを含むものは投入し直さずに待つ
+        batches = [
+            entry
+            for entry in manifest.batches
+            if any(cache_key_by_id.get(id_) == key for id_, key in zip(entry.ids, entry.cache_keys))
+        ]
+        resumed_ids = {
+            id_ for entry in batches for id_, key in zip(entry.ids, entry.cache_keys) if cache_key_by_id.get(id_) == key
+        }
+        for entry in batches:
+            logger.info(
+                f"Resuming batch {entry.batch_id} ({len(entry.ids)} requests) from {self.manifest_path(output_schema)}"
+            )
+
+        to_submit = {id_: prompt for id_, prompt in prompt_by_id.items() if id_ not in resumed_ids}
+        for batch_file, ids in self.write_batch_files(to_submit, output_schema):
+            batch_id = self._backend.submit(batch_file)
+            logger.info(f"Submitted batch {batch_id} ({len(ids)} requests): {batch_file}")
+            entry = BatchManifestEntry(batch_id=batch_id, ids=ids, cache_keys=[cache_key_by_id[id_] for id_ in ids])
+            manifest.batches.append(entry)
+            self._save_manifest(output_schema, manifest)
+            batches.append(entry)
+
+        results: dict[str, T] = {}
+        for entry in batches:
+            batch_results, batch_errors = self._collect(entry, output_schema)
+            # 成功した分はキャッシュに保存済みなので、失敗した分があってもマニフェストからは外す
+            manifest.batches = [other for other in manifest.batches if other.batch_id != entry.batch_id]
+            self._save_manifest(output_schema, manifest)
+            for position, (id_, key) in enumerate(zip(entry.ids, entry.cache_keys)):
+                if cache_key_by_id.get(id_) != key:
+                    continue
+                if position in batch_results:
+                    results[id_] = batch_results[position]
+                else:
+                    error = batch_errors.get(position, "no result")
+                    logger.error(f"Batch {entry.batch_id} request for {id_} failed: {error}")
+        return results
+
+    def _collect(self, entry: BatchManifestEntry, output_schema: type[T]) -> tuple[dict[int, T], dict[int, str]]:
+        """バッチの完了を待って結果を連番の位置ごとに返し、成功した応答をキャッシュに保存する
+
+        Returns:
+            tuple[dict[int, T], dict[int, str]]: (位置ごとの出力, 位置ごとのエラー)
+        """
+        status = self._wait(entry.batch_id)
+        if status.state in {"failed", "cancelled"}:
+            return {}, {position: f"batch {status.state}" for position in range(len(entry.ids))}
+
+        results: dict[int, T] = {}
+        errors: dict[int, str] = {}
+        for line in self._backend.results(entry.batch_id):
+            position = int(line["custom_id"].removeprefix("request-"))
+            try:
+                results[position] = self._parse(line, output_schema)
+            except (BatchAPIError, ValidationError) as e:
+                errors[position] = str(e)
+        if self.response_cache is not None:
+            # キャッシュのファイルを読み書きで開き直すのは、バッチごとに1回だけにする
+            self.response_cache.set_many(
+                [
+                    (entry.cache_keys[position], self.model_name, result.model_dump_json())
+                    for position, result in results.items()
+                ]
+            )
+        return results, errors
+
+    def _load_manifest(self, output_schema: type[BaseModel]) -> BatchManifest:
+        path = self.manifest_path(output_schema)
+        if not path.exists():
+            return BatchManifest()
+        return BatchManifest.model_validate_json(path.read_text())
+
+    def _save_manifest(self, output_schema: type[BaseModel], manifest: BatchManifest) -> None:
+        """書き込み中にプロセスが止まっても壊れないよう、一時ファイルに書いてから置き換える"""
+        path = self.manifest_path(output_schema)
+        if not manifest.batches:
+            path.unlink(missing_ok=True)
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(manifest.model_dump_json(indent=2))
+        os.replace(tmp_path, path)
+
+    def _wait(self, batch_id: str) -> BatchStatus:
+        """結果が確定するまで状態を問い合わせる"""
+        deadline = time.monotonic() + self.timeout_seconds
+        while True:
+            status = self._backend.status(batch_id)
+            logger.info(
+                f"Batch {batch_id}: {status.state} ({status.completed}/{status.total} completed, {status.failed} failed)"
+            )
+            if status.state in TERMINAL_BATCH_STATES:
+                return status
+            if time.monotonic() > deadline:
+                raise BatchAPIError(f"Timed out waiting for batch {batch_id} ({self.timeout_seconds}s)")
+            self._sleep(self.poll_interval_seconds)
+
+    def _cached(self, prompt: str, output_schema: type[T]) -> T | None:
+        if self.response_cache is None:
+            return None
+        cached = self.response_cache.get(response_cache_key(self.model_name, self.temperature, prompt, output_schema))
+        return output_schema.model_validate_json(cached) if cached is not None else None
+
+    @staticmethod
+    def _parse(line: dict[str, Any], output_schema: type[T]) -> T:
+        response = line.get("response")
+        if line.get("error") or not response or response["status_code"] != 200:
+            raise BatchAPIError(str(line.get("error") or response))
+        content = response["body"]["choices"][0]["message"]["content"]
+        return output_schema.model_validate_json(content)
+
+
+def _read_jsonl(text: str) -> list[dict[str, Any]]:
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
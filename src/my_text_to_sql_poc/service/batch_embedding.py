@@ -0,0 +1,123 @@
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from langchain_core.embeddings import Embeddings
+from loguru import logger
+
+# OpenAIの埋め込みAPIの1リクエストあたりの上限(30万トークン / 2048件)より余裕を持たせた既定値
+DEFAULT_MAX_TOKENS_PER_REQUEST = 100_000
+DEFAULT_MAX_TEXTS_PER_REQUEST = 1000
+DEFAULT_MAX_CONCURRENT_REQUESTS = 4
+
+TokenCounter = Callable[[str], int]
+
+
+def pack_by_token_budget(token_counts: list[int], max_tokens: int, max_texts: int) -> list[list[int]]:
+    """テキストを先頭から順に、トークン数の合計が max_tokens 以下かつ件数が max_texts 以下のバッチに詰める
+
+    1件で max_tokens を超えるテキストは、単独のバッチにする(切り詰めは埋め込みモデル側に任せる)。
+
+    Returns:
+        list[list[int]]: バッチごとの、テキストの位置のリスト
+    """
+    batches: list[list[int]] = []
+    batch: list[int] = []
+    batch_tokens = 0
+    for position, tokens in enumerate(token_counts):
+        if batch and (batch_tokens + tokens > max_tokens or len(batch) >= max_texts):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(position)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def token_counter_for(model_name: str) -> TokenCounter:
+    """モデルのtiktokenのエンコーディングでトークン数を数える関数を返す。
+
+    エンコーディングは最初に数える時点で読み込み、読み込めない場合(オフライン環境など)はUTF-8のバイト数で数える
+    (バイト単位のBPEではトークン数はバイト数を超えないので、バッチの上限を超えることは無い)。
+    """
+
+    def count_tokens(text: str) -> int:
+        encoding = _tiktoken_encoding(model_name)
+        if encoding is None:
+            return _count_utf8_bytes(text)
+        return len(encoding.encode(text, disallowed_special=()))
+
+    return count_tokens
+
+
+@functools.cache
+def _tiktoken_encoding(model_name: str):
+    try:
+        import tiktoken
+
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning(f"Failed to load tiktoken encoding for {model_name}. Counting UTF-8 bytes instead: {e}")
+        return None
+
+
+class BatchEmbedder:
+    """大量のドキュメントを、トークン数で上限を決めたバッチに詰めて、複数のリクエストを並行に投げて埋め込む"""
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        count_tokens: TokenCounter | None = None,
+        max_tokens_per_request: int = DEFAULT_MAX_TOKENS_PER_REQUEST,
+        max_texts_per_request: int = DEFAULT_MAX_TEXTS_PER_REQUEST,
+        max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS,
+    ) -> None:
+        """
+        Args:
+            count_tokens: テキストのトークン数を数える関数。指定しない場合はUTF-8のバイト数で数える
+        """
+        if max_tokens_per_request < 1 or max_texts_per_request < 1 or max_concurrent_requests < 1:
+            raise ValueError("max_tokens_per_request, max_texts_per_request and max_concurrent_requests must be >= 1")
+        self._embeddings = embeddings
+        self._count_tokens = count_tokens or _count_utf8_bytes
+        self.max_tokens_per_request = max_tokens_per_request
+        self.max_texts_per_request = max_texts_per_request
+        self.max_concurrent_requests = max_concurrent_requests
+
+    def plan(self, texts: list[str]) -> list[list[int]]:
+        # トークン数はバイト数を超えないので、バイト数で1リクエストに収まる場合はトークン化を省く
+        byte_counts = [_count_utf8_bytes(text) for text in texts]
+        if len(texts) <= self.max_texts_per_request and sum(byte_counts) <= self.max_tokens_per_request:
+            return [list(range(len(texts)))]
+        token_counts = [self._count_tokens(text) for text in texts]
+        return pack_by_token_budget(token_counts, self.max_tokens_per_request, self.max_texts_per_request)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """入力と同じ順序で埋め込みを返す"""
+        if not texts:
+            return []
+        batches = self.plan(texts)
+        logger.info(
+            f"Embedding {len(texts)} documents in {len(batches)} requests "
+            f"(concurrency={min(self.max_concurrent_requests, len(batches))})"
+        )
+        if len(batches) == 1:
+            return self._embeddings.embed_documents(texts)
+
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrent_requests, len(batches))) as executor:
+            batch_embeddings = list(
+                executor.map(lambda batch: self._embeddings.embed_documents([texts[i] for i in batch]), batches)
+            )
+        embeddings: list[list[float]] = [[] for _ in texts]
+        for batch, vectors in zip(batches, batch_embeddings):
+            for position, vector in zip(batch, vectors):
+                embeddings[position] = vector
+        return embeddings
+
+
+def _count_utf8_bytes(text: str) -> int:
+    return len(text.encode())
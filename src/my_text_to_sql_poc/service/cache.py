@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, TypeVar
+
+from pydantic import BaseModel
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class CacheStats(BaseModel):
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class TTLCache(Generic[K, V]):
+    """件数上限(LRU)とTTLで値を追い出す、スレッドセーフなインメモリキャッシュ"""
+
+    def __init__(
+        self,
+        max_size: int = 1024,
+        ttl_seconds: float | None = 600.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        if max_size < 1:
+            raise ValueError(f"max_size must be >= 1: {max_size}")
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._entries: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self._lock = threading.Lock()
+        # カウンタは複数のスレッドから更新されるので、必ず self._lock の下で更新する
+        self._stats = CacheStats()
+        # invalidate/clear のたびに増やす。読み込み中に破棄された古い値を set しないために使う
+        self._generation = 0
+
+    @property
+    def generation(self) -> int:
+        """invalidate/clear された回数。元データを読む前に取っておき、set に渡す"""
+        with self._lock:
+            return self._generation
+
+    @property
+    def stats(self) -> CacheStats:
+        """ヒット数などのカウンタのスナップショット"""
+        with self._lock:
+            return self._stats.model_copy()
+
+    def get(self, key: K, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats.misses += 1
+                return default
+            stored_at, value = entry
+            if self.ttl_seconds is not None and self._clock() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                self._stats.evictions += 1
+                self._stats.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self._stats.hits += 1
+            return value
+
+    def set(self, key: K, value: V, generation: int | None = None) -> bool:
+        """値を保存する。generation を渡した場合、その後に invalidate/clear されていたら保存せずにFalseを返す"""
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return False
+            self._entries[key] = (self._clock(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats.evictions += 1
+            return True
+
+    def invalidate(self, key: K) -> None:
+        with self._lock:
+            self._generation += 1
+            if self._entries.pop(key, None) is not None:
+                self._stats.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._stats.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
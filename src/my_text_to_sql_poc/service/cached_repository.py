@@ -0,0 +1,112 @@
+from my_text_to_sql_poc.service.cache import CacheStats, TTLCache
+from my_text_to_sql_poc.service.repository import SampleQueryRepositoryInterface, TableMetadataRepositoryInterface
+
+# キャッシュに載っていないことを表す番兵と、「DBに存在しない」ことをキャッシュするための番兵
+_MISS = object()
+_NOT_FOUND = object()
+
+
+class CachedTableMetadataRepository(TableMetadataRepositoryInterface):
+    """テーブルメタデータの読み取りをインメモリでキャッシュするデコレータ。
+    put/put_bulk で更新されたテーブルのキャッシュは破棄されるので、次回のgetで最新の値が読み込まれる。
+    """
+
+    def __init__(
+        self,
+        repository: TableMetadataRepositoryInterface,
+        max_size: int = 1024,
+        ttl_seconds: float | None = 600.0,
+    ) -> None:
+        self._repository = repository
+        self._cache: TTLCache[str, str | object] = TTLCache(max_size=max_size, ttl_seconds=ttl_seconds)
+
+    @property
+    def cache_stats(self) -> CacheStats:
+        return self._cache.stats
+
+    def get(self, table_names: list[str]) -> dict[str, str]:
+        metadata_by_table = {name: self._cache.get(name, _MISS) for name in table_names}
+        missing_names = [name for name, metadata in metadata_by_table.items() if metadata is _MISS]
+        if missing_names:
+            # 読み込み中に put/put_bulk で破棄された場合は、読んだ値が古い可能性があるのでキャッシュしない
+            generation = self._cache.generation
+            fetched = self._repository.get(missing_names)
+            for name in missing_names:
+                metadata_by_table[name] = fetched.get(name, _NOT_FOUND)
+                self._cache.set(name, metadata_by_table[name], generation=generation)
+        return {name: metadata for name, metadata in metadata_by_table.items() if metadata is not _NOT_FOUND}
+
+    def put(self, table_name: str, metadata: str) -> None:
+        self._repository.put(table_name, metadata)
+        self._cache.invalidate(table_name)
+
+    def get_all(self) -> dict[str, str]:
+        return self._repository.get_all()
+
+    def put_bulk(self, items: list[tuple[str, str]]) -> None:
+        self._repository.put_bulk(items)
+        for table_name, _ in items:
+            self._cache.invalidate(table_name)
+
+
+class CachedSampleQueryRepository(SampleQueryRepositoryInterface):
+    """サンプルクエリの読み取りをインメモリでキャッシュするデコレータ。
+    retrieve_by_table_name の結果は、いずれかのサンプルクエリが更新された時点で全て破棄する
+    (更新されたクエリがどのテーブルを参照していたかを、このデコレータは知らないため)。
+    """
+
+    def __init__(
+        self,
+        repository: SampleQueryRepositoryInterface,
+        max_size: int = 1024,
+        ttl_seconds: float | None = 600.0,
+    ) -> None:
+        self._repository = repository
+        self._query_cache: TTLCache[str, str | object] = TTLCache(max_size=max_size, ttl_seconds=ttl_seconds)
+        self._by_table_cache: TTLCache[str, dict[str, str]] = TTLCache(max_size=max_size, ttl_seconds=ttl_seconds)
+
+    @property
+    def cache_stats(self) -> CacheStats:
+        query_stats = self._query_cache.stats
+        by_table_stats = self._by_table_cache.stats
+        return CacheStats(
+            hits=query_stats.hits + by_table_stats.hits,
+            misses=query_stats.misses + by_table_stats.misses,
+            evictions=query_stats.evictions + by_table_stats.evictions,
+            invalidations=query_stats.invalidations + by_table_stats.invalidations,
+        )
+
+    def get(self, query_names: list[str]) -> dict[str, str]:
+        sql_by_query_name = {name: self._query_cache.get(name, _MISS) for name in query_names}
+        missing_names = [name for name, sql in sql_by_query_name.items() if sql is _MISS]
+        if missing_names:
+            generation = self._query_cache.generation
+            fetched = self._repository.get(missing_names)
+            for name in missing_names:
+                sql_by_query_name[name] = fetched.get(name, _NOT_FOUND)
+                self._query_cache.set(name, sql_by_query_name[name], generation=generation)
+        return {name: sql for name, sql in sql_by_query_name.items() if sql is not _NOT_FOUND}
+
+    def put(self, query_name: str, query: str, query_url: str) -> None:
+        self._repository.put(query_name, query, query_url)
+        self._query_cache.invalidate(query_name)
+        self._by_table_cache.clear()
+
+    def retrieve_by_table_name(self, table_name: str) -> dict[str, str]:
+        key = table_name.lower()
+        cached = self._by_table_cache.get(key)
+        if cached is not None:
+            return dict(cached)
+        generation = self._by_table_cache.generation
+        sql_by_query_name = self._repository.retrieve_by_table_name(table_name)
+        self._by_table_cache.set(key, dict(sql_by_query_name), generation=generation)
+        return sql_by_query_name
+
+    def get_all(self) -> dict[str, str]:
+        return self._repository.get_all()
+
+    def put_bulk(self, items: list[tuple[str, str, str]]) -> None:
+        self._repository.put_bulk(items)
+        for query_name, _, _ in items:
+            self._query_cache.invalidate(query_name)
+        self._by_table_cache.clear()
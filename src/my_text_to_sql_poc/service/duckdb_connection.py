@@ -0,0 +1,434 @@
+import atexit
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+import duckdb
+from loguru import logger
+
+
+class ConnectionPoolTimeoutError(RuntimeError):
+    """プールから一定時間内にカーソルを取得できなかった場合の例外"""
+
+
+class DuckDBConnectionManager:
+    """1つのDuckDBファイルに対する長寿命のコネクションと、そこから派生したカーソルのプールを管理する。
+
+    DuckDBは同一プロセス内で同じファイルを複数回 `duckdb.connect()` するとカタログの読み込みやキャッシュの再構築が
+    毎回発生するので、ルートコネクションは1つだけ開き、スレッドごとの処理には `cursor()` で派生させたカーソルを使う。
+    - 参照系: `read_cursor()` で READ ONLY トランザクションを張ったカーソルを貸し出す
+    - 更新系: `write_cursor()` で書き込みロックを取った上でトランザクションを張ったカーソルを貸し出す
+
+    DuckDBは読み書き可能で開いたファイルに排他ロックを掛けるので、他のプロセスは同じファイルを読むことも書くこともできない。
+    lock_on_write=True の場合は、普段はファイルを読み取り専用で開き(他のプロセスも読み取り専用でなら同時に開ける)、
+    `write_cursor()` の間だけ読み書き可能で開き直して排他ロックを取る。
+    開き直す間はプロセス内の参照も待たせ、`open_cursor()` で作ったカーソルは閉じる(`generation` が変わる)。
+    """
+
+    def __init__(
+        self,
+        db_path: str | Path,
+        pool_size: int = 4,
+        read_only: bool = False,
+        acquire_timeout_seconds: float = 30.0,
+        root_connection: duckdb.DuckDBPyConnection | None = None,
+        cursor_init_sql: list[str] | None = None,
+        lock_on_write: bool = False,
+        write_lock_timeout_seconds: float = 30.0,
+    ) -> None:
+        """
+        Args:
+            root_connection: 既に開いているコネクションを使う場合に指定する(ATTACHしたリモートのストアなど)。
+                指定しない場合は db_path を開く
+            cursor_init_sql: カーソルを作るたびに実行するSQL(`USE` でデフォルトのカタログを切り替える場合など)
+            lock_on_write: 書き込む間だけファイルの排他ロックを取るか。root_connection を指定する場合は使えない
+            write_lock_timeout_seconds: lock_on_write の場合に、他のプロセスがファイルを開いていて
+                排他ロックが取れないときに再試行する秒数
+        """
+        if pool_size < 1:
+            raise ValueError(f"pool_size must be >= 1: {pool_size}")
+        if lock_on_write and (read_only or root_connection is not None):
+            raise ValueError("lock_on_write cannot be combined with read_only or root_connection")
+        self.db_path = str(db_path)
+        self.pool_size = pool_size
+        self.read_only = read_only
+        self.lock_on_write = lock_on_write and self.db_path != ":memory:"
+        self.generation = 0
+        self._acquire_timeout_seconds = acquire_timeout_seconds
+        self._write_lock_timeout_seconds = write_lock_timeout_seconds
+        self._cursor_init_sql = cursor_init_sql or []
+
+        self._access = _SharedExclusiveLock()
+        self._open_cursors: list[duckdb.DuckDBPyConnection] = []
+        self._idle_cursors: queue.LifoQueue[duckdb.DuckDBPyConnection] = queue.LifoQueue(maxsize=pool_size)
+        self._root_conn = root_connection or self._connect(writable=not (read_only or self.lock_on_write))
+        self._fill_pool()
+        self._write_lock = threading.Lock()
+        self._closed = False
+        logger.debug(
+            f"Opened DuckDB connection pool: {self.db_path} "
+            f"(pool_size={pool_size}, read_only={read_only}, lock_on_write={self.lock_on_write})"
+        )
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    @property
+    def opened_read_only(self) -> bool:
+        """参照用のカーソルが読み取り専用のコネクションから作られているか(DDLを発行できないか)"""
+        return self.read_only or self.lock_on_write
+
+    @contextmanager
+    def read_cursor(self) -> Iterator[duckdb.DuckDBPyConnection]:
+        """参照系のクエリ用に、READ ONLY トランザクションを開始したカーソルを貸し出す"""
+        with self._access.shared():
+            cursor = self._acquire()
+            failed = False
+            try:
+                cursor.execute("BEGIN TRANSACTION READ ONLY")
+                yield cursor
+            except duckdb.Error:
+                failed = True
+                raise
+            finally:
+                self._finish_transaction(cursor, commit=False)
+                self._release(cursor, check_health=failed)
+
+    @contextmanager
+    def write_cursor(self) -> Iterator[duckdb.DuckDBPyConnection]:
+        """更新系のクエリ用のカーソルを貸し出す。書き込みは1つずつ直列化し、正常終了時にcommitする"""
+        if self.read_only:
+            raise PermissionError(f"Connection pool is opened in read-only mode: {self.db_path}")
+        with self._write_lock:
+            if not self.lock_on_write:
+                with self._transaction() as cursor:
+                    yield cursor
+                return
+            with self._access.exclusive(), self._writable(), self._transaction() as cursor:
+                yield cursor
+
+    @contextmanager
+    def cursor(self) -> Iterator[duckdb.DuckDBPyConnection]:
+        """トランザクションを張らずにカーソルを貸し出す(DDLやライブラリにコネクションを渡す場合用)"""
+        with self._access.shared():
+            cursor = self._acquire()
+            failed = False
+            try:
+                yield cursor
+            except duckdb.Error:
+                failed = True
+                raise
+            finally:
+                self._release(cursor, check_health=failed)
+
+    def open_cursor(self) -> duckdb.DuckDBPyConnection:
+        """プールとは別に、呼び出し側が専有する長寿命のカーソルを作る。不要になったら呼び出し側でcloseすること。
+        (このマネージャをcloseするとルートコネクションごと使えなくなる)
+
+        lock_on_write の場合、カーソルは書き込みのたびに閉じられるので、使う間は `shared_access()` を取り、
+        `generation` が変わっていたら作り直すこと。
+        """
+        if self._closed:
+            raise RuntimeError(f"Connection pool is already closed: {self.db_path}")
+        with self._access.shared():
+            cursor = self._new_cursor()
+            if self.lock_on_write:
+                self._open_cursors.append(cursor)
+        return cursor
+
+    @contextmanager
+    def shared_access(self) -> Iterator[None]:
+        """`open_cursor()` で作ったカーソルを使う間に取る共有ロック。書き込みのために開き直す間は待たされる"""
+        with self._access.shared():
+            yield
+
+    def checkpoint(self) -> None:
+        """WALの内容をDBファイル本体に書き出す。ファイルをS3等にアップロードする前に呼ぶ
+        (lock_on_write の場合は書き込みのたびに書き出し済み)
+        """
+        if self.opened_read_only:
+            return
+        with self._write_lock, self.cursor() as cursor:
+            cursor.execute("CHECKPOINT")
+
+    def health_check(self) -> bool:
+        """アイドル状態のカーソルで疎通確認を行い、壊れているカーソルは新しいものに差し替える
+
+        Returns:
+            bool: ルートコネクションが正常に応答すればTrue
+        """
+        if self._closed:
+            return False
+        with self._access.shared():
+            try:
+                self._root_conn.execute("SELECT 1").fetchone()
+            except duckdb.Error as e:
+                logger.error(f"DuckDB health check failed: {self.db_path}: {e}")
+                return False
+
+            checked = []
+            while True:
+                try:
+                    checked.append(self._idle_cursors.get_nowait())
+                except queue.Empty:
+                    break
+            for cursor in checked:
+                self._release(cursor, check_health=True)
+        return True
+
+    def close(self) -> None:
+        """プール内のカーソルとルートコネクションを閉じる。貸し出し中のカーソルは返却時に閉じられる"""
+        if self._closed:
+            return
+        self._closed = True
+        while True:
+            try:
+                self._idle_cursors.get_nowait().close()
+            except queue.Empty:
+                break
+        self._root_conn.close()
+        logger.debug(f"Closed DuckDB connection pool: {self.db_path}")
+
+    def __enter__(self) -> "DuckDBConnectionManager":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _acquire(self) -> duckdb.DuckDBPyConnection:
+        if self._closed:
+            raise RuntimeError(f"Connection pool is already closed: {self.db_path}")
+        try:
+            return self._idle_cursors.get(timeout=self._acquire_timeout_seconds)
+        except queue.Empty as e:
+            raise ConnectionPoolTimeoutError(
+                f"Timed out waiting for a DuckDB cursor ({self._acquire_timeout_seconds}s): {self.db_path}"
+            ) from e
+
+    def _release(self, cursor: duckdb.DuckDBPyConnection, check_health: bool = False) -> None:
+        """カーソルをプールに戻す。疎通確認は、利用中にDuckDBのエラーが起きた場合と health_check() の時だけ行う"""
+        if self._closed:
+            cursor.close()
+            return
+        if check_health and not self._is_healthy(cursor):
+            logger.warning(f"Replacing broken DuckDB cursor: {self.db_path}")
+            cursor.close()
+            cursor = self._new_cursor()
+        self._idle_cursors.put_nowait(cursor)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[duckdb.DuckDBPyConnection]:
+        cursor = self._acquire()
+        failed = False
+        try:
+            cursor.execute("BEGIN TRANSACTION")
+            try:
+                yield cursor
+            except BaseException:
+                self._finish_transaction(cursor, commit=False)
+                raise
+            self._finish_transaction(cursor, commit=True)
+        except duckdb.Error:
+            failed = True
+            raise
+        finally:
+            self._release(cursor, check_health=failed)
+
+    @contextmanager
+    def _writable(self) -> Iterator[None]:
+        """ファイルを読み書き可能で開き直し、抜ける時に変更を書き出して読み取り専用で開き直す(排他ロック下で呼ぶ)"""
+        if self._closed:
+            raise RuntimeError(f"Connection pool is already closed: {self.db_path}")
+        self._close_connections()
+        try:
+            self._root_conn = self._connect_with_retry()
+        except BaseException:
+            self._root_conn = self._connect(writable=False)
+            self._fill_pool()
+            raise
+        self._fill_pool()
+        try:
+            yield
+        finally:
+            try:
+                self._root_conn.execute("CHECKPOINT")
+            finally:
+                self._close_connections()
+                self._root_conn = self._connect(writable=False)
+                self._fill_pool()
+
+    def _connect_with_retry(self) -> duckdb.DuckDBPyConnection:
+        """他のプロセスが同じファイルを開いている間は排他ロックが取れないので、一定時間再試行する"""
+        deadline = time.monotonic() + self._write_lock_timeout_seconds
+        delay = 0.05
+        while True:
+            try:
+                return self._connect(writable=True)
+            except duckdb.IOException as e:
+                if "lock" not in str(e).lower() or time.monotonic() + delay > deadline:
+                    raise
+                logger.debug(f"Waiting for the write lock on {self.db_path}: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+
+    def _connect(self, writable: bool) -> duckdb.DuckDBPyConnection:
+        if not writable and self.lock_on_write and not Path(self.db_path).exists():
+            # 読み取り専用では存在しないファイルを開けないので、空のDBファイルを作っておく
+            duckdb.connect(self.db_path).close()
+        return duckdb.connect(self.db_path, read_only=not writable)
+
+    def _fill_pool(self) -> None:
+        for _ in range(self.pool_size):
+            self._idle_cursors.put_nowait(self._new_cursor())
+
+    def _close_connections(self) -> None:
+        """ルートコネクションとそこから作った全てのカーソルを閉じる(DuckDBは全て閉じるまでファイルを開き直せない)"""
+        while True:
+            try:
+                self._idle_cursors.get_nowait().close()
+            except queue.Empty:
+                break
+        open_cursors, self._open_cursors = self._open_cursors, []
+        for cursor in open_cursors:
+            cursor.close()
+        self._root_conn.close()
+        self.generation += 1
+
+    def _new_cursor(self) -> duckdb.DuckDBPyConnection:
+        cursor = self._root_conn.cursor()
+        for sql in self._cursor_init_sql:
+            cursor.execute(sql)
+        return cursor
+
+    def _finish_transaction(self, cursor: duckdb.DuckDBPyConnection, commit: bool) -> None:
+        if commit:
+            cursor.execute("COMMIT")
+            return
+        try:
+            cursor.execute("ROLLBACK")
+        except duckdb.TransactionException:
+            # トランザクションが既に終了している場合(例: 利用側でCOMMIT済み)は何もしない
+            pass
+
+    @staticmethod
+    def _is_healthy(cursor: duckdb.DuckDBPyConnection) -> bool:
+        try:
+            cursor.execute("SELECT 1").fetchone()
+            return True
+        except duckdb.Error:
+            return False
+
+
+class _SharedExclusiveLock:
+    """共有(参照)と排他(ファイルの開き直し)の2種類のロック。排他ロックを待つ間は新しい共有ロックも待たせる"""
+
+    def __init__(self) -> None:
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+        self._reader_threads: dict[int, int] = {}
+
+    @contextmanager
+    def shared(self) -> Iterator[None]:
+        thread_id = threading.get_ident()
+        with self._condition:
+            # 同じスレッドが共有ロックを入れ子で取る場合は、排他ロックを待つ側がいても待たせない(デッドロックを避ける)
+            if not self._reader_threads.get(thread_id):
+                self._condition.wait_for(lambda: not self._writer and not self._writers_waiting)
+            self._readers += 1
+            self._reader_threads[thread_id] = self._reader_threads.get(thread_id, 0) + 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                self._reader_threads[thread_id] -= 1
+                if not self._reader_threads[thread_id]:
+                    del self._reader_threads[thread_id]
+                self._condition.notify_all()
+
+    @contextmanager
+    def exclusive(self) -> Iterator[None]:
+        with self._condition:
+            self._writers_waiting += 1
+            try:
+                self._condition.wait_for(lambda: not self._writer and not self._readers)
+            finally:
+                self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer = False
+                self._condition.notify_all()
+
+
+# 以下はプロセス全体で共有するコネクションマネージャのレジストリ
+_managers: dict[str, DuckDBConnectionManager] = {}
+_managers_lock = threading.Lock()
+
+
+def get_connection_manager(
+    db_path: str | Path,
+    pool_size: int = 4,
+    read_only: bool = False,
+    lock_on_write: bool = False,
+) -> DuckDBConnectionManager:
+    """DBファイルごとに1つのコネクションマネージャを返す。同じファイルを扱うリポジトリ間で共有される
+
+    DuckDBは同一プロセス内で同じファイルを異なる設定で開けないため、既存のマネージャと
+    read_only / lock_on_write が異なる場合はエラーにする。pool_size が異なる場合は既存のマネージャの
+    pool_size のまま共有する(警告を出す)
+    """
+    key = _normalize_db_path(db_path)
+    with _managers_lock:
+        manager = _managers.get(key)
+        if manager is not None and not manager.closed:
+            if (manager.read_only, manager.lock_on_write) != (read_only, lock_on_write):
+                raise ValueError(
+                    f"{key} is already opened with read_only={manager.read_only}, "
+                    f"lock_on_write={manager.lock_on_write}, "
+                    f"but read_only={read_only}, lock_on_write={lock_on_write} is requested"
+                )
+            if manager.pool_size != pool_size:
+                logger.warning(
+                    f"{key} is already opened with pool_size={manager.pool_size}; "
+                    f"ignoring the requested pool_size={pool_size}"
+                )
+            return manager
+        manager = DuckDBConnectionManager(key, pool_size=pool_size, read_only=read_only, lock_on_write=lock_on_write)
+        _managers[key] = manager
+        return manager
+
+
+def close_connection_manager(db_path: str | Path) -> None:
+    """指定したDBファイルのコネクションマネージャを閉じてレジストリから外す(ファイルを差し替える前などに使う)"""
+    key = _normalize_db_path(db_path)
+    with _managers_lock:
+        manager = _managers.pop(key, None)
+    if manager is not None:
+        manager.close()
+
+
+def close_all_connection_managers() -> None:
+    """レジストリ内の全てのコネクションマネージャを閉じる。プロセス終了時に自動で呼ばれる"""
+    with _managers_lock:
+        managers = list(_managers.values())
+        _managers.clear()
+    for manager in managers:
+        manager.close()
+
+
+def _normalize_db_path(db_path: str | Path) -> str:
+    if str(db_path) == ":memory:":
+        return ":memory:"
+    return str(Path(db_path).resolve())
+
+
+atexit.register(close_all_connection_managers)
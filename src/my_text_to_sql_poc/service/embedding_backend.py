@@ -0,0 +1,168 @@
+import threading
+from typing import Literal
+
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+from loguru import logger
+from pydantic import BaseModel, Field, model_validator
+
+from my_text_to_sql_poc.service.batch_embedding import (
+    DEFAULT_MAX_CONCURRENT_REQUESTS,
+    DEFAULT_MAX_TEXTS_PER_REQUEST,
+    DEFAULT_MAX_TOKENS_PER_REQUEST,
+    BatchEmbedder,
+    token_counter_for,
+)
+
+EmbeddingBackend = Literal["openai", "sentence_transformers"]
+# sentence-transformers の推論方式。onnx_int8 は動的量子化済みのONNXファイルを使う
+SentenceTransformerRuntime = Literal["torch", "onnx", "onnx_int8"]
+
+DEFAULT_MODEL_NAME_BY_BACKEND: dict[EmbeddingBackend, str] = {
+    "openai": "text-embedding-3-small",
+    "sentence_transformers": "intfloat/multilingual-e5-small",
+}
+# onnx_int8 で onnx_file_name を指定しない場合に読み込む、モデルのリポジトリ内のファイル
+DEFAULT_QUANTIZED_ONNX_FILE_NAME = "onnx/model_qint8_avx2.onnx"
+
+
+class EmbeddingSettings(BaseModel):
+    """埋め込みモデルの設定。backend=sentence_transformers の場合は、ネットワーク越しの問い合わせ無しにローカルのCPUで埋め込む"""
+
+    backend: EmbeddingBackend = Field(default="openai", description="埋め込みのバックエンド")
+    model_name: str | None = Field(default=None, description="モデル名。指定しない場合はバックエンドごとの既定のモデル")
+    batch_size: int = Field(default=32, ge=1, description="sentence_transformers で1回の推論にまとめるテキスト数")
+    num_threads: int | None = Field(
+        default=None,
+        ge=1,
+        description="sentence_transformers の推論スレッド数。指定しない場合はライブラリの既定(全コア)",
+    )
+    runtime: SentenceTransformerRuntime = Field(default="torch", description="sentence_transformers の推論方式")
+    onnx_file_name: str | None = Field(default=None, description="runtime=onnx/onnx_int8 で読み込むONNXファイル")
+    query_prefix: str = Field(default="query: ", description="sentence_transformers で質問の前に付ける文字列(e5系向け)")
+    document_prefix: str = Field(
+        default="passage: ", description="sentence_transformers でドキュメントの前に付ける文字列(e5系向け)"
+    )
+    max_tokens_per_request: int = Field(
+        default=DEFAULT_MAX_TOKENS_PER_REQUEST, ge=1, description="一括登録時に1リクエストにまとめるトークン数の上限"
+    )
+    max_texts_per_request: int = Field(
+        default=DEFAULT_MAX_TEXTS_PER_REQUEST, ge=1, description="一括登録時に1リクエストにまとめるテキスト数の上限"
+    )
+    max_concurrent_requests: int = Field(
+        default=DEFAULT_MAX_CONCURRENT_REQUESTS, ge=1, description="一括登録時に並行に投げるリクエスト数の上限"
+    )
+
+    @model_validator(mode="after")
+    def _fill_default_model_name(self) -> "EmbeddingSettings":
+        if self.model_name is None:
+            self.model_name = DEFAULT_MODEL_NAME_BY_BACKEND[self.backend]
+        return self
+
+    @property
+    def cache_key(self) -> str:
+        """埋め込みキャッシュのキーに使うモデルの識別子。推論方式が違えばベクトルも変わるので区別する"""
+        if self.backend == "openai":
+            return self.model_name
+        return f"{self.backend}:{self.model_name}:{self.runtime}"
+
+
+class SentenceTransformerEmbeddings(Embeddings):
+    """sentence-transformers のモデルでローカルに埋め込むEmbeddings。
+
+    モデルはプロセス内で設定ごとに1つだけ読み込んで共有する(`warm_up_embeddings()` で事前に読み込める)。
+    埋め込みは正規化して返すので、内積がそのままコサイン類似度になる。
+    """
+
+    def __init__(self, settings: EmbeddingSettings) -> None:
+        self.settings = settings
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._encode([self.settings.document_prefix + text for text in texts])
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._encode([self.settings.query_prefix + text])[0]
+
+    def _encode(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        model = get_sentence_transformer(self.settings)
+        embeddings = model.encode(
+            texts,
+            batch_size=self.settings.batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+        return embeddings.tolist()
+
+
+def create_embeddings(settings: EmbeddingSettings) -> Embeddings:
+    if settings.backend == "openai":
+        return OpenAIEmbeddings(model=settings.model_name)
+    if settings.backend == "sentence_transformers":
+        return SentenceTransformerEmbeddings(settings)
+    raise ValueError(f"Unknown embedding backend: {settings.backend}")
+
+
+_model_by_key: dict[tuple, object] = {}
+_model_lock = threading.Lock()
+
+
+def get_sentence_transformer(settings: EmbeddingSettings):
+    """設定ごとに1つだけ読み込んだ SentenceTransformer を返す"""
+    key = (settings.model_name, settings.runtime, settings.onnx_file_name, settings.num_threads)
+    model = _model_by_key.get(key)
+    if model is None:
+        with _model_lock:
+            model = _model_by_key.get(key)
+            if model is None:
+                model = _load_sentence_transformer(settings)
+                _model_by_key[key] = model
+    return model
+
+
+def warm_up_embeddings(settings: EmbeddingSettings) -> None:
+    """ローカルの埋め込みモデルを読み込んでおく(最初の質問でモデルの読み込みを待たせないため)。OpenAIの場合は何もしない"""
+    if settings.backend == "sentence_transformers":
+        get_sentence_transformer(settings)
+
+
+def create_batch_embedder(embeddings: Embeddings, settings: EmbeddingSettings) -> BatchEmbedder:
+    """一括登録用に、設定に応じたトークン数の数え方とバッチの上限で埋め込むBatchEmbedderを作る"""
+    return BatchEmbedder(
+        embeddings,
+        # ローカルのモデルはリクエストの上限が無いので、トークン化のコストをかけずにバイト数で数える
+        count_tokens=token_counter_for(settings.model_name) if settings.backend == "openai" else None,
+        max_tokens_per_request=settings.max_tokens_per_request,
+        max_texts_per_request=settings.max_texts_per_request,
+        max_concurrent_requests=settings.max_concurrent_requests,
+    )
+
+
+def _load_sentence_transformer(settings: EmbeddingSettings):
+    # sentence-transformers(とtorch)の読み込みは重いので、ローカルの埋め込みを使う場合にだけimportする
+    from sentence_transformers import SentenceTransformer
+
+    logger.info(f"Loading sentence-transformers model: {settings.model_name} (runtime={settings.runtime})")
+    if settings.runtime == "torch":
+        if settings.num_threads is not None:
+            import torch
+
+            # torchのスレッド数はプロセス全体の設定
+            torch.set_num_threads(settings.num_threads)
+        return SentenceTransformer(settings.model_name, device="cpu")
+
+    model_kwargs: dict = {"provider": "CPUExecutionProvider"}
+    onnx_file_name = settings.onnx_file_name
+    if onnx_file_name is None and settings.runtime == "onnx_int8":
+        onnx_file_name = DEFAULT_QUANTIZED_ONNX_FILE_NAME
+    if onnx_file_name is not None:
+        model_kwargs["file_name"] = onnx_file_name
+    if settings.num_threads is not None:
+        import onnxruntime
+
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = settings.num_threads
+        model_kwargs["session_options"] = session_options
+    return SentenceTransformer(settings.model_name, device="cpu", backend="onnx", model_kwargs=model_kwargs)
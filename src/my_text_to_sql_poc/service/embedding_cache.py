@@ -0,0 +1,227 @@
+import hashlib
+import json
+import threading
+import time
+import unicodedata
+from pathlib import Path
+from typing import Literal
+
+import duckdb
+from langchain_core.embeddings import Embeddings
+from loguru import logger
+
+from my_text_to_sql_poc.service.cache import CacheStats
+from my_text_to_sql_poc.service.duckdb_connection import DuckDBConnectionManager, get_connection_manager
+from my_text_to_sql_poc.service.s3_store import DEFAULT_STORE_CACHE_DIR
+
+DEFAULT_EMBEDDING_CACHE_PATH = DEFAULT_STORE_CACHE_DIR / "embedding_cache.duckdb"
+
+EmbeddingKind = Literal["query", "document"]
+
+
+def normalize_text(text: str) -> str:
+    """全角/半角の揺れ(NFKC)と、前後・連続する空白の違いを吸収する"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode()).hexdigest()
+
+
+class CachedEmbeddings(Embeddings):
+    """埋め込みモデルの前段に置く、ローカルのDuckDBファイルに永続化する埋め込みキャッシュ。
+
+    キーは (モデル名, query/document の別, 正規化したテキストのハッシュ)。
+    件数が max_entries を超えたら、最後に参照された時刻が古いものから追い出す(LRU)。
+
+    ファイルは普段は読み取り専用で開き、キャッシュを引く間は書き込みロックを取らない。
+    ヒットした埋め込みの最終参照時刻はメモリに溜めておき、次に埋め込みを登録する時(または件数が
+    access_flush_threshold に達した時)にまとめて書き込む。
+    他のプロセスがファイルを開いていて排他ロックが取れない場合は、警告を出してキャッシュを使わずに埋め込む。
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        model_name: str,
+        cache_path: str | Path = DEFAULT_EMBEDDING_CACHE_PATH,
+        max_entries: int = 100_000,
+        access_flush_threshold: int = 1024,
+    ) -> None:
+        if max_entries < 1:
+            raise ValueError(f"max_entries must be >= 1: {max_entries}")
+        self._embeddings = embeddings
+        self.model_name = model_name
+        self.cache_path = Path(cache_path)
+        self.max_entries = max_entries
+        self.access_flush_threshold = access_flush_threshold
+        self.disabled = False
+        self._lock = threading.Lock()
+        # カウンタと未反映の最終参照時刻は複数のスレッドから更新されるので、self._lock の下で更新する
+        self._stats = CacheStats()
+        self._pending_access: dict[tuple[EmbeddingKind, str], float] = {}
+        self._connections: DuckDBConnectionManager | None = None
+
+    @property
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return self._stats.model_copy()
+
+    @property
+    def connections(self) -> DuckDBConnectionManager:
+        if self._connections is None or self._connections.closed:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            self._connections = get_connection_manager(self.cache_path, lock_on_write=True)
+            with self._connections.write_cursor() as cursor:
+                cursor.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS embedding_cache (
+                        model_name TEXT,
+                        kind TEXT,
+                        text_hash TEXT,
+                        embedding FLOAT[],
+                        last_accessed_at DOUBLE,
+                        PRIMARY KEY (model_name, kind, text_hash)
+                    )
+                    """
+                )
+        return self._connections
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._embed(texts, kind="document")
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed([text], kind="query")[0]
+
+    def flush_access_times(self) -> None:
+        """メモリに溜めている最終参照時刻をキャッシュのファイルに書き込む"""
+        if self.disabled:
+            return
+        try:
+            with self.connections.write_cursor() as cursor:
+                self._write_access_times(cursor)
+        except (duckdb.IOException, duckdb.ConnectionException) as e:
+            self._disable(e)
+
+    def _embed(self, texts: list[str], kind: EmbeddingKind) -> list[list[float]]:
+        if self.disabled:
+            return self._embed_uncached(texts, kind)
+        hashes = [text_hash(text) for text in texts]
+        try:
+            embedding_by_hash = self._lookup(list(dict.fromkeys(hashes)), kind)
+        except (duckdb.IOException, duckdb.ConnectionException) as e:
+            self._disable(e)
+            return self._embed_uncached(texts, kind)
+
+        # 同じテキストが複数回含まれていても、モデルには1回だけ問い合わせる
+        missing_text_by_hash = {h: text for h, text in zip(hashes, texts) if h not in embedding_by_hash}
+        misses = sum(1 for h in hashes if h in missing_text_by_hash)
+        with self._lock:
+            self._stats.hits += len(texts) - misses
+            self._stats.misses += misses
+        if missing_text_by_hash:
+            new_embeddings = self._embed_uncached(list(missing_text_by_hash.values()), kind)
+            new_embedding_by_hash = dict(zip(missing_text_by_hash, new_embeddings))
+            try:
+                self._store(new_embedding_by_hash, kind)
+            except (duckdb.IOException, duckdb.ConnectionException) as e:
+                self._disable(e)
+            embedding_by_hash.update(new_embedding_by_hash)
+        elif self._pending_access_count() >= self.access_flush_threshold:
+            self.flush_access_times()
+
+        return [embedding_by_hash[h] for h in hashes]
+
+    def _embed_uncached(self, texts: list[str], kind: EmbeddingKind) -> list[list[float]]:
+        if kind == "query":
+            return [self._embeddings.embed_query(text) for text in texts]
+        return self._embeddings.embed_documents(texts)
+
+    def _disable(self, error: Exception) -> None:
+        """ロックが取れないなどでキャッシュのファイルを使えない場合は、以降はキャッシュせずに埋め込む"""
+        self.disabled = True
+        logger.warning(f"Embedding cache is disabled because {self.cache_path} is not available: {error}")
+
+    def _lookup(self, hashes: list[str], kind: EmbeddingKind) -> dict[str, list[float]]:
+        """キャッシュ済みの埋め込みを読み取り専用で引き、見つかったものの最終参照時刻をメモリに溜める"""
+        with self.connections.read_cursor() as cursor:
+            rows = cursor.execute(
+                """
+                SELECT text_hash, embedding FROM embedding_cache
+                WHERE model_name = ? AND kind = ? AND text_hash IN (SELECT unnest(from_json(?, '["VARCHAR"]')))
+                """,
+                (self.model_name, kind, json.dumps(hashes)),
+            ).fetchall()
+        if rows:
+            now = time.time()
+            with self._lock:
+                self._pending_access.update({(kind, hash_): now for hash_, _ in rows})
+        return {hash_: list(embedding) for hash_, embedding in rows}
+
+    def _pending_access_count(self) -> int:
+        with self._lock:
+            return len(self._pending_access)
+
+    def _write_access_times(self, cursor: duckdb.DuckDBPyConnection) -> None:
+        with self._lock:
+            pending_access, self._pending_access = self._pending_access, {}
+        if not pending_access:
+            return
+        try:
+            # UPDATE ... FROM の副問い合わせで from_json を使うと、DuckDBがコミット時に内部エラーになるのでリストで渡す
+            cursor.execute(
+                """
+                UPDATE embedding_cache SET last_accessed_at = accessed.last_accessed_at
+                FROM (
+                    SELECT unnest(?::VARCHAR[]) AS kind,
+                        unnest(?::VARCHAR[]) AS text_hash,
+                        unnest(?::DOUBLE[]) AS last_accessed_at
+                ) AS accessed
+                WHERE embedding_cache.model_name = ?
+                    AND embedding_cache.kind = accessed.kind
+                    AND embedding_cache.text_hash = accessed.text_hash
+                """,
+                (
+                    [kind for kind, _ in pending_access],
+                    [hash_ for _, hash_ in pending_access],
+                    list(pending_access.values()),
+                    self.model_name,
+                ),
+            )
+        except BaseException:
+            # 書き込めなかった分は次の機会に書き込む(その間に参照されたものは新しい時刻を優先する)
+            with self._lock:
+                self._pending_access = {**pending_access, **self._pending_access}
+            raise
+
+    def _store(self, embedding_by_hash: dict[str, list[float]], kind: EmbeddingKind) -> None:
+        with self.connections.write_cursor() as cursor:
+            # 追い出す順番が正しくなるよう、溜めている最終参照時刻を先に反映する
+            self._write_access_times(cursor)
+            # executemanyは1行ずつ実行されて遅いので、JSONで渡して1回のINSERTで登録する
+            cursor.execute(
+                """
+                INSERT OR REPLACE INTO embedding_cache
+                SELECT ?, ?, unnest(from_json(?, '["VARCHAR"]')), unnest(from_json(?, '[["FLOAT"]]')), ?
+                """,
+                (
+                    self.model_name,
+                    kind,
+                    json.dumps(list(embedding_by_hash)),
+                    json.dumps(list(embedding_by_hash.values())),
+                    time.time(),
+                ),
+            )
+            overflow = cursor.execute("SELECT count(*) FROM embedding_cache").fetchone()[0] - self.max_entries
+            if overflow > 0:
+                cursor.execute(
+                    """
+                    DELETE FROM embedding_cache WHERE (model_name, kind, text_hash) IN (
+                        SELECT (model_name, kind, text_hash) FROM embedding_cache ORDER BY last_accessed_at LIMIT ?
+                    )
+                    """,
+                    (overflow,),
+                )
+                with self._lock:
+                    self._stats.evictions += overflow
+                logger.debug(f"Evicted {overflow} entries from embedding cache: {self.cache_path}")
@@ -0,0 +1,345 @@
+import hashlib
+import json
+import math
+import threading
+from pathlib import Path
+from typing import Literal
+
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from loguru import logger
+
+from my_text_to_sql_poc.service.repository import (
+    DuckDBVectorStoreRepository,
+    VectorStoreRepositoryInterface,
+    document_from_row,
+)
+from my_text_to_sql_poc.service.s3_store import atomic_write_bytes
+from my_text_to_sql_poc.service.vector_filter import DocumentAttributes, VectorSearchFilter
+
+FaissIndexType = Literal["flat", "ivf", "hnsw"]
+
+
+class FaissIndexParams:
+    """索引の種類ごとのパラメータ"""
+
+    def __init__(
+        self,
+        ivf_nlist: int = 1024,
+        ivf_nprobe: int = 16,
+        ivf_retrain_growth: float = 4.0,
+        hnsw_m: int = 32,
+        hnsw_ef_search: int = 64,
+        hnsw_max_stale_fraction: float = 0.2,
+    ) -> None:
+        """
+        Args:
+            ivf_nlist: IVFのクラスタ数の上限(実際にはドキュメント数の平方根を上限に小さくする)
+            ivf_nprobe: IVFで検索時に探索するクラスタ数
+            ivf_retrain_growth: IVFの索引のドキュメント数が、クラスタを学習した時点の何倍になったら学習し直すか
+            hnsw_m: HNSWの各ノードの近傍数
+            hnsw_ef_search: HNSWの検索時の探索幅
+            hnsw_max_stale_fraction: HNSWの索引に残っている削除済みのベクトルの割合がこれを超えたら索引を作り直す
+        """
+        self.ivf_nlist = ivf_nlist
+        self.ivf_nprobe = ivf_nprobe
+        self.ivf_retrain_growth = ivf_retrain_growth
+        self.hnsw_m = hnsw_m
+        self.hnsw_ef_search = hnsw_ef_search
+        self.hnsw_max_stale_fraction = hnsw_max_stale_fraction
+
+
+class _FaissTable:
+    """1つのベクトルテーブルに対するFAISSの索引と、索引のIDからドキュメントへの対応。
+
+    索引は IndexIDMap2 で、DuckDBの行のIDから決まるID(`_faiss_id`)でベクトルを登録するので、
+    upsertで置き換えられた行は個別に消して追加し直せる。
+    HNSWはベクトルを消せないので、削除された行のIDは stale_ids に残して検索時に除外する。
+    FAISSの索引は検索中の追加・削除に対してスレッドセーフではないので、いずれも lock の下で行う。
+    """
+
+    def __init__(self, index: faiss.IndexIDMap2, trained_size: int, removable: bool) -> None:
+        self.index = index
+        # IVFのクラスタを学習した時点のドキュメント数
+        self.trained_size = trained_size
+        self.removable = removable
+        # 索引のID -> (DuckDBの行のID, 本文, メタデータ)
+        self.documents: dict[int, tuple[str, str, str | None]] = {}
+        self.stale_ids: set[int] = set()
+        self.lock = threading.Lock()
+
+    @property
+    def row_ids(self) -> list[str]:
+        return [row_id for row_id, _, _ in self.documents.values()]
+
+    def add(self, ids: list[str], matrix: np.ndarray, texts: list[str], metadatas: list[str | None]) -> None:
+        faiss_ids = [_faiss_id(id_) for id_ in ids]
+        with self.lock:
+            self.index.add_with_ids(_normalize_rows(matrix), np.asarray(faiss_ids, dtype=np.int64))
+            self.documents.update(zip(faiss_ids, zip(ids, texts, metadatas)))
+
+    def remove(self, ids: list[str]) -> None:
+        faiss_ids = [_faiss_id(id_) for id_ in ids]
+        with self.lock:
+            if self.removable:
+                self.index.remove_ids(np.asarray(faiss_ids, dtype=np.int64))
+            else:
+                self.stale_ids.update(faiss_ids)
+            for faiss_id in faiss_ids:
+                self.documents.pop(faiss_id, None)
+
+    def search(self, matrix: np.ndarray, k: int) -> list[list[tuple[str, str | None, float]]]:
+        """検索ベクトルごとの、類似度の降順の (本文, メタデータ, 類似度) のリスト"""
+        with self.lock:
+            if self.stale_ids:
+                params = faiss.SearchParametersHNSW(
+                    sel=faiss.IDSelectorNot(faiss.IDSelectorBatch(np.fromiter(self.stale_ids, dtype=np.int64))),
+                    efSearch=faiss.downcast_index(self.index.index).hnsw.efSearch,
+                )
+                scores, faiss_ids = self.index.search(matrix, k, params=params)
+            else:
+                scores, faiss_ids = self.index.search(matrix, k)
+            documents = self.documents
+            # 件数が足りない場合、FAISSは -1 を返す
+            return [
+                [
+                    (documents[faiss_id][1], documents[faiss_id][2], float(score))
+                    for faiss_id, score in zip(row_ids, row_scores)
+                    if faiss_id in documents
+                ]
+                for row_ids, row_scores in zip(faiss_ids.tolist(), scores.tolist())
+            ]
+
+
+class FaissVectorStoreRepository(VectorStoreRepositoryInterface):
+    """DuckDBのベクトルストアの埋め込みを、テーブルごとのFAISSの索引で検索するリポジトリ。
+
+    - 索引の種類: flat(総当たり) / ivf(クラスタリングで探索範囲を絞る) / hnsw(近傍グラフ)。いずれも内積(正規化済み=コサイン類似度)
+    - 索引はDuckDBのストアと同じディレクトリに `{ストア名}.{テーブル名}.{索引の種類}.faiss` として保存し、次回起動時は読み込むだけで済む
+    - 書き込みはDuckDBのストアに委譲し、索引にはDuckDBにあって索引に無いドキュメントだけを追加し、
+      upsertで置き換えられて消えた行は索引からも消す
+    - IVFはドキュメント数がクラスタを学習した時点の ivf_retrain_growth 倍になったら、HNSWは削除済みのベクトルが
+      hnsw_max_stale_fraction を超えたら索引を作り直す
+    """
+
+    def __init__(
+        self,
+        repository: DuckDBVectorStoreRepository,
+        index_type: FaissIndexType = "hnsw",
+        index_dir: Path | None = None,
+        params: FaissIndexParams | None = None,
+    ) -> None:
+        """
+        Args:
+            index_dir: 索引の保存先。指定しない場合はDuckDBのストアと同じディレクトリ
+                (レンジリードで開いたストアにはローカルのファイルが無いので、指定が必要)
+        """
+        self._repository = repository
+        self.index_type = index_type
+        self._index_dir = index_dir
+        self.params = params or FaissIndexParams()
+        self._tables: dict[str, _FaissTable] = {}
+        self._lock = threading.Lock()
+
+    def retrieve_relevant_docs(
+        self, question: str, table_name: str, k: int = 5, search_filter: VectorSearchFilter | None = None
+    ) -> list:
+        return self.retrieve_relevant_docs_by_vector(
+            self.embed_query(question), table_name, k=k, search_filter=search_filter
+        )
+
+    def embed_query(self, question: str) -> list[float]:
+        return self._repository.embed_query(question)
+
+    def retrieve_relevant_docs_by_vector(
+        self,
+        embedding: list[float],
+        table_name: str,
+        k: int = 5,
+        search_filter: VectorSearchFilter | None = None,
+    ) -> list:
+        """search_filter を指定した場合は、FAISSの索引ではなく、絞り込んでから類似度を計算するDuckDBのストアで検索する"""
+        if search_filter is not None and not search_filter.is_empty():
+            return self._repository.retrieve_relevant_docs_by_vector(
+                embedding, table_name, k=k, search_filter=search_filter
+            )
+        return self.retrieve_relevant_docs_by_vectors([embedding], table_name, k=k)[0]
+
+    def retrieve_relevant_docs_by_vectors(
+        self, embeddings: list[list[float]], table_name: str, k: int = 5
+    ) -> list[list[Document]]:
+        """複数の検索ベクトルをまとめて検索する
+
+        Returns:
+            list[list[Document]]: 検索ベクトルごとの、類似度の降順のドキュメントのリスト
+        """
+        table = self._table(table_name)
+        if table is None or table.index.ntotal == 0:
+            return [[] for _ in embeddings]
+        rows = table.search(_normalize_rows(np.asarray(embeddings, dtype=np.float32)), k)
+        return [[document_from_row(text, metadata, score) for text, metadata, score in row] for row in rows]
+
+    def put(self, doc_id: str, document: str, table_name: str, attributes: DocumentAttributes | None = None) -> None:
+        self._repository.put(doc_id, document, table_name, attributes)
+        self.sync(table_name)
+
+    def put_bulk(
+        self,
+        docs: list[tuple[str, str]],
+        table_name: str,
+        attributes_by_doc_id: dict[str, DocumentAttributes] | None = None,
+    ) -> None:
+        self._repository.put_bulk(docs, table_name, attributes_by_doc_id)
+        self.sync(table_name)
+
+    def sync(self, table_name: str) -> None:
+        """DuckDBのストアに追加されたドキュメントを索引に追加して保存する"""
+        with self._lock:
+            table = self._tables.get(table_name) or self._load(table_name)
+            table = self._sync(table_name, table)
+            if table is not None:
+                self._tables[table_name] = table
+
+    def close(self) -> None:
+        with self._lock:
+            self._tables.clear()
+        self._repository.close()
+
+    def __enter__(self) -> "FaissVectorStoreRepository":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def index_path(self, table_name: str) -> Path:
+        index_dir = self._index_dir or self._repository.vector_db_path.parent
+        return index_dir / f"{self._repository.store_name}.{table_name}.{self.index_type}.faiss"
+
+    def _table(self, table_name: str) -> _FaissTable | None:
+        table = self._tables.get(table_name)
+        if table is None:
+            with self._lock:
+                table = self._tables.get(table_name)
+                if table is None:
+                    table = self._sync(table_name, self._load(table_name))
+                    if table is not None:
+                        self._tables[table_name] = table
+        return table
+
+    def _load(self, table_name: str) -> _FaissTable | None:
+        """保存済みの索引を読み込む。索引が無い、または索引とIDの一覧が食い違う場合はNone"""
+        index_path = self.index_path(table_name)
+        ids_path = _ids_path(index_path)
+        if not index_path.exists() or not ids_path.exists():
+            return None
+        saved = json.loads(ids_path.read_text())
+        if not isinstance(saved, dict):
+            logger.info(f"FAISS index was saved without stable ids. Rebuilding: {index_path}")
+            return None
+        index = faiss.read_index(str(index_path))
+        indexed_ids = (
+            set(faiss.vector_to_array(index.id_map).tolist()) if isinstance(index, faiss.IndexIDMap2) else None
+        )
+        ids = saved["ids"]
+        if indexed_ids is None or any(_faiss_id(id_) not in indexed_ids for id_ in ids):
+            logger.warning(f"FAISS index and its id list are inconsistent. Rebuilding: {index_path}")
+            return None
+        self._configure(index)
+        table = _FaissTable(index, trained_size=saved["trained_size"], removable=self.index_type != "hnsw")
+        table.stale_ids = indexed_ids - {_faiss_id(id_) for id_ in ids}
+        document_by_id = self._repository.load_documents(table_name)
+        table.documents = {_faiss_id(id_): (id_, *document_by_id[id_]) for id_ in ids if id_ in document_by_id}
+        # 保存した後にDuckDBから消えた行
+        table.remove([id_ for id_ in ids if id_ not in document_by_id])
+        logger.info(f"Loaded FAISS index of {len(ids)} vectors: {index_path}")
+        return table
+
+    def _sync(self, table_name: str, table: _FaissTable | None) -> _FaissTable | None:
+        removed_ids: list[str] = []
+        if table is not None:
+            live_ids = self._repository.load_ids(table_name)
+            removed_ids = [id_ for id_ in table.row_ids if id_ not in live_ids]
+            added_count = len(live_ids) - (len(table.documents) - len(removed_ids))
+            if self._needs_rebuild(table, len(removed_ids), added_count):
+                logger.info(f"Rebuilding FAISS index of {table_name} ({self.index_type})")
+                table = None
+            elif removed_ids:
+                # upsertで置き換えられた行は、新しい行を追加する前に索引から消す
+                table.remove(removed_ids)
+        ids, matrix, texts, metadatas = self._repository.load_embeddings(
+            table_name, exclude_ids=table.row_ids if table is not None else None
+        )
+        if table is None:
+            if not ids:
+                return None
+            table = self._new_table(matrix)
+        if ids:
+            table.add(ids, matrix, texts, metadatas)
+        if ids or removed_ids:
+            self._save(table_name, table)
+            logger.info(
+                f"Added {len(ids)} and removed {len(removed_ids)} vectors in FAISS index of {table_name} "
+                f"(total {len(table.documents)})"
+            )
+        return table
+
+    def _needs_rebuild(self, table: _FaissTable, removed_count: int, added_count: int) -> bool:
+        if self.index_type == "ivf":
+            # 最初に登録したドキュメントだけで学習したクラスタは、件数が大きく増えると偏るので学習し直す
+            document_count = len(table.documents) - removed_count + added_count
+            return document_count >= self.params.ivf_retrain_growth * table.trained_size
+        if self.index_type == "hnsw":
+            stale_count = len(table.stale_ids) + removed_count
+            return stale_count > self.params.hnsw_max_stale_fraction * (table.index.ntotal + added_count)
+        return False
+
+    def _new_table(self, training_matrix: np.ndarray) -> _FaissTable:
+        index = faiss.IndexIDMap2(self._build_index(training_matrix))
+        return _FaissTable(index, trained_size=len(training_matrix), removable=self.index_type != "hnsw")
+
+    def _build_index(self, training_matrix: np.ndarray) -> faiss.Index:
+        dimension = training_matrix.shape[1]
+        if self.index_type == "flat":
+            index = faiss.IndexFlatIP(dimension)
+        elif self.index_type == "hnsw":
+            index = faiss.IndexHNSWFlat(dimension, self.params.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        elif self.index_type == "ivf":
+            # クラスタあたりのドキュメント数が少なすぎると学習できないので、クラスタ数はドキュメント数の平方根までにする
+            nlist = max(1, min(self.params.ivf_nlist, int(math.sqrt(len(training_matrix)))))
+            index = faiss.IndexIVFFlat(faiss.IndexFlatIP(dimension), dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+            index.train(_normalize_rows(training_matrix))
+        else:
+            raise ValueError(f"Unknown FAISS index type: {self.index_type}")
+        self._configure(index)
+        return index
+
+    def _configure(self, index: faiss.Index) -> None:
+        if self.index_type == "ivf":
+            faiss.extract_index_ivf(index).nprobe = self.params.ivf_nprobe
+        elif self.index_type == "hnsw":
+            if isinstance(index, faiss.IndexIDMap2):
+                index = faiss.downcast_index(index.index)
+            index.hnsw.efSearch = self.params.hnsw_ef_search
+
+    def _save(self, table_name: str, table: _FaissTable) -> None:
+        index_path = self.index_path(table_name)
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write_bytes(index_path, faiss.serialize_index(table.index).tobytes())
+        saved = {"ids": table.row_ids, "trained_size": table.trained_size}
+        atomic_write_bytes(_ids_path(index_path), json.dumps(saved).encode())
+
+
+def _ids_path(index_path: Path) -> Path:
+    return index_path.with_name(index_path.name + ".ids.json")
+
+
+def _faiss_id(id_: str) -> int:
+    """DuckDBの行のIDから決まる、索引に登録するID(FAISSは -1 を欠損に使うので非負の63bit)"""
+    return int.from_bytes(hashlib.sha256(id_.encode()).digest()[:8], "little") & 0x7FFF_FFFF_FFFF_FFFF
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32).copy()
+    faiss.normalize_L2(matrix)
+    return matrix
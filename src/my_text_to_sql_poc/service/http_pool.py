@@ -0,0 +1,145 @@
+import asyncio
+import atexit
+import os
+import threading
+import weakref
+from typing import Any
+
+import httpx
+from loguru import logger
+from pydantic import BaseModel, Field
+
+
+class HTTPConnectionPoolSettings(BaseModel):
+    """プロセス内で共有するHTTP接続プールの設定。`from_env()` で環境変数から上書きできる"""
+
+    max_connections: int = Field(default=20, ge=1, description="同時に開く接続数の上限")
+    max_keepalive_connections: int = Field(default=10, ge=0, description="アイドル状態で保持する接続数の上限")
+    keepalive_expiry_seconds: float = Field(default=60.0, gt=0, description="アイドル状態の接続を閉じるまでの秒数")
+
+    @classmethod
+    def from_env(cls) -> "HTTPConnectionPoolSettings":
+        """環境変数 TEXT2SQL_HTTP_MAX_CONNECTIONS 等が設定されていればその値を使う"""
+        env_by_field = {
+            "max_connections": "TEXT2SQL_HTTP_MAX_CONNECTIONS",
+            "max_keepalive_connections": "TEXT2SQL_HTTP_MAX_KEEPALIVE_CONNECTIONS",
+            "keepalive_expiry_seconds": "TEXT2SQL_HTTP_KEEPALIVE_EXPIRY_SECONDS",
+        }
+        overrides = {field: os.environ[env] for field, env in env_by_field.items() if env in os.environ}
+        return cls(**overrides)
+
+
+class ConnectionPoolStats(BaseModel):
+    requests: int = 0
+    new_connections: int = 0
+    tls_handshakes: int = 0
+
+    @property
+    def reused_connections(self) -> int:
+        """既存の接続を使い回したリクエスト数"""
+        return max(self.requests - self.new_connections, 0)
+
+    @property
+    def reuse_rate(self) -> float:
+        return self.reused_connections / self.requests if self.requests else 0.0
+
+
+class HTTPConnectionPool:
+    """複数のAPIクライアントで共有する、keep-aliveのHTTP接続プール。
+
+    同期用の httpx.Client は1つ、非同期用の httpx.AsyncClient はイベントループごとに1つ作る
+    (AsyncClientの接続は作成したイベントループでしか使えないため)。
+    接続の確立とTLSハンドシェイクの回数を、httpcoreのtrace拡張で数える。
+    """
+
+    def __init__(self, settings: HTTPConnectionPoolSettings | None = None) -> None:
+        self.settings = settings or HTTPConnectionPoolSettings()
+        self.stats = ConnectionPoolStats()
+        self._lock = threading.Lock()
+        self._client: httpx.Client | None = None
+        self._async_clients: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient] = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def client(self) -> httpx.Client:
+        with self._lock:
+            if self._client is None or self._client.is_closed:
+                self._client = httpx.Client(limits=self._limits(), event_hooks={"request": [self._on_request]})
+            return self._client
+
+    def async_client(self) -> httpx.AsyncClient:
+        """実行中のイベントループ用のクライアント"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.get(loop)
+            if client is None or client.is_closed:
+                client = httpx.AsyncClient(limits=self._limits(), event_hooks={"request": [self._on_async_request]})
+                self._async_clients[loop] = client
+            return client
+
+    def log_stats(self) -> None:
+        logger.info(
+            f"HTTP connections: {self.stats.requests} requests, {self.stats.new_connections} new connections, "
+            f"{self.stats.tls_handshakes} TLS handshakes, reuse rate {self.stats.reuse_rate:.1%}"
+        )
+
+    def close(self) -> None:
+        """同期用のクライアントを閉じる。非同期用のクライアントは、イベントループと一緒に破棄される"""
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+            self._client = None
+            self._async_clients.clear()
+
+    def _limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.settings.max_connections,
+            max_keepalive_connections=self.settings.max_keepalive_connections,
+            keepalive_expiry=self.settings.keepalive_expiry_seconds,
+        )
+
+    def _on_request(self, request: httpx.Request) -> None:
+        request.extensions["trace"] = self._trace
+        with self._lock:
+            self.stats.requests += 1
+
+    async def _on_async_request(self, request: httpx.Request) -> None:
+        request.extensions["trace"] = self._async_trace
+        with self._lock:
+            self.stats.requests += 1
+
+    def _trace(self, event_name: str, info: dict[str, Any]) -> None:
+        with self._lock:
+            if event_name == "connection.connect_tcp.complete":
+                self.stats.new_connections += 1
+            elif event_name == "connection.start_tls.complete":
+                self.stats.tls_handshakes += 1
+
+    async def _async_trace(self, event_name: str, info: dict[str, Any]) -> None:
+        self._trace(event_name, info)
+
+
+# 以下はプロセス全体で共有するHTTP接続プール
+_pool: HTTPConnectionPool | None = None
+_pool_lock = threading.Lock()
+
+
+def get_http_connection_pool() -> HTTPConnectionPool:
+    """プロセス全体で1つのHTTP接続プールを返す。設定は最初に呼ばれた時点の環境変数で決まる"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = HTTPConnectionPool(HTTPConnectionPoolSettings.from_env())
+        return _pool
+
+
+def close_http_connection_pool() -> None:
+    """共有のHTTP接続プールを閉じる。プロセス終了時に自動で呼ばれる"""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.close()
+
+
+atexit.register(close_http_connection_pool)
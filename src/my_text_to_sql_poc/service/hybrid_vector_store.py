@@ -0,0 +1,187 @@
+import json
+import threading
+
+import numpy as np
+from langchain_core.documents import Document
+from loguru import logger
+
+from my_text_to_sql_poc.service.lexical_index import BM25Index
+from my_text_to_sql_poc.service.numpy_vector_store import NumpyVectorIndex, load_numpy_vector_index
+from my_text_to_sql_poc.service.repository import (
+    DuckDBVectorStoreRepository,
+    SampleQueryRepositoryInterface,
+    TableMetadataRepositoryInterface,
+    VectorStoreRepositoryInterface,
+)
+from my_text_to_sql_poc.service.vector_filter import DocumentAttributes, VectorSearchFilter
+
+
+class HybridVectorIndex:
+    """ベクトルテーブルの埋め込みの索引と、同じ行番号で引けるキーワード(BM25)の索引の組"""
+
+    def __init__(self, vectors: NumpyVectorIndex, lexical: BM25Index) -> None:
+        self.vectors = vectors
+        self.lexical = lexical
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+
+class HybridVectorStoreRepository(VectorStoreRepositoryInterface):
+    """キーワード検索で候補を絞り込んでから、候補だけをベクトルで検索するリポジトリ。
+
+    1. テーブル名・カラム名・要約のBM25の索引で、質問のキーワードに一致する上位 prefilter_size 件を候補にする
+    2. 候補の埋め込みだけとのコサイン類似度を計算して、上位k件を返す
+
+    検索のコストはカタログの大きさではなく候補数に比例する。
+    一致する候補が k * min_candidates_factor 件に満たない場合(質問に索引のキーワードがほとんど無い場合など)は、
+    取りこぼさないように全件をベクトルで検索する。
+    キーワードの索引は、要約に加えてテーブルメタデータ(table_embeddings)やサンプルクエリ(query_embeddings)の本文から作る。
+    書き込みはDuckDBのストアに委譲し、更新されたテーブルの索引は次の検索時に読み込み直す。
+
+    ベクトルで近いドキュメントが候補に入るのは、質問のキーワードを含む場合だけなので、
+    全件の総当たりに対する recall@k はキーワードと埋め込みの相関に依存する。
+    キーワードと埋め込みの相関が弱いカタログでは recall@k が大きく下がる(benchmarks.retrieval_suite で確認できる)。
+    質問とドキュメントの語彙がずれやすいカタログでは、min_candidates_factor を大きくして全件の検索に切り替えやすくするか、
+    numpy などの全件を検索する実装を使う。
+    """
+
+    def __init__(
+        self,
+        repository: DuckDBVectorStoreRepository,
+        table_metadata_repository: TableMetadataRepositoryInterface | None = None,
+        sample_query_repository: SampleQueryRepositoryInterface | None = None,
+        prefilter_size: int = 200,
+        min_candidates_factor: int = 2,
+    ) -> None:
+        """
+        Args:
+            table_metadata_repository: table_embeddings のキーワードの索引に、カラム名などのメタデータを含める場合に指定する
+            sample_query_repository: query_embeddings のキーワードの索引に、サンプルクエリのSQLを含める場合に指定する
+            prefilter_size: キーワード検索で絞り込む候補の最大数
+            min_candidates_factor: 候補数がkのこの倍数に満たない場合は全件を検索する
+        """
+        if prefilter_size <= 0:
+            raise ValueError(f"prefilter_size must be > 0: {prefilter_size}")
+        self._repository = repository
+        self._source_repository_by_table: dict[
+            str, TableMetadataRepositoryInterface | SampleQueryRepositoryInterface | None
+        ] = {
+            "table_embeddings": table_metadata_repository,
+            "query_embeddings": sample_query_repository,
+        }
+        self.prefilter_size = prefilter_size
+        self.min_candidates_factor = min_candidates_factor
+        self._indexes: dict[str, HybridVectorIndex] = {}
+        self._lock = threading.Lock()
+
+    def retrieve_relevant_docs(
+        self, question: str, table_name: str, k: int = 5, search_filter: VectorSearchFilter | None = None
+    ) -> list:
+        return self.retrieve_relevant_docs_hybrid(
+            question, self.embed_query(question), table_name, k=k, search_filter=search_filter
+        )
+
+    def embed_query(self, question: str) -> list[float]:
+        return self._repository.embed_query(question)
+
+    def retrieve_relevant_docs_by_vector(
+        self,
+        embedding: list[float],
+        table_name: str,
+        k: int = 5,
+        search_filter: VectorSearchFilter | None = None,
+    ) -> list:
+        """質問のテキストが無いので、キーワードでは絞り込まずに(search_filter に一致する)全件を検索する"""
+        index = self.index(table_name)
+        hits = index.vectors.search(np.asarray([embedding]), k, rows=index.vectors.filtered_rows(search_filter))[0]
+        return [index.vectors.document(row, score) for row, score in hits]
+
+    def retrieve_relevant_docs_hybrid(
+        self,
+        question: str,
+        embedding: list[float],
+        table_name: str,
+        k: int = 5,
+        search_filter: VectorSearchFilter | None = None,
+    ) -> list[Document]:
+        index = self.index(table_name)
+        rows = self.candidate_rows(question, table_name, k, search_filter)
+        hits = index.vectors.search(np.asarray([embedding]), k, rows=rows)[0]
+        return [index.vectors.document(row, score) for row, score in hits]
+
+    def candidate_rows(
+        self, question: str, table_name: str, k: int, search_filter: VectorSearchFilter | None = None
+    ) -> np.ndarray | None:
+        """キーワード検索で絞り込んだ候補の行番号を返す。候補が少なすぎて全件を検索すべき場合は、
+        search_filter に一致する全件の行番号(絞り込まない場合はNone)
+        """
+        index = self.index(table_name)
+        filtered_rows = index.vectors.filtered_rows(search_filter)
+        # 属性で絞り込んだ行がキーワードの候補で埋まらないように、キーワード検索は絞り込んだ行の中で行う
+        candidates = index.lexical.search(question, self.prefilter_size, rows=filtered_rows)
+        num_rows = len(index) if filtered_rows is None else len(filtered_rows)
+        if len(candidates) < min(num_rows, k * self.min_candidates_factor):
+            logger.debug(
+                f"Lexical prefilter matched only {len(candidates)} rows in {table_name}. Falling back to full scan"
+            )
+            return filtered_rows
+        return np.fromiter((position for position, _ in candidates), dtype=np.int64, count=len(candidates))
+
+    def put(self, doc_id: str, document: str, table_name: str, attributes: DocumentAttributes | None = None) -> None:
+        self._repository.put(doc_id, document, table_name, attributes)
+        self.invalidate(table_name)
+
+    def put_bulk(
+        self,
+        docs: list[tuple[str, str]],
+        table_name: str,
+        attributes_by_doc_id: dict[str, DocumentAttributes] | None = None,
+    ) -> None:
+        self._repository.put_bulk(docs, table_name, attributes_by_doc_id)
+        self.invalidate(table_name)
+
+    def index(self, table_name: str) -> HybridVectorIndex:
+        """テーブルの索引を返す。まだ読み込んでいなければDuckDBのストアから読み込む"""
+        index = self._indexes.get(table_name)
+        if index is None:
+            with self._lock:
+                index = self._indexes.get(table_name)
+                if index is None:
+                    index = self._build(table_name)
+                    self._indexes[table_name] = index
+        return index
+
+    def invalidate(self, table_name: str) -> None:
+        with self._lock:
+            self._indexes.pop(table_name, None)
+
+    def close(self) -> None:
+        with self._lock:
+            self._indexes.clear()
+        self._repository.close()
+
+    def __enter__(self) -> "HybridVectorStoreRepository":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _build(self, table_name: str) -> HybridVectorIndex:
+        vectors = load_numpy_vector_index(self._repository, table_name)
+        doc_ids = [_doc_id(metadata) for metadata in vectors.metadatas]
+        source_repository = self._source_repository_by_table.get(table_name)
+        sources = source_repository.get([doc_id for doc_id in doc_ids if doc_id]) if source_repository else {}
+        lexical = BM25Index(
+            [
+                "\n".join([doc_id or "", text, sources.get(doc_id, "") if doc_id else ""])
+                for doc_id, text in zip(doc_ids, vectors.texts)
+            ]
+        )
+        return HybridVectorIndex(vectors, lexical)
+
+
+def _doc_id(metadata: str | None) -> str | None:
+    if not metadata:
+        return None
+    return json.loads(metadata).get("doc_id")
@@ -0,0 +1,103 @@
+import math
+import re
+import unicodedata
+from collections import Counter, defaultdict
+
+import numpy as np
+
+_ASCII_WORD_PATTERN = re.compile(r"[a-z0-9]+")
+# テーブル名やカラム名などの識別子(schema.table_name など)
+_IDENTIFIER_PATTERN = re.compile(r"[a-z0-9]+(?:[._][a-z0-9]+)+")
+# 英数字以外の文字(日本語など)の連続
+_NON_ASCII_RUN_PATTERN = re.compile(r"[^\x00-\x7f\s\W]+")
+# ひらがなだけのトークン(助詞や送り仮名のbigram)
+_HIRAGANA_PATTERN = re.compile(r"[\u3041-\u309f]+")
+
+
+def tokenize(text: str) -> list[str]:
+    """BM25用にテキストをトークンに分ける
+
+    - 英数字: 単語ごと(識別子は `_` や `.` で区切った単語と、識別子全体の両方)
+    - 日本語など: 形態素解析器を使わずに文字bigram(1文字だけの場合はその文字)
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = _ASCII_WORD_PATTERN.findall(text) + _IDENTIFIER_PATTERN.findall(text)
+    for run in _NON_ASCII_RUN_PATTERN.findall(text):
+        tokens.extend([run] if len(run) == 1 else [run[i : i + 2] for i in range(len(run) - 1)])
+    return tokens
+
+
+class BM25Index:
+    """転置インデックスによるBM25のキーワード検索。
+
+    トークンごとに、含むドキュメントの位置とBM25の項の重み(idfを掛ける前)をNumPyの配列で持ち、
+    検索では質問のトークンの配列をスコアの配列に足し込む。
+    ひらがなだけのトークン(「の」「する」など)と、max_df_ratio を超える割合のドキュメントに含まれるトークンは、
+    絞り込みに役立たず足し込む件数だけが多いので、検索に使わない。
+    """
+
+    def __init__(self, texts: list[str], k1: float = 1.5, b: float = 0.75, max_df_ratio: float = 0.5) -> None:
+        """
+        Args:
+            max_df_ratio: 含むドキュメントの割合がこれを超えるトークンは検索に使わない
+        """
+        self.k1 = k1
+        self.b = b
+        self.max_df_ratio = max_df_ratio
+        self._num_docs = len(texts)
+        counts_by_doc = [Counter(tokenize(text)) for text in texts]
+        doc_lengths = np.fromiter(
+            (sum(counts.values()) for counts in counts_by_doc), dtype=np.float32, count=len(texts)
+        )
+        average_doc_length = float(doc_lengths.mean()) if texts else 0.0
+        length_norms = 1 - b + b * doc_lengths / average_doc_length if average_doc_length else np.ones_like(doc_lengths)
+        postings: dict[str, tuple[list[int], list[int]]] = defaultdict(lambda: ([], []))
+        for position, counts in enumerate(counts_by_doc):
+            for token, count in counts.items():
+                positions, token_counts = postings[token]
+                positions.append(position)
+                token_counts.append(count)
+        # トークン -> (ドキュメントの位置, idfを掛ける前のBM25の項の重み)
+        self._postings: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+        for token, (positions, token_counts) in postings.items():
+            positions_array = np.asarray(positions, dtype=np.int32)
+            counts_array = np.asarray(token_counts, dtype=np.float32)
+            weights = counts_array * (k1 + 1) / (counts_array + k1 * length_norms[positions_array])
+            self._postings[token] = (positions_array, weights.astype(np.float32))
+
+    def __len__(self) -> int:
+        return self._num_docs
+
+    def is_stop_token(self, token: str) -> bool:
+        """検索に使わないトークンか"""
+        if _HIRAGANA_PATTERN.fullmatch(token):
+            return True
+        postings = self._postings.get(token)
+        return postings is not None and len(postings[0]) > self.max_df_ratio * self._num_docs
+
+    def search(self, query: str, limit: int, rows: np.ndarray | None = None) -> list[tuple[int, float]]:
+        """
+        Args:
+            rows: 指定した場合、この位置のドキュメントだけを対象にする
+        Returns:
+            list[tuple[int, float]]: 質問のトークン(検索に使わないトークンを除く)を1つ以上含むドキュメントの
+                (位置, BM25スコア) のリスト。スコアの降順で最大limit件
+        """
+        scores = np.zeros(self._num_docs, dtype=np.float32)
+        for token in set(tokenize(query)):
+            postings = self._postings.get(token)
+            if postings is None or self.is_stop_token(token):
+                continue
+            positions, weights = postings
+            idf = math.log(1 + (self._num_docs - len(positions) + 0.5) / (len(positions) + 0.5))
+            # 1つのトークンのポスティングに同じ位置は重複しないので、ファンシーインデックスで足し込める
+            scores[positions] += idf * weights
+        if rows is not None:
+            allowed = np.zeros(self._num_docs, dtype=bool)
+            allowed[np.asarray(rows, dtype=np.int64)] = True
+            scores[~allowed] = 0.0
+        matched = np.flatnonzero(scores > 0)
+        if len(matched) > limit:
+            matched = matched[np.argpartition(-scores[matched], limit - 1)[:limit]]
+        matched = matched[np.argsort(-scores[matched], kind="stable")]
+        return [(int(position), float(scores[position])) for position in matched]
@@ -0,0 +1,209 @@
+import hashlib
+import json
+import threading
+import time
+from pathlib import Path
+
+import duckdb
+from loguru import logger
+from pydantic import BaseModel
+
+from my_text_to_sql_poc.service.cache import CacheStats
+from my_text_to_sql_poc.service.duckdb_connection import DuckDBConnectionManager, get_connection_manager
+from my_text_to_sql_poc.service.s3_store import DEFAULT_STORE_CACHE_DIR
+
+DEFAULT_LLM_RESPONSE_CACHE_PATH = DEFAULT_STORE_CACHE_DIR / "llm_response_cache.duckdb"
+
+
+def response_cache_key(
+    model_name: str, temperature: float | None, prompt: str, output_schema: type[BaseModel] | None = None
+) -> str:
+    """(モデル名, temperature, プロンプトのハッシュ, 出力スキーマ) から作るキャッシュのキー。
+
+    出力スキーマはクラス名ではなくJSON Schemaで区別するので、フィールドや説明文を変えると別のキーになる。
+    """
+    key = {
+        "model_name": model_name,
+        "temperature": temperature,
+        "prompt_hash": hashlib.sha256(prompt.encode()).hexdigest(),
+        "output_schema": output_schema.model_json_schema() if output_schema is not None else None,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+class LLMResponseCache:
+    """生成AIモデルの応答を、ローカルのDuckDBファイルに永続化するキャッシュ。
+
+    登録から ttl_seconds 秒を過ぎた応答は使わずに削除する。
+    件数が max_entries を超えたら、最後に参照された時刻が古いものから追い出す(LRU)。
+
+    ファイルは普段は読み取り専用で開き、書き込む間だけ読み書きで開き直すので、他のプロセスも同じファイルを読める。
+    ヒットした応答の最終参照時刻と期限切れの応答の削除はメモリに溜めておき、次に応答を登録する時(または件数が
+    access_flush_threshold に達した時)にまとめて書き込む。
+    他のプロセスがファイルを開いていて排他ロックが取れない場合は、警告を出してキャッシュを使わずに動く。
+    """
+
+    def __init__(
+        self,
+        cache_path: str | Path = DEFAULT_LLM_RESPONSE_CACHE_PATH,
+        ttl_seconds: float | None = None,
+        max_entries: int = 10_000,
+        access_flush_threshold: int = 256,
+    ) -> None:
+        if max_entries < 1:
+            raise ValueError(f"max_entries must be >= 1: {max_entries}")
+        self.cache_path = Path(cache_path)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.access_flush_threshold = access_flush_threshold
+        self.disabled = False
+        self._lock = threading.Lock()
+        # カウンタと未反映の書き込みは複数のスレッドから更新されるので、self._lock の下で更新する
+        self._stats = CacheStats()
+        self._pending_access: dict[str, float] = {}
+        self._pending_expired: set[str] = set()
+        self._connections: DuckDBConnectionManager | None = None
+
+    @property
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return self._stats.model_copy()
+
+    @property
+    def connections(self) -> DuckDBConnectionManager:
+        if self._connections is None or self._connections.closed:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            self._connections = get_connection_manager(self.cache_path, lock_on_write=True)
+            with self._connections.write_cursor() as cursor:
+                cursor.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS llm_response_cache (
+                        cache_key TEXT PRIMARY KEY,
+                        model_name TEXT,
+                        response TEXT,
+                        created_at DOUBLE,
+                        last_accessed_at DOUBLE
+                    )
+                    """
+                )
+        return self._connections
+
+    def get(self, cache_key: str) -> str | None:
+        """キャッシュ済みの応答を読み取り専用で引く。期限切れの応答はNoneを返し、次の書き込みで削除する"""
+        if self.disabled:
+            return None
+        try:
+            with self.connections.read_cursor() as cursor:
+                row = cursor.execute(
+                    "SELECT response, created_at FROM llm_response_cache WHERE cache_key = ?", (cache_key,)
+                ).fetchone()
+        except (duckdb.IOException, duckdb.ConnectionException) as e:
+            self._disable(e)
+            return None
+        now = time.time()
+        with self._lock:
+            if row is None:
+                self._stats.misses += 1
+                return None
+            response, created_at = row
+            if self.ttl_seconds is not None and now - created_at > self.ttl_seconds:
+                if cache_key not in self._pending_expired:
+                    self._pending_expired.add(cache_key)
+                    self._stats.evictions += 1
+                self._stats.misses += 1
+                return None
+            self._stats.hits += 1
+            self._pending_access[cache_key] = now
+            num_pending = len(self._pending_access) + len(self._pending_expired)
+        if num_pending >= self.access_flush_threshold:
+            self.flush()
+        return response
+
+    def set(self, cache_key: str, model_name: str, response: str) -> None:
+        self.set_many([(cache_key, model_name, response)])
+
+    def set_many(self, items: list[tuple[str, str, str]]) -> None:
+        """(キー, モデル名, 応答) をまとめて登録する。ファイルを読み書きで開き直すのは1回だけ"""
+        if self.disabled or not items:
+            return
+        now = time.time()
+        try:
+            with self.connections.write_cursor() as cursor:
+                # 追い出す順番が正しくなるよう、溜めている最終参照時刻を先に反映する
+                self._write_pending(cursor)
+                # executemanyは1行ずつ実行されて遅いので、リストで渡して1回のINSERTで登録する
+                # (同じキーが複数ある場合は後の応答を使う)
+                item_by_key = {cache_key: (model_name, response) for cache_key, model_name, response in items}
+                cursor.execute(
+                    """
+                    INSERT OR REPLACE INTO llm_response_cache
+                    SELECT unnest(?::VARCHAR[]), unnest(?::VARCHAR[]), unnest(?::VARCHAR[]), ?, ?
+                    """,
+                    (
+                        list(item_by_key),
+                        [model_name for model_name, _ in item_by_key.values()],
+                        [response for _, response in item_by_key.values()],
+                        now,
+                        now,
+                    ),
+                )
+                overflow = cursor.execute("SELECT count(*) FROM llm_response_cache").fetchone()[0] - self.max_entries
+                if overflow > 0:
+                    cursor.execute(
+                        """
+                        DELETE FROM llm_response_cache WHERE cache_key IN (
+                            SELECT cache_key FROM llm_response_cache ORDER BY last_accessed_at LIMIT ?
+                        )
+                        """,
+                        (overflow,),
+                    )
+                    with self._lock:
+                        self._stats.evictions += overflow
+                    logger.debug(f"Evicted {overflow} entries from LLM response cache: {self.cache_path}")
+        except (duckdb.IOException, duckdb.ConnectionException) as e:
+            self._disable(e)
+
+    def flush(self) -> None:
+        """メモリに溜めている最終参照時刻と期限切れの応答の削除をキャッシュのファイルに書き込む"""
+        if self.disabled:
+            return
+        try:
+            with self.connections.write_cursor() as cursor:
+                self._write_pending(cursor)
+        except (duckdb.IOException, duckdb.ConnectionException) as e:
+            self._disable(e)
+
+    def _disable(self, error: Exception) -> None:
+        """ロックが取れないなどでキャッシュのファイルを使えない場合は、以降はキャッシュせずにモデルを呼ぶ"""
+        self.disabled = True
+        logger.warning(f"LLM response cache is disabled because {self.cache_path} is not available: {error}")
+
+    def _write_pending(self, cursor: duckdb.DuckDBPyConnection) -> None:
+        with self._lock:
+            pending_access, self._pending_access = self._pending_access, {}
+            pending_expired, self._pending_expired = self._pending_expired, set()
+        try:
+            if pending_expired:
+                # 溜めている間に登録し直された応答は消さない
+                cursor.execute(
+                    "DELETE FROM llm_response_cache WHERE cache_key IN (SELECT unnest(?::VARCHAR[])) AND created_at < ?",
+                    (list(pending_expired), time.time() - (self.ttl_seconds or 0.0)),
+                )
+            if pending_access:
+                # UPDATE ... FROM の副問い合わせで from_json を使うと、DuckDBがコミット時に内部エラーになるのでリストで渡す
+                cursor.execute(
+                    """
+                    UPDATE llm_response_cache SET last_accessed_at = accessed.last_accessed_at
+                    FROM (
+                        SELECT unnest(?::VARCHAR[]) AS cache_key, unnest(?::DOUBLE[]) AS last_accessed_at
+                    ) AS accessed
+                    WHERE llm_response_cache.cache_key = accessed.cache_key
+                    """,
+                    (list(pending_access), list(pending_access.values())),
+                )
+        except BaseException:
+            # 書き込めなかった分は次の機会に書き込む(その間に参照されたものは新しい時刻を優先する)
+            with self._lock:
+                self._pending_access = {**pending_access, **self._pending_access}
+                self._pending_expired |= pending_expired
+            raise
@@ -1,17 +1,85 @@
+import asyncio
+import itertools
 import os
+import threading
+import weakref
 from typing import Any, TypeVar
 
+import openai
 import pydantic
 from langchain.callbacks.base import BaseCallbackHandler
-from langchain.schema.messages import HumanMessage
+from langchain.schema.messages import AIMessage, HumanMessage
+from langchain_core.language_models import BaseChatModel
 from langchain_core.outputs import LLMResult
 from langchain_openai import ChatOpenAI
 from loguru import logger
+from pydantic import BaseModel, Field
+
+from my_text_to_sql_poc.service.batch_embedding import token_counter_for
+from my_text_to_sql_poc.service.http_pool import HTTPConnectionPool, get_http_connection_pool
+from my_text_to_sql_poc.service.llm_response_cache import (
+    DEFAULT_LLM_RESPONSE_CACHE_PATH,
+    LLMResponseCache,
+    response_cache_key,
+)
+from my_text_to_sql_poc.service.rate_limiter import RateLimiter, get_rate_limiter
 
 # ジェネリック型を定義
 T = TypeVar("T", bound=pydantic.BaseModel)
 
 
+class ModelGatewaySettings(BaseModel):
+    """生成AIモデルの呼び出しの設定。`from_env()` で環境変数から上書きできる"""
+
+    max_concurrent_requests: int = Field(
+        default=8, ge=1, description="非同期の呼び出し(agenerate_*)で同時に投げるリクエスト数の上限"
+    )
+    timeout_seconds: float | None = Field(
+        default=120.0, gt=0, description="1回の呼び出しのタイムアウト秒数。Noneの場合はタイムアウトしない"
+    )
+    use_response_cache: bool = Field(
+        default=False, description="呼び出しごとに指定しない場合に、応答キャッシュを使うか(use_cache引数で上書きできる)"
+    )
+    response_cache_path: str | None = Field(
+        default=str(DEFAULT_LLM_RESPONSE_CACHE_PATH),
+        description="応答キャッシュのファイル。空文字列またはNoneの場合はキャッシュしない",
+    )
+    response_cache_ttl_seconds: float | None = Field(
+        default=30 * 24 * 60 * 60, gt=0, description="応答キャッシュの有効期間の秒数。Noneの場合は期限切れにしない"
+    )
+    response_cache_max_entries: int = Field(default=10_000, ge=1, description="応答キャッシュの件数の上限")
+    requests_per_minute: int | None = Field(
+        default=None, ge=1, description="1分あたりのリクエスト数の上限(RPM)。Noneの場合は制限しない"
+    )
+    tokens_per_minute: int | None = Field(
+        default=None, ge=1, description="1分あたりのトークン数の上限(TPM)。Noneの場合は制限しない"
+    )
+    estimated_completion_tokens: int = Field(
+        default=1000, ge=0, description="送信前のトークン数の見積もりに加える、応答のトークン数の見込み"
+    )
+    max_rate_limit_retries: int = Field(
+        default=5, ge=0, description="RPM/TPMを設定した場合に、429(レート制限)を受けたリクエストを再送する回数の上限"
+    )
+
+    @classmethod
+    def from_env(cls) -> "ModelGatewaySettings":
+        """環境変数 TEXT2SQL_LLM_MAX_CONCURRENT_REQUESTS 等が設定されていればその値を使う"""
+        env_by_field = {
+            "max_concurrent_requests": "TEXT2SQL_LLM_MAX_CONCURRENT_REQUESTS",
+            "timeout_seconds": "TEXT2SQL_LLM_TIMEOUT_SECONDS",
+            "use_response_cache": "TEXT2SQL_LLM_USE_RESPONSE_CACHE",
+            "response_cache_path": "TEXT2SQL_LLM_RESPONSE_CACHE_PATH",
+            "response_cache_ttl_seconds": "TEXT2SQL_LLM_RESPONSE_CACHE_TTL_SECONDS",
+            "response_cache_max_entries": "TEXT2SQL_LLM_RESPONSE_CACHE_MAX_ENTRIES",
+            "requests_per_minute": "TEXT2SQL_LLM_REQUESTS_PER_MINUTE",
+            "tokens_per_minute": "TEXT2SQL_LLM_TOKENS_PER_MINUTE",
+            "estimated_completion_tokens": "TEXT2SQL_LLM_ESTIMATED_COMPLETION_TOKENS",
+            "max_rate_limit_retries": "TEXT2SQL_LLM_MAX_RATE_LIMIT_RETRIES",
+        }
+        overrides = {field: os.environ[env] for field, env in env_by_field.items() if env in os.environ}
+        return cls(**overrides)
+
+
 class TokenUsageLoggingHandler(BaseCallbackHandler):
     def __init__(
         self,
@@ -57,36 +125,109 @@ class TokenUsageLoggingHandler(BaseCallbackHandler):
 
 
 class ModelGateway:
-    def __init__(self, model_name: str = "gpt-4o-mini") -> None:
+    """生成AIモデルの呼び出し口。
+
+    同期の generate_* に加えて、非同期の agenerate_* を持つ。agenerate_* は `asyncio.gather` で多数のプロンプトを
+    並行に投げても、同時に投げるリクエストが settings.max_concurrent_requests 件を超えないように待たせる。
+
+    応答キャッシュを使う呼び出しは、(モデル名, temperature, プロンプト, 出力スキーマ) が同じ過去の応答を
+    モデルに問い合わせずに返す。同じプロンプトを繰り返し投げるバッチ処理の再実行向け。
+
+    RPM/TPMの上限を設定した場合は、送信前にtiktokenで見積もったトークン数でレートリミッタの空きを待ってから送信する。
+    429を受けた場合は、応答ヘッダーが示す時間だけ同じモデルへの全ての送信を止めてから再送する。
+
+    通常は `get_model_gateway()` で、モデルの設定ごとにプロセス内で共有するインスタンスを使う。
+    """
+
+    def __init__(
+        self,
+        model_name: str = "gpt-4o-mini",
+        settings: ModelGatewaySettings | None = None,
+        llm: BaseChatModel | None = None,
+        response_cache: LLMResponseCache | None = None,
+        http_pool: HTTPConnectionPool | None = None,
+        rate_limiter: RateLimiter | None = None,
+    ) -> None:
+        """
+        Args:
+            llm: 呼び出すチャットモデル。指定しない場合は OPENAI_API_KEY を使うChatOpenAIを生成する
+            response_cache: 応答キャッシュ。指定しない場合は settings.response_cache_path のファイルを使う
+            http_pool: ChatOpenAIが使うHTTP接続プール。指定しない場合はクライアントごとに接続を張る
+            rate_limiter: 送信を待たせるレートリミッタ。指定しない場合は、settingsにRPM/TPMがあれば同じモデルで共有のものを使う
+        """
+        self.model_name = model_name
+        self.settings = settings or ModelGatewaySettings.from_env()
+        if response_cache is None and self.settings.response_cache_path:
+            response_cache = LLMResponseCache(
+                self.settings.response_cache_path,
+                ttl_seconds=self.settings.response_cache_ttl_seconds,
+                max_entries=self.settings.response_cache_max_entries,
+            )
+        self.response_cache = response_cache
+        if rate_limiter is None and (self.settings.requests_per_minute or self.settings.tokens_per_minute):
+            rate_limiter = get_rate_limiter(
+                model_name, self.settings.requests_per_minute, self.settings.tokens_per_minute
+            )
+        self.rate_limiter = rate_limiter
+        self._count_tokens = token_counter_for(model_name)
+        # asyncio.Semaphore は最初に待たせたイベントループに紐づくので、イベントループごとに作る
+        self._semaphores: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore] = (
+            weakref.WeakKeyDictionary()
+        )
+        # 接続プールの非同期用のクライアントもイベントループごとなので、非同期の呼び出しに使うモデルもイベントループごとに作る
+        self._async_llms: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, BaseChatModel] = (
+            weakref.WeakKeyDictionary()
+        )
+        self._http_pool = http_pool
+        self._chat_openai_kwargs: dict[str, Any] | None = None
+        if llm is not None:
+            self.llm = llm
+            return
+
         # APIキーとモデルの設定
         self.api_key = os.getenv("OPENAI_API_KEY")
         if not self.api_key:
             raise ValueError("APIキーが設定されていません。環境変数 'OPENAI_API_KEY' を確認してください。")
 
-        self.llm = ChatOpenAI(
-            model=model_name,
-            temperature=0.7,
-            callbacks=[TokenUsageLoggingHandler(cost_per_1m_input_tokens=0.00002)],
-            api_key=self.api_key,
-        )
+        self._chat_openai_kwargs = {
+            "model": model_name,
+            "temperature": 0.7,
+            "callbacks": [TokenUsageLoggingHandler(cost_per_1m_input_tokens=0.00002)],
+            "api_key": self.api_key,
+            "timeout": self.settings.timeout_seconds,
+            "http_client": http_pool.client() if http_pool is not None else None,
+            # レートリミッタの残量をAPIの残量に合わせるため、応答ヘッダーを応答のメタデータに含める
+            "include_response_headers": True,
+        }
+        if self.rate_limiter is not None:
+            # 429の再送は、同じモデルへの全ての送信を止めるためにレートリミッタ側で行う
+            self._chat_openai_kwargs["max_retries"] = 0
+        self.llm = ChatOpenAI(**self._chat_openai_kwargs)
 
-    def generate_response(self, prompt: str) -> str:
-        """生成AIモデルにプロンプトを送信して応答を取得する関数"""
-        request = [HumanMessage(content=prompt)]
-        try:
-            response = self.llm.invoke(request)
-            response_text = response.content
-            logger.debug(f"Model response: {response_text}")
+    def generate_response(self, prompt: str, use_cache: bool | None = None) -> str:
+        """生成AIモデルにプロンプトを送信して応答を取得する関数
 
-            return response_text
-        except Exception as e:
-            logger.error(f"生成AIモデルのAPI呼び出しに失敗しました: {e}")
-            raise
+        Args:
+            use_cache: 応答キャッシュを使うか。指定しない場合は settings.use_response_cache
+        """
+        cache_key = self._response_cache_key(prompt, None, use_cache)
+        if cache_key is not None and (cached := self.response_cache.get(cache_key)) is not None:
+            logger.debug(f"Model response (cached): {cached}")
+            return cached
+
+        response = self._invoke(self.llm, prompt)
+        response_text = response.content
+        logger.debug(f"Model response: {response_text}")
+
+        if cache_key is not None:
+            self.response_cache.set(cache_key, self.model_name, response_text)
+        return response_text
 
     def generate_response_with_structured_output(
         self,
         prompt: str,
         output_schema: type[T],  # Pydanticモデルクラスそのものを受け取る
+        use_cache: bool | None = None,
     ) -> T:  # output_schemaで指定された型のインスタンスを返す
         """
         プロンプトを送信し、スキーマに従って応答を取得する。
@@ -94,16 +235,207 @@ class ModelGateway:
         Args:
             prompt (str): 生成AIへのプロンプト文字列
             output_schema (Type[T]): 出力データ形式を定義するPydanticモデルクラス
+            use_cache (bool | None): 応答キャッシュを使うか。指定しない場合は settings.use_response_cache
 
         Returns:
             T: 指定されたスキーマのインスタンス
         """
-        response = self.llm.with_structured_output(output_schema).invoke([HumanMessage(content=prompt)])
+        cache_key = self._response_cache_key(prompt, output_schema, use_cache)
+        if cache_key is not None and (cached := self.response_cache.get(cache_key)) is not None:
+            logger.debug(f"Model response (cached): {cached}")
+            return output_schema.model_validate_json(cached)
+
+        response = _parsed(self._invoke(self.llm.with_structured_output(output_schema, include_raw=True), prompt))
         logger.debug(f"Model response: {response}")
+        if cache_key is not None:
+            self.response_cache.set(cache_key, self.model_name, response.model_dump_json())
         return response  # type: ignore
 
+    async def agenerate_response(
+        self, prompt: str, timeout_seconds: float | None = None, use_cache: bool | None = None
+    ) -> str:
+        """generate_response の非同期版。キャッシュにある応答は、同時実行数の空きを待たずに返す。
+        キャッシュのファイルの読み書きは、イベントループを止めないように別スレッドで行う。
+
+        Args:
+            timeout_seconds: この呼び出しのタイムアウト秒数。指定しない場合は settings.timeout_seconds
+            use_cache: 応答キャッシュを使うか。指定しない場合は settings.use_response_cache
+
+        Raises:
+            TimeoutError: 同時実行数の空きを得てからタイムアウト秒数以内に応答が無い場合
+        """
+        cache_key = self._response_cache_key(prompt, None, use_cache)
+        if (
+            cache_key is not None
+            and (cached := await asyncio.to_thread(self.response_cache.get, cache_key)) is not None
+        ):
+            logger.debug(f"Model response (cached): {cached}")
+            return cached
+
+        response = await self._ainvoke(self._async_llm(), prompt, timeout_seconds)
+        logger.debug(f"Model response: {response.content}")
+        if cache_key is not None:
+            await asyncio.to_thread(self.response_cache.set, cache_key, self.model_name, response.content)
+        return response.content
+
+    async def agenerate_response_with_structured_output(
+        self,
+        prompt: str,
+        output_schema: type[T],
+        timeout_seconds: float | None = None,
+        use_cache: bool | None = None,
+    ) -> T:
+        """generate_response_with_structured_output の非同期版。タイムアウトとキャッシュは agenerate_response と同じ"""
+        cache_key = self._response_cache_key(prompt, output_schema, use_cache)
+        if (
+            cache_key is not None
+            and (cached := await asyncio.to_thread(self.response_cache.get, cache_key)) is not None
+        ):
+            logger.debug(f"Model response (cached): {cached}")
+            return output_schema.model_validate_json(cached)
+
+        response = _parsed(
+            await self._ainvoke(
+                self._async_llm().with_structured_output(output_schema, include_raw=True), prompt, timeout_seconds
+            )
+        )
+        logger.debug(f"Model response: {response}")
+        if cache_key is not None:
+            await asyncio.to_thread(self.response_cache.set, cache_key, self.model_name, response.model_dump_json())
+        return response  # type: ignore
+
+    def _response_cache_key(
+        self, prompt: str, output_schema: type[pydantic.BaseModel] | None, use_cache: bool | None
+    ) -> str | None:
+        """応答キャッシュを使う呼び出しならキャッシュのキーを、使わないならNoneを返す"""
+        use_cache = self.settings.use_response_cache if use_cache is None else use_cache
+        if not use_cache or self.response_cache is None:
+            return None
+        return response_cache_key(self.model_name, getattr(self.llm, "temperature", None), prompt, output_schema)
+
+    def _invoke(self, runnable, prompt: str) -> Any:
+        """レートリミッタの空きを待ってから呼び出す。429を受けた場合は、全ての送信を止めてから再送する"""
+        estimated_tokens = self._estimate_tokens(prompt)
+        for attempt in itertools.count():
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(estimated_tokens)
+            try:
+                response = runnable.invoke([HumanMessage(content=prompt)])
+            except openai.RateLimitError as e:
+                if self.rate_limiter is None or attempt >= self.settings.max_rate_limit_retries:
+                    logger.error(f"生成AIモデルのAPI呼び出しがレート制限で失敗しました: {e}")
+                    raise
+                self.rate_limiter.back_off(e.response.headers, attempt, estimated_tokens)
+                continue
+            except Exception as e:
+                logger.error(f"生成AIモデルのAPI呼び出しに失敗しました: {e}")
+                raise
+            self._record_rate_limit(response, estimated_tokens)
+            return response
+
+    async def _ainvoke(self, runnable, prompt: str, timeout_seconds: float | None) -> Any:
+        """同時実行数とレートリミッタの空きを待ってから呼び出す。429の扱いは _invoke と同じ。
+
+        タイムアウトは空きを得てからの時間に掛けるので、多数のプロンプトを並行に投げても順番待ちの間にはタイムアウトしない。
+        呼び出し元のタスクがキャンセルされた場合は、リクエストを中断して空きを返す。
+        """
+        timeout_seconds = timeout_seconds if timeout_seconds is not None else self.settings.timeout_seconds
+        estimated_tokens = self._estimate_tokens(prompt)
+        async with self._semaphore():
+            for attempt in itertools.count():
+                if self.rate_limiter is not None:
+                    await self.rate_limiter.aacquire(estimated_tokens)
+                try:
+                    async with asyncio.timeout(timeout_seconds):
+                        response = await runnable.ainvoke([HumanMessage(content=prompt)])
+                except openai.RateLimitError as e:
+                    if self.rate_limiter is None or attempt >= self.settings.max_rate_limit_retries:
+                        logger.error(f"生成AIモデルのAPI呼び出しがレート制限で失敗しました: {e}")
+                        raise
+                    self.rate_limiter.back_off(e.response.headers, attempt, estimated_tokens)
+                    continue
+                except TimeoutError:
+                    logger.error(f"生成AIモデルのAPI呼び出しが{timeout_seconds}秒でタイムアウトしました")
+                    raise
+                except asyncio.CancelledError:
+                    logger.warning("生成AIモデルのAPI呼び出しがキャンセルされました")
+                    raise
+                except Exception as e:
+                    logger.error(f"生成AIモデルのAPI呼び出しに失敗しました: {e}")
+                    raise
+                self._record_rate_limit(response, estimated_tokens)
+                return response
+
+    def _estimate_tokens(self, prompt: str) -> int:
+        """送信前のトークン数の見積もり。APIはmax_tokens相当の応答もTPMに数えるので、応答の見込みを加える"""
+        if self.rate_limiter is None:
+            return 0
+        return self._count_tokens(prompt) + self.settings.estimated_completion_tokens
+
+    def _record_rate_limit(self, response: Any, estimated_tokens: int) -> None:
+        """応答ヘッダーの残量と、実際に使ったトークン数をレートリミッタに反映する"""
+        if self.rate_limiter is None:
+            return
+        message = response["raw"] if isinstance(response, dict) else response
+        if not isinstance(message, AIMessage):
+            return
+        if headers := message.response_metadata.get("headers"):
+            self.rate_limiter.update_from_headers(headers)
+        usage = message.usage_metadata
+        self.rate_limiter.record_usage(estimated_tokens, usage["total_tokens"] if usage else None)
+
+    def _async_llm(self) -> BaseChatModel:
+        if self._http_pool is None or self._chat_openai_kwargs is None:
+            return self.llm
+        loop = asyncio.get_running_loop()
+        if loop not in self._async_llms:
+            self._async_llms[loop] = ChatOpenAI(
+                **self._chat_openai_kwargs, http_async_client=self._http_pool.async_client()
+            )
+        return self._async_llms[loop]
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.settings.max_concurrent_requests)
+        return self._semaphores[loop]
+
+
+def _parsed(result: dict[str, Any]) -> Any:
+    """with_structured_output(include_raw=True) の結果から、スキーマのインスタンスを取り出す"""
+    if result["parsing_error"] is not None:
+        raise result["parsing_error"]
+    return result["parsed"]
+
+
+# 以下はプロセス全体で共有するModelGatewayのレジストリ
+_gateways: dict[tuple[str, str], ModelGateway] = {}
+_gateways_lock = threading.Lock()
+
+
+def get_model_gateway(model_name: str = "gpt-4o-mini", settings: ModelGatewaySettings | None = None) -> ModelGateway:
+    """モデル名と設定ごとに1つのModelGatewayを返す。
+
+    ゲートウェイはプロセス全体で共有するkeep-aliveのHTTP接続プールを使うので、呼び出しのたびに接続を張り直さない。
+    設定を指定しない場合は、環境変数から読んだ設定を使う。
+    """
+    settings = settings or ModelGatewaySettings.from_env()
+    key = (model_name, settings.model_dump_json())
+    with _gateways_lock:
+        gateway = _gateways.get(key)
+        if gateway is None:
+            gateway = ModelGateway(model_name, settings, http_pool=get_http_connection_pool())
+            _gateways[key] = gateway
+        return gateway
+
+
+def clear_model_gateways() -> None:
+    """レジストリからゲートウェイを外す(環境変数を変えた後やテストで使う)。接続プールはそのまま残す"""
+    with _gateways_lock:
+        _gateways.clear()
+
 
 if __name__ == "__main__":
-    gateway = ModelGateway()
+    gateway = get_model_gateway()
     response = gateway.generate_response("こんにちは!")
     print(response)
@@ -0,0 +1,167 @@
+import threading
+
+import numpy as np
+from langchain_core.documents import Document
+
+from my_text_to_sql_poc.service.repository import (
+    DuckDBVectorStoreRepository,
+    VectorStoreRepositoryInterface,
+    document_from_row,
+)
+from my_text_to_sql_poc.service.vector_filter import AttributeIndex, DocumentAttributes, VectorSearchFilter
+
+
+class NumpyVectorIndex:
+    """埋め込みを行ごとに正規化した1つの float32 行列として持ち、コサイン類似度の上位k件を総当たりで求める索引"""
+
+    def __init__(
+        self,
+        matrix: np.ndarray,
+        texts: list[str],
+        metadatas: list[str | None],
+        attributes: list[DocumentAttributes | None] | None = None,
+    ) -> None:
+        self.matrix = _normalize_rows(np.ascontiguousarray(matrix, dtype=np.float32))
+        self.texts = texts
+        self.metadatas = metadatas
+        self.attributes = AttributeIndex(attributes if attributes is not None else [None] * len(texts))
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def search(self, queries: np.ndarray, k: int, rows: np.ndarray | None = None) -> list[list[tuple[int, float]]]:
+        """
+        Args:
+            queries: 検索ベクトルを行に並べた (クエリ数, 次元数) の行列
+            rows: 指定した場合、この行番号の行だけを検索する(キーワード検索などで絞り込んだ候補)
+        Returns:
+            list[list[tuple[int, float]]]: クエリごとの (行番号, 類似度) のリスト。類似度の降順
+        """
+        num_rows = len(self) if rows is None else len(rows)
+        if num_rows == 0 or k <= 0:
+            return [[] for _ in range(len(queries))]
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        scores = _normalize_rows(np.atleast_2d(np.asarray(queries, dtype=np.float32))) @ matrix.T
+        k = min(k, num_rows)
+        # 全件をソートせずに、上位k件だけを取り出してからk件の中で並べる
+        top_indices = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top_indices, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top_indices = np.take_along_axis(top_indices, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        if rows is not None:
+            top_indices = np.asarray(rows)[top_indices]
+        return [
+            list(zip(indices.tolist(), row_scores.tolist())) for indices, row_scores in zip(top_indices, top_scores)
+        ]
+
+    def filtered_rows(self, search_filter: VectorSearchFilter | None) -> np.ndarray | None:
+        """絞り込み条件に一致する行番号。絞り込まない場合はNone"""
+        if search_filter is None or search_filter.is_empty():
+            return None
+        return self.attributes.rows(search_filter)
+
+    def document(self, index: int, score: float) -> Document:
+        return document_from_row(self.texts[index], self.metadatas[index], score)
+
+
+class NumpyVectorStoreRepository(VectorStoreRepositoryInterface):
+    """DuckDBのベクトルストアの埋め込みを、テーブルごとにメモリ上の NumpyVectorIndex に載せて検索するリポジトリ。
+
+    書き込みと埋め込みの計算はDuckDBのベクトルストアに委譲し、更新されたテーブルの索引は次の検索時に読み込み直す。
+    SQLで1行ずつ類似度を計算する代わりに、行列とベクトルの積1回で全件の類似度を求める。
+    """
+
+    def __init__(self, repository: DuckDBVectorStoreRepository) -> None:
+        self._repository = repository
+        self._indexes: dict[str, NumpyVectorIndex] = {}
+        self._lock = threading.Lock()
+
+    def retrieve_relevant_docs(
+        self, question: str, table_name: str, k: int = 5, search_filter: VectorSearchFilter | None = None
+    ) -> list:
+        return self.retrieve_relevant_docs_by_vector(
+            self.embed_query(question), table_name, k=k, search_filter=search_filter
+        )
+
+    def embed_query(self, question: str) -> list[float]:
+        return self._repository.embed_query(question)
+
+    def retrieve_relevant_docs_by_vector(
+        self,
+        embedding: list[float],
+        table_name: str,
+        k: int = 5,
+        search_filter: VectorSearchFilter | None = None,
+    ) -> list:
+        return self.retrieve_relevant_docs_by_vectors([embedding], table_name, k=k, search_filter=search_filter)[0]
+
+    def retrieve_relevant_docs_by_vectors(
+        self,
+        embeddings: list[list[float]],
+        table_name: str,
+        k: int = 5,
+        search_filter: VectorSearchFilter | None = None,
+    ) -> list[list[Document]]:
+        """複数の検索ベクトルを1回の行列積でまとめて検索する。search_filter に一致する行だけの類似度を計算する
+
+        Returns:
+            list[list[Document]]: 検索ベクトルごとの、類似度の降順のドキュメントのリスト
+        """
+        index = self.index(table_name)
+        hits_per_query = index.search(np.asarray(embeddings), k, rows=index.filtered_rows(search_filter))
+        return [[index.document(row, score) for row, score in hits] for hits in hits_per_query]
+
+    def put(self, doc_id: str, document: str, table_name: str, attributes: DocumentAttributes | None = None) -> None:
+        self._repository.put(doc_id, document, table_name, attributes)
+        self.invalidate(table_name)
+
+    def put_bulk(
+        self,
+        docs: list[tuple[str, str]],
+        table_name: str,
+        attributes_by_doc_id: dict[str, DocumentAttributes] | None = None,
+    ) -> None:
+        self._repository.put_bulk(docs, table_name, attributes_by_doc_id)
+        self.invalidate(table_name)
+
+    def index(self, table_name: str) -> NumpyVectorIndex:
+        """テーブルの索引を返す。まだ読み込んでいなければDuckDBのストアから読み込む"""
+        index = self._indexes.get(table_name)
+        if index is None:
+            with self._lock:
+                index = self._indexes.get(table_name)
+                if index is None:
+                    index = load_numpy_vector_index(self._repository, table_name)
+                    self._indexes[table_name] = index
+        return index
+
+    def invalidate(self, table_name: str) -> None:
+        with self._lock:
+            self._indexes.pop(table_name, None)
+
+    def close(self) -> None:
+        with self._lock:
+            self._indexes.clear()
+        self._repository.close()
+
+    def __enter__(self) -> "NumpyVectorStoreRepository":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def load_numpy_vector_index(repository: DuckDBVectorStoreRepository, table_name: str) -> NumpyVectorIndex:
+    """DuckDBのストアのテーブルの埋め込みと属性を読み込んで索引を作る"""
+    ids, matrix, texts, metadatas = repository.load_embeddings(table_name)
+    attributes_by_id = repository.load_attributes(table_name)
+    return NumpyVectorIndex(matrix, texts, metadatas, [attributes_by_id.get(id_) for id_ in ids])
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    if matrix.size == 0:
+        return matrix
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
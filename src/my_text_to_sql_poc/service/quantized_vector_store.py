@@ -0,0 +1,251 @@
+import io
+import threading
+from pathlib import Path
+from typing import Literal
+
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+
+from my_text_to_sql_poc.service.repository import (
+    DuckDBVectorStoreRepository,
+    VectorStoreRepositoryInterface,
+    document_from_row,
+)
+from my_text_to_sql_poc.service.s3_store import atomic_write_bytes
+from my_text_to_sql_poc.service.vector_filter import DocumentAttributes, VectorSearchFilter
+
+VectorPrecision = Literal["float16", "int8"]
+
+# int8の類似度を計算するときに一度にfloat32に戻す行数(CPUキャッシュに収まる大きさにすると速い)
+_INT8_SCORING_CHUNK_ROWS = 256
+
+
+class QuantizedMatrix:
+    """行ごとに正規化した埋め込みを、float16 または行ごとのスケール付きの int8 で持つ行列
+
+    - float16: FAISSのスカラー量子化索引(QT_fp16)に載せ、SIMDで類似度を計算する
+    - int8: 各行を最大絶対値が127になるようにスケーリングした符号と、行ごとのスケールを持つ(x ≒ codes * scale)
+    """
+
+    def __init__(self, matrix: np.ndarray, precision: VectorPrecision) -> None:
+        normalized = _normalize_rows(np.ascontiguousarray(matrix, dtype=np.float32))
+        self.precision = precision
+        self._length = len(normalized)
+        if precision == "float16":
+            self._index = faiss.IndexScalarQuantizer(
+                normalized.shape[1], faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT
+            )
+            self._index.add(normalized)
+        elif precision == "int8":
+            max_abs = np.abs(normalized).max(axis=1) if normalized.size else np.empty(0, dtype=np.float32)
+            self._scales = np.where(max_abs > 0, max_abs / 127.0, 1.0).astype(np.float32)
+            self._codes = np.clip(np.rint(normalized / self._scales[:, None]), -127, 127).astype(np.int8)
+        else:
+            raise ValueError(f"Unknown vector precision: {precision}")
+
+    def __len__(self) -> int:
+        return self._length
+
+    @property
+    def nbytes(self) -> int:
+        """量子化した埋め込みがメモリ上で占めるバイト数"""
+        if self.precision == "float16":
+            return self._index.sa_code_size() * self._index.ntotal
+        return self._codes.nbytes + self._scales.nbytes
+
+    def search(self, queries: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """正規化済みの検索ベクトルとの近似的なコサイン類似度の上位k件を求める
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: (類似度, 行番号)。いずれも (クエリ数, k) で、行内は順不同
+        """
+        k = min(k, len(self))
+        if self.precision == "float16":
+            return self._index.search(queries, k)
+        scores = np.empty((len(queries), len(self)), dtype=np.float32)
+        for start in range(0, len(self), _INT8_SCORING_CHUNK_ROWS):
+            chunk = self._codes[start : start + _INT8_SCORING_CHUNK_ROWS].astype(np.float32)
+            scores[:, start : start + len(chunk)] = queries @ chunk.T
+        scores *= self._scales
+        rows = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        return np.take_along_axis(scores, rows, axis=1), rows
+
+
+class QuantizedVectorIndex:
+    """量子化した埋め込みと、並べ替え用の元の埋め込み(メモリマップしたファイル)を持つ索引"""
+
+    def __init__(
+        self,
+        matrix: QuantizedMatrix,
+        originals: np.ndarray | None,
+        texts: list[str],
+        metadatas: list[str | None],
+    ) -> None:
+        self.matrix = matrix
+        # 行ごとに正規化済みの float32 の埋め込み。np.memmap なので、候補の行だけがディスクから読まれる。
+        # 並べ替えない(rerank_factor=0)場合はNone
+        self.originals = originals
+        self.texts = texts
+        self.metadatas = metadatas
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def document(self, index: int, score: float) -> Document:
+        return document_from_row(self.texts[index], self.metadatas[index], score)
+
+
+class QuantizedVectorStoreRepository(VectorStoreRepositoryInterface):
+    """DuckDBのベクトルストアの埋め込みを、量子化(float16 / int8)してメモリ上に載せて検索するリポジトリ。
+
+    1. メモリ上の量子化した埋め込みで、上位 k * rerank_factor 件の候補を絞り込む
+    2. 候補の元の float32 の埋め込みだけを読み、正確なコサイン類似度で並べ替えて上位k件を返す
+
+    量子化するのはメモリ上の索引だけで、DuckDBのストアには元の float32 の埋め込みがそのまま残る(ストアのファイルは小さくならない)。
+    並べ替える場合は、元の埋め込みをストアと同じディレクトリの `{ストア名}.{テーブル名}.float32.npy` に書き出して
+    メモリマップするので、ディスクには float32 のコピーが1つ増える一方、プロセスのメモリに常駐するのは
+    量子化した埋め込みだけになる(float32 に比べて float16 で1/2、int8 で約1/4)。
+    rerank_factor=0 の場合はこのファイルを書き出さない。
+    書き込みはDuckDBのストアに委譲し、更新されたテーブルの索引は次の検索時に読み込み直す。
+    """
+
+    def __init__(
+        self,
+        repository: DuckDBVectorStoreRepository,
+        precision: VectorPrecision = "int8",
+        rerank_factor: int = 4,
+        index_dir: Path | None = None,
+    ) -> None:
+        """
+        Args:
+            rerank_factor: 正確に並べ替える候補の数の、kに対する倍率。0の場合は並べ替えずに近似的な類似度で返す
+            index_dir: 元の埋め込みのファイルの保存先。指定しない場合はDuckDBのストアと同じディレクトリ
+                (レンジリードで開いたストアにはローカルのファイルが無いので、指定が必要)
+        """
+        if rerank_factor < 0:
+            raise ValueError(f"rerank_factor must be >= 0: {rerank_factor}")
+        self._repository = repository
+        self.precision = precision
+        self.rerank_factor = rerank_factor
+        self._index_dir = index_dir
+        self._indexes: dict[str, QuantizedVectorIndex] = {}
+        self._lock = threading.Lock()
+
+    def retrieve_relevant_docs(
+        self, question: str, table_name: str, k: int = 5, search_filter: VectorSearchFilter | None = None
+    ) -> list:
+        return self.retrieve_relevant_docs_by_vector(
+            self.embed_query(question), table_name, k=k, search_filter=search_filter
+        )
+
+    def embed_query(self, question: str) -> list[float]:
+        return self._repository.embed_query(question)
+
+    def retrieve_relevant_docs_by_vector(
+        self,
+        embedding: list[float],
+        table_name: str,
+        k: int = 5,
+        search_filter: VectorSearchFilter | None = None,
+    ) -> list:
+        """search_filter を指定した場合は、量子化した埋め込みの索引ではなく、絞り込んでから類似度を計算するDuckDBのストアで検索する"""
+        if search_filter is not None and not search_filter.is_empty():
+            return self._repository.retrieve_relevant_docs_by_vector(
+                embedding, table_name, k=k, search_filter=search_filter
+            )
+        return self.retrieve_relevant_docs_by_vectors([embedding], table_name, k=k)[0]
+
+    def retrieve_relevant_docs_by_vectors(
+        self, embeddings: list[list[float]], table_name: str, k: int = 5
+    ) -> list[list[Document]]:
+        """複数の検索ベクトルをまとめて検索する
+
+        Returns:
+            list[list[Document]]: 検索ベクトルごとの、類似度の降順のドキュメントのリスト
+        """
+        index = self.index(table_name)
+        if len(index) == 0 or k <= 0:
+            return [[] for _ in embeddings]
+        queries = _normalize_rows(np.atleast_2d(np.asarray(embeddings, dtype=np.float32)))
+        scores, candidates = index.matrix.search(queries, max(k, k * self.rerank_factor))
+        if index.originals is not None:
+            # 全クエリの候補の元の埋め込みを、ファイルから1回で読む
+            candidate_rows, positions = np.unique(candidates, return_inverse=True)
+            candidate_vectors = np.asarray(index.originals[candidate_rows])[positions.reshape(candidates.shape)]
+            scores = np.einsum("qd,qcd->qc", queries, candidate_vectors)
+
+        results = []
+        for row_candidates, row_scores in zip(candidates, scores):
+            order = np.argsort(-row_scores)[:k]
+            results.append([index.document(int(row_candidates[i]), float(row_scores[i])) for i in order])
+        return results
+
+    def put(self, doc_id: str, document: str, table_name: str, attributes: DocumentAttributes | None = None) -> None:
+        self._repository.put(doc_id, document, table_name, attributes)
+        self.invalidate(table_name)
+
+    def put_bulk(
+        self,
+        docs: list[tuple[str, str]],
+        table_name: str,
+        attributes_by_doc_id: dict[str, DocumentAttributes] | None = None,
+    ) -> None:
+        self._repository.put_bulk(docs, table_name, attributes_by_doc_id)
+        self.invalidate(table_name)
+
+    def index(self, table_name: str) -> QuantizedVectorIndex:
+        """テーブルの索引を返す。まだ読み込んでいなければDuckDBのストアから読み込んで量子化する"""
+        index = self._indexes.get(table_name)
+        if index is None:
+            with self._lock:
+                index = self._indexes.get(table_name)
+                if index is None:
+                    index = self._build(table_name)
+                    self._indexes[table_name] = index
+        return index
+
+    def originals_path(self, table_name: str) -> Path:
+        index_dir = self._index_dir or self._repository.vector_db_path.parent
+        return index_dir / f"{self._repository.store_name}.{table_name}.float32.npy"
+
+    def invalidate(self, table_name: str) -> None:
+        with self._lock:
+            self._indexes.pop(table_name, None)
+
+    def close(self) -> None:
+        with self._lock:
+            self._indexes.clear()
+        self._repository.close()
+
+    def __enter__(self) -> "QuantizedVectorStoreRepository":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _build(self, table_name: str) -> QuantizedVectorIndex:
+        _, matrix, texts, metadatas = self._repository.load_embeddings(table_name)
+        if not texts:
+            empty = np.empty((0, 1), dtype=np.float32)
+            return QuantizedVectorIndex(QuantizedMatrix(empty, self.precision), None, [], [])
+        originals = _normalize_rows(np.ascontiguousarray(matrix, dtype=np.float32))
+        quantized = QuantizedMatrix(originals, self.precision)
+        if self.rerank_factor == 0:
+            return QuantizedVectorIndex(quantized, None, texts, metadatas)
+
+        originals_path = self.originals_path(table_name)
+        originals_path.parent.mkdir(parents=True, exist_ok=True)
+        buffer = io.BytesIO()
+        np.save(buffer, originals)
+        atomic_write_bytes(originals_path, buffer.getvalue())
+        del matrix, originals
+        return QuantizedVectorIndex(quantized, np.load(originals_path, mmap_mode="r"), texts, metadatas)
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    if matrix.size == 0:
+        return matrix
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
@@ -0,0 +1,197 @@
+import asyncio
+import random
+import re
+import threading
+import time
+from typing import Callable, Mapping
+
+from loguru import logger
+
+# x-ratelimit-reset-* ヘッダーの "1s", "6m0s", "20ms", "1h2m3.5s" などの形式
+_DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_SECONDS_BY_UNIT = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_reset_duration(value: str | None) -> float | None:
+    """x-ratelimit-reset-requests / x-ratelimit-reset-tokens の値を秒数にする。解釈できない場合はNone"""
+    if not value:
+        return None
+    matches = _DURATION_PATTERN.findall(value)
+    if not matches:
+        return None
+    return sum(float(amount) * _SECONDS_BY_UNIT[unit] for amount, unit in matches)
+
+
+def retry_after_seconds(headers: Mapping[str, str]) -> float | None:
+    """429の応答ヘッダーから、再送まで待つ秒数を求める。ヘッダーが無い場合はNone"""
+    headers = {key.lower(): value for key, value in headers.items()}
+    for key, scale in [("retry-after-ms", 0.001), ("retry-after", 1.0)]:
+        try:
+            return float(headers[key]) * scale
+        except (KeyError, ValueError):
+            continue
+    # 上限に達した方のリセットまでの時間
+    resets = [
+        parse_reset_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+        for kind in ["requests", "tokens"]
+        if headers.get(f"x-ratelimit-remaining-{kind}") == "0"
+    ]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+
+class TokenBucket:
+    """1分あたり capacity_per_minute を上限に、連続的に補充されるトークンバケツ。スレッドセーフではない(RateLimiterのロック下で使う)
+
+    取り出しは先に予約してバケツを負にしてよく、負の分が補充されるまでの秒数を呼び出し側が待つ。
+    """
+
+    def __init__(self, capacity_per_minute: int, now: float) -> None:
+        self.capacity = float(capacity_per_minute)
+        self._refill_per_second = capacity_per_minute / 60.0
+        self._level = self.capacity
+        self._updated_at = now
+
+    @property
+    def level(self) -> float:
+        return self._level
+
+    def reserve(self, amount: float, now: float) -> float:
+        """amount を取り出し、取り出した分がバケツに揃うまで待つ秒数を返す"""
+        self._refill(now)
+        self._level -= amount
+        return max(0.0, -self._level / self._refill_per_second)
+
+    def refund(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self._level = min(self.capacity, self._level + amount)
+
+    def limit_to(self, remaining: float, now: float) -> None:
+        """APIが返した残量の方が少ない場合は、バケツをその残量に合わせる(他のプロセスの消費分を反映する)"""
+        self._refill(now)
+        self._level = min(self._level, remaining)
+
+    def _refill(self, now: float) -> None:
+        self._level = min(self.capacity, self._level + (now - self._updated_at) * self._refill_per_second)
+        self._updated_at = now
+
+
+class RateLimiter:
+    """1分あたりのリクエスト数(RPM)とトークン数(TPM)の上限を守るように、送信を待たせるスケジューラ。
+
+    スレッドと非同期タスクの間で共有でき、どちらからも同じバケツを消費する。
+    429を受けた場合は `back_off()` で、応答ヘッダーが示す時間(無ければ指数バックオフ)だけ全ての送信を止める。
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: int | None = None,
+        tokens_per_minute: int | None = None,
+        clock: Callable[[], float] = time.monotonic,
+        max_backoff_seconds: float = 60.0,
+    ) -> None:
+        """
+        Args:
+            requests_per_minute: 1分あたりのリクエスト数の上限。Noneの場合は制限しない
+            tokens_per_minute: 1分あたりのトークン数の上限。Noneの場合は制限しない
+        """
+        if (requests_per_minute is not None and requests_per_minute < 1) or (
+            tokens_per_minute is not None and tokens_per_minute < 1
+        ):
+            raise ValueError("requests_per_minute and tokens_per_minute must be >= 1")
+        self._clock = clock
+        self._lock = threading.Lock()
+        now = clock()
+        self._requests = TokenBucket(requests_per_minute, now) if requests_per_minute else None
+        self._tokens = TokenBucket(tokens_per_minute, now) if tokens_per_minute else None
+        self._paused_until = now
+        self.max_backoff_seconds = max_backoff_seconds
+
+    def reserve(self, tokens: int) -> float:
+        """1リクエスト分と tokens トークン分を予約し、送信してよくなるまでの秒数を返す"""
+        with self._lock:
+            now = self._clock()
+            waits = [self._paused_until - now]
+            if self._requests is not None:
+                waits.append(self._requests.reserve(1, now))
+            if self._tokens is not None:
+                waits.append(self._tokens.reserve(tokens, now))
+        return max(0.0, *waits)
+
+    def acquire(self, tokens: int) -> None:
+        """送信してよくなるまでスレッドを止める"""
+        time.sleep(self.reserve(tokens))
+        # 待っている間に他の送信が429を受けた場合は、その分も待つ
+        while (pause := self._pause_remaining()) > 0:
+            time.sleep(pause)
+
+    async def aacquire(self, tokens: int) -> None:
+        """acquire の非同期版。待っている間もイベントループは止めない"""
+        await asyncio.sleep(self.reserve(tokens))
+        while (pause := self._pause_remaining()) > 0:
+            await asyncio.sleep(pause)
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: int | None) -> None:
+        """送信前の見積もりと実際のトークン数の差をバケツに反映する"""
+        if self._tokens is None or actual_tokens is None:
+            return
+        with self._lock:
+            now = self._clock()
+            if actual_tokens < estimated_tokens:
+                self._tokens.refund(estimated_tokens - actual_tokens, now)
+            else:
+                self._tokens.reserve(actual_tokens - estimated_tokens, now)
+
+    def update_from_headers(self, headers: Mapping[str, str]) -> None:
+        """応答ヘッダー(x-ratelimit-remaining-*)の残量がバケツより少なければ、バケツを残量に合わせる"""
+        headers = {key.lower(): value for key, value in headers.items()}
+        with self._lock:
+            now = self._clock()
+            for bucket, kind in [(self._requests, "requests"), (self._tokens, "tokens")]:
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                if bucket is None or remaining is None:
+                    continue
+                try:
+                    bucket.limit_to(float(remaining), now)
+                except ValueError:
+                    continue
+
+    def back_off(self, headers: Mapping[str, str], attempt: int, refund_tokens: int = 0) -> float:
+        """429を受けた送信の予約を取り消し、全ての送信を止める秒数を決めて返す
+
+        Args:
+            attempt: 何回目の再送か(0始まり)。ヘッダーで待ち時間が分からない場合の指数バックオフに使う
+            refund_tokens: 429を受けた送信で予約していたトークン数(APIには消費されていないので返す)
+        """
+        delay = retry_after_seconds(headers)
+        if delay is None:
+            delay = min(self.max_backoff_seconds, 2**attempt) * random.uniform(0.5, 1.0)
+        with self._lock:
+            now = self._clock()
+            self._paused_until = max(self._paused_until, now + delay)
+            if self._requests is not None:
+                self._requests.refund(1, now)
+            if self._tokens is not None:
+                self._tokens.refund(refund_tokens, now)
+        logger.warning(f"Rate limited by the model provider. Pausing requests for {delay:.2f}s (retry {attempt + 1})")
+        return delay
+
+    def _pause_remaining(self) -> float:
+        with self._lock:
+            return self._paused_until - self._clock()
+
+
+# 以下はプロセス全体で共有するレートリミッタのレジストリ。上限はモデルごとに掛かるので、モデルごとに共有する
+_limiters: dict[tuple[str, int | None, int | None], RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model_name: str, requests_per_minute: int | None, tokens_per_minute: int | None) -> RateLimiter:
+    """モデルと上限ごとに1つのレートリミッタを返す。同じモデルを呼ぶゲートウェイ間でバケツを共有する"""
+    key = (model_name, requests_per_minute, tokens_per_minute)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+            _limiters[key] = limiter
+        return limiter
@@ -2,8 +2,9 @@ import re
 
 # FROM、JOINキーワードの後に続くテーブル名を正規表現で取得(スキーマを含む)
 TABLE_PATTERN = re.compile(r"(?:FROM|JOIN)\s+(\w+(?:\.\w+)?)", re.IGNORECASE)
-# CTE(Common Table Expression, with句で定義される一時テーブル)を除外
-CTE_PATTERN = re.compile(r"WITH\s+(\w+)\s+AS", re.IGNORECASE)
+# CTE(Common Table Expression, with句で定義される一時テーブル)を除外。2つ目以降のCTEは `, cte_name as (` や
+# `,cte_name as (` の形で現れる。`with recursive cte_name as (` と、列名を付けた `cte_name (a, b) as (` にも対応する
+CTE_PATTERN = re.compile(r"(?:\bWITH(?:\s+RECURSIVE)?\s+|,\s*)(\w+)\s*(?:\([^)]*\))?\s+AS\s*\(", re.IGNORECASE)
 
 
 def extract_related_tables(query: str) -> set[str]:
@@ -15,11 +16,10 @@ def extract_related_tables(query: str) -> set[str]:
     table_names = set()
 
     matche_tables = set(TABLE_PATTERN.findall(query))
-    cte_tables = set(CTE_PATTERN.findall(query))
-    print(f"{cte_tables=}")
+    cte_tables = {cte_table.lower() for cte_table in CTE_PATTERN.findall(query)}
     for match_table in matche_tables:
-        # CTEの場合はスキップ
-        if match_table in cte_tables:
+        # CTEの場合はスキップ(SQLの識別子は大文字小文字を区別しないので、小文字で比較する)
+        if match_table.lower() in cte_tables:
             continue
         table_names.add(match_table.lower())  # 重複テーブル名を避けるために小文字化
 
@@ -1,12 +1,48 @@
+import hashlib
+import json
 import os
+import queue
+import threading
+import uuid
+import weakref
 from abc import ABC, abstractmethod
 from pathlib import Path
+from typing import Literal
 
-import boto3
 import duckdb
+import numpy as np
 from langchain_community.vectorstores import DuckDB
-from langchain_openai import OpenAIEmbeddings
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from loguru import logger
+from pydantic import BaseModel
+
+from my_text_to_sql_poc.service.batch_embedding import BatchEmbedder
+from my_text_to_sql_poc.service.duckdb_connection import DuckDBConnectionManager, get_connection_manager
+from my_text_to_sql_poc.service.embedding_backend import (
+    EmbeddingSettings,
+    create_batch_embedder,
+    create_embeddings,
+)
+from my_text_to_sql_poc.service.embedding_cache import CachedEmbeddings
+from my_text_to_sql_poc.service.related_table_extractor import extract_related_tables
+from my_text_to_sql_poc.service.s3_range_read import open_range_read_store
+from my_text_to_sql_poc.service.s3_store import (
+    DEFAULT_MULTIPART_PART_SIZE,
+    DEFAULT_UPLOAD_CONCURRENCY,
+    S3StoreCache,
+    UploadResult,
+    get_default_store_cache,
+    upload_file_if_changed,
+)
+from my_text_to_sql_poc.service.vector_filter import ATTRIBUTE_COLUMNS, DocumentAttributes, VectorSearchFilter
+
+DEFAULT_TABLE_METADATA_DB_PATH = "s3://staging-newspicks-datalake-mart/tmp/text2sql_poc/table_metadata_store.duckdb"
+DEFAULT_SAMPLE_QUERY_DB_PATH = "s3://staging-newspicks-datalake-mart/tmp/text2sql_poc/sample_query_store.duckdb"
+DEFAULT_VECTOR_DB_PATH = "s3://staging-newspicks-datalake-mart/tmp/text2sql_poc/sample_vectorstore.duckdb"
+
+# S3上のストアの開き方。詳細は LazyDuckDBStore を参照
+StoreAccessMode = Literal["download", "range_read"]
 
 
 class TableMetadataRepositoryInterface(ABC):
@@ -102,47 +138,53 @@ class DuckDBTableMetadataRepository(TableMetadataRepositoryInterface):
     def __init__(
         self,
         # db_path: str = "table_metadata_store.duckdb",
-        db_path: str = "s3://staging-newspicks-datalake-mart/tmp/text2sql_poc/table_metadata_store.duckdb",
+        db_path: str = DEFAULT_TABLE_METADATA_DB_PATH,
+        connection_manager: DuckDBConnectionManager | None = None,
+        access_mode: StoreAccessMode = "download",
     ) -> None:
-        self._original_db_path = db_path
-        if db_path.startswith("s3://"):
-            self.db_path = download_duckdb_from_s3(db_path)
-        else:
-            self.db_path = Path(db_path)
+        # S3からのダウンロードとコネクションの作成は、最初にget/putされるまで遅延する
+        self._store = LazyDuckDBStore(db_path, connection_manager, access_mode)
+
+    @property
+    def db_path(self) -> Path:
+        return self._store.local_path
+
+    @property
+    def _connections(self) -> DuckDBConnectionManager:
+        return self._store.connections
 
     def get(self, table_names: list[str]) -> dict[str, str]:
-        conn = duckdb.connect(self.db_path)
-        metadata_by_table = {}
-        for table_name in table_names:
-            query = f"SELECT metadata FROM table_metadata WHERE table_name = '{table_name}'"
-            result = conn.execute(query).fetchone()
-            if result:
-                metadata_by_table[table_name] = result[0]
-        conn.close()
-        return metadata_by_table
+        if not table_names:
+            return {}
+        # テーブル名のリストを1回のパラメータ化クエリでまとめて引く
+        with self._connections.read_cursor() as cursor:
+            query = """
+                SELECT table_name, metadata
+                FROM table_metadata
+                WHERE table_name IN (SELECT unnest(from_json(?, '["VARCHAR"]')))
+            """
+            results = cursor.execute(query, (_to_json_list(table_names),)).fetchall()
+        return _order_by_names(table_names, results)
 
     def put(self, table_name: str, metadata: str) -> None:
-        conn = duckdb.connect(self.db_path)
-        conn.execute("CREATE TABLE IF NOT EXISTS table_metadata (table_name TEXT, metadata TEXT)")
-        conn.execute("INSERT INTO table_metadata (table_name, metadata) VALUES (?, ?)", (table_name, metadata))
-        conn.close()
+        with self._connections.write_cursor() as cursor:
+            cursor.execute("CREATE TABLE IF NOT EXISTS table_metadata (table_name TEXT, metadata TEXT)")
+            cursor.execute("INSERT INTO table_metadata (table_name, metadata) VALUES (?, ?)", (table_name, metadata))
 
     def get_all(self) -> dict[str, str]:
-        conn = duckdb.connect(self.db_path)
-        query = "SELECT table_name, metadata FROM table_metadata"
-        results = conn.execute(query).fetchall()
-        conn.close()
+        with self._connections.read_cursor() as cursor:
+            query = "SELECT table_name, metadata FROM table_metadata"
+            results = cursor.execute(query).fetchall()
         return {row[0]: row[1] for row in results}
 
     def put_bulk(self, items: list[tuple[str, str]]) -> None:
-        conn = duckdb.connect(self.db_path)
-        conn.execute("CREATE TABLE IF NOT EXISTS table_metadata (table_name TEXT, metadata TEXT)")
-        conn.executemany("INSERT INTO table_metadata (table_name, metadata) VALUES (?, ?)", items)
-        conn.close()
+        with self._connections.write_cursor() as cursor:
+            cursor.execute("CREATE TABLE IF NOT EXISTS table_metadata (table_name TEXT, metadata TEXT)")
+            cursor.executemany("INSERT INTO table_metadata (table_name, metadata) VALUES (?, ?)", items)
 
-        if self._original_db_path.startswith("s3://"):
-            upload_duckdb_to_s3(self.db_path, self._original_db_path)
-            logger.info(f"Uploaded table metadata to S3: {self._original_db_path}")
+        if self._store.is_remote:
+            self._store.upload()
+            logger.info(f"Uploaded table metadata to S3: {self._store.original_path}")
 
 
 class DuckDBSampleQueryRepository(SampleQueryRepositoryInterface):
@@ -154,164 +196,965 @@ class DuckDBSampleQueryRepository(SampleQueryRepositoryInterface):
         query_url TEXT,
     );
     ```
+    また、テーブル名からサンプルクエリを引くための転置インデックスとして、以下のエッジテーブルを put/put_bulk 時に更新する。
+    `schema.table` 形式で参照されているテーブルは、スキーマ無しの `table` でも引けるように両方の名前で登録する。
+    ```sql
+    CREATE TABLE sample_query_tables (
+        query_name TEXT,
+        table_name TEXT,  -- 小文字化済み
+    );
+    ```
     """
 
     def __init__(
         self,
         # db_path: str = "sample_query_store.duckdb",
-        db_path: str = "s3://staging-newspicks-datalake-mart/tmp/text2sql_poc/sample_query_store.duckdb",
+        db_path: str = DEFAULT_SAMPLE_QUERY_DB_PATH,
+        connection_manager: DuckDBConnectionManager | None = None,
+        access_mode: StoreAccessMode = "download",
     ) -> None:
-        self._original_db_path = db_path
-        if db_path.startswith("s3://"):
-            self.db_path = download_duckdb_from_s3(db_path)
-        else:
-            self.db_path = db_path
+        self._store = LazyDuckDBStore(db_path, connection_manager, access_mode)
+
+    @property
+    def db_path(self) -> Path:
+        return self._store.local_path
+
+    @property
+    def _connections(self) -> DuckDBConnectionManager:
+        return self._store.connections
 
     def get(self, query_names: list[str]) -> dict[str, str]:
-        conn = duckdb.connect(self.db_path)
-        sql_by_query_name = {}
-        for query_name in query_names:
-            query = f"SELECT query FROM sample_queries WHERE query_name = '{query_name}'"
-            result = conn.execute(query).fetchone()
-            if result:
-                sql_by_query_name[query_name] = result[0]
-        conn.close()
-        return sql_by_query_name
+        if not query_names:
+            return {}
+        with self._connections.read_cursor() as cursor:
+            query = """
+                SELECT query_name, query
+                FROM sample_queries
+                WHERE query_name IN (SELECT unnest(from_json(?, '["VARCHAR"]')))
+            """
+            results = cursor.execute(query, (_to_json_list(query_names),)).fetchall()
+        return _order_by_names(query_names, results)
 
     def put(self, query_name: str, query: str, query_url: str) -> None:
-        conn = duckdb.connect(self.db_path)
-        conn.execute("CREATE TABLE IF NOT EXISTS sample_queries (query_name TEXT, query TEXT, query_url TEXT)")
-        conn.execute(
+        self._upsert([(query_name, query, query_url)])
+
+    def retrieve_by_table_name(self, table_name: str) -> dict[str, str]:
+        with self._connections.read_cursor() as cursor:
+            if not _table_exists(cursor, "sample_query_tables"):
+                logger.warning(
+                    f"sample_query_tables is not found in {self._store.original_path}. Falling back to full text scan. "
+                    "Run `python -m my_text_to_sql_poc.app.rebuild_sample_query_index` to build it."
+                )
+                return self._scan_by_table_name(cursor, table_name)
+
+            query = """
+                SELECT q.query_name, q.query
+                FROM sample_query_tables AS t
+                JOIN sample_queries AS q USING (query_name)
+                WHERE t.table_name = ?
+                ORDER BY q.query_name
             """
-            INSERT INTO sample_queries (query_name, query, query_url)
-            VALUES (?, ?, ?)
-            ON CONFLICT (query_name) DO UPDATE SET
-                query = excluded.query,
-                query_url = excluded.query_url
-            """,
-            (query_name, query, query_url),
+            results = cursor.execute(query, (table_name.lower(),)).fetchall()
+        return {row[0]: row[1] for row in results}
+
+    def get_all(self) -> dict[str, str]:
+        with self._connections.read_cursor() as cursor:
+            query = "SELECT query_name, query FROM sample_queries"
+            results = cursor.execute(query).fetchall()
+        return {row[0]: row[1] for row in results}
+
+    def put_bulk(self, items: list[tuple[str, str, str]]) -> None:
+        self._upsert(items)
+
+        if self._store.is_remote:
+            self._store.upload()
+            logger.info(f"Uploaded sample queries to S3: {self._store.original_path}")
+
+    def rebuild_table_index(self) -> int:
+        """既存の全サンプルクエリからエッジテーブルを作り直す(エッジテーブル導入前のストアのバックフィル用)
+
+        Returns:
+            int: 登録されたエッジ(サンプルクエリ, テーブル)の数
+        """
+        with self._connections.write_cursor() as cursor:
+            self._ensure_tables(cursor)
+            sample_queries = cursor.execute("SELECT query_name, query FROM sample_queries").fetchall()
+            cursor.execute("DELETE FROM sample_query_tables")
+            edges = _build_table_edges(sample_queries)
+            _insert_table_edges(cursor, edges)
+        logger.info(f"Rebuilt sample_query_tables: {len(sample_queries)} queries, {len(edges)} edges")
+
+        if self._store.is_remote:
+            self._store.upload()
+            logger.info(f"Uploaded sample queries to S3: {self._store.original_path}")
+        return len(edges)
+
+    def _upsert(self, items: list[tuple[str, str, str]]) -> None:
+        with self._connections.write_cursor() as cursor:
+            self._ensure_tables(cursor)
+            cursor.executemany(
+                """
+                INSERT INTO sample_queries (query_name, query, query_url)
+                VALUES (?, ?, ?)
+                ON CONFLICT (query_name) DO UPDATE SET
+                    query = excluded.query,
+                    query_url = excluded.query_url
+                """,
+                items,
+            )
+            # 更新されたクエリの古いエッジを消してから張り直す
+            cursor.execute(
+                """
+                DELETE FROM sample_query_tables
+                WHERE query_name IN (SELECT unnest(from_json(?, '["VARCHAR"]')))
+                """,
+                (_to_json_list([query_name for query_name, _, _ in items]),),
+            )
+            edges = _build_table_edges([(query_name, query) for query_name, query, _ in items])
+            _insert_table_edges(cursor, edges)
+
+    @staticmethod
+    def _ensure_tables(cursor) -> None:
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS sample_queries (query_name TEXT PRIMARY KEY, query TEXT, query_url TEXT)"
+        )
+        cursor.execute("CREATE TABLE IF NOT EXISTS sample_query_tables (query_name TEXT, table_name TEXT)")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS sample_query_tables_table_name_idx ON sample_query_tables (table_name)"
         )
-        conn.close()
 
-    def retrieve_by_table_name(self, table_name: str) -> dict[str, str]:
-        conn = duckdb.connect(self.db_path)
+    @staticmethod
+    def _scan_by_table_name(cursor, table_name: str) -> dict[str, str]:
+        """エッジテーブルが無い古いストア向けの、クエリ本文の部分一致による検索"""
         query = """
             SELECT query_name, query
             FROM sample_queries
             WHERE lower(query) LIKE '%' || lower(?) || '%'
         """
-        results = conn.execute(query, (table_name,)).fetchall()
-        conn.close()
+        results = cursor.execute(query, (table_name,)).fetchall()
         return {row[0]: row[1] for row in results}
 
-    def get_all(self) -> dict[str, str]:
-        conn = duckdb.connect(self.db_path)
-        query = "SELECT query_name, query FROM sample_queries"
-        results = conn.execute(query).fetchall()
-        conn.close()
-        return {row[0]: row[1] for row in results}
 
-    def put_bulk(self, items: list[tuple[str, str, str]]) -> None:
-        conn = duckdb.connect(self.db_path)
-        conn.execute("CREATE TABLE IF NOT EXISTS sample_queries (query_name TEXT, query TEXT, query_url TEXT)")
-        conn.executemany(
-            """
-            INSERT INTO sample_queries (query_name, query, query_url)
-            VALUES (?, ?, ?)
-            ON CONFLICT (query_name) DO UPDATE SET
-                query = excluded.query,
-                query_url = excluded.query_url
-            """,
-            items,
-        )
-        conn.close()
+def _build_table_edges(sample_queries: list[tuple[str, str]]) -> list[tuple[str, str]]:
+    """(サンプルクエリ名, SQL)のリストから、(サンプルクエリ名, 参照テーブル名)のエッジのリストを作る"""
+    edges = set()
+    for query_name, query in sample_queries:
+        for table_name in extract_related_tables(query):
+            edges.add((query_name, table_name))
+            # `schema.table` はスキーマ無しの `table` でも引けるようにする
+            if "." in table_name:
+                edges.add((query_name, table_name.rsplit(".", 1)[1]))
+    return sorted(edges)
+
+
+def _insert_table_edges(cursor, edges: list[tuple[str, str]]) -> None:
+    """エッジを1回のINSERTでまとめて登録する(executemanyは1行ずつ実行されて遅いため)"""
+    if not edges:
+        return
+    cursor.execute(
+        """
+        INSERT INTO sample_query_tables (query_name, table_name)
+        SELECT unnest(from_json(?, '["VARCHAR"]')), unnest(from_json(?, '["VARCHAR"]'))
+        """,
+        (_to_json_list([query_name for query_name, _ in edges]), _to_json_list([table for _, table in edges])),
+    )
 
-        if self._original_db_path.startswith("s3://"):
-            upload_duckdb_to_s3(self.db_path, self._original_db_path)
-            logger.info(f"Uploaded sample queries to S3: {self._original_db_path}")
+
+def _table_exists(cursor, table_name: str) -> bool:
+    result = cursor.execute("SELECT count(*) FROM duckdb_tables() WHERE table_name = ?", (table_name,)).fetchone()
+    return result[0] > 0
+
+
+class CompactionResult(BaseModel):
+    """ベクトルテーブルの重複した行の削除結果"""
+
+    table_name: str
+    rows_before: int = 0
+    rows_removed: int = 0
+    embedding_bytes_removed: int = 0
+    # DuckDBは削除した領域を後の書き込みで再利用するので、ファイルサイズは小さくならないことがある
+    file_bytes_before: int = 0
+    file_bytes_after: int = 0
 
 
 class VectorStoreRepositoryInterface(ABC):
+    """ベクトルストアのリポジトリ。
+
+    検索メソッドの search_filter を指定すると、ドキュメントの属性(スキーマ名・データベース名・方言・タグ)で
+    絞り込んだ行だけの類似度を計算する。
+    """
+
+    @abstractmethod
+    def retrieve_relevant_docs(
+        self, question: str, table_name: str, k: int = 5, search_filter: VectorSearchFilter | None = None
+    ) -> list:
+        pass
+
+    @abstractmethod
+    def embed_query(self, question: str) -> list[float]:
+        """質問を埋め込む。複数のベクトルテーブルを同じ質問で検索する場合に、埋め込みを1回で済ませるために使う"""
+        pass
+
     @abstractmethod
-    def retrieve_relevant_docs(self, question: str, table_name: str, k: int = 5) -> list:
+    def retrieve_relevant_docs_by_vector(
+        self,
+        embedding: list[float],
+        table_name: str,
+        k: int = 5,
+        search_filter: VectorSearchFilter | None = None,
+    ) -> list:
+        """`embed_query()` で埋め込み済みのベクトルで検索する"""
         pass
 
+    def retrieve_relevant_docs_hybrid(
+        self,
+        question: str,
+        embedding: list[float],
+        table_name: str,
+        k: int = 5,
+        search_filter: VectorSearchFilter | None = None,
+    ) -> list:
+        """質問のキーワードと埋め込み済みのベクトルの両方を使って検索する。
+        キーワードの索引を持たないリポジトリでは、ベクトルだけで検索する
+        """
+        return self.retrieve_relevant_docs_by_vector(embedding, table_name, k=k, search_filter=search_filter)
+
     @abstractmethod
-    def put(self, doc_id: str, document: str, table_name: str) -> None:
+    def put(self, doc_id: str, document: str, table_name: str, attributes: DocumentAttributes | None = None) -> None:
         """
         Args:
             doc_id (str): ドキュメントの一意の識別子
             document (str): 保存するドキュメントの内容
             table_name (str): ドキュメントを保存するベクトルDBのテーブル名
+            attributes (DocumentAttributes | None): 絞り込み検索用の属性
         """
         pass
 
     @abstractmethod
-    def put_bulk(self, docs: list[tuple[str, str]], table_name: str) -> None:
+    def put_bulk(
+        self,
+        docs: list[tuple[str, str]],
+        table_name: str,
+        attributes_by_doc_id: dict[str, DocumentAttributes] | None = None,
+    ) -> None:
         """
         ベクトルストアにドキュメントを一括保存する
         Args:
             docs: list of (doc_id, document)
             table_name: str: ドキュメントを保存するベクトルDBのテーブル名
+            attributes_by_doc_id: doc_idごとの絞り込み検索用の属性。含まれないドキュメントは属性無しで保存する
         """
         pass
 
 
 class DuckDBVectorStoreRepository(VectorStoreRepositoryInterface):
+    """DuckDBをベクトルストアとして使うリポジトリ。
+
+    埋め込みモデルのクライアントと、ベクトルテーブルごとの検索用ハンドルは最初の検索時に作って使い回す。
+    使い終わったら `close()` するか、withブロックで使うこと。
+    """
+
     def __init__(
         self,
-        vector_db_path: str = "s3://staging-newspicks-datalake-mart/tmp/text2sql_poc/sample_vectorstore.duckdb",
+        vector_db_path: str = DEFAULT_VECTOR_DB_PATH,
         model_name: str = "text-embedding-3-small",
+        connection_manager: DuckDBConnectionManager | None = None,
+        access_mode: StoreAccessMode = "download",
+        embeddings: Embeddings | None = None,
+        embedding_cache_path: str | Path | None = None,
+        embedding_settings: EmbeddingSettings | None = None,
+    ) -> None:
+        """
+        Args:
+            embeddings: 埋め込みモデル。指定しない場合は embedding_settings の埋め込みモデルを最初に使う時点で作る
+            embedding_cache_path: 指定した場合、埋め込みモデルの前段にこのファイルに永続化する埋め込みキャッシュを置く
+            embedding_settings: 埋め込みのバックエンドとモデルの設定。指定しない場合は model_name の OpenAIEmbeddings
+        """
+        self._store = LazyDuckDBStore(vector_db_path, connection_manager, access_mode)
+        self.embedding_settings = embedding_settings or EmbeddingSettings(model_name=model_name)
+        self.model_name = self.embedding_settings.model_name
+        self._embeddings = embeddings
+        self._embedding_cache_path = embedding_cache_path
+        self._batch_embedder: BatchEmbedder | None = None
+        self._search_handles: dict[str, _VectorSearchHandle] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def vector_db_path(self) -> Path:
+        return self._store.local_path
+
+    @property
+    def store_name(self) -> str:
+        """ストアのファイル名(拡張子なし)。ストアに付随するファイルの名前に使う"""
+        return Path(self._store.original_path).stem
+
+    @property
+    def _connections(self) -> DuckDBConnectionManager:
+        return self._store.connections
+
+    @property
+    def embeddings(self) -> Embeddings:
+        if self._embeddings is None:
+            with self._lock:
+                if self._embeddings is None:
+                    embeddings = create_embeddings(self.embedding_settings)
+                    if self._embedding_cache_path is not None:
+                        embeddings = CachedEmbeddings(
+                            embeddings, self.embedding_settings.cache_key, self._embedding_cache_path
+                        )
+                    self._embeddings = embeddings
+        return self._embeddings
+
+    @property
+    def batch_embedder(self) -> BatchEmbedder:
+        """一括登録用の埋め込み。トークン数で区切ったバッチを並行にリクエストする"""
+        if self._batch_embedder is None:
+            embeddings = self.embeddings
+            with self._lock:
+                if self._batch_embedder is None:
+                    self._batch_embedder = create_batch_embedder(embeddings, self.embedding_settings)
+        return self._batch_embedder
+
+    def retrieve_relevant_docs(
+        self, question: str, table_name: str, k: int = 5, search_filter: VectorSearchFilter | None = None
+    ) -> list:
+        return self.retrieve_relevant_docs_by_vector(
+            self.embed_query(question), table_name, k=k, search_filter=search_filter
+        )
+
+    def embed_query(self, question: str) -> list[float]:
+        return self.embeddings.embed_query(question)
+
+    def retrieve_relevant_docs_by_vector(
+        self,
+        embedding: list[float],
+        table_name: str,
+        k: int = 5,
+        search_filter: VectorSearchFilter | None = None,
+    ) -> list:
+        """search_filter はSQLのWHERE句にして、絞り込んだ行だけの類似度を計算する"""
+        return self._search_handle(table_name).similarity_search_by_vector(embedding, k=k, search_filter=search_filter)
+
+    def put(self, doc_id: str, document: str, table_name: str, attributes: DocumentAttributes | None = None) -> None:
+        self._add([(doc_id, document)], table_name, {doc_id: attributes} if attributes else None)
+
+    def put_bulk(
+        self,
+        docs: list[tuple[str, str]],
+        table_name: str,
+        attributes_by_doc_id: dict[str, DocumentAttributes] | None = None,
+    ) -> None:
+        """doc_idをキーにドキュメントを一括でupsertする。
+
+        本文・埋め込みモデル・属性のハッシュが保存済みのものと同じドキュメントは、埋め込まずにスキップする。
+        それ以外はトークン数で区切ったバッチで並行に埋め込み、同じdoc_idの既存の行を消してから1回のINSERTで登録する。
+        """
+        self._add(docs, table_name, attributes_by_doc_id)
+        self.upload()
+
+    def _add(
+        self,
+        docs: list[tuple[str, str]],
+        table_name: str,
+        attributes_by_doc_id: dict[str, DocumentAttributes] | None = None,
+    ) -> None:
+        if not docs:
+            return
+        # 同じdoc_idが複数ある場合は後のドキュメントを使う
+        document_by_doc_id = dict(docs)
+        attributes_by_doc_id = {
+            doc_id: (attributes_by_doc_id or {}).get(doc_id) or DocumentAttributes() for doc_id in document_by_doc_id
+        }
+        hash_by_doc_id = {
+            doc_id: self.content_hash(document, attributes_by_doc_id[doc_id])
+            for doc_id, document in document_by_doc_id.items()
+        }
+        self._ensure_vector_table(table_name)
+        with self._connections.read_cursor() as cursor:
+            stored_hashes = _stored_content_hashes(cursor, table_name, list(document_by_doc_id))
+        changed = [
+            doc_id for doc_id, content_hash in hash_by_doc_id.items() if stored_hashes.get(doc_id) != content_hash
+        ]
+        if not changed:
+            logger.debug(f"All {len(document_by_doc_id)} documents are unchanged in {table_name}")
+            return
+
+        texts = [document_by_doc_id[doc_id] for doc_id in changed]
+        matrix = np.asarray(self.batch_embedder.embed_documents(texts), dtype=np.float32)
+        self._upsert_embeddings(changed, texts, matrix, table_name, attributes_by_doc_id, hash_by_doc_id)
+        logger.info(
+            f"Upserted {len(changed)} documents into {table_name} "
+            f"(skipped {len(document_by_doc_id) - len(changed)} unchanged documents)"
+        )
+
+    def put_embeddings(
+        self,
+        docs: list[tuple[str, str]],
+        matrix: np.ndarray,
+        table_name: str,
+        attributes_by_doc_id: dict[str, DocumentAttributes] | None = None,
+    ) -> None:
+        """埋め込み済みのドキュメントを、埋め込みモデルを呼ばずにdoc_idをキーに一括でupsertする
+        (別の手段で埋め込んだドキュメントや、ベンチマークの合成カタログを登録する用)
+
+        Args:
+            docs: (doc_id, 本文) のリスト。doc_idは重複しないこと
+            matrix: docs と同じ順に埋め込みを行に並べた行列
+        """
+        if len(docs) != len(matrix):
+            raise ValueError(f"docs and matrix must have the same length: {len(docs)} != {len(matrix)}")
+        if not docs:
+            return
+        attributes_by_doc_id = {
+            doc_id: (attributes_by_doc_id or {}).get(doc_id) or DocumentAttributes() for doc_id, _ in docs
+        }
+        doc_ids = [doc_id for doc_id, _ in docs]
+        texts = [document for _, document in docs]
+        hash_by_doc_id = {
+            doc_id: self.content_hash(document, attributes_by_doc_id[doc_id]) for doc_id, document in docs
+        }
+        self._upsert_embeddings(
+            doc_ids, texts, np.asarray(matrix, dtype=np.float32), table_name, attributes_by_doc_id, hash_by_doc_id
+        )
+        self.upload()
+
+    def _upsert_embeddings(
+        self,
+        doc_ids: list[str],
+        texts: list[str],
+        matrix: np.ndarray,
+        table_name: str,
+        attributes_by_doc_id: dict[str, DocumentAttributes],
+        hash_by_doc_id: dict[str, str],
     ) -> None:
-        self._original_vector_db_path = vector_db_path
-        if vector_db_path.startswith("s3://"):
-            self.vector_db_path = download_duckdb_from_s3(vector_db_path)
-        else:
-            self.vector_db_path = Path(vector_db_path)
-        self.model_name = model_name
-
-    def retrieve_relevant_docs(self, question: str, table_name: str, k: int = 5) -> list:
-        embeddings = OpenAIEmbeddings(model=self.model_name)
-        conn = duckdb.connect(database=self.vector_db_path)
-        vectorstore = DuckDB(connection=conn, embedding=embeddings, table_name=table_name)
-        return vectorstore.similarity_search(question, k=k)
-
-    def put(self, doc_id: str, document: str, table_name: str) -> None:
-        embeddings = OpenAIEmbeddings(model=self.model_name)
-        conn = duckdb.connect(database=self.vector_db_path)
-        vectorstore = DuckDB(connection=conn, embedding=embeddings, table_name=table_name)
-        vectorstore.add_texts([document], metadatas=[{"doc_id": doc_id}])
-        conn.close()
-
-    def put_bulk(self, docs: list[tuple[str, str]], table_name: str) -> None:
-        embeddings = OpenAIEmbeddings(model=self.model_name)
-        conn = duckdb.connect(database=self.vector_db_path)
-        vectorstore = DuckDB(connection=conn, embedding=embeddings, table_name=table_name)
-        vectorstore.add_texts(
-            texts=[text for _, text in docs],
-            metadatas=[{"doc_id": doc_id} for doc_id, _ in docs],
+        """同じdoc_idの既存の行を消してから、1回のINSERTで登録する"""
+        self._ensure_vector_table(table_name)
+        with self._connections.write_cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {table_name} WHERE doc_id IN (SELECT unnest(from_json(?, '[\"VARCHAR\"]')))",
+                (_to_json_list(doc_ids),),
+            )
+            _insert_vectors(
+                cursor,
+                table_name,
+                ids=[str(uuid.uuid4()) for _ in doc_ids],
+                texts=texts,
+                matrix=matrix,
+                metadatas=[json.dumps({"doc_id": doc_id}) for doc_id in doc_ids],
+                attributes=[attributes_by_doc_id[doc_id] for doc_id in doc_ids],
+                doc_ids=doc_ids,
+                content_hashes=[hash_by_doc_id[doc_id] for doc_id in doc_ids],
+            )
+
+    def _ensure_vector_table(self, table_name: str) -> None:
+        """ベクトルテーブルと追加の列を用意する。列の追加とdoc_idの移行はテーブルを走査するので、
+        同じコネクションマネージャ(=DBファイル)のテーブルごとにプロセスで1回だけ行う
+        """
+        connections = self._connections
+        if table_name in _ensured_vector_tables.get(connections, ()):
+            return
+        with _ensured_vector_tables_lock:
+            ensured = _ensured_vector_tables.setdefault(connections, set())
+            if table_name in ensured:
+                return
+            with connections.write_cursor() as cursor:
+                _ensure_vector_table(cursor, table_name)
+            ensured.add(table_name)
+
+    def content_hash(self, document: str, attributes: DocumentAttributes | None = None) -> str:
+        """upsert時に変更の有無を判定するハッシュ。本文・埋め込みモデル・属性のいずれかが変わると変わる"""
+        attributes = attributes or DocumentAttributes()
+        payload = "\0".join([self.embedding_settings.cache_key, attributes.model_dump_json(), document])
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def compact(self, table_name: str) -> "CompactionResult":
+        """同じdoc_idの重複した行を、最後に登録された行だけを残して削除する(upsert導入前に重複して登録されたストア用)
+
+        登録順は created_at の列で判定する。created_at の無い(列の追加前に登録された)行は、それ以降に登録された行より古いものとし、
+        created_at の無い行どうしは行の位置(rowid)の順とみなす。
+        """
+        file_bytes_before = _file_size(self.vector_db_path)
+        with self._connections.read_cursor() as cursor:
+            if not _table_exists(cursor, table_name):
+                return CompactionResult(table_name=table_name, file_bytes_before=file_bytes_before)
+        self._ensure_vector_table(table_name)
+        with self._connections.write_cursor() as cursor:
+            (rows_before,) = cursor.execute(f"SELECT count(*) FROM {table_name}").fetchone()
+            # doc_idが無い行は、それぞれを別のドキュメントとして扱う
+            duplicated_rows = f"""
+                rowid IN (
+                    SELECT rowid FROM {table_name}
+                    QUALIFY row_number() OVER (
+                        PARTITION BY coalesce(doc_id, id) ORDER BY created_at DESC NULLS LAST, rowid DESC
+                    ) > 1
+                )
+            """
+            rows_removed, embedding_bytes_removed = cursor.execute(
+                f"SELECT count(*), coalesce(sum(len(embedding)), 0) * 4 FROM {table_name} WHERE {duplicated_rows}"
+            ).fetchone()
+            cursor.execute(f"DELETE FROM {table_name} WHERE {duplicated_rows}")
+        self._connections.checkpoint()
+        result = CompactionResult(
+            table_name=table_name,
+            rows_before=rows_before,
+            rows_removed=rows_removed,
+            embedding_bytes_removed=embedding_bytes_removed,
+            file_bytes_before=file_bytes_before,
+            file_bytes_after=_file_size(self.vector_db_path),
+        )
+        logger.info(
+            f"Compacted {table_name}: removed {rows_removed} of {rows_before} rows "
+            f"({embedding_bytes_removed / 1024**2:.1f} MB of embeddings)"
+        )
+        return result
+
+    def upload(self) -> None:
+        """S3上のストアの場合、ローカルの変更をアップロードする"""
+        if self._store.is_remote:
+            self._store.upload()
+            logger.info(f"Uploaded vector store to S3: {self._store.original_path}")
+
+    def load_ids(self, table_name: str) -> set[str]:
+        """テーブルのドキュメントのIDを読み込む(インメモリの索引から削除されたドキュメントを見つける用)"""
+        with self._connections.read_cursor() as cursor:
+            if not _table_exists(cursor, table_name):
+                return set()
+            return {id_ for (id_,) in cursor.execute(f"SELECT id FROM {table_name}").fetchall()}
+
+    def load_embeddings(
+        self, table_name: str, exclude_ids: list[str] | None = None
+    ) -> tuple[list[str], np.ndarray, list[str], list[str | None]]:
+        """テーブルのドキュメントを埋め込みと一緒に読み込む(インメモリの索引を作る用)
+
+        Args:
+            exclude_ids: 読み込まないドキュメントのID(索引に追加済みのもの)
+        Returns:
+            tuple: (IDのリスト, 埋め込みを行に並べた float32 の行列, 本文のリスト, メタデータ(JSON文字列)のリスト)
+        """
+        with self._connections.read_cursor() as cursor:
+            if not _table_exists(cursor, table_name):
+                return [], np.empty((0, 0), dtype=np.float32), [], []
+            columns = cursor.execute(
+                f"""
+                SELECT id, text, embedding, metadata FROM {table_name}
+                WHERE id NOT IN (SELECT unnest(from_json(?, '["VARCHAR"]')))
+                """,
+                (_to_json_list(exclude_ids or []),),
+            ).fetchnumpy()
+        if len(columns["id"]) == 0:
+            return [], np.empty((0, 0), dtype=np.float32), [], []
+        matrix = np.stack(columns["embedding"]).astype(np.float32, copy=False)
+        return columns["id"].tolist(), matrix, columns["text"].tolist(), columns["metadata"].tolist()
+
+    def load_attributes(self, table_name: str) -> dict[str, DocumentAttributes]:
+        """テーブルのドキュメントの絞り込み検索用の属性を読み込む(インメモリの索引で絞り込む用)
+
+        Returns:
+            dict[str, DocumentAttributes]: IDをキー、属性を値とする辞書。属性の列が無いテーブルの場合は空
+        """
+        with self._connections.read_cursor() as cursor:
+            if not _table_exists(cursor, table_name) or not _has_attribute_columns(cursor, table_name):
+                return {}
+            rows = cursor.execute(f"SELECT id, {', '.join(ATTRIBUTE_COLUMNS)} FROM {table_name}").fetchall()
+        return {
+            id_: DocumentAttributes(
+                schema_name=schema_name, database_name=database_name, dialect=dialect, tags=tags or []
+            )
+            for id_, schema_name, database_name, dialect, tags in rows
+        }
+
+    def load_documents(self, table_name: str) -> dict[str, tuple[str, str | None]]:
+        """テーブルのドキュメントを埋め込み無しで読み込む
+
+        Returns:
+            dict[str, tuple[str, str | None]]: IDをキー、(本文, メタデータ(JSON文字列))を値とする辞書
+        """
+        with self._connections.read_cursor() as cursor:
+            if not _table_exists(cursor, table_name):
+                return {}
+            rows = cursor.execute(f"SELECT id, text, metadata FROM {table_name}").fetchall()
+        return {id_: (text, metadata) for id_, text, metadata in rows}
+
+    def close(self) -> None:
+        """検索用ハンドルが持つカーソルを閉じる。(コネクションプールは他のリポジトリと共有しているので閉じない)"""
+        with self._lock:
+            handles = list(self._search_handles.values())
+            self._search_handles.clear()
+        for handle in handles:
+            handle.close()
+
+    def __enter__(self) -> "DuckDBVectorStoreRepository":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _search_handle(self, table_name: str) -> "_VectorSearchHandle":
+        connections = self._connections
+        handle = self._search_handles.get(table_name)
+        if handle is not None and handle.connections is connections:
+            return handle
+        with self._lock:
+            handle = self._search_handles.get(table_name)
+            # ストアの差し替え等でコネクションプールが作り直されていたら、ハンドルも作り直す
+            if handle is None or handle.connections is not connections:
+                if handle is not None:
+                    handle.close()
+                handle = _VectorSearchHandle(connections, self.embeddings, table_name)
+                self._search_handles[table_name] = handle
+        return handle
+
+
+class _VectorSearchHandle:
+    """1つのベクトルテーブルに対する、長寿命の検索用ハンドル。
+
+    langchainのDuckDBラッパーは生成時にCREATE TABLE IF NOT EXISTSを発行するので、検索のたびに作らずに使い回す。
+    DuckDBのカーソルはスレッドセーフではないため、ラッパーとその専用カーソルの組を同時に検索するスレッドの数だけ作り、
+    検索のたびに借りて返す。
+    """
+
+    def __init__(self, connections: DuckDBConnectionManager, embeddings: Embeddings, table_name: str) -> None:
+        self.connections = connections
+        self.table_name = table_name
+        self._embeddings = embeddings
+        # (カーソルを作った時点のコネクションの世代, ラッパー)。書き込みでコネクションが開き直されたら世代が変わる
+        self._idle_vectorstores: queue.SimpleQueue[tuple[int, DuckDB]] = queue.SimpleQueue()
+        self._cursors: list[duckdb.DuckDBPyConnection] = []
+        self._lock = threading.Lock()
+
+    def similarity_search_by_vector(
+        self, embedding: list[float], k: int, search_filter: VectorSearchFilter | None = None
+    ) -> list:
+        # 検索中に他のスレッドの書き込みでカーソルが閉じられないよう、共有ロックを取る
+        with self.connections.shared_access():
+            generation, vectorstore = self._acquire()
+            try:
+                return vectorstore.similarity_search_by_vector(embedding, k=k, search_filter=search_filter)
+            finally:
+                self._idle_vectorstores.put((generation, vectorstore))
+
+    def close(self) -> None:
+        with self._lock:
+            cursors, self._cursors = self._cursors, []
+        for cursor in cursors:
+            cursor.close()
+
+    def _acquire(self) -> tuple[int, "_SearchableDuckDB"]:
+        generation = self.connections.generation
+        while True:
+            try:
+                idle_generation, vectorstore = self._idle_vectorstores.get_nowait()
+            except queue.Empty:
+                break
+            if idle_generation == generation:
+                return generation, vectorstore
+            # 書き込みで閉じられたカーソルのラッパーは捨てる
+        cursor = self.connections.open_cursor()
+        with self._lock:
+            self._cursors.append(cursor)
+        vectorstore_class = _ReadOnlyDuckDB if self.connections.opened_read_only else _SearchableDuckDB
+        return generation, vectorstore_class(connection=cursor, embedding=self._embeddings, table_name=self.table_name)
+
+
+class _SearchableDuckDB(DuckDB):
+    """langchainのDuckDBに、埋め込み済みのベクトルで検索するメソッドを足したもの"""
+
+    def similarity_search_by_vector(
+        self, embedding: list[float], k: int = 4, search_filter: VectorSearchFilter | None = None, **kwargs
+    ) -> list[Document]:
+        list_cosine_similarity = self.duckdb.FunctionExpression(
+            "list_cosine_similarity",
+            self.duckdb.ColumnExpression(self._vector_key),
+            self.duckdb.ConstantExpression(embedding),
+        )
+        filtered = search_filter is not None and not search_filter.is_empty()
+        try:
+            table = self._table
+            if filtered:
+                # 類似度より先に絞り込むので、類似度は条件に一致した行だけで計算される
+                table = table.filter(self._filter_expression(search_filter))
+            rows = (
+                table.select(
+                    self.duckdb.ColumnExpression(self._text_key),
+                    self.duckdb.ColumnExpression("metadata"),
+                    list_cosine_similarity.alias("similarity_score"),
+                )
+                .order("similarity_score desc")
+                .limit(k)
+                .fetchall()
+            )
+        except self.duckdb.BinderException:
+            if not filtered:
+                raise
+            # 属性の列が導入される前に作られたテーブル。属性が無いので、どのドキュメントも条件に一致しない
+            logger.warning(f"{self._table_name} has no attribute columns. No documents match {search_filter}")
+            return []
+        return [document_from_row(text, metadata, score) for text, metadata, score in rows]
+
+    def _filter_expression(self, search_filter: VectorSearchFilter):
+        conditions = [
+            self.duckdb.ColumnExpression(column) == self.duckdb.ConstantExpression(value)
+            for column, value in [
+                ("schema_name", search_filter.schema_name),
+                ("database_name", search_filter.database_name),
+                ("dialect", search_filter.dialect),
+            ]
+            if value is not None
+        ]
+        if search_filter.tags:
+            conditions.append(
+                self.duckdb.FunctionExpression(
+                    "list_has_all",
+                    self.duckdb.ColumnExpression("tags"),
+                    self.duckdb.ConstantExpression(search_filter.tags),
+                )
+            )
+        expression = conditions[0]
+        for condition in conditions[1:]:
+            expression = expression & condition
+        return expression
+
+
+class _ReadOnlyDuckDB(_SearchableDuckDB):
+    """読み取り専用で開いたストア用のラッパー。生成時のCREATE TABLE IF NOT EXISTSを発行しない"""
+
+    def _ensure_table(self) -> None:
+        pass
+
+
+def document_from_row(text: str, metadata: str | None, score: float) -> Document:
+    """ベクトルストアの行から検索結果のドキュメントを作る(langchainのDuckDBと同じく、類似度をメタデータに含める)"""
+    return Document(
+        page_content=text,
+        metadata={**json.loads(metadata), "_similarity_score": score} if metadata else {},
+    )
+
+
+def _ensure_vector_table(cursor, table_name: str) -> None:
+    """langchainのDuckDBと同じ列構成に、絞り込み検索用の属性の列を足したベクトルテーブルを作る
+    (属性の列が無い既存のテーブルには列を追加する)
+    """
+    cursor.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            id VARCHAR PRIMARY KEY,
+            text VARCHAR,
+            embedding FLOAT[],
+            metadata VARCHAR
+        )
+        """
+    )
+    for column, column_type in {**ATTRIBUTE_COLUMNS, **_UPSERT_COLUMNS}.items():
+        cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS {column} {column_type}")
+    # upsert導入前の行は、メタデータのdoc_idを列に移す
+    cursor.execute(
+        f"UPDATE {table_name} SET doc_id = json_extract_string(metadata, '$.doc_id') "
+        "WHERE doc_id IS NULL AND metadata IS NOT NULL"
+    )
+
+
+def _stored_content_hashes(cursor, table_name: str, doc_ids: list[str]) -> dict[str, str | None]:
+    """doc_idごとの保存済みのハッシュ。同じdoc_idの行が複数ある場合は、upsertで1行にまとめ直すためにNoneにする"""
+    rows = cursor.execute(
+        f"""
+        SELECT doc_id, CASE WHEN count(*) = 1 THEN any_value(content_hash) END
+        FROM {table_name}
+        WHERE doc_id IN (SELECT unnest(from_json(?, '["VARCHAR"]')))
+        GROUP BY doc_id
+        """,
+        (_to_json_list(doc_ids),),
+    ).fetchall()
+    return dict(rows)
+
+
+def _file_size(path: Path) -> int:
+    return os.path.getsize(path) if path.exists() else 0
+
+
+# upsert用の列。doc_idはメタデータ(JSON)のdoc_idと同じ値で、content_hashは content_hash() の値。
+# created_at は登録した時刻(compact() で最後に登録された行を残すのに使う)
+_UPSERT_COLUMNS = {"doc_id": "VARCHAR", "content_hash": "VARCHAR", "created_at": "TIMESTAMP"}
+
+# _ensure_vector_table() 済みのテーブル名。閉じて開き直したコネクションマネージャ(ダウンロードし直したファイルなど)は別に扱う
+_ensured_vector_tables: "weakref.WeakKeyDictionary[DuckDBConnectionManager, set[str]]" = weakref.WeakKeyDictionary()
+_ensured_vector_tables_lock = threading.Lock()
+
+
+def _has_attribute_columns(cursor, table_name: str) -> bool:
+    columns = cursor.execute("SELECT column_name FROM duckdb_columns() WHERE table_name = ?", (table_name,)).fetchall()
+    return set(ATTRIBUTE_COLUMNS) <= {column for (column,) in columns}
+
+
+def _insert_vectors(
+    cursor,
+    table_name: str,
+    ids: list[str],
+    texts: list[str],
+    matrix: np.ndarray,
+    metadatas: list[str],
+    attributes: list[DocumentAttributes | None],
+    doc_ids: list[str],
+    content_hashes: list[str | None],
+) -> None:
+    """埋め込みの行列を1回のINSERTで登録する。
+
+    埋め込みはJSONにすると遅いので、NumPy配列のまま (行番号, 列番号, 値) の縦持ちにして渡し、DuckDB側で行ごとのリストに集約する。
+    ID・本文・メタデータ・属性・doc_id・ハッシュはJSONで渡す。
+    """
+    attributes = [attribute or DocumentAttributes() for attribute in attributes]
+    num_rows, dimension = matrix.shape
+    vectors = {
+        "row_number": np.repeat(np.arange(num_rows, dtype=np.int32), dimension),
+        "position": np.tile(np.arange(dimension, dtype=np.int32), num_rows),
+        "value": np.ascontiguousarray(matrix, dtype=np.float32).reshape(-1),
+    }
+    cursor.register("_insert_vectors", vectors)
+    try:
+        cursor.execute(
+            f"""
+            INSERT INTO {table_name} (
+                id, text, embedding, metadata, schema_name, database_name, dialect, tags, doc_id, content_hash,
+                created_at
+            )
+            WITH documents AS (
+                SELECT
+                    unnest(from_json(?, '["VARCHAR"]')) AS id,
+                    unnest(from_json(?, '["VARCHAR"]')) AS text,
+                    unnest(from_json(?, '["VARCHAR"]')) AS metadata,
+                    unnest(from_json(?, '["VARCHAR"]')) AS schema_name,
+                    unnest(from_json(?, '["VARCHAR"]')) AS database_name,
+                    unnest(from_json(?, '["VARCHAR"]')) AS dialect,
+                    unnest(from_json(?, '[["VARCHAR"]]')) AS tags,
+                    unnest(from_json(?, '["VARCHAR"]')) AS doc_id,
+                    unnest(from_json(?, '["VARCHAR"]')) AS content_hash,
+                    unnest(range(?::INTEGER)) AS row_number
+            ), embeddings AS (
+                SELECT row_number, list(value ORDER BY position) AS embedding FROM _insert_vectors GROUP BY row_number
+            )
+            SELECT
+                d.id, d.text, e.embedding, d.metadata, d.schema_name, d.database_name, d.dialect, d.tags,
+                d.doc_id, d.content_hash, now()::TIMESTAMP
+            FROM documents AS d JOIN embeddings AS e USING (row_number)
+            ORDER BY d.row_number
+            """,
+            (
+                _to_json_list(ids),
+                _to_json_list(texts),
+                _to_json_list(metadatas),
+                json.dumps([attribute.schema_name for attribute in attributes], ensure_ascii=False),
+                json.dumps([attribute.database_name for attribute in attributes], ensure_ascii=False),
+                json.dumps([attribute.dialect for attribute in attributes], ensure_ascii=False),
+                json.dumps([attribute.tags for attribute in attributes], ensure_ascii=False),
+                _to_json_list(doc_ids),
+                json.dumps(content_hashes),
+                num_rows,
+            ),
         )
-        conn.close()
+    finally:
+        cursor.unregister("_insert_vectors")
+
+
+def _to_json_list(names: list[str]) -> str:
+    """名前のリストをJSON文字列として1つのパラメータで渡す。
+    (DuckDBにPythonのlistを直接バインドすると要素数に比例して遅くなるため)
+    """
+    return json.dumps(names, ensure_ascii=False)
+
 
-        if self._original_vector_db_path.startswith("s3://"):
-            upload_duckdb_to_s3(self.vector_db_path, self._original_vector_db_path)
-            logger.info(f"Uploaded vector store to S3: {self._original_vector_db_path}")
+def _order_by_names(names: list[str], rows: list[tuple[str, str]]) -> dict[str, str]:
+    """(名前, 値)の検索結果を、引数で渡された名前の順序(=retrieveの順位)に並べ直す。見つからない名前は含めない"""
+    value_by_name = {}
+    for name, value in rows:
+        # 同名の行が複数ある場合は最初に見つかった行を採用する
+        value_by_name.setdefault(name, value)
+    return {name: value_by_name[name] for name in names if name in value_by_name}
+
+
+class LazyDuckDBStore:
+    """リポジトリが扱うDuckDBファイルへのハンドル。
+
+    S3上のファイルのダウンロードとコネクションプールの作成を、最初に `local_path` / `connections` に
+    アクセスされるまで遅延する。これにより、リポジトリを生成しただけ(モジュールのimportやCLIの--help等)では
+    ネットワークやディスクI/Oが発生しない。
+
+    S3上のストアの開き方(access_mode):
+    - "download": ファイル全体をローカルキャッシュにダウンロードして開く。書き込み(put/put_bulk)が可能。
+      普段は読み取り専用で開くので、同じストアを読むだけの他のプロセスと同時に開ける
+    - "range_read": ダウンロードせずに読み取り専用でATTACHし、クエリに必要なページだけをレンジリードで取得する。
+      書き込みはできないので、バッチ処理などの書き込み側は "download" を使うこと
+    """
+
+    def __init__(
+        self,
+        db_path: str | Path,
+        connection_manager: DuckDBConnectionManager | None = None,
+        access_mode: StoreAccessMode = "download",
+    ) -> None:
+        self.original_path = str(db_path)
+        self.access_mode = access_mode
+        self._local_path: Path | None = None if self.is_remote else Path(db_path)
+        self._connections = connection_manager
+        self._lock = threading.Lock()
+
+    @property
+    def is_remote(self) -> bool:
+        return self.original_path.startswith("s3://")
+
+    @property
+    def is_range_read(self) -> bool:
+        return self.is_remote and self.access_mode == "range_read"
+
+    @property
+    def local_path(self) -> Path:
+        if self.is_range_read:
+            raise PermissionError(f"{self.original_path} is attached in range_read mode and has no local copy")
+        if self._local_path is None:
+            with self._lock:
+                if self._local_path is None:
+                    self._local_path = download_duckdb_from_s3(self.original_path)
+        return self._local_path
+
+    @property
+    def connections(self) -> DuckDBConnectionManager:
+        if self._connections is None or self._connections.closed:
+            if self.is_range_read:
+                with self._lock:
+                    if self._connections is None or self._connections.closed:
+                        self._connections = open_range_read_store(self.original_path)
+                return self._connections
+
+            local_path = self.local_path
+            with self._lock:
+                if self._connections is None or self._connections.closed:
+                    # 同じDBファイルを扱うリポジトリ間でコネクションプールを共有する。
+                    # 参照しかしないプロセス(MCPサーバーなど)が排他ロックを持ち続けないように、普段は読み取り専用で開き、
+                    # put/put_bulk などで書き込む間だけ排他ロックを取る
+                    self._connections = get_connection_manager(local_path, lock_on_write=True)
+        return self._connections
+
+    def upload(self) -> None:
+        """ローカルの変更をDBファイルに書き出してから、S3にアップロードする"""
+        self.connections.checkpoint()
+        upload_duckdb_to_s3(self.local_path, self.original_path)
 
 
 # 以下はS3上のduckdbファイルとやりとりするための共通処理
-def download_duckdb_from_s3(s3_path: str, local_dir: Path = Path("/tmp")) -> Path:
-    s3 = boto3.client("s3")
-    bucket, key = s3_path[5:].split("/", 1)
-    local_path = local_dir / os.path.basename(key)
-    logger.info(f"Downloading {s3_path} to {local_path}...")
-    s3.download_file(bucket, key, local_path)
-    logger.info("Download complete.")
-    return local_path
-
-
-def upload_duckdb_to_s3(local_path: Path, s3_uri: str) -> None:
-    s3 = boto3.client("s3")
-    bucket, key = s3_uri[5:].split("/", 1)
-    logger.info(f"Uploading {local_path} to {s3_uri}...")
-    s3.upload_file(str(local_path), bucket, key)
-    logger.info("Upload complete.")
+def download_duckdb_from_s3(s3_path: str, local_dir: Path | None = None) -> Path:
+    """S3上のduckdbファイルをローカルキャッシュ経由で取得する。S3側が更新されていなければダウンロードしない"""
+    store_cache = S3StoreCache(local_dir) if local_dir is not None else get_default_store_cache()
+    return store_cache.fetch(s3_path)
+
+
+def upload_duckdb_to_s3(
+    local_path: Path,
+    s3_uri: str,
+    part_size: int = DEFAULT_MULTIPART_PART_SIZE,
+    max_concurrency: int = DEFAULT_UPLOAD_CONCURRENCY,
+) -> UploadResult:
+    """DuckDBファイルをS3にアップロードする。S3上のファイルと内容が変わっていなければアップロードしない"""
+    result = upload_file_if_changed(local_path, s3_uri, part_size=part_size, max_concurrency=max_concurrency)
+    # アップロードしたファイルがキャッシュそのものの場合は、次回起動時に再ダウンロードしないよう検証用メタデータを更新する
+    store_cache = get_default_store_cache()
+    if result.uploaded and Path(local_path).resolve() == store_cache.local_path(s3_uri).resolve():
+        store_cache.record_upload(s3_uri)
+    return result
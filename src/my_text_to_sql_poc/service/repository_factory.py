@@ -0,0 +1,182 @@
+import os
+from typing import Literal
+
+from pydantic import BaseModel, Field
+
+from my_text_to_sql_poc.service.cached_repository import CachedSampleQueryRepository, CachedTableMetadataRepository
+from my_text_to_sql_poc.service.embedding_backend import (
+    EmbeddingBackend,
+    EmbeddingSettings,
+    SentenceTransformerRuntime,
+    warm_up_embeddings,
+)
+from my_text_to_sql_poc.service.embedding_cache import DEFAULT_EMBEDDING_CACHE_PATH
+from my_text_to_sql_poc.service.faiss_vector_store import FaissIndexType, FaissVectorStoreRepository
+from my_text_to_sql_poc.service.hybrid_vector_store import HybridVectorStoreRepository
+from my_text_to_sql_poc.service.numpy_vector_store import NumpyVectorStoreRepository
+from my_text_to_sql_poc.service.quantized_vector_store import QuantizedVectorStoreRepository, VectorPrecision
+from my_text_to_sql_poc.service.repository import (
+    DEFAULT_SAMPLE_QUERY_DB_PATH,
+    DEFAULT_TABLE_METADATA_DB_PATH,
+    DEFAULT_VECTOR_DB_PATH,
+    DuckDBSampleQueryRepository,
+    DuckDBTableMetadataRepository,
+    DuckDBVectorStoreRepository,
+    SampleQueryRepositoryInterface,
+    StoreAccessMode,
+    TableMetadataRepositoryInterface,
+    VectorStoreRepositoryInterface,
+)
+from my_text_to_sql_poc.service.s3_store import DEFAULT_STORE_CACHE_DIR, prefetch_s3_stores
+
+VectorIndexType = Literal["duckdb", "numpy", "faiss", "quantized", "hybrid"]
+
+
+class RepositoryConfig(BaseModel):
+    """各リポジトリの接続先の設定。`from_env()` で環境変数から上書きできる"""
+
+    table_metadata_db_path: str = Field(default=DEFAULT_TABLE_METADATA_DB_PATH, description="テーブルメタデータストア")
+    sample_query_db_path: str = Field(default=DEFAULT_SAMPLE_QUERY_DB_PATH, description="サンプルクエリストア")
+    vector_db_path: str = Field(default=DEFAULT_VECTOR_DB_PATH, description="ベクトルストア")
+    embedding_backend: EmbeddingBackend = Field(
+        default="openai", description="埋め込みのバックエンド。sentence_transformersはローカルのCPUで埋め込む"
+    )
+    embedding_model_name: str | None = Field(
+        default=None, description="埋め込みモデル名。指定しない場合はバックエンドごとの既定のモデル"
+    )
+    embedding_batch_size: int = Field(default=32, description="ローカルの埋め込みモデルで1回の推論にまとめるテキスト数")
+    embedding_num_threads: int | None = Field(default=None, description="ローカルの埋め込みモデルの推論スレッド数")
+    embedding_max_concurrent_requests: int = Field(
+        default=4, description="ベクトルストアへの一括登録時に並行に投げる埋め込みリクエスト数の上限"
+    )
+    embedding_runtime: SentenceTransformerRuntime = Field(
+        default="torch", description="ローカルの埋め込みモデルの推論方式(torch / onnx / 量子化済みのonnx_int8)"
+    )
+    use_read_cache: bool = Field(default=False, description="メタデータとサンプルクエリの読み取りをキャッシュするか")
+    embedding_cache_path: str | None = Field(
+        default=None,
+        description="埋め込みキャッシュのファイル(例: "
+        f"{DEFAULT_EMBEDDING_CACHE_PATH})。空文字列またはNoneの場合はキャッシュしない。"
+        "書き込む間はファイルを排他ロックするので、同時に動くプロセスごとに別のファイルを指定する",
+    )
+    vector_index: VectorIndexType = Field(
+        default="duckdb",
+        description="ベクトル検索の方式。numpyはテーブルごとの埋め込みをメモリ上の行列に載せて総当たりで検索し、"
+        "faissはFAISSの索引(faiss_index_type)で検索し、"
+        "quantizedは量子化した埋め込みで絞り込んだ候補を元の埋め込みで並べ替え、"
+        "hybridはキーワード検索(BM25)で絞り込んだ候補だけをベクトルで検索する",
+    )
+    faiss_index_type: FaissIndexType = Field(default="hnsw", description="vector_index=faiss の場合の索引の種類")
+    vector_precision: VectorPrecision = Field(
+        default="int8", description="vector_index=quantized の場合にメモリ上に持つ埋め込みの精度"
+    )
+    rerank_factor: int = Field(
+        default=4,
+        description="vector_index=quantized の場合に、元の埋め込みで並べ替える候補数のkに対する倍率。"
+        "0の場合は並べ替えず、元の埋め込みのコピーもディスクに書き出さない",
+    )
+    lexical_prefilter_size: int = Field(
+        default=200, description="vector_index=hybrid の場合に、キーワード検索で絞り込む候補の最大数"
+    )
+    store_access_mode: StoreAccessMode = Field(
+        default="download",
+        description="S3上のストアの開き方。range_readはダウンロードせずに読み取り専用でATTACHする(書き込み不可)",
+    )
+
+    @classmethod
+    def from_env(cls) -> "RepositoryConfig":
+        """環境変数 TEXT2SQL_TABLE_METADATA_DB_PATH 等が設定されていればその値を使う"""
+        env_by_field = {
+            "table_metadata_db_path": "TEXT2SQL_TABLE_METADATA_DB_PATH",
+            "sample_query_db_path": "TEXT2SQL_SAMPLE_QUERY_DB_PATH",
+            "vector_db_path": "TEXT2SQL_VECTOR_DB_PATH",
+            "embedding_backend": "TEXT2SQL_EMBEDDING_BACKEND",
+            "embedding_model_name": "TEXT2SQL_EMBEDDING_MODEL_NAME",
+            "embedding_batch_size": "TEXT2SQL_EMBEDDING_BATCH_SIZE",
+            "embedding_num_threads": "TEXT2SQL_EMBEDDING_NUM_THREADS",
+            "embedding_runtime": "TEXT2SQL_EMBEDDING_RUNTIME",
+            "embedding_max_concurrent_requests": "TEXT2SQL_EMBEDDING_MAX_CONCURRENT_REQUESTS",
+            "use_read_cache": "TEXT2SQL_USE_READ_CACHE",
+            "embedding_cache_path": "TEXT2SQL_EMBEDDING_CACHE_PATH",
+            "vector_index": "TEXT2SQL_VECTOR_INDEX",
+            "faiss_index_type": "TEXT2SQL_FAISS_INDEX_TYPE",
+            "vector_precision": "TEXT2SQL_VECTOR_PRECISION",
+            "rerank_factor": "TEXT2SQL_RERANK_FACTOR",
+            "lexical_prefilter_size": "TEXT2SQL_LEXICAL_PREFILTER_SIZE",
+            "store_access_mode": "TEXT2SQL_STORE_ACCESS_MODE",
+        }
+        overrides = {field: os.environ[env] for field, env in env_by_field.items() if env in os.environ}
+        return cls(**overrides)
+
+    @property
+    def store_paths(self) -> list[str]:
+        return [self.table_metadata_db_path, self.sample_query_db_path, self.vector_db_path]
+
+    @property
+    def embedding_settings(self) -> EmbeddingSettings:
+        return EmbeddingSettings(
+            backend=self.embedding_backend,
+            model_name=self.embedding_model_name,
+            batch_size=self.embedding_batch_size,
+            num_threads=self.embedding_num_threads,
+            runtime=self.embedding_runtime,
+            max_concurrent_requests=self.embedding_max_concurrent_requests,
+        )
+
+
+class RepositoryFactory:
+    """設定に基づいてリポジトリを生成する。生成されるリポジトリはストアを遅延オープンするので、生成自体は軽量"""
+
+    def __init__(self, config: RepositoryConfig | None = None) -> None:
+        self.config = config or RepositoryConfig.from_env()
+
+    def prefetch(self, max_workers: int = 3) -> None:
+        """S3上のストアを並行にローカルへ取得し、ローカルの埋め込みモデルを読み込んでおく
+        (サーバ起動時など、最初のリクエストを待たせたくない場合用)
+        """
+        warm_up_embeddings(self.config.embedding_settings)
+        if self.config.store_access_mode == "range_read":
+            return
+        prefetch_s3_stores(self.config.store_paths, max_workers=max_workers)
+
+    def table_metadata_repository(self) -> TableMetadataRepositoryInterface:
+        repository = DuckDBTableMetadataRepository(
+            self.config.table_metadata_db_path, access_mode=self.config.store_access_mode
+        )
+        return CachedTableMetadataRepository(repository) if self.config.use_read_cache else repository
+
+    def sample_query_repository(self) -> SampleQueryRepositoryInterface:
+        repository = DuckDBSampleQueryRepository(
+            self.config.sample_query_db_path, access_mode=self.config.store_access_mode
+        )
+        return CachedSampleQueryRepository(repository) if self.config.use_read_cache else repository
+
+    def vector_store_repository(self) -> VectorStoreRepositoryInterface:
+        repository = DuckDBVectorStoreRepository(
+            self.config.vector_db_path,
+            access_mode=self.config.store_access_mode,
+            embedding_cache_path=self.config.embedding_cache_path or None,
+            embedding_settings=self.config.embedding_settings,
+        )
+        if self.config.vector_index == "numpy":
+            return NumpyVectorStoreRepository(repository)
+        if self.config.vector_index == "quantized":
+            index_dir = DEFAULT_STORE_CACHE_DIR / "quantized" if self.config.store_access_mode == "range_read" else None
+            return QuantizedVectorStoreRepository(
+                repository,
+                precision=self.config.vector_precision,
+                rerank_factor=self.config.rerank_factor,
+                index_dir=index_dir,
+            )
+        if self.config.vector_index == "hybrid":
+            return HybridVectorStoreRepository(
+                repository,
+                table_metadata_repository=self.table_metadata_repository(),
+                sample_query_repository=self.sample_query_repository(),
+                prefilter_size=self.config.lexical_prefilter_size,
+            )
+        if self.config.vector_index == "faiss":
+            # レンジリードの場合はストアのローカルファイルが無いので、索引はストアのキャッシュと同じ場所に置く
+            index_dir = DEFAULT_STORE_CACHE_DIR / "faiss" if self.config.store_access_mode == "range_read" else None
+            return FaissVectorStoreRepository(repository, index_type=self.config.faiss_index_type, index_dir=index_dir)
+        return repository
@@ -0,0 +1,217 @@
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import boto3
+import duckdb
+from botocore.exceptions import ClientError
+from fsspec.spec import AbstractBufferedFile, AbstractFileSystem
+from loguru import logger
+from pydantic import BaseModel
+
+from my_text_to_sql_poc.service.duckdb_connection import DuckDBConnectionManager
+from my_text_to_sql_poc.service.s3_store import DEFAULT_STORE_CACHE_DIR, parse_s3_uri
+
+RANGE_READ_PROTOCOL = "s3range"
+REMOTE_STORE_ALIAS = "remote_store"
+
+
+class RemoteStoreChangedError(RuntimeError):
+    """読み込み中に、S3上のストアが別の内容に置き換えられた"""
+
+
+class RangeReadStats(BaseModel):
+    """レンジリードで実際に転送したバイト数と、対象ファイルのサイズの集計"""
+
+    requests: int = 0
+    bytes_transferred: int = 0
+    block_cache_hits: int = 0
+    file_size_by_path: dict[str, int] = {}
+
+    @property
+    def total_file_size(self) -> int:
+        return sum(self.file_size_by_path.values())
+
+    @property
+    def transfer_ratio(self) -> float:
+        """ファイルサイズに対する転送量の比率(1.0なら全体をダウンロードしたのと同じ)"""
+        return self.bytes_transferred / self.total_file_size if self.total_file_size else 0.0
+
+
+class S3RangeReadFileSystem(AbstractFileSystem):
+    """S3上のファイルを、必要なブロックだけHTTPレンジリードで取得する読み取り専用のfsspecファイルシステム。
+
+    DuckDBに `register_filesystem()` して `ATTACH 's3range://bucket/key' (READ_ONLY)` することで、
+    DuckDBファイル全体をダウンロードせずに、クエリが触ったページだけを取得できる。
+    取得したブロックは `{cache_dir}/{bucket}/{key}.{etag}.blocks/` にも保存するので、再起動後も再利用される。
+    (ETagごとにディレクトリを分けているので、S3側が更新されると古いブロックは使われない)
+    """
+
+    protocol = RANGE_READ_PROTOCOL
+    # fsspecのインスタンスキャッシュは使わない(s3_clientなどの引数ごとに別インスタンスにしたいため)
+    cachable = False
+
+    def __init__(
+        self,
+        s3_client=None,
+        block_size: int = 1024 * 1024,
+        cache_dir: Path | None = DEFAULT_STORE_CACHE_DIR / "blocks",
+        memory_cache_blocks: int = 256,
+        **kwargs,
+    ) -> None:
+        super().__init__(**kwargs)
+        self._s3_client = s3_client
+        self.block_size = block_size
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self._memory_cache: OrderedDict[tuple[str, str, int], bytes] = OrderedDict()
+        self._memory_cache_blocks = memory_cache_blocks
+        self._lock = threading.Lock()
+        self._info_by_path: dict[str, dict] = {}
+        self.stats = RangeReadStats()
+
+    @property
+    def s3(self):
+        if self._s3_client is None:
+            self._s3_client = boto3.client("s3")
+        return self._s3_client
+
+    def info(self, path: str, **kwargs) -> dict:
+        path = self._strip_protocol(path)
+        if path in self._info_by_path:
+            return self._info_by_path[path]
+        bucket, key = path.split("/", 1)
+        try:
+            response = self.s3.head_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response["ResponseMetadata"]["HTTPStatusCode"] == 404:
+                raise FileNotFoundError(path) from e
+            raise
+        info = {"name": path, "size": response["ContentLength"], "type": "file", "etag": response["ETag"]}
+        with self._lock:
+            self._info_by_path[path] = info
+            self.stats.file_size_by_path[path] = info["size"]
+        return info
+
+    def ls(self, path: str, detail: bool = True, **kwargs):
+        info = self.info(path)
+        return [info] if detail else [info["name"]]
+
+    def _open(self, path: str, mode: str = "rb", block_size=None, **kwargs):
+        if mode != "rb":
+            raise PermissionError(f"{self.protocol}:// is read-only. Use the download/upload path for writes.")
+        info = self.info(path)
+        return S3RangeReadFile(self, info["name"], size=info["size"])
+
+    def read_block_range(self, path: str, start: int, end: int) -> bytes:
+        """[start, end) のバイト列を、ブロック単位のキャッシュを介して返す"""
+        info = self.info(path)
+        end = min(end, info["size"])
+        if start >= end:
+            return b""
+        first_block, last_block = start // self.block_size, (end - 1) // self.block_size
+        data = b"".join(self._read_block(info, index) for index in range(first_block, last_block + 1))
+        offset = first_block * self.block_size
+        return data[start - offset : end - offset]
+
+    def _read_block(self, info: dict, index: int) -> bytes:
+        cache_key = (info["name"], info["etag"], index)
+        with self._lock:
+            block = self._memory_cache.get(cache_key)
+            if block is not None:
+                self._memory_cache.move_to_end(cache_key)
+                self.stats.block_cache_hits += 1
+                return block
+
+        block_path = self._block_path(info, index)
+        if block_path is not None and block_path.exists():
+            block = block_path.read_bytes()
+            with self._lock:
+                self.stats.block_cache_hits += 1
+        else:
+            block = self._fetch_block(info, index)
+            if block_path is not None:
+                block_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = block_path.with_name(block_path.name + f".{threading.get_ident()}.tmp")
+                tmp_path.write_bytes(block)
+                tmp_path.replace(block_path)
+
+        with self._lock:
+            self._memory_cache[cache_key] = block
+            while len(self._memory_cache) > self._memory_cache_blocks:
+                self._memory_cache.popitem(last=False)
+        return block
+
+    def _fetch_block(self, info: dict, index: int) -> bytes:
+        bucket, key = info["name"].split("/", 1)
+        start = index * self.block_size
+        end = min(start + self.block_size, info["size"]) - 1
+        try:
+            response = self.s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}", IfMatch=info["etag"])
+        except ClientError as e:
+            if e.response["ResponseMetadata"]["HTTPStatusCode"] != 412:
+                raise
+            # ATTACH済みのDB(古いETagの内容)と新しい内容のページが混ざらないよう、読み込みを続けずに止める。
+            # 次の info() で新しいETagを取り直すので、ATTACHし直せば新しい内容を読める
+            with self._lock:
+                self._info_by_path.pop(info["name"], None)
+            raise RemoteStoreChangedError(
+                f"{self.protocol}://{info['name']} was replaced on S3 (ETag {info['etag']} no longer matches). "
+                "Re-attach the store to read the new version."
+            ) from e
+        block = response["Body"].read()
+        with self._lock:
+            self.stats.requests += 1
+            self.stats.bytes_transferred += len(block)
+        return block
+
+    def _block_path(self, info: dict, index: int) -> Path | None:
+        if self.cache_dir is None:
+            return None
+        etag = info["etag"].strip('"')
+        return self.cache_dir / f"{info['name']}.{etag}.blocks" / f"{index:08d}"
+
+
+class S3RangeReadFile(AbstractBufferedFile):
+    def __init__(self, fs: S3RangeReadFileSystem, path: str, size: int) -> None:
+        # ブロック単位のキャッシュはファイルシステム側で持つので、fsspec側のキャッシュは使わない
+        super().__init__(fs, path, mode="rb", block_size=fs.block_size, cache_type="none", size=size)
+
+    def _fetch_range(self, start: int, end: int) -> bytes:
+        return self.fs.read_block_range(self.path, start, end)
+
+
+_default_filesystem: S3RangeReadFileSystem | None = None
+_default_filesystem_lock = threading.Lock()
+
+
+def get_default_range_read_filesystem() -> S3RangeReadFileSystem:
+    global _default_filesystem
+    with _default_filesystem_lock:
+        if _default_filesystem is None:
+            _default_filesystem = S3RangeReadFileSystem()
+        return _default_filesystem
+
+
+def open_range_read_store(
+    s3_uri: str,
+    filesystem: S3RangeReadFileSystem | None = None,
+    pool_size: int = 4,
+) -> DuckDBConnectionManager:
+    """S3上のDuckDBファイルを、ダウンロードせずにレンジリードで読み取り専用ATTACHしたコネクションプールを返す。
+
+    インメモリDBに `remote_store` としてATTACHし、各カーソルで `USE remote_store` しておくので、
+    リポジトリ側のSQLはテーブル名をそのまま参照できる。
+    """
+    filesystem = filesystem or get_default_range_read_filesystem()
+    bucket, key = parse_s3_uri(s3_uri)
+    root_conn = duckdb.connect(":memory:")
+    root_conn.register_filesystem(filesystem)
+    root_conn.execute(f"ATTACH '{RANGE_READ_PROTOCOL}://{bucket}/{key}' AS {REMOTE_STORE_ALIAS} (READ_ONLY)")
+    logger.info(f"Attached {s3_uri} in range-read mode")
+    return DuckDBConnectionManager(
+        s3_uri,
+        pool_size=pool_size,
+        read_only=True,
+        root_connection=root_conn,
+        cursor_init_sql=[f"USE {REMOTE_STORE_ALIAS}"],
+    )
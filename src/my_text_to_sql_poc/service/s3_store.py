@@ -0,0 +1,287 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from loguru import logger
+from pydantic import BaseModel
+
+from my_text_to_sql_poc.service.duckdb_connection import close_connection_manager
+
+DEFAULT_STORE_CACHE_DIR = Path("/tmp/text2sql_store_cache")
+# アップロード時にオブジェクトのユーザーメタデータへ記録する、ファイル内容のSHA-256
+CONTENT_SHA256_METADATA_KEY = "content-sha256"
+DEFAULT_MULTIPART_PART_SIZE = 64 * 1024 * 1024
+DEFAULT_UPLOAD_CONCURRENCY = 8
+
+
+def parse_s3_uri(s3_uri: str) -> tuple[str, str]:
+    """`s3://bucket/key` を (bucket, key) に分解する"""
+    if not s3_uri.startswith("s3://"):
+        raise ValueError(f"Not an S3 URI: {s3_uri}")
+    bucket, key = s3_uri[5:].split("/", 1)
+    return bucket, key
+
+
+class S3StoreCache:
+    """S3上のDuckDBファイルをローカルにキャッシュする。
+
+    キャッシュ済みのファイルはETag(と Last-Modified)で条件付きGETを行い、S3側が更新されていなければダウンロードしない。
+    ダウンロードは同じディレクトリの一時ファイルに書き込んでから rename するので、途中で失敗しても壊れたファイルは残らない。
+    キャッシュの配置: {cache_dir}/{bucket}/{key} と、検証用メタデータ {cache_dir}/{bucket}/{key}.meta.json
+    """
+
+    def __init__(self, cache_dir: Path = DEFAULT_STORE_CACHE_DIR, s3_client=None) -> None:
+        self.cache_dir = Path(cache_dir)
+        self._s3_client = s3_client
+        self._locks: dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+
+    @property
+    def s3(self):
+        if self._s3_client is None:
+            self._s3_client = boto3.client("s3")
+        return self._s3_client
+
+    def local_path(self, s3_uri: str) -> Path:
+        bucket, key = parse_s3_uri(s3_uri)
+        return self.cache_dir / bucket / key
+
+    def fetch(self, s3_uri: str) -> Path:
+        """S3上のファイルのローカルパスを返す。キャッシュが古い場合のみダウンロードする"""
+        bucket, key = parse_s3_uri(s3_uri)
+        local_path = self.local_path(s3_uri)
+        with self._lock_for(s3_uri):
+            cached_meta = self._load_meta(local_path)
+            conditions = {}
+            if cached_meta is not None and cached_meta.get("etag"):
+                conditions["IfNoneMatch"] = cached_meta["etag"]
+            elif cached_meta is not None and cached_meta.get("last_modified"):
+                conditions["IfModifiedSince"] = datetime.fromisoformat(cached_meta["last_modified"])
+
+            try:
+                response = self.s3.get_object(Bucket=bucket, Key=key, **conditions)
+            except ClientError as e:
+                if e.response["ResponseMetadata"]["HTTPStatusCode"] == 304:
+                    logger.info(f"Local cache of {s3_uri} is up to date: {local_path}")
+                    return local_path
+                raise
+
+            logger.info(f"Downloading {s3_uri} to {local_path}...")
+            # 差し替え前に、古いファイルを開いているコネクションを閉じておく
+            close_connection_manager(local_path)
+            _atomic_write_stream(local_path, response["Body"])
+            self._save_meta(local_path, etag=response["ETag"], last_modified=response["LastModified"].isoformat())
+            logger.info(f"Download complete: {response['ContentLength']} bytes")
+            return local_path
+
+    def fetch_many(self, s3_uris: list[str], max_workers: int = 4) -> dict[str, Path]:
+        """複数のストアを並行に取得する
+
+        Returns:
+            dict[str, Path]: S3 URIをキー、ローカルパスを値とする辞書
+        """
+        unique_uris = list(dict.fromkeys(s3_uris))
+        if not unique_uris:
+            return {}
+        _ = self.s3  # boto3のクライアント生成はスレッドセーフではないので、並行処理の前に作っておく
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(unique_uris))) as executor:
+            local_paths = list(executor.map(self.fetch, unique_uris))
+        return dict(zip(unique_uris, local_paths))
+
+    def record_upload(self, s3_uri: str) -> None:
+        """ローカルのファイルをS3にアップロードした後に呼び、キャッシュの検証用メタデータを最新のETagに更新する"""
+        bucket, key = parse_s3_uri(s3_uri)
+        local_path = self.local_path(s3_uri)
+        with self._lock_for(s3_uri):
+            response = self.s3.head_object(Bucket=bucket, Key=key)
+            self._save_meta(local_path, etag=response["ETag"], last_modified=response["LastModified"].isoformat())
+
+    def _lock_for(self, s3_uri: str) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault(s3_uri, threading.Lock())
+
+    @staticmethod
+    def _meta_path(local_path: Path) -> Path:
+        return local_path.with_name(local_path.name + ".meta.json")
+
+    def _load_meta(self, local_path: Path) -> dict | None:
+        meta_path = self._meta_path(local_path)
+        if not local_path.exists() or not meta_path.exists():
+            return None
+        try:
+            return json.loads(meta_path.read_text())
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"Ignoring broken cache metadata {meta_path}: {e}")
+            return None
+
+    def _save_meta(self, local_path: Path, etag: str, last_modified: str) -> None:
+        payload = json.dumps({"etag": etag, "last_modified": last_modified}).encode()
+        atomic_write_bytes(self._meta_path(local_path), payload)
+
+
+def _atomic_write_stream(path: Path, body, chunk_size: int = 8 * 1024 * 1024) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in iter(lambda: body.read(chunk_size), b""):
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_name, path)
+    except BaseException:
+        Path(tmp_name).unlink(missing_ok=True)
+        raise
+
+
+def atomic_write_bytes(path: Path, data: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_name, path)
+    except BaseException:
+        Path(tmp_name).unlink(missing_ok=True)
+        raise
+
+
+_default_store_cache: S3StoreCache | None = None
+_default_store_cache_lock = threading.Lock()
+
+
+def get_default_store_cache() -> S3StoreCache:
+    global _default_store_cache
+    with _default_store_cache_lock:
+        if _default_store_cache is None:
+            _default_store_cache = S3StoreCache()
+        return _default_store_cache
+
+
+def prefetch_s3_stores(s3_uris: list[str], max_workers: int = 4) -> dict[str, Path]:
+    """起動時に複数のS3上のストアをまとめて(並行に)ローカルキャッシュへ取得しておく。s3:// 以外のパスは無視する"""
+    return get_default_store_cache().fetch_many(
+        [uri for uri in s3_uris if uri.startswith("s3://")],
+        max_workers=max_workers,
+    )
+
+
+class UploadResult(BaseModel):
+    s3_uri: str
+    uploaded: bool
+    bytes: int
+    elapsed_seconds: float
+    content_sha256: str
+
+    @property
+    def throughput_mb_per_second(self) -> float:
+        if not self.uploaded or self.elapsed_seconds <= 0:
+            return 0.0
+        return self.bytes / 1024 / 1024 / self.elapsed_seconds
+
+
+class _UploadProgress:
+    """boto3のアップロードのコールバック。進捗が report_every 割合進むごとに転送量とスループットをログに出す"""
+
+    def __init__(self, label: str, total_bytes: int, report_every: float = 0.1) -> None:
+        self._label = label
+        self._total_bytes = total_bytes
+        self._report_every = report_every
+        self._transferred = 0
+        self._next_report = report_every
+        self._started_at = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, bytes_amount: int) -> None:
+        # マルチパートの各パートは別スレッドから報告される
+        with self._lock:
+            self._transferred += bytes_amount
+            progress = self._transferred / self._total_bytes if self._total_bytes else 1.0
+            if progress < self._next_report:
+                return
+            while self._next_report <= progress:
+                self._next_report += self._report_every
+            elapsed = time.perf_counter() - self._started_at
+        throughput = self._transferred / 1024 / 1024 / elapsed if elapsed > 0 else 0.0
+        logger.info(
+            f"Uploading {self._label}: {progress:.0%} "
+            f"({self._transferred / 1024 / 1024:.1f}/{self._total_bytes / 1024 / 1024:.1f} MiB, {throughput:.1f} MiB/s)"
+        )
+
+
+def compute_file_sha256(path: Path, chunk_size: int = 8 * 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def upload_file_if_changed(
+    local_path: Path,
+    s3_uri: str,
+    s3_client=None,
+    part_size: int = DEFAULT_MULTIPART_PART_SIZE,
+    max_concurrency: int = DEFAULT_UPLOAD_CONCURRENCY,
+    force: bool = False,
+) -> UploadResult:
+    """ローカルファイルをS3にアップロードする。S3上のオブジェクトと内容が同じ場合はアップロードしない。
+
+    内容の比較には、アップロード時にオブジェクトのメタデータ(x-amz-meta-content-sha256)へ記録したSHA-256を使う。
+    (マルチパートアップロードのETagはファイル内容のMD5にならないため、ETagとは比較しない)
+    part_size を超えるファイルは、part_size ごとのパートに分けて max_concurrency 並列でアップロードする。
+    """
+    s3 = s3_client or boto3.client("s3")
+    bucket, key = parse_s3_uri(s3_uri)
+    local_path = Path(local_path)
+    size = local_path.stat().st_size
+    content_sha256 = compute_file_sha256(local_path)
+
+    if not force:
+        try:
+            remote_metadata = s3.head_object(Bucket=bucket, Key=key).get("Metadata", {})
+        except ClientError as e:
+            if e.response["ResponseMetadata"]["HTTPStatusCode"] != 404:
+                raise
+            remote_metadata = {}
+        if remote_metadata.get(CONTENT_SHA256_METADATA_KEY) == content_sha256:
+            logger.info(f"Skipped uploading {local_path}: {s3_uri} is already up to date")
+            return UploadResult(
+                s3_uri=s3_uri, uploaded=False, bytes=size, elapsed_seconds=0.0, content_sha256=content_sha256
+            )
+
+    logger.info(f"Uploading {local_path} to {s3_uri} ({size / 1024 / 1024:.1f} MiB)...")
+    started_at = time.perf_counter()
+    s3.upload_file(
+        str(local_path),
+        bucket,
+        key,
+        ExtraArgs={"Metadata": {CONTENT_SHA256_METADATA_KEY: content_sha256}},
+        Config=TransferConfig(
+            multipart_threshold=part_size,
+            multipart_chunksize=part_size,
+            max_concurrency=max_concurrency,
+        ),
+        Callback=_UploadProgress(s3_uri, size),
+    )
+    result = UploadResult(
+        s3_uri=s3_uri,
+        uploaded=True,
+        bytes=size,
+        elapsed_seconds=time.perf_counter() - started_at,
+        content_sha256=content_sha256,
+    )
+    logger.info(
+        f"Upload complete: {result.bytes} bytes in {result.elapsed_seconds:.1f}s "
+        f"({result.throughput_mb_per_second:.1f} MiB/s)"
+    )
+    return result
@@ -0,0 +1,68 @@
+from collections import defaultdict
+
+import numpy as np
+from pydantic import BaseModel, Field
+
+
+class DocumentAttributes(BaseModel):
+    """ベクトルストアのドキュメントに付ける、絞り込み検索用の属性。埋め込みと同じ行に型付きの列として保存する"""
+
+    schema_name: str | None = Field(default=None, description="テーブルのスキーマ名(dynamodb.news の dynamodb など)")
+    database_name: str | None = Field(default=None, description="テーブルがあるデータベース名")
+    dialect: str | None = Field(default=None, description="SQLの方言(SQLite, Redshift など)")
+    tags: list[str] = Field(default_factory=list, description="任意のタグ")
+
+    @classmethod
+    def from_table_name(cls, table_name: str, **kwargs) -> "DocumentAttributes":
+        """`スキーマ名.テーブル名` 形式のテーブル名からスキーマ名を取り出して属性を作る"""
+        schema_name, _, _ = table_name.rpartition(".")
+        return cls(schema_name=schema_name or None, **kwargs)
+
+
+class VectorSearchFilter(DocumentAttributes):
+    """ベクトル検索の絞り込み条件。Noneの項目は絞り込まず、tagsは指定したタグをすべて持つドキュメントに絞り込む"""
+
+    def is_empty(self) -> bool:
+        return self.schema_name is None and self.database_name is None and self.dialect is None and not self.tags
+
+
+# 属性を保存する列と型。DuckDBのベクトルテーブルに、langchainのDuckDBの列(id, text, embedding, metadata)と並べて持つ
+ATTRIBUTE_COLUMNS = {
+    "schema_name": "VARCHAR",
+    "database_name": "VARCHAR",
+    "dialect": "VARCHAR",
+    "tags": "VARCHAR[]",
+}
+
+
+class AttributeIndex:
+    """メモリ上の索引の行ごとの属性。絞り込み条件に一致する行のマスクを、行ごとのループ無しで求める"""
+
+    def __init__(self, attributes: list[DocumentAttributes | None]) -> None:
+        self._length = len(attributes)
+        self._values_by_field = {
+            field: np.asarray([getattr(attribute, field, None) or "" for attribute in attributes], dtype=np.str_)
+            for field in ["schema_name", "database_name", "dialect"]
+        }
+        rows_by_tag: dict[str, list[int]] = defaultdict(list)
+        for row, attribute in enumerate(attributes):
+            for tag in attribute.tags if attribute else []:
+                rows_by_tag[tag].append(row)
+        self._rows_by_tag = {tag: np.asarray(rows, dtype=np.int64) for tag, rows in rows_by_tag.items()}
+
+    def mask(self, search_filter: VectorSearchFilter) -> np.ndarray:
+        """絞り込み条件に一致する行を True にした bool の配列"""
+        mask = np.ones(self._length, dtype=bool)
+        for field, values in self._values_by_field.items():
+            value = getattr(search_filter, field)
+            if value is not None:
+                mask &= values == value
+        for tag in search_filter.tags:
+            tag_mask = np.zeros(self._length, dtype=bool)
+            tag_mask[self._rows_by_tag.get(tag, np.empty(0, dtype=np.int64))] = True
+            mask &= tag_mask
+        return mask
+
+    def rows(self, search_filter: VectorSearchFilter) -> np.ndarray:
+        """絞り込み条件に一致する行番号"""
+        return np.flatnonzero(self.mask(search_filter))
@@ -0,0 +1,59 @@
+from pathlib import Path
+
+import pytest
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from my_text_to_sql_poc.app.text2sql.text2sql_facade import Text2SQLFacade
+from my_text_to_sql_poc.service.repository import (
+    DuckDBSampleQueryRepository,
+    DuckDBTableMetadataRepository,
+    DuckDBVectorStoreRepository,
+)
+from my_text_to_sql_poc.service.vector_filter import DocumentAttributes, VectorSearchFilter
+
+
+@pytest.fixture
+def text2sql_facade(tmp_path: Path, monkeypatch) -> Text2SQLFacade:
+    # ModelGatewayの生成にAPIキーが必要なのでダミーを設定する(このテストではLLMは呼ばない)
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    vector_store_repo = DuckDBVectorStoreRepository(
+        str(tmp_path / "vectorstore.duckdb"), embeddings=DeterministicFakeEmbedding(size=16)
+    )
+    vector_store_repo.put_bulk([("schema.users", "ユーザー"), ("schema.orders", "注文")], "table_embeddings")
+    vector_store_repo.put_bulk([("daily_orders", "日別の注文数")], "query_embeddings")
+    table_metadata_repo = DuckDBTableMetadataRepository(str(tmp_path / "table_metadata_store.duckdb"))
+    table_metadata_repo.put_bulk([("schema.users", "usersのスキーマ"), ("schema.orders", "ordersのスキーマ")])
+    sample_query_repo = DuckDBSampleQueryRepository(str(tmp_path / "sample_query_store.duckdb"))
+    sample_query_repo.put("daily_orders", "select count(*) from schema.orders", "url")
+    return Text2SQLFacade(vector_store_repo, table_metadata_repo, sample_query_repo)
+
+
+def test_テーブルとサンプルクエリを1回の埋め込みでretrieveする(text2sql_facade: Text2SQLFacade, mocker):
+    # Arrange
+    embed_query = mocker.spy(text2sql_facade.vector_store_repo, "embed_query")
+
+    # Act
+    related_metadata_by_table, related_sql_by_query_name = text2sql_facade.retrieve_context(
+        "注文", k_tables=1, k_queries=1
+    )
+
+    # Assert
+    assert related_metadata_by_table == {"schema.orders": "ordersのスキーマ"}
+    assert related_sql_by_query_name == {"daily_orders": "select count(*) from schema.orders"}
+    assert embed_query.call_count == 1, "質問の埋め込みは1回だけ計算すること"
+
+
+def test_スキーマで絞り込んでretrieveする(text2sql_facade: Text2SQLFacade):
+    # Arrange
+    text2sql_facade.vector_store_repo.put(
+        "analytics.orders", "注文", "table_embeddings", DocumentAttributes(schema_name="analytics")
+    )
+    text2sql_facade.table_metadata_repo.put("analytics.orders", "analytics.ordersのスキーマ")
+
+    # Act
+    related_metadata_by_table = text2sql_facade.retrieve_related_tables(
+        "注文", k=5, search_filter=VectorSearchFilter(schema_name="analytics")
+    )
+
+    # Assert
+    assert related_metadata_by_table == {"analytics.orders": "analytics.ordersのスキーマ"}
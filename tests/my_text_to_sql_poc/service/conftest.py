@@ -0,0 +1,51 @@
+from pathlib import Path
+from typing import Callable
+
+import pytest
+from langchain_core.embeddings import DeterministicFakeEmbedding, Embeddings
+
+from my_text_to_sql_poc.service.duckdb_connection import close_all_connection_managers
+from my_text_to_sql_poc.service.repository import DuckDBVectorStoreRepository, TableMetadataRepositoryInterface
+
+VectorStoreFactory = Callable[..., DuckDBVectorStoreRepository]
+
+
+class InMemoryTableMetadataRepository(TableMetadataRepositoryInterface):
+    def __init__(self, metadata_by_table: dict[str, str] | None = None) -> None:
+        self.metadata_by_table = dict(metadata_by_table or {})
+
+    def get(self, table_names: list[str]) -> dict[str, str]:
+        return {name: self.metadata_by_table[name] for name in table_names if name in self.metadata_by_table}
+
+    def put(self, table_name: str, metadata: str) -> None:
+        self.metadata_by_table[table_name] = metadata
+
+    def get_all(self) -> dict[str, str]:
+        return dict(self.metadata_by_table)
+
+    def put_bulk(self, items: list[tuple[str, str]]) -> None:
+        self.metadata_by_table.update(items)
+
+
+@pytest.fixture
+def vector_store_factory(tmp_path: Path) -> VectorStoreFactory:
+    """tmp_path の vectorstore.duckdb を開くベクトルストアを作る。埋め込みは指定しなければ決定的な偽物を使う"""
+
+    def create(size: int = 8, embeddings: Embeddings | None = None) -> DuckDBVectorStoreRepository:
+        return DuckDBVectorStoreRepository(
+            str(tmp_path / "vectorstore.duckdb"), embeddings=embeddings or DeterministicFakeEmbedding(size=size)
+        )
+
+    return create
+
+
+@pytest.fixture
+def table_metadata_repository() -> InMemoryTableMetadataRepository:
+    return InMemoryTableMetadataRepository()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def close_connection_managers():
+    """プロセス終了時(atexit)ではなく、ログの出力先が開いている間にコネクションプールを閉じる"""
+    yield
+    close_all_connection_managers()
@@ -0,0 +1,320 @@
+import json
+from pathlib import Path
+from typing import Any
+
+import pytest
+from langchain_core.language_models import FakeListChatModel
+from pydantic import BaseModel, Field
+
+from my_text_to_sql_poc.app.prepare_RAG_documents_batch import DocumentSummaryError, RAGDocumentPreparer
+from my_text_to_sql_poc.service.batch_api import (
+    BatchAPIError,
+    BatchAPIRunner,
+    BatchStatus,
+    LocalFileBatchAPIBackend,
+)
+from my_text_to_sql_poc.service.llm_response_cache import LLMResponseCache, response_cache_key
+from my_text_to_sql_poc.service.model_gateway import ModelGateway, ModelGatewaySettings
+from my_text_to_sql_poc.service.repository import (
+    DuckDBSampleQueryRepository,
+    DuckDBTableMetadataRepository,
+)
+
+
+class Summary(BaseModel):
+    summary: str = Field(description="概要")
+
+
+class FakeChatCompletions:
+    """バッチのリクエストごとに、プロンプトを含む要約をJSONで返す。fail_on を含むプロンプトは失敗させ、
+    invalid_on を含むプロンプトには出力スキーマに合わない応答を返す
+    """
+
+    def __init__(self, fail_on: str | None = None, invalid_on: str | None = None) -> None:
+        self.prompts: list[str] = []
+        self.fail_on = fail_on
+        self.invalid_on = invalid_on
+
+    def __call__(self, body: dict[str, Any]) -> dict[str, Any]:
+        prompt = body["messages"][0]["content"]
+        self.prompts.append(prompt)
+        if self.fail_on is not None and self.fail_on in prompt:
+            raise ValueError("server_error")
+        if self.invalid_on is not None and self.invalid_on in prompt:
+            return {"choices": [{"index": 0, "message": {"role": "assistant", "content": "要約できません"}}]}
+        schema = body["response_format"]["json_schema"]["schema"]
+        content = json.dumps({field: f"{prompt}の要約" for field in schema["properties"]}, ensure_ascii=False)
+        return {"choices": [{"index": 0, "message": {"role": "assistant", "content": content}}]}
+
+
+class FailingModelGateway(ModelGateway):
+    """fail_on を含むプロンプトの要約だけを失敗させる"""
+
+    def __init__(self, fail_on: str) -> None:
+        super().__init__(settings=ModelGatewaySettings(response_cache_path=""), llm=FakeListChatModel(responses=[]))
+        self.fail_on = fail_on
+
+    async def agenerate_response_with_structured_output(
+        self, prompt, output_schema, timeout_seconds=None, use_cache=None
+    ):
+        if self.fail_on in prompt:
+            raise ValueError("server_error")
+        return output_schema.model_validate({field: "要約" for field in output_schema.model_fields})
+
+
+class PendingBatchAPIBackend(LocalFileBatchAPIBackend):
+    """投入したバッチがいつまでも完了しないバックエンド(完了を待つ間にプロセスが止まる場合の模擬)"""
+
+    def status(self, batch_id: str) -> BatchStatus:
+        return BatchStatus(batch_id=batch_id, state="in_progress")
+
+
+def _runner(
+    tmp_path: Path, respond: FakeChatCompletions, backend: LocalFileBatchAPIBackend | None = None, **kwargs: Any
+) -> BatchAPIRunner:
+    return BatchAPIRunner(
+        backend or LocalFileBatchAPIBackend(tmp_path / "backend", respond),
+        response_cache=LLMResponseCache(tmp_path / "llm_response_cache.duckdb"),
+        work_dir=tmp_path / "batch_api",
+        poll_interval_seconds=0,
+        **kwargs,
+    )
+
+
+def test_プロンプトをChat_Completionsのリクエストとして1行ずつ書き出す(tmp_path: Path):
+    # Arrange
+    runner = _runner(tmp_path, FakeChatCompletions())
+
+    # Act
+    ((batch_file, ids),) = runner.write_batch_files({"schema.users": "ユーザー", "schema.orders": "注文"}, Summary)
+
+    # Assert
+    requests = [json.loads(line) for line in batch_file.read_text().splitlines()]
+    assert ids == ["schema.users", "schema.orders"]
+    assert [request["custom_id"] for request in requests] == ["request-0", "request-1"]
+    assert requests[0]["url"] == "/v1/chat/completions"
+    assert requests[0]["body"]["messages"] == [{"role": "user", "content": "ユーザー"}]
+    assert requests[0]["body"]["response_format"]["json_schema"]["schema"] == Summary.model_json_schema()
+
+
+def test_リクエスト数かファイルサイズが上限を超える場合は複数のバッチファイルに分ける(tmp_path: Path):
+    # Arrange
+    prompts = {f"schema.table_{i}": f"テーブル{i}" for i in range(5)}
+    by_count = _runner(tmp_path, FakeChatCompletions(), max_requests_per_batch=2)
+    ((first_file, _),) = by_count.write_batch_files({"schema.table_0": "テーブル0"}, Summary)
+    by_size = _runner(tmp_path, FakeChatCompletions(), max_batch_file_bytes=3 * first_file.stat().st_size + 100)
+
+    # Act
+    split_by_count = by_count.write_batch_files(prompts, Summary)
+    split_by_size = by_size.write_batch_files(prompts, Summary)
+
+    # Assert
+    assert [ids for _, ids in split_by_count] == [
+        ["schema.table_0", "schema.table_1"],
+        ["schema.table_2", "schema.table_3"],
+        ["schema.table_4"],
+    ]
+    assert [len(ids) for _, ids in split_by_size] == [3, 2]
+    assert all(batch_file.stat().st_size <= by_size.max_batch_file_bytes for batch_file, _ in split_by_size)
+    custom_ids = [json.loads(line)["custom_id"] for line in split_by_count[1][0].read_text().splitlines()]
+    assert custom_ids == ["request-0", "request-1"], "連番はファイルごとに振ること"
+    with pytest.raises(BatchAPIError, match="exceeds the batch file size limit"):
+        _runner(tmp_path, FakeChatCompletions(), max_batch_file_bytes=10).write_batch_files(prompts, Summary)
+
+
+def test_分けたバッチの結果をまとめて返す(tmp_path: Path, mocker):
+    # Arrange
+    respond = FakeChatCompletions()
+    runner = _runner(tmp_path, respond, max_requests_per_batch=1)
+    submit = mocker.spy(LocalFileBatchAPIBackend, "submit")
+
+    # Act
+    summaries = runner.run({"schema.users": "ユーザー", "schema.orders": "注文"}, Summary)
+
+    # Assert
+    assert submit.call_count == 2
+    assert summaries == {
+        "schema.users": Summary(summary="ユーザーの要約"),
+        "schema.orders": Summary(summary="注文の要約"),
+    }
+    assert not runner.manifest_path(Summary).exists(), "結果を受け取ったバッチはマニフェストから消すこと"
+
+
+def test_完了を待つ間に止まったバッチは再実行時に投入し直さずに結果を待つ(tmp_path: Path, mocker):
+    # Arrange
+    respond = FakeChatCompletions()
+    prompts = {"schema.users": "ユーザー", "schema.orders": "注文"}
+    pending_backend = PendingBatchAPIBackend(tmp_path / "backend", respond)
+    interrupted = _runner(tmp_path, respond, backend=pending_backend, timeout_seconds=0)
+    with pytest.raises(BatchAPIError, match="Timed out"):
+        interrupted.run(prompts, Summary)
+    manifest = json.loads(interrupted.manifest_path(Summary).read_text())
+    submit = mocker.spy(LocalFileBatchAPIBackend, "submit")
+
+    # Act
+    summaries = _runner(tmp_path, respond).run({**prompts, "schema.items": "商品"}, Summary)
+
+    # Assert
+    assert [batch["ids"] for batch in manifest["batches"]] == [["schema.users", "schema.orders"]]
+    assert submit.call_count == 1, "記録したバッチに無いプロンプトだけを投入すること"
+    assert sorted(respond.prompts) == sorted(["ユーザー", "注文", "商品"]), "同じプロンプトを二重に処理しないこと"
+    assert list(summaries) == ["schema.users", "schema.orders", "schema.items"]
+    assert not interrupted.manifest_path(Summary).exists()
+
+
+def test_バッチの結果をIDごとに対応付け再実行時はキャッシュ済みのプロンプトを投入しない(tmp_path: Path):
+    # Arrange
+    respond = FakeChatCompletions()
+    _runner(tmp_path, respond).run({"schema.users": "ユーザー"}, Summary)
+    respond.prompts.clear()
+
+    # Act
+    summaries = _runner(tmp_path, respond).run({"schema.users": "ユーザー", "schema.orders": "注文"}, Summary)
+
+    # Assert
+    assert summaries == {
+        "schema.users": Summary(summary="ユーザーの要約"),
+        "schema.orders": Summary(summary="注文の要約"),
+    }
+    assert respond.prompts == ["注文"], "キャッシュに無いプロンプトだけをバッチに含めること"
+
+
+def test_一部のリクエストが失敗したら成功した分を保存して例外を投げ再実行で失敗した分だけ投入する(tmp_path: Path):
+    # Arrange
+    failing = FakeChatCompletions(fail_on="注文")
+    with pytest.raises(BatchAPIError, match="1 of 2 requests"):
+        _runner(tmp_path, failing).run({"schema.users": "ユーザー", "schema.orders": "注文"}, Summary)
+    respond = FakeChatCompletions()
+
+    # Act
+    summaries = _runner(tmp_path, respond).run({"schema.users": "ユーザー", "schema.orders": "注文"}, Summary)
+
+    # Assert
+    assert list(summaries) == ["schema.users", "schema.orders"], "プロンプトと同じ順序で返すこと"
+    assert respond.prompts == ["注文"], "成功したリクエストの結果はキャッシュから使うこと"
+
+
+def test_バッチAPIで生成した要約をベクトルストアに登録する(
+    tmp_path: Path, vector_store_factory, table_metadata_repository
+):
+    # Arrange
+    table_metadata_repository = DuckDBTableMetadataRepository(str(tmp_path / "table_metadata_store.duckdb"))
+    table_metadata_repository.put("schema.users", "usersテーブルのメタデータ")
+    sample_query_repository = DuckDBSampleQueryRepository(str(tmp_path / "sample_query_store.duckdb"))
+    sample_query_repository.put("query1", "SELECT * FROM schema.users", "https://example.com/query1")
+    vector_store_repository = vector_store_factory()
+    # リアルタイムのAPIを呼ばないことを確かめるため、応答の無いモデルを渡す
+    model_gateway = ModelGateway(
+        settings=ModelGatewaySettings(response_cache_path=""), llm=FakeListChatModel(responses=[])
+    )
+    respond = FakeChatCompletions()
+    preparer = RAGDocumentPreparer(
+        table_metadata_repository=table_metadata_repository,
+        sample_query_repository=sample_query_repository,
+        vector_store_repository=vector_store_repository,
+        model_gateway=model_gateway,
+        batch_runner=_runner(tmp_path, respond),
+    )
+
+    # Act
+    preparer.register_table_metadata()
+    preparer.register_sample_queries()
+
+    # Assert
+    assert len(respond.prompts) == 2, "テーブルとサンプルクエリの要約を1件ずつバッチで生成すること"
+    table_documents = vector_store_repository.load_documents("table_embeddings")
+    query_documents = vector_store_repository.load_documents("query_embeddings")
+    assert len(table_documents) == len(query_documents) == 1
+    ((table_document, _),) = table_documents.values()
+    assert "usersテーブルのメタデータ" in json.loads(table_document)["summary"]
+
+
+def test_一部の要約が失敗しても成功した要約を登録してから例外を投げる(tmp_path: Path, vector_store_factory):
+    # Arrange
+    table_metadata_repository = DuckDBTableMetadataRepository(str(tmp_path / "table_metadata_store.duckdb"))
+    table_metadata_repository.put_bulk(
+        [("schema.users", "usersテーブルのメタデータ"), ("schema.orders", "ordersテーブルのメタデータ")]
+    )
+    sample_query_repository = DuckDBSampleQueryRepository(str(tmp_path / "sample_query_store.duckdb"))
+    sample_query_repository.put("query1", "SELECT * FROM schema.users", "https://example.com/query1")
+    vector_store_repository = vector_store_factory()
+    preparer = RAGDocumentPreparer(
+        table_metadata_repository=table_metadata_repository,
+        sample_query_repository=sample_query_repository,
+        vector_store_repository=vector_store_repository,
+        model_gateway=FailingModelGateway(fail_on="ordersテーブル"),
+    )
+
+    # Act
+    with pytest.raises(DocumentSummaryError, match=r"1 of 2 documents: \['schema.orders'\]"):
+        preparer.register_table_metadata()
+
+    # Assert
+    documents = vector_store_repository.load_documents("table_embeddings")
+    assert [json.loads(metadata)["doc_id"] for _, metadata in documents.values()] == [
+        "schema.users"
+    ], "成功した要約は登録すること"
+
+
+def test_要約のプロンプトは集合の順序によらず同じキャッシュのキーになる(
+    tmp_path: Path, vector_store_factory, table_metadata_repository
+):
+    # Arrange
+    table_metadata_repository.put_bulk([("schema.users", "usersのメタデータ"), ("schema.orders", "ordersのメタデータ")])
+    preparer = RAGDocumentPreparer(
+        table_metadata_repository=table_metadata_repository,
+        sample_query_repository=DuckDBSampleQueryRepository(str(tmp_path / "sample_query_store.duckdb")),
+        vector_store_repository=vector_store_factory(),
+        model_gateway=FailingModelGateway(fail_on="-"),
+    )
+    # 集合の反復順序はプロセスごとに変わるので、順序だけが違う入力で再現する
+    queries = ["SELECT * FROM schema.users", "SELECT * FROM schema.orders", "SELECT 1"]
+
+    # Act
+    table_prompts = [
+        preparer._table_summary_prompt("schema.users", "usersのメタデータ", ordered)
+        for ordered in [dict.fromkeys(queries).keys(), dict.fromkeys(reversed(queries)).keys()]
+    ]
+    query_prompts = [
+        preparer._query_summary_prompt("SELECT ...", ordered)
+        for ordered in [
+            dict.fromkeys(["schema.users", "schema.orders"]).keys(),
+            dict.fromkeys(["schema.orders", "schema.users"]).keys(),
+        ]
+    ]
+
+    # Assert
+    assert len({response_cache_key("gpt-4o-mini", 0.7, prompt, Summary) for prompt in table_prompts}) == 1
+    assert len({response_cache_key("gpt-4o-mini", 0.7, prompt, Summary) for prompt in query_prompts}) == 1
+
+
+def test_バッチAPIで一部の要約が失敗しても成功した要約を登録してから例外を投げる(tmp_path: Path, vector_store_factory):
+    # Arrange
+    table_metadata_repository = DuckDBTableMetadataRepository(str(tmp_path / "table_metadata_store.duckdb"))
+    table_metadata_repository.put_bulk(
+        [("schema.users", "usersテーブルのメタデータ"), ("schema.orders", "ordersテーブルのメタデータ")]
+    )
+    sample_query_repository = DuckDBSampleQueryRepository(str(tmp_path / "sample_query_store.duckdb"))
+    sample_query_repository.put("query1", "SELECT * FROM schema.users", "https://example.com/query1")
+    vector_store_repository = vector_store_factory()
+    # ordersテーブルの要約は、結果ファイルに出力スキーマに合わない応答として返る
+    respond = FakeChatCompletions(invalid_on="ordersテーブル")
+    preparer = RAGDocumentPreparer(
+        table_metadata_repository=table_metadata_repository,
+        sample_query_repository=sample_query_repository,
+        vector_store_repository=vector_store_repository,
+        model_gateway=FailingModelGateway(fail_on="-"),
+        batch_runner=_runner(tmp_path, respond),
+    )
+
+    # Act
+    with pytest.raises(DocumentSummaryError, match=r"1 of 2 documents: \['schema.orders'\]"):
+        preparer.register_table_metadata()
+    preparer.register_sample_queries()
+
+    # Assert
+    table_documents = vector_store_repository.load_documents("table_embeddings")
+    assert [json.loads(metadata)["doc_id"] for _, metadata in table_documents.values()] == [
+        "schema.users"
+    ], "成功した要約は登録すること"
+    assert len(vector_store_repository.load_documents("query_embeddings")) == 1
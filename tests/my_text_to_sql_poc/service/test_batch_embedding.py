@@ -0,0 +1,78 @@
+import threading
+import time
+from pathlib import Path
+
+from langchain_core.embeddings import DeterministicFakeEmbedding, Embeddings
+from pytest_mock import MockerFixture
+
+from my_text_to_sql_poc.service.batch_embedding import BatchEmbedder, pack_by_token_budget
+from my_text_to_sql_poc.service.embedding_backend import EmbeddingSettings
+from my_text_to_sql_poc.service.repository import DuckDBVectorStoreRepository
+
+
+def test_トークン数と件数の上限を超えないようにバッチに詰める():
+    # Act
+    batches = pack_by_token_budget([3, 4, 2, 10, 1, 1, 1], max_tokens=7, max_texts=2)
+
+    # Assert
+    assert batches == [[0, 1], [2], [3], [4, 5], [6]], "上限を超える1件は単独のバッチにすること"
+
+
+class _ConcurrencyRecordingEmbedding(Embeddings):
+    """同時に処理しているリクエスト数の最大値を記録するダミーの埋め込み"""
+
+    def __init__(self, size: int) -> None:
+        self._embeddings = DeterministicFakeEmbedding(size=size)
+        self._lock = threading.Lock()
+        self._running = 0
+        self.max_running = 0
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        with self._lock:
+            self._running += 1
+            self.max_running = max(self.max_running, self._running)
+        time.sleep(0.05)
+        with self._lock:
+            self._running -= 1
+        return self._embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embeddings.embed_query(text)
+
+
+def test_バッチを並行に埋め込み入力と同じ順序で返す():
+    # Arrange
+    embeddings = _ConcurrencyRecordingEmbedding(size=8)
+    embedder = BatchEmbedder(
+        embeddings, count_tokens=len, max_tokens_per_request=10, max_texts_per_request=3, max_concurrent_requests=2
+    )
+    texts = [f"テキスト{i}" for i in range(12)]
+
+    # Act
+    actual = embedder.embed_documents(texts)
+
+    # Assert
+    assert actual == DeterministicFakeEmbedding(size=8).embed_documents(texts)
+    assert embeddings.max_running == 2, "並行数の上限までリクエストを同時に投げること"
+
+
+def test_一括登録は1回のINSERTで埋め込みと一緒に保存する(tmp_path: Path, mocker: MockerFixture):
+    # Arrange
+    embed_documents = mocker.spy(DeterministicFakeEmbedding, "embed_documents")
+    repository = DuckDBVectorStoreRepository(
+        str(tmp_path / "vectorstore.duckdb"),
+        embeddings=DeterministicFakeEmbedding(size=16),
+        embedding_settings=EmbeddingSettings(max_texts_per_request=10),
+    )
+    docs = [(f"table_{i}", f"テーブル{i}の説明") for i in range(25)]
+
+    # Act
+    repository.put_bulk(docs, "table_embeddings")
+
+    # Assert
+    assert embed_documents.call_count == 3, "上限の件数ごとにまとめてリクエストすること"
+    ids, matrix, texts, _ = repository.load_embeddings("table_embeddings")
+    assert len(ids) == 25
+    assert sorted(texts) == sorted(text for _, text in docs)
+    results = repository.retrieve_relevant_docs("テーブル7の説明", "table_embeddings", k=1)
+    assert results[0].metadata["doc_id"] == "table_7", "登録した埋め込みで検索できること"
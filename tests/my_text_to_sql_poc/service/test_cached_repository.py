@@ -0,0 +1,163 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from my_text_to_sql_poc.service.cached_repository import (
+    CachedSampleQueryRepository,
+    CachedTableMetadataRepository,
+    TTLCache,
+)
+from my_text_to_sql_poc.service.repository import DuckDBSampleQueryRepository, DuckDBTableMetadataRepository
+
+
+def test_2回目以降のgetはキャッシュから返される(tmp_path: Path, mocker):
+    # Arrange
+    repository = DuckDBTableMetadataRepository(str(tmp_path / "table_metadata_store.duckdb"))
+    repository.put_bulk([("table_a", "metadata_a"), ("table_b", "metadata_b")])
+    cached_repository = CachedTableMetadataRepository(repository)
+    spy = mocker.spy(repository, "get")
+
+    # Act
+    first = cached_repository.get(["table_a", "missing"])
+    second = cached_repository.get(["table_a", "missing", "table_b"])
+
+    # Assert
+    assert first == {"table_a": "metadata_a"}
+    assert second == {"table_a": "metadata_a", "table_b": "metadata_b"}
+    assert [call.args[0] for call in spy.call_args_list] == [
+        ["table_a", "missing"],
+        ["table_b"],
+    ], "キャッシュに無いテーブルだけがDBから読まれること"
+    assert cached_repository.cache_stats.hits == 2
+    assert cached_repository.cache_stats.misses == 3
+
+
+def test_putされたテーブルのキャッシュは破棄される(tmp_path: Path):
+    # Arrange
+    repository = DuckDBTableMetadataRepository(str(tmp_path / "table_metadata_store.duckdb"))
+    repository.put_bulk([("table_b", "metadata_b")])
+    cached_repository = CachedTableMetadataRepository(repository)
+    assert cached_repository.get(["table_a"]) == {}
+
+    # Act
+    cached_repository.put_bulk([("table_a", "metadata_a")])
+
+    # Assert
+    assert cached_repository.get(["table_a"]) == {
+        "table_a": "metadata_a"
+    }, "存在しなかったことのキャッシュも破棄されること"
+
+
+def test_getの読み込み中にputされた場合は古い値をキャッシュしない(tmp_path: Path, mocker):
+    # Arrange
+    repository = DuckDBTableMetadataRepository(str(tmp_path / "table_metadata_store.duckdb"))
+    repository.put_bulk([("table_b", "metadata_b")])
+    cached_repository = CachedTableMetadataRepository(repository)
+    original_get = repository.get
+
+    def get_then_put_concurrently(table_names: list[str]) -> dict[str, str]:
+        # DBから読んだ直後、キャッシュに載せる前に別のスレッドが更新した状況を再現する
+        fetched = original_get(table_names)
+        cached_repository.put("table_a", "metadata_a")
+        return fetched
+
+    mocker.patch.object(repository, "get", side_effect=get_then_put_concurrently)
+
+    # Act
+    first = cached_repository.get(["table_a"])
+    mocker.patch.object(repository, "get", side_effect=original_get)
+    second = cached_repository.get(["table_a"])
+
+    # Assert
+    assert first == {}
+    assert second == {"table_a": "metadata_a"}, "読み込み中に破棄された古い値をキャッシュしないこと"
+
+
+def test_サンプルクエリの2回目以降の参照はキャッシュから返される(tmp_path: Path, mocker):
+    # Arrange
+    repository = DuckDBSampleQueryRepository(str(tmp_path / "sample_query_store.duckdb"))
+    repository.put_bulk(
+        [
+            ("query_a", "SELECT * FROM schema.users", "https://example.com/query_a"),
+            ("query_b", "SELECT * FROM schema.orders", "https://example.com/query_b"),
+        ]
+    )
+    cached_repository = CachedSampleQueryRepository(repository)
+    get_spy = mocker.spy(repository, "get")
+    retrieve_spy = mocker.spy(repository, "retrieve_by_table_name")
+
+    # Act
+    first = cached_repository.get(["query_a", "missing"])
+    second = cached_repository.get(["query_a", "missing", "query_b"])
+    by_table = [cached_repository.retrieve_by_table_name(name) for name in ["schema.users", "SCHEMA.USERS"]]
+
+    # Assert
+    assert first == {"query_a": "SELECT * FROM schema.users"}
+    assert second == {"query_a": "SELECT * FROM schema.users", "query_b": "SELECT * FROM schema.orders"}
+    assert [call.args[0] for call in get_spy.call_args_list] == [
+        ["query_a", "missing"],
+        ["query_b"],
+    ], "キャッシュに無いサンプルクエリだけがDBから読まれること"
+    assert by_table == [{"query_a": "SELECT * FROM schema.users"}] * 2
+    assert retrieve_spy.call_count == 1, "テーブル名の大文字小文字が違っても同じキャッシュを使うこと"
+    assert cached_repository.cache_stats.hits == 3
+    assert cached_repository.cache_stats.misses == 4
+
+
+def test_サンプルクエリがputされたらクエリとテーブルごとのキャッシュが破棄される(tmp_path: Path):
+    # Arrange
+    repository = DuckDBSampleQueryRepository(str(tmp_path / "sample_query_store.duckdb"))
+    repository.put("query_a", "SELECT * FROM schema.users", "https://example.com/query_a")
+    cached_repository = CachedSampleQueryRepository(repository)
+    assert cached_repository.get(["query_b", "query_c"]) == {}
+    assert cached_repository.retrieve_by_table_name("schema.orders") == {}
+
+    # Act
+    cached_repository.put("query_b", "SELECT * FROM schema.orders", "https://example.com/query_b")
+    after_put = cached_repository.retrieve_by_table_name("schema.orders")
+    cached_repository.put_bulk([("query_c", "SELECT id FROM schema.orders", "https://example.com/query_c")])
+
+    # Assert
+    assert after_put == {"query_b": "SELECT * FROM schema.orders"}, "putでテーブルごとのキャッシュが破棄されること"
+    assert cached_repository.get(["query_b", "query_c"]) == {
+        "query_b": "SELECT * FROM schema.orders",
+        "query_c": "SELECT id FROM schema.orders",
+    }, "存在しなかったことのキャッシュも破棄されること"
+    assert cached_repository.retrieve_by_table_name("schema.orders") == {
+        "query_b": "SELECT * FROM schema.orders",
+        "query_c": "SELECT id FROM schema.orders",
+    }, "put_bulkでテーブルごとのキャッシュが破棄されること"
+
+
+def test_複数のスレッドから参照してもヒット数とミス数を数え漏らさない():
+    # Arrange
+    cache = TTLCache(max_size=10, ttl_seconds=None)
+    cache.set("a", 1)
+
+    # Act
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda i: cache.get("a" if i % 2 == 0 else "b"), range(10_000)))
+
+    # Assert
+    assert cache.stats.hits == 5_000
+    assert cache.stats.misses == 5_000
+
+
+def test_TTLと件数上限を超えた値は追い出される():
+    # Arrange
+    now = [0.0]
+    cache = TTLCache(max_size=2, ttl_seconds=10, clock=lambda: now[0])
+    cache.set("a", 1)
+    cache.set("b", 2)
+
+    # Act
+    cache.get("a")  # aを最近使ったことにする
+    cache.set("c", 3)
+    now[0] = 5.0
+    cache.set("d", 4)
+    now[0] = 12.0
+
+    # Assert
+    assert cache.get("b") is None, "最も使われていないbが件数上限で追い出されること"
+    assert cache.get("c") is None, "TTLを過ぎたcが追い出されること"
+    assert cache.get("d") == 4
+    assert cache.stats.evictions == 3
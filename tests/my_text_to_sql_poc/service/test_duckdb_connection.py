@@ -0,0 +1,165 @@
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import duckdb
+import pytest
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from loguru import logger
+
+from my_text_to_sql_poc.service.duckdb_connection import (
+    ConnectionPoolTimeoutError,
+    DuckDBConnectionManager,
+    close_connection_manager,
+    get_connection_manager,
+)
+from my_text_to_sql_poc.service.repository import DuckDBTableMetadataRepository, DuckDBVectorStoreRepository
+
+
+def test_read_cursorでは書き込みができない(tmp_path: Path):
+    # Arrange
+    with DuckDBConnectionManager(tmp_path / "store.duckdb", pool_size=2) as manager:
+        with manager.write_cursor() as cursor:
+            cursor.execute("CREATE TABLE t (a INTEGER)")
+
+        # Act & Assert
+        with pytest.raises(duckdb.TransactionException):
+            with manager.read_cursor() as cursor:
+                cursor.execute("INSERT INTO t VALUES (1)")
+
+        with manager.read_cursor() as cursor:
+            assert cursor.execute("SELECT count(*) FROM t").fetchone() == (0,), "書き込みが反映されていないこと"
+
+
+def test_write_cursorで例外が発生した場合はロールバックされる(tmp_path: Path):
+    # Arrange
+    with DuckDBConnectionManager(tmp_path / "store.duckdb", pool_size=2) as manager:
+        with manager.write_cursor() as cursor:
+            cursor.execute("CREATE TABLE t (a INTEGER)")
+
+        # Act
+        with pytest.raises(ValueError):
+            with manager.write_cursor() as cursor:
+                cursor.execute("INSERT INTO t VALUES (1)")
+                raise ValueError("boom")
+
+        # Assert
+        with manager.read_cursor() as cursor:
+            assert cursor.execute("SELECT count(*) FROM t").fetchone() == (0,), "INSERTがロールバックされていること"
+        assert manager.health_check(), "例外発生後もプールが利用可能であること"
+
+
+def test_プールが枯渇した場合はタイムアウトする(tmp_path: Path):
+    # Arrange
+    manager = DuckDBConnectionManager(tmp_path / "store.duckdb", pool_size=1, acquire_timeout_seconds=0.1)
+
+    # Act & Assert
+    with manager.read_cursor():
+        with pytest.raises(ConnectionPoolTimeoutError):
+            with manager.read_cursor():
+                pass
+    manager.close()
+    assert not manager.health_check(), "close後はヘルスチェックが失敗すること"
+
+
+def test_同じDBファイルのリポジトリ間でコネクションマネージャが共有される(tmp_path: Path):
+    # Arrange
+    db_path = tmp_path / "table_metadata_store.duckdb"
+    writer = DuckDBTableMetadataRepository(str(db_path))
+    reader = DuckDBTableMetadataRepository(str(db_path))
+    writer.put_bulk([(f"table_{i}", f"metadata_{i}") for i in range(10)])
+
+    # Act
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda i: reader.get([f"table_{i}"]), range(10)))
+
+    # Assert
+    assert get_connection_manager(db_path, lock_on_write=True) is reader._connections is writer._connections
+    assert results == [{f"table_{i}": f"metadata_{i}"} for i in range(10)], "並行に参照しても正しく取得できること"
+    close_connection_manager(db_path)
+
+
+def test_書き込む間以外は読み取り専用で開くので他のプロセスも同じストアを読める(tmp_path: Path):
+    # Arrange
+    db_path = tmp_path / "table_metadata_store.duckdb"
+    repository = DuckDBTableMetadataRepository(str(db_path))
+    repository.put_bulk([("table_1", "metadata_1")])
+    assert repository.get(["table_1"]) == {"table_1": "metadata_1"}
+    read_in_other_process = (
+        "import duckdb, sys; "
+        "print(duckdb.connect(sys.argv[1], read_only=True).execute('SELECT count(*) FROM table_metadata').fetchone()[0])"
+    )
+
+    # Act
+    other_process = subprocess.run(
+        [sys.executable, "-c", read_in_other_process, str(db_path)], capture_output=True, text=True
+    )
+    repository.put("table_2", "metadata_2")
+
+    # Assert
+    assert other_process.returncode == 0, f"他のプロセスが読み取り専用で開けること: {other_process.stderr}"
+    assert other_process.stdout.strip() == "1"
+    assert repository.get(["table_1", "table_2"]) == {"table_1": "metadata_1", "table_2": "metadata_2"}
+    assert repository._connections.opened_read_only, "書き込み後は読み取り専用で開き直すこと"
+    close_connection_manager(db_path)
+
+
+def test_書き込みで開き直した後も検索用のカーソルを作り直して検索できる(tmp_path: Path):
+    # Arrange
+    db_path = tmp_path / "vectorstore.duckdb"
+    repository = DuckDBVectorStoreRepository(str(db_path), embeddings=DeterministicFakeEmbedding(size=8))
+    repository.put_bulk([("schema.users", "ユーザー")], "table_embeddings")
+    repository.retrieve_relevant_docs("ユーザー", "table_embeddings", k=1)
+    generation = repository._connections.generation
+
+    # Act
+    repository.put_bulk([("schema.orders", "注文")], "table_embeddings")
+    docs = repository.retrieve_relevant_docs("注文", "table_embeddings", k=2)
+
+    # Assert
+    assert repository._connections.generation > generation, "書き込みのためにコネクションを開き直すこと"
+    assert {doc.page_content for doc in docs} == {"ユーザー", "注文"}
+    repository.close()
+    close_connection_manager(db_path)
+
+
+def test_カーソルの疎通確認はDuckDBのエラーが起きた時だけ行う(tmp_path: Path, mocker):
+    # Arrange
+    is_healthy = mocker.spy(DuckDBConnectionManager, "_is_healthy")
+    with DuckDBConnectionManager(tmp_path / "store.duckdb", pool_size=1) as manager:
+        with manager.write_cursor() as cursor:
+            cursor.execute("CREATE TABLE t (a INTEGER)")
+
+        # Act
+        with manager.read_cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM t").fetchone()
+        calls_without_error = is_healthy.call_count
+        with pytest.raises(duckdb.CatalogException), manager.read_cursor() as cursor:
+            cursor.execute("SELECT * FROM missing_table")
+
+        # Assert
+        assert calls_without_error == 0, "正常に返却されたカーソルでは SELECT 1 を実行しないこと"
+        assert is_healthy.call_count == 1
+        with manager.read_cursor() as cursor:
+            assert cursor.execute("SELECT count(*) FROM t").fetchone() == (0,)
+
+
+def test_既存のマネージャとpool_sizeが異なる場合は警告して既存のマネージャを返す(tmp_path: Path):
+    # Arrange
+    db_path = tmp_path / "store.duckdb"
+    manager = get_connection_manager(db_path, pool_size=2)
+    messages: list[str] = []
+    handler_id = logger.add(messages.append, level="WARNING")
+
+    # Act
+    try:
+        shared = get_connection_manager(db_path, pool_size=8)
+    finally:
+        logger.remove(handler_id)
+
+    # Assert
+    assert shared is manager
+    assert shared.pool_size == 2
+    assert any("pool_size=8" in message for message in messages), "無視したpool_sizeを警告すること"
+    close_connection_manager(db_path)
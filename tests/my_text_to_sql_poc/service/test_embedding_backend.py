@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from pytest_mock import MockerFixture
+
+from my_text_to_sql_poc.service import embedding_backend
+from my_text_to_sql_poc.service.embedding_backend import EmbeddingSettings, SentenceTransformerEmbeddings
+from my_text_to_sql_poc.service.repository_factory import RepositoryConfig, RepositoryFactory
+
+
+class _FakeSentenceTransformer:
+    def __init__(self) -> None:
+        self.calls: list[tuple[list[str], int]] = []
+
+    def encode(self, texts: list[str], batch_size: int, **kwargs) -> np.ndarray:
+        self.calls.append((texts, batch_size))
+        return np.array([[float(len(text)), 1.0] for text in texts], dtype=np.float32)
+
+
+@pytest.fixture
+def fake_model(mocker: MockerFixture, monkeypatch: pytest.MonkeyPatch) -> _FakeSentenceTransformer:
+    monkeypatch.setattr(embedding_backend, "_model_by_key", {})
+    model = _FakeSentenceTransformer()
+    mocker.patch.object(embedding_backend, "_load_sentence_transformer", return_value=model)
+    return model
+
+
+def test_バックエンドごとの既定のモデルと推論方式を区別したキャッシュキーになる():
+    # Act
+    openai_settings = EmbeddingSettings()
+    torch_settings = EmbeddingSettings(backend="sentence_transformers")
+    onnx_settings = EmbeddingSettings(backend="sentence_transformers", runtime="onnx_int8")
+
+    # Assert
+    assert openai_settings.cache_key == "text-embedding-3-small", "既存の埋め込みキャッシュをそのまま使えること"
+    assert torch_settings.model_name == embedding_backend.DEFAULT_MODEL_NAME_BY_BACKEND["sentence_transformers"]
+    assert torch_settings.cache_key != onnx_settings.cache_key
+
+
+def test_ローカルのモデルは1度だけ読み込み設定したバッチサイズで埋め込む(fake_model: _FakeSentenceTransformer):
+    # Arrange
+    settings = EmbeddingSettings(backend="sentence_transformers", batch_size=4)
+    embeddings = SentenceTransformerEmbeddings(settings)
+
+    # Act
+    documents = embeddings.embed_documents(["注文", "顧客"])
+    query = SentenceTransformerEmbeddings(settings).embed_query("注文")
+
+    # Assert
+    assert embedding_backend._load_sentence_transformer.call_count == 1, "モデルはプロセス内で共有すること"
+    assert fake_model.calls == [(["passage: 注文", "passage: 顧客"], 4), (["query: 注文"], 4)]
+    assert len(documents) == 2
+    assert query == [float(len("query: 注文")), 1.0]
+
+
+def test_設定に応じてローカルの埋め込みモデルを使うベクトルストアを生成する(fake_model: _FakeSentenceTransformer):
+    # Arrange
+    factory = RepositoryFactory(
+        RepositoryConfig(embedding_backend="sentence_transformers", embedding_cache_path=None, embedding_batch_size=8)
+    )
+
+    # Act
+    repository = factory.vector_store_repository()
+
+    # Assert
+    assert isinstance(repository.embeddings, SentenceTransformerEmbeddings)
+    assert repository.embeddings.settings.batch_size == 8
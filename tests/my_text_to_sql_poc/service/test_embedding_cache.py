@@ -0,0 +1,104 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from my_text_to_sql_poc.service.duckdb_connection import DuckDBConnectionManager
+from my_text_to_sql_poc.service.embedding_cache import CachedEmbeddings
+
+
+def test_表記揺れのある同じ質問はキャッシュから返す(tmp_path: Path, mocker):
+    # Arrange
+    model = DeterministicFakeEmbedding(size=8)
+    spy = mocker.spy(DeterministicFakeEmbedding, "embed_query")
+    embeddings = CachedEmbeddings(model, "fake-model", tmp_path / "embedding_cache.duckdb")
+    expected = embeddings.embed_query("先月の売上は？")
+
+    # Act
+    actual = embeddings.embed_query("  先月の売上は?  ")
+
+    # Assert
+    assert actual == pytest.approx(expected, abs=1e-6), "キャッシュにはfloat32で保存する"
+    assert spy.call_count == 1, "全角/半角と前後の空白の違いはキャッシュヒットになること"
+    assert embeddings.stats.hit_rate == 0.5
+
+
+def test_キャッシュはファイルに永続化されモデルごとに分かれる(tmp_path: Path, mocker):
+    # Arrange
+    cache_path = tmp_path / "embedding_cache.duckdb"
+    CachedEmbeddings(DeterministicFakeEmbedding(size=8), "model-a", cache_path).embed_documents(["doc_1", "doc_2"])
+    model = DeterministicFakeEmbedding(size=8)
+    spy = mocker.spy(DeterministicFakeEmbedding, "embed_documents")
+
+    # Act
+    CachedEmbeddings(model, "model-a", cache_path).embed_documents(["doc_1", "doc_2", "doc_1"])
+    CachedEmbeddings(model, "model-b", cache_path).embed_documents(["doc_1"])
+
+    # Assert
+    assert [call.args[1] for call in spy.call_args_list] == [["doc_1"]], "別のモデルの埋め込みは使い回さないこと"
+
+
+def test_件数の上限を超えると最後に参照されてから最も古いものを追い出す(tmp_path: Path, mocker):
+    # Arrange
+    model = DeterministicFakeEmbedding(size=8)
+    embeddings = CachedEmbeddings(model, "fake-model", tmp_path / "embedding_cache.duckdb", max_entries=2)
+    clock = mocker.patch("my_text_to_sql_poc.service.embedding_cache.time.time", side_effect=[1.0, 2.0, 3.0, 4.0])
+    embeddings.embed_documents(["doc_1"])
+    embeddings.embed_documents(["doc_2"])
+    embeddings.embed_documents(["doc_1"])  # doc_1を参照し直す
+    spy = mocker.spy(DeterministicFakeEmbedding, "embed_documents")
+
+    # Act
+    embeddings.embed_documents(["doc_3"])
+
+    # Assert
+    clock.side_effect = None
+    clock.return_value = 5.0
+    embeddings.embed_documents(["doc_1", "doc_2"])
+    assert [call.args[1] for call in spy.call_args_list] == [["doc_3"], ["doc_2"]], "doc_2が追い出されていること"
+    assert embeddings.stats.evictions == 2
+
+
+def test_キャッシュを引く間は書き込みロックを取らず最終参照時刻はまとめて書き込む(tmp_path: Path, mocker):
+    # Arrange
+    embeddings = CachedEmbeddings(
+        DeterministicFakeEmbedding(size=8), "fake-model", tmp_path / "embedding_cache.duckdb", access_flush_threshold=2
+    )
+    embeddings.embed_documents(["doc_1", "doc_2"])
+    write_cursor = mocker.spy(DuckDBConnectionManager, "write_cursor")
+
+    # Act
+    embeddings.embed_documents(["doc_1"])
+    writes_after_first_hit = write_cursor.call_count
+    embeddings.embed_documents(["doc_2"])
+
+    # Assert
+    assert writes_after_first_hit == 0, "ヒットしただけでは書き込まないこと"
+    assert write_cursor.call_count == 1, "溜めた最終参照時刻が閾値に達したらまとめて書き込むこと"
+    with embeddings.connections.read_cursor() as cursor:
+        last_accessed_at = cursor.execute("SELECT min(last_accessed_at) FROM embedding_cache").fetchone()[0]
+    assert last_accessed_at > 0
+
+
+def test_他のプロセスがロックを持っている場合はキャッシュを使わずに埋め込む(tmp_path: Path, mocker):
+    # Arrange
+    cache_path = tmp_path / "embedding_cache.duckdb"
+    hold_lock = "import duckdb, sys; conn = duckdb.connect(sys.argv[1]); print('locked', flush=True); sys.stdin.read()"
+    other_process = subprocess.Popen(
+        [sys.executable, "-c", hold_lock, str(cache_path)], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
+    )
+    assert other_process.stdout.readline().strip() == "locked"
+    model = DeterministicFakeEmbedding(size=8)
+    embeddings = CachedEmbeddings(model, "fake-model", cache_path)
+
+    # Act
+    try:
+        actual = embeddings.embed_query("先月の売上は？")
+    finally:
+        other_process.communicate("")
+
+    # Assert
+    assert actual == model.embed_query("先月の売上は？")
+    assert embeddings.disabled, "ロックが取れない場合はキャッシュを無効にすること"
@@ -0,0 +1,131 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from my_text_to_sql_poc.service.faiss_vector_store import FaissIndexParams, FaissVectorStoreRepository
+
+
+@pytest.mark.parametrize("index_type", ["flat", "ivf", "hnsw"])
+def test_検索結果をdoc_idに対応付けて返す(index_type: str, vector_store_factory):
+    # Arrange
+    repository = FaissVectorStoreRepository(vector_store_factory(size=32), index_type=index_type)
+    repository.put_bulk([(f"table_{i}", f"テーブル{i}の説明") for i in range(50)], "table_embeddings")
+
+    # Act
+    docs = repository.retrieve_relevant_docs("テーブル42の説明", "table_embeddings", k=3)
+
+    # Assert
+    assert len(docs) == 3
+    assert docs[0].metadata["doc_id"] == "table_42"
+    assert docs[0].page_content == "テーブル42の説明"
+
+
+def test_索引は保存され追加分だけが索引に追加される(tmp_path: Path, mocker, vector_store_factory):
+    # Arrange
+    repository = FaissVectorStoreRepository(vector_store_factory(size=32), index_type="hnsw")
+    repository.put_bulk([(f"table_{i}", f"テーブル{i}の説明") for i in range(10)], "table_embeddings")
+    repository.close()
+    reopened = FaissVectorStoreRepository(vector_store_factory(size=32), index_type="hnsw")
+    load_embeddings = mocker.spy(reopened._repository, "load_embeddings")
+
+    # Act
+    reopened.put_bulk([("table_new", "新しいテーブル")], "table_embeddings")
+
+    # Assert
+    assert reopened.index_path("table_embeddings") == tmp_path / "vectorstore.table_embeddings.hnsw.faiss"
+    assert reopened.index_path("table_embeddings").exists()
+    ids, matrix, _, _ = load_embeddings.spy_return
+    assert len(ids) == 1 and matrix.shape == (1, 32), "索引済みのドキュメントは読み込み直さないこと"
+    assert (
+        reopened.retrieve_relevant_docs("新しいテーブル", "table_embeddings", k=1)[0].metadata["doc_id"] == "table_new"
+    )
+
+
+def test_テーブルが無ければ空を返す(vector_store_factory):
+    # Arrange
+    repository = FaissVectorStoreRepository(vector_store_factory(size=32), index_type="flat")
+
+    # Act & Assert
+    assert repository.retrieve_relevant_docs("注文", "query_embeddings") == []
+
+
+@pytest.mark.parametrize("index_type", ["flat", "ivf", "hnsw"])
+def test_上書きされたドキュメントは索引を作り直さずに置き換える(index_type: str, vector_store_factory, mocker):
+    # Arrange
+    repository = FaissVectorStoreRepository(vector_store_factory(size=32), index_type=index_type)
+    repository.put_bulk([(f"table_{i}", f"テーブル{i}の説明") for i in range(50)], "table_embeddings")
+    new_table = mocker.spy(repository, "_new_table")
+
+    # Act
+    repository.put("table_3", "サブスクリプションの契約", "table_embeddings")
+
+    # Assert
+    assert new_table.call_count == 0, "上書きされた1件だけを索引から消して追加し直すこと"
+    docs = repository.retrieve_relevant_docs("サブスクリプションの契約", "table_embeddings", k=50)
+    assert len(docs) == 50
+    assert docs[0].page_content == "サブスクリプションの契約"
+    assert "テーブル3の説明" not in {doc.page_content for doc in docs}, "置き換えられた本文は返さないこと"
+
+
+def test_IVFはドキュメント数が学習時から大きく増えたら学習し直す(vector_store_factory):
+    # Arrange
+    repository = FaissVectorStoreRepository(
+        vector_store_factory(size=32), index_type="ivf", params=FaissIndexParams(ivf_retrain_growth=2.0)
+    )
+    repository.put_bulk([(f"table_{i}", f"テーブル{i}の説明") for i in range(10)], "table_embeddings")
+    repository.put_bulk([(f"table_{i}", f"テーブル{i}の説明") for i in range(10, 15)], "table_embeddings")
+    trained_size = repository._tables["table_embeddings"].trained_size
+
+    # Act
+    repository.put_bulk([(f"table_{i}", f"テーブル{i}の説明") for i in range(15, 40)], "table_embeddings")
+
+    # Assert
+    assert trained_size == 10, "学習時の2倍に満たないうちは追加するだけであること"
+    assert repository._tables["table_embeddings"].trained_size == 40
+    assert repository.retrieve_relevant_docs("テーブル33の説明", "table_embeddings", k=1)[0].metadata["doc_id"] == (
+        "table_33"
+    )
+
+
+def test_HNSWは削除済みのベクトルを検索から除き一定の割合を超えたら作り直す(vector_store_factory):
+    # Arrange
+    repository = FaissVectorStoreRepository(
+        vector_store_factory(size=32), index_type="hnsw", params=FaissIndexParams(hnsw_max_stale_fraction=0.2)
+    )
+    repository.put_bulk([(f"table_{i}", f"テーブル{i}の説明") for i in range(20)], "table_embeddings")
+
+    # Act
+    repository.put_bulk([(f"table_{i}", f"新しいテーブル{i}の説明") for i in range(3)], "table_embeddings")
+    stale_count = len(repository._tables["table_embeddings"].stale_ids)
+    docs = repository.retrieve_relevant_docs("テーブル1の説明", "table_embeddings", k=20)
+    reopened = FaissVectorStoreRepository(vector_store_factory(size=32), index_type="hnsw")
+    reopened_docs = reopened.retrieve_relevant_docs("テーブル1の説明", "table_embeddings", k=20)
+    repository.put_bulk([(f"table_{i}", f"新しいテーブル{i}の説明") for i in range(3, 6)], "table_embeddings")
+
+    # Assert
+    assert stale_count == 3
+    assert not {"テーブル0の説明", "テーブル1の説明", "テーブル2の説明"} & {doc.page_content for doc in docs}
+    assert [doc.page_content for doc in reopened_docs] == [
+        doc.page_content for doc in docs
+    ], "保存した索引を読み込んでも削除済みのベクトルを除くこと"
+    assert repository._tables["table_embeddings"].stale_ids == set(), "削除済みが2割を超えたら作り直すこと"
+
+
+def test_書き込み中も並行に検索できる(vector_store_factory):
+    # Arrange
+    repository = FaissVectorStoreRepository(vector_store_factory(size=32), index_type="hnsw")
+    repository.put_bulk([(f"table_{i}", f"テーブル{i}の説明") for i in range(20)], "table_embeddings")
+
+    def search(i: int) -> int:
+        return len(repository.retrieve_relevant_docs(f"テーブル{i}の説明", "table_embeddings", k=5))
+
+    # Act
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = executor.map(search, range(200))
+        for i in range(20, 40):
+            repository.put(f"table_{i}", f"テーブル{i}の説明", "table_embeddings")
+        counts = list(results)
+
+    # Assert
+    assert counts == [5] * 200
@@ -0,0 +1,100 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator
+
+import pytest
+
+from my_text_to_sql_poc.service.http_pool import close_http_connection_pool, get_http_connection_pool
+from my_text_to_sql_poc.service.model_gateway import ModelGatewaySettings, clear_model_gateways, get_model_gateway
+
+
+class FakeChatCompletionHandler(BaseHTTPRequestHandler):
+    """OpenAIのChat Completions APIの代わりに、keep-aliveで固定の応答を返す"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self) -> None:
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        body = json.dumps(
+            {
+                "id": "chatcmpl-test",
+                "object": "chat.completion",
+                "created": 0,
+                "model": request["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": f"{request['model']}の応答"},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+            }
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def fake_openai_server(monkeypatch) -> Iterator[ThreadingHTTPServer]:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeChatCompletionHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    monkeypatch.setenv("OPENAI_API_BASE", f"http://127.0.0.1:{server.server_address[1]}/v1")
+    clear_model_gateways()
+    close_http_connection_pool()
+    yield server
+    clear_model_gateways()
+    close_http_connection_pool()
+    server.shutdown()
+    server.server_close()
+
+
+def test_モデルの設定ごとにゲートウェイを共有し接続を使い回す(fake_openai_server):
+    # Arrange
+    settings = ModelGatewaySettings(response_cache_path="")
+    gateway = get_model_gateway("gpt-4o-mini", settings)
+    other_model_gateway = get_model_gateway("gpt-4o", settings)
+
+    # Act
+    responses = [
+        get_model_gateway("gpt-4o-mini", settings).generate_response("質問1"),
+        get_model_gateway("gpt-4o-mini", settings).generate_response("質問2"),
+        other_model_gateway.generate_response("質問3"),
+    ]
+
+    # Assert
+    assert get_model_gateway("gpt-4o-mini", settings) is gateway, "同じ設定なら同じゲートウェイを返すこと"
+    assert other_model_gateway is not gateway
+    assert responses == ["gpt-4o-miniの応答", "gpt-4o-miniの応答", "gpt-4oの応答"]
+    stats = get_http_connection_pool().stats
+    assert stats.requests == 3
+    assert (stats.new_connections, stats.reused_connections) == (
+        1,
+        2,
+    ), "モデルが違うゲートウェイ間でも接続を使い回すこと"
+
+
+def test_非同期の呼び出しもイベントループごとの接続を使い回す(fake_openai_server):
+    # Arrange
+    gateway = get_model_gateway("gpt-4o-mini", ModelGatewaySettings(response_cache_path="", max_concurrent_requests=1))
+
+    async def generate_all() -> list[str]:
+        return await asyncio.gather(*(gateway.agenerate_response(f"質問{i}") for i in range(3)))
+
+    # Act
+    first_loop = asyncio.run(generate_all())
+    second_loop = asyncio.run(generate_all())
+
+    # Assert
+    assert first_loop == second_loop == ["gpt-4o-miniの応答"] * 3
+    stats = get_http_connection_pool().stats
+    assert (stats.requests, stats.new_connections) == (6, 2), "接続はイベントループごとに1本だけ張ること"
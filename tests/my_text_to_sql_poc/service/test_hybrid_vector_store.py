@@ -0,0 +1,94 @@
+import numpy as np
+
+from my_text_to_sql_poc.service.hybrid_vector_store import HybridVectorStoreRepository
+from my_text_to_sql_poc.service.lexical_index import BM25Index, tokenize
+from my_text_to_sql_poc.service.numpy_vector_store import NumpyVectorIndex
+
+
+def test_識別子は全体と単語の両方に分け日本語は文字bigramにする():
+    # Act
+    tokens = tokenize("Ｄynamodb.news の tap_article_events を集計")
+
+    # Assert
+    assert {"dynamodb", "news", "dynamodb.news", "tap", "article", "events", "tap_article_events"} <= set(tokens)
+    assert {"集計"} <= set(tokens)
+    assert "の" in tokens, "1文字だけの日本語はその文字をトークンにすること"
+
+
+def test_BM25は質問のキーワードを含むドキュメントだけを返す():
+    # Arrange
+    index = BM25Index(["users テーブル", "orders テーブル 注文", "orders_items 注文明細", "課金 履歴"])
+
+    # Act
+    actual = index.search("注文の件数", limit=10)
+
+    # Assert
+    assert [position for position, _ in actual] == [1, 2]
+
+
+def test_BM25はひらがなだけのトークンとほぼ全ドキュメントに含まれるトークンを検索に使わない():
+    # Arrange
+    texts = [f"このテーブルは{subject}の履歴を記録する" for subject in ["注文", "顧客", "商品", "在庫"]]
+    index = BM25Index(texts + ["課金の明細"], max_df_ratio=0.5)
+
+    # Act
+    particles_only = index.search("のテーブルは履歴", limit=10)
+    with_keyword = index.search("商品のテーブルの履歴", limit=10)
+
+    # Assert
+    assert index.is_stop_token("の"), "ひらがなだけのトークンは使わないこと"
+    assert index.is_stop_token("履歴"), "半分を超えるドキュメントに含まれるトークンは使わないこと"
+    assert not index.is_stop_token("商品")
+    assert particles_only == [], "使わないトークンだけの質問には一致しないこと"
+    assert [position for position, _ in with_keyword] == [2]
+
+
+def test_BM25は指定した行の中でスコアの降順に返す():
+    # Arrange
+    index = BM25Index(["注文 注文 注文", "注文", "注文 注文", "顧客"], max_df_ratio=1.0)
+
+    # Act
+    actual = index.search("注文", limit=2, rows=np.asarray([1, 2, 3]))
+
+    # Assert
+    assert [position for position, _ in actual] == [2, 1], "指定していない0行目は返さないこと"
+    assert actual[0][1] > actual[1][1]
+
+
+def test_指定した行だけを検索して元の行番号を返す():
+    # Arrange
+    matrix = np.eye(4, dtype=np.float32)
+    index = NumpyVectorIndex(matrix, ["a", "b", "c", "d"], [None] * 4)
+
+    # Act
+    actual = index.search(np.asarray([[0.1, 0.0, 0.9, 0.5]]), k=2, rows=np.asarray([1, 3]))
+
+    # Assert
+    assert [row for row, _ in actual[0]] == [3, 1], "候補以外の行(最も類似度が高い2行目)は返さないこと"
+
+
+def test_カラム名で絞り込んだ候補からベクトル検索し少なすぎる場合は全件を検索する(
+    vector_store_factory, table_metadata_repository
+):
+    # Arrange
+    duckdb_repository = vector_store_factory(size=16)
+    duckdb_repository.put_bulk([(f"schema.table_{i}", f"テーブル{i}の説明") for i in range(20)], "table_embeddings")
+    table_metadata_repository.put_bulk(
+        [("schema.table_3", "columns: subscription_id"), ("schema.table_7", "columns: subscription_plan")]
+    )
+    repository = HybridVectorStoreRepository(
+        duckdb_repository, table_metadata_repository=table_metadata_repository, min_candidates_factor=1
+    )
+    embedding = repository.embed_query("subscription ごとの件数")
+
+    # Act
+    filtered = repository.retrieve_relevant_docs_hybrid("subscription ごとの件数", embedding, "table_embeddings", k=2)
+    fallback = repository.retrieve_relevant_docs_hybrid("subscription ごとの件数", embedding, "table_embeddings", k=5)
+
+    # Assert
+    assert {doc.metadata["doc_id"] for doc in filtered} == {"schema.table_3", "schema.table_7"}
+    assert len(fallback) == 5, "候補がk件に満たない場合は全件から検索すること"
+    assert [doc.metadata["doc_id"] for doc in fallback] == [
+        doc.metadata["doc_id"]
+        for doc in duckdb_repository.retrieve_relevant_docs_by_vector(embedding, "table_embeddings", k=5)
+    ]
@@ -0,0 +1,161 @@
+import asyncio
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from langchain_core.language_models import FakeListChatModel
+from pydantic import BaseModel, Field
+
+from my_text_to_sql_poc.service.duckdb_connection import DuckDBConnectionManager
+from my_text_to_sql_poc.service.llm_response_cache import LLMResponseCache, response_cache_key
+from my_text_to_sql_poc.service.model_gateway import ModelGateway, ModelGatewaySettings
+
+
+class Summary(BaseModel):
+    summary: str = Field(description="概要")
+
+
+class DetailedSummary(BaseModel):
+    summary: str = Field(description="詳細な概要")
+
+
+def _gateway(cache_path: Path, use_response_cache: bool = False) -> ModelGateway:
+    settings = ModelGatewaySettings(use_response_cache=use_response_cache, response_cache_path=str(cache_path))
+    return ModelGateway(settings=settings, llm=FakeListChatModel(responses=["応答1", "応答2", "応答3"]))
+
+
+def test_キャッシュを使う呼び出しは再実行時にモデルへ問い合わせない(tmp_path: Path):
+    # Arrange
+    cache_path = tmp_path / "llm_response_cache.duckdb"
+    first = _gateway(cache_path).generate_response("テーブルを要約して", use_cache=True)
+    gateway = _gateway(cache_path)
+
+    # Act
+    cached = gateway.generate_response("テーブルを要約して", use_cache=True)
+    cached_async = asyncio.run(gateway.agenerate_response("テーブルを要約して", use_cache=True))
+    other_prompt = gateway.generate_response("クエリを要約して", use_cache=True)
+
+    # Assert
+    assert (first, cached, cached_async) == (
+        "応答1",
+        "応答1",
+        "応答1",
+    ), "別のModelGatewayがファイルに保存した応答も使うこと"
+    assert other_prompt == "応答1", "キャッシュに無いプロンプトだけをモデルに問い合わせること"
+    assert (gateway.response_cache.stats.hits, gateway.response_cache.stats.misses) == (2, 1)
+
+
+def test_呼び出しごとにキャッシュの利用を切り替えられる(tmp_path: Path):
+    # Arrange
+    gateway = _gateway(tmp_path / "llm_response_cache.duckdb", use_response_cache=True)
+    gateway.generate_response("テーブルを要約して")
+
+    # Act
+    opted_out = gateway.generate_response("テーブルを要約して", use_cache=False)
+    by_default = gateway.generate_response("テーブルを要約して")
+
+    # Assert
+    assert opted_out == "応答2", "use_cache=Falseの場合はキャッシュがあってもモデルに問い合わせること"
+    assert by_default == "応答1"
+
+
+def test_キーはモデル_temperature_出力スキーマで区別する():
+    # Arrange
+    prompt = "テーブルを要約して"
+
+    # Act
+    keys = {
+        response_cache_key("gpt-4o-mini", 0.7, prompt, Summary),
+        response_cache_key("gpt-4o", 0.7, prompt, Summary),
+        response_cache_key("gpt-4o-mini", 0.0, prompt, Summary),
+        response_cache_key("gpt-4o-mini", 0.7, prompt, DetailedSummary),
+        response_cache_key("gpt-4o-mini", 0.7, prompt, None),
+    }
+
+    # Assert
+    assert len(keys) == 5
+    assert response_cache_key("gpt-4o-mini", 0.7, prompt, Summary) in keys
+
+
+def test_期限切れと件数の上限を超えた応答は追い出す(tmp_path: Path, mocker):
+    # Arrange
+    cache = LLMResponseCache(tmp_path / "llm_response_cache.duckdb", ttl_seconds=100, max_entries=2)
+    clock = mocker.patch("my_text_to_sql_poc.service.llm_response_cache.time.time")
+    clock.return_value = 0.0
+    cache.set("a", "fake-model", "応答a")
+    clock.return_value = 10.0
+    cache.set("b", "fake-model", "応答b")
+    clock.return_value = 20.0
+    cache.get("a")  # aを参照し直す
+
+    # Act
+    cache.set("c", "fake-model", "応答c")
+    clock.return_value = 105.0
+    expired = cache.get("a")
+
+    # Assert
+    assert cache.get("b") is None, "最後に参照されてから最も古いbが追い出されていること"
+    assert expired is None, "登録から100秒を過ぎたaは使わないこと"
+    assert cache.get("c") == "応答c"
+    assert cache.stats.evictions == 2
+
+
+def test_キャッシュを引く間は書き込みロックを取らず最終参照時刻はまとめて書き込む(tmp_path: Path, mocker):
+    # Arrange
+    cache = LLMResponseCache(tmp_path / "llm_response_cache.duckdb", access_flush_threshold=100)
+    cache.set_many([(f"key_{i}", "fake-model", f"応答{i}") for i in range(10)])
+    write_cursor = mocker.spy(DuckDBConnectionManager, "write_cursor")
+
+    # Act
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        responses = list(executor.map(lambda i: cache.get(f"key_{i % 10}"), range(200)))
+    writes_after_hits = write_cursor.call_count
+    cache.flush()
+
+    # Assert
+    assert responses == [f"応答{i % 10}" for i in range(200)]
+    assert writes_after_hits == 0, "ヒットしただけでは書き込まないこと"
+    assert cache.stats.hits == 200, "並行に引いてもヒット数を数え漏らさないこと"
+    with cache.connections.read_cursor() as cursor:
+        accessed = cursor.execute(
+            "SELECT count(*) FROM llm_response_cache WHERE last_accessed_at > created_at"
+        ).fetchone()[0]
+    assert accessed == 10, "溜めた最終参照時刻をまとめて書き込むこと"
+
+
+def test_非同期の呼び出しはキャッシュの読み書きを別スレッドで行う(tmp_path: Path, mocker):
+    # Arrange
+    gateway = _gateway(tmp_path / "llm_response_cache.duckdb", use_response_cache=True)
+    to_thread = mocker.spy(asyncio, "to_thread")
+
+    # Act
+    first = asyncio.run(gateway.agenerate_response("テーブルを要約して"))
+    cached = asyncio.run(gateway.agenerate_response("テーブルを要約して"))
+
+    # Assert
+    assert (first, cached) == ("応答1", "応答1")
+    called = [call.args[0].__name__ for call in to_thread.call_args_list]
+    assert called == ["get", "set", "get"]
+
+
+def test_他のプロセスがロックを持っている場合はキャッシュを使わずにモデルに問い合わせる(tmp_path: Path):
+    # Arrange
+    cache_path = tmp_path / "llm_response_cache.duckdb"
+    hold_lock = "import duckdb, sys; conn = duckdb.connect(sys.argv[1]); print('locked', flush=True); sys.stdin.read()"
+    other_process = subprocess.Popen(
+        [sys.executable, "-c", hold_lock, str(cache_path)], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
+    )
+    assert other_process.stdout.readline().strip() == "locked"
+    gateway = _gateway(cache_path, use_response_cache=True)
+
+    # Act
+    try:
+        first = gateway.generate_response("テーブルを要約して")
+        second = gateway.generate_response("テーブルを要約して")
+    finally:
+        other_process.communicate("")
+
+    # Assert
+    assert (first, second) == ("応答1", "応答2"), "キャッシュを使わずにモデルに問い合わせること"
+    assert gateway.response_cache.disabled, "ロックが取れない場合はキャッシュを無効にすること"
@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from my_text_to_sql_poc.service.model_gateway import ModelGateway, ModelGatewaySettings
+
+
+class SlowChatModel(BaseChatModel):
+    """応答までに delay_seconds 秒かかり、同時に処理しているリクエスト数を記録するチャットモデル"""
+
+    delay_seconds: float = 0.02
+    running: int = 0
+    max_running: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "slow-fake"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        raise NotImplementedError
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(self.delay_seconds)
+        finally:
+            self.running -= 1
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=f"{messages[-1].content}への応答"))])
+
+
+def test_並行に投げたリクエストは同時実行数の上限を超えない():
+    # Arrange
+    llm = SlowChatModel()
+    gateway = ModelGateway(settings=ModelGatewaySettings(max_concurrent_requests=3), llm=llm)
+
+    async def generate_all() -> list[str]:
+        return await asyncio.gather(*(gateway.agenerate_response(f"質問{i}") for i in range(10)))
+
+    # Act
+    responses = asyncio.run(generate_all())
+
+    # Assert
+    assert responses == [f"質問{i}への応答" for i in range(10)], "入力と同じ順序で応答を返すこと"
+    assert llm.max_running == 3, "同時に処理するリクエストは上限の3件まで"
+
+
+def test_タイムアウトした呼び出しは同時実行数の空きを返す():
+    # Arrange
+    llm = SlowChatModel(delay_seconds=1.0)
+    gateway = ModelGateway(settings=ModelGatewaySettings(max_concurrent_requests=1, timeout_seconds=0.05), llm=llm)
+
+    async def timeout_then_generate() -> str:
+        with pytest.raises(TimeoutError):
+            await gateway.agenerate_response("遅い質問")
+        llm.delay_seconds = 0.0
+        return await gateway.agenerate_response("速い質問", timeout_seconds=1.0)
+
+    # Act
+    response = asyncio.run(timeout_then_generate())
+
+    # Assert
+    assert response == "速い質問への応答"
+    assert llm.running == 0
+
+
+def test_キャンセルした呼び出しは中断されて同時実行数の空きを返す():
+    # Arrange
+    llm = SlowChatModel(delay_seconds=10.0)
+    gateway = ModelGateway(settings=ModelGatewaySettings(max_concurrent_requests=1), llm=llm)
+
+    async def cancel_then_generate() -> tuple[int, str]:
+        task = asyncio.create_task(gateway.agenerate_response("遅い質問"))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        running_after_cancel = llm.running
+        llm.delay_seconds = 0.0
+        return running_after_cancel, await gateway.agenerate_response("速い質問")
+
+    # Act
+    running_after_cancel, response = asyncio.run(cancel_then_generate())
+
+    # Assert
+    assert running_after_cancel == 0, "キャンセルしたリクエストは中断されること"
+    assert response == "速い質問への応答"
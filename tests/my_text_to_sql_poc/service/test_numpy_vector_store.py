@@ -0,0 +1,54 @@
+import numpy as np
+
+from my_text_to_sql_poc.service.numpy_vector_store import NumpyVectorIndex, NumpyVectorStoreRepository
+
+
+def test_複数の検索ベクトルの上位k件を類似度の降順で返す():
+    # Arrange
+    index = NumpyVectorIndex(
+        np.array([[1.0, 0.0], [0.0, 2.0], [1.0, 1.0], [-1.0, 0.0]]),
+        texts=["x", "y", "xy", "-x"],
+        metadatas=[None] * 4,
+    )
+
+    # Act
+    results = index.search(np.array([[1.0, 0.1], [0.0, 1.0]]), k=2)
+
+    # Assert
+    assert [[row for row, _ in hits] for hits in results] == [[0, 2], [1, 2]]
+    assert results[1][0][1] == np.float32(1.0), "ベクトルの長さに関係なくコサイン類似度で比較すること"
+
+
+def test_DuckDBのベクトルストアと同じ順位で検索できる(vector_store_factory):
+    # Arrange
+    duckdb_repository = vector_store_factory(size=32)
+    duckdb_repository.put_bulk([(f"table_{i}", f"テーブル{i}の説明") for i in range(50)], "table_embeddings")
+    repository = NumpyVectorStoreRepository(duckdb_repository)
+    embeddings = [repository.embed_query(f"テーブル{i}の説明") for i in [3, 30]]
+
+    # Act
+    actual = repository.retrieve_relevant_docs_by_vectors(embeddings, "table_embeddings", k=5)
+
+    # Assert
+    expected = [
+        duckdb_repository.retrieve_relevant_docs_by_vector(embedding, "table_embeddings", k=5)
+        for embedding in embeddings
+    ]
+    assert [[doc.metadata["doc_id"] for doc in docs] for docs in actual] == [
+        [doc.metadata["doc_id"] for doc in docs] for docs in expected
+    ]
+    assert actual[0][0].metadata["doc_id"] == "table_3"
+
+
+def test_書き込んだテーブルの索引は読み込み直される(vector_store_factory):
+    # Arrange
+    repository = NumpyVectorStoreRepository(vector_store_factory())
+    assert repository.retrieve_relevant_docs("注文", "table_embeddings") == [], "テーブルが無ければ空を返すこと"
+
+    # Act
+    repository.put("schema.orders", "注文", "table_embeddings")
+
+    # Assert
+    assert [doc.metadata["doc_id"] for doc in repository.retrieve_relevant_docs("注文", "table_embeddings")] == [
+        "schema.orders"
+    ]
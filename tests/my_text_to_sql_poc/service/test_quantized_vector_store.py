@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from my_text_to_sql_poc.service.numpy_vector_store import NumpyVectorStoreRepository
+from my_text_to_sql_poc.service.quantized_vector_store import QuantizedMatrix, QuantizedVectorStoreRepository
+
+
+def test_int8は行ごとのスケールで元の埋め込みを近似しメモリが約4分の1になる():
+    # Arrange
+    matrix = np.random.default_rng(0).standard_normal((100, 64)).astype(np.float32)
+
+    # Act
+    quantized = QuantizedMatrix(matrix, "int8")
+    scores, rows = quantized.search(matrix[:3] / np.linalg.norm(matrix[:3], axis=1, keepdims=True), k=1)
+
+    # Assert
+    assert rows[:, 0].tolist() == [0, 1, 2]
+    assert scores[:, 0] == pytest.approx([1.0, 1.0, 1.0], abs=1e-2)
+    assert quantized.nbytes == 100 * 64 + 100 * 4, "int8の符号と行ごとの float32 のスケールだけを持つこと"
+
+
+@pytest.mark.parametrize("precision", ["float16", "int8"])
+def test_候補を元の埋め込みで並べ替えて総当たりと同じ結果を返す(precision: str, vector_store_factory):
+    # Arrange
+    duckdb_repository = vector_store_factory(size=32)
+    duckdb_repository.put_bulk([(f"table_{i}", f"テーブル{i}の説明") for i in range(50)], "table_embeddings")
+    repository = QuantizedVectorStoreRepository(duckdb_repository, precision=precision, rerank_factor=4)
+    embeddings = [repository.embed_query(f"テーブル{i}の説明") for i in [3, 30]]
+
+    # Act
+    actual = repository.retrieve_relevant_docs_by_vectors(embeddings, "table_embeddings", k=5)
+
+    # Assert
+    expected = NumpyVectorStoreRepository(duckdb_repository).retrieve_relevant_docs_by_vectors(
+        embeddings, "table_embeddings", k=5
+    )
+    assert [[doc.metadata["doc_id"] for doc in docs] for docs in actual] == [
+        [doc.metadata["doc_id"] for doc in docs] for docs in expected
+    ]
+    assert [doc.metadata["_similarity_score"] for doc in actual[0]] == pytest.approx(
+        [doc.metadata["_similarity_score"] for doc in expected[0]], abs=1e-5
+    ), "並べ替え後の類似度は元の埋め込みのコサイン類似度であること"
+    assert repository.originals_path("table_embeddings").exists()
+
+
+def test_テーブルが無ければ空を返し書き込み後は読み込み直す(vector_store_factory):
+    # Arrange
+    repository = QuantizedVectorStoreRepository(vector_store_factory())
+    assert repository.retrieve_relevant_docs("注文", "table_embeddings") == []
+
+    # Act
+    repository.put("schema.orders", "注文", "table_embeddings")
+
+    # Assert
+    assert [doc.metadata["doc_id"] for doc in repository.retrieve_relevant_docs("注文", "table_embeddings")] == [
+        "schema.orders"
+    ]
+
+
+def test_並べ替えない場合は元の埋め込みのコピーを書き出さない(vector_store_factory):
+    # Arrange
+    repository = QuantizedVectorStoreRepository(vector_store_factory(size=32), precision="int8", rerank_factor=0)
+    repository.put_bulk([(f"table_{i}", f"テーブル{i}の説明") for i in range(20)], "table_embeddings")
+
+    # Act
+    docs = repository.retrieve_relevant_docs("テーブル7の説明", "table_embeddings", k=3)
+
+    # Assert
+    assert docs[0].metadata["doc_id"] == "table_7"
+    assert repository.index("table_embeddings").originals is None
+    assert not repository.originals_path("table_embeddings").exists()
@@ -0,0 +1,146 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator
+
+import pytest
+
+from my_text_to_sql_poc.service.model_gateway import ModelGateway, ModelGatewaySettings
+from my_text_to_sql_poc.service.rate_limiter import RateLimiter, parse_reset_duration, retry_after_seconds
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_RPMとTPMの上限を超える分は補充されるまで待たせる():
+    # Arrange
+    request_limiter = RateLimiter(requests_per_minute=2, clock=FakeClock())
+    token_limiter = RateLimiter(tokens_per_minute=1000, clock=FakeClock())
+
+    # Act
+    waits = [request_limiter.reserve(100), request_limiter.reserve(100), request_limiter.reserve(100)]
+    token_waits = [token_limiter.reserve(800), token_limiter.reserve(400)]
+
+    # Assert
+    assert waits == [0.0, 0.0, pytest.approx(30.0)], "RPM=2なら3件目は1件分が補充される30秒後まで待つ"
+    assert token_waits == [0.0, pytest.approx(12.0)], "TPM=1000の不足分200トークンが補充される12秒後まで待つ"
+
+
+def test_応答ヘッダーの残量と実際のトークン数をバケツに反映する():
+    # Arrange
+    clock = FakeClock()
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=6000, clock=clock)
+    limiter.reserve(1000)
+
+    # Act
+    limiter.record_usage(estimated_tokens=1000, actual_tokens=400)
+    limiter.update_from_headers({"x-ratelimit-remaining-requests": "0", "x-ratelimit-remaining-tokens": "9999"})
+    wait = limiter.reserve(5600)
+
+    # Assert
+    assert wait == pytest.approx(1.0), "他のプロセスが使い切った分(残り0件)は1件分補充されるまで待つこと"
+
+
+def test_429を受けたら応答ヘッダーが示す時間だけ全ての送信を止める():
+    # Arrange
+    clock = FakeClock()
+    limiter = RateLimiter(requests_per_minute=60, clock=clock)
+    limiter.reserve(0)
+
+    # Act
+    delay = limiter.back_off({"retry-after-ms": "1500"}, attempt=0)
+
+    # Assert
+    assert delay == pytest.approx(1.5)
+    assert limiter.reserve(0) == pytest.approx(1.5)
+    clock.now = 2.0
+    assert limiter.reserve(0) == 0.0
+
+
+def test_待ち時間はretry_afterが無ければ上限に達した方のリセット時間を使う():
+    # Arrange
+    headers = {
+        "x-ratelimit-remaining-requests": "10",
+        "x-ratelimit-reset-requests": "1s",
+        "x-ratelimit-remaining-tokens": "0",
+        "x-ratelimit-reset-tokens": "6m0.5s",
+    }
+
+    # Act
+    delay = retry_after_seconds(headers)
+
+    # Assert
+    assert delay == pytest.approx(360.5)
+    assert parse_reset_duration("20ms") == pytest.approx(0.02)
+    assert retry_after_seconds({}) is None
+
+
+class RateLimitedChatCompletionHandler(BaseHTTPRequestHandler):
+    """最初のリクエストには429を、以降はレート制限の残量ヘッダー付きで固定の応答を返す"""
+
+    protocol_version = "HTTP/1.1"
+    requested_at: list[float] = []
+
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.requested_at.append(time.monotonic())
+        if len(self.requested_at) == 1:
+            body = json.dumps({"error": {"message": "Rate limit reached", "type": "requests"}}).encode()
+            self.send_response(429)
+            self.send_header("retry-after-ms", "300")
+        else:
+            body = json.dumps(
+                {
+                    "id": "chatcmpl-test",
+                    "object": "chat.completion",
+                    "created": 0,
+                    "model": "gpt-4o-mini",
+                    "choices": [
+                        {"index": 0, "message": {"role": "assistant", "content": "応答"}, "finish_reason": "stop"}
+                    ],
+                    "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+                }
+            ).encode()
+            self.send_response(200)
+            self.send_header("x-ratelimit-remaining-requests", "0")
+            self.send_header("x-ratelimit-remaining-tokens", "100000")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def rate_limited_server(monkeypatch) -> Iterator[type[RateLimitedChatCompletionHandler]]:
+    RateLimitedChatCompletionHandler.requested_at = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RateLimitedChatCompletionHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    monkeypatch.setenv("OPENAI_API_BASE", f"http://127.0.0.1:{server.server_address[1]}/v1")
+    yield RateLimitedChatCompletionHandler
+    server.shutdown()
+    server.server_close()
+
+
+def test_ゲートウェイは429を受けたら待ってから再送し応答ヘッダーの残量に合わせて待たせる(rate_limited_server):
+    # Arrange
+    limiter = RateLimiter(requests_per_minute=600)
+    gateway = ModelGateway(settings=ModelGatewaySettings(response_cache_path=""), rate_limiter=limiter)
+
+    # Act
+    response = gateway.generate_response("質問")
+
+    # Assert
+    assert response == "応答"
+    first, retried = rate_limited_server.requested_at
+    assert retried - first >= 0.3, "retry-after-msの300ミリ秒を待ってから再送すること"
+    assert limiter.reserve(0) == pytest.approx(0.1, abs=0.02), "残量0件のヘッダーを受けたら次の1件分の補充を待つこと"
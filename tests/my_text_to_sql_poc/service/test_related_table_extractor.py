@@ -53,3 +53,28 @@ def test_extract_related_tables_with_more_2_cte():
         "table2",
         "table3",
     }, "CTEテーブルが除外され、table1, table2, table3のみが抽出されること"
+
+
+def test_extract_related_tables_with_comma_without_space_and_recursive_cte():
+    """カンマの直後にスペースが無いCTEと、WITH RECURSIVEのCTEを除外するテスト"""
+    # Arrange
+    sql_query = """
+    WITH RECURSIVE Dates (d) AS (
+        SELECT min(created_at) FROM schema.events
+        UNION ALL
+        SELECT d + 1 FROM Dates WHERE d < current_date
+    )
+    ,daily AS (
+        SELECT * FROM schema.users
+    )
+    SELECT * FROM dates JOIN daily USING (d)
+    """
+
+    # Act
+    related_tables = extract_related_tables(sql_query)
+
+    # Assert
+    assert related_tables == {
+        "schema.events",
+        "schema.users",
+    }, "RECURSIVEのCTE(列名付き・大文字小文字違いの参照を含む)とカンマ直後のCTEが除外されること"
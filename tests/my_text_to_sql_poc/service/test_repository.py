@@ -0,0 +1,137 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import duckdb
+
+from my_text_to_sql_poc.service.repository import (
+    DuckDBSampleQueryRepository,
+    DuckDBTableMetadataRepository,
+)
+
+
+def test_テーブルメタデータをretrieveの順序のまま一括取得できる(tmp_path: Path):
+    # Arrange
+    repository = DuckDBTableMetadataRepository(str(tmp_path / "table_metadata_store.duckdb"))
+    repository.put_bulk([(f"table_{i}", f"metadata_{i}") for i in range(100)] + [("o'reilly", "quoted")])
+
+    # Act
+    actual = repository.get(["table_42", "missing_table", "table_7", "o'reilly", "table_99"])
+
+    # Assert
+    assert list(actual.items()) == [
+        ("table_42", "metadata_42"),
+        ("table_7", "metadata_7"),
+        ("o'reilly", "quoted"),
+        ("table_99", "metadata_99"),
+    ], "存在しないテーブルは除外され、引数の順序が保たれること"
+    assert repository.get([]) == {}
+
+
+def test_サンプルクエリをretrieveの順序のまま一括取得できる(tmp_path: Path):
+    # Arrange
+    repository = DuckDBSampleQueryRepository(str(tmp_path / "sample_query_store.duckdb"))
+    repository.put_bulk([(f"query_{i}", f"select {i}", f"https://example.com/{i}") for i in range(10)])
+
+    # Act
+    actual = repository.get(["query_3", "query_1", "unknown"])
+
+    # Assert
+    assert list(actual.items()) == [("query_3", "select 3"), ("query_1", "select 1")]
+
+
+def test_テーブル名でサンプルクエリを引く際に部分一致のテーブルは含まれない(tmp_path: Path):
+    # Arrange
+    repository = DuckDBSampleQueryRepository(str(tmp_path / "sample_query_store.duckdb"))
+    repository.put_bulk(
+        [
+            ("users_query", "select * from analytics.user u", "https://example.com/1"),
+            (
+                "events_query",
+                "select * from user_events e join analytics.user u using (user_id)",
+                "https://example.com/2",
+            ),
+            ("cte_query", "with user as (select 1) select * from user", "https://example.com/3"),
+        ]
+    )
+
+    # Act & Assert
+    assert set(repository.retrieve_by_table_name("user")) == {"users_query", "events_query"}
+    assert set(repository.retrieve_by_table_name("Analytics.User")) == {"users_query", "events_query"}
+    assert set(repository.retrieve_by_table_name("user_events")) == {"events_query"}
+
+    # クエリが更新された場合は、エッジも張り直される
+    repository.put("events_query", "select * from user_events", "https://example.com/2")
+    assert set(repository.retrieve_by_table_name("user")) == {"users_query"}
+
+
+def test_エッジテーブルが無い既存ストアをバックフィルできる(tmp_path: Path):
+    # Arrange
+    db_path = tmp_path / "sample_query_store.duckdb"
+    conn = duckdb.connect(str(db_path))
+    conn.execute("CREATE TABLE sample_queries (query_name TEXT PRIMARY KEY, query TEXT, query_url TEXT)")
+    conn.execute("INSERT INTO sample_queries VALUES ('q1', 'select * from user_events', 'url')")
+    conn.close()
+    repository = DuckDBSampleQueryRepository(str(db_path))
+    assert set(repository.retrieve_by_table_name("user")) == {"q1"}, "バックフィル前は部分一致で検索されること"
+
+    # Act
+    edge_count = repository.rebuild_table_index()
+
+    # Assert
+    assert edge_count == 1
+    assert repository.retrieve_by_table_name("user") == {}
+    assert repository.retrieve_by_table_name("user_events") == {"q1": "select * from user_events"}
+
+
+def test_S3上のストアは最初のアクセスまでダウンロードされない(tmp_path: Path, mocker):
+    # Arrange
+    local_path = tmp_path / "table_metadata_store.duckdb"
+    download = mocker.patch(
+        "my_text_to_sql_poc.service.repository.download_duckdb_from_s3",
+        return_value=local_path,
+    )
+
+    # Act
+    repository = DuckDBTableMetadataRepository("s3://text2sql-test-bucket/table_metadata_store.duckdb")
+
+    # Assert
+    download.assert_not_called()
+    repository.put("table_a", "metadata_a")
+    assert repository.get(["table_a"]) == {"table_a": "metadata_a"}
+    download.assert_called_once_with("s3://text2sql-test-bucket/table_metadata_store.duckdb")
+
+
+def test_ベクトルストアの検索ハンドルは使い回される(mocker, vector_store_factory):
+    # Arrange
+    repository = vector_store_factory(size=16)
+    repository.put_bulk(
+        [("table_a", "ユーザーのテーブル"), ("table_b", "注文のテーブル")], table_name="table_embeddings"
+    )
+    open_cursor = mocker.spy(repository._connections, "open_cursor")
+
+    # Act
+    results = [repository.retrieve_relevant_docs("注文のテーブル", "table_embeddings", k=1) for _ in range(3)]
+
+    # Assert
+    assert [docs[0].metadata["doc_id"] for docs in results] == ["table_b"] * 3
+    assert open_cursor.call_count == 1, "2回目以降の検索ではカーソルを作り直さないこと"
+    repository.close()
+
+
+def test_ベクトルストアの検索ハンドルは複数スレッドから同時に使える(vector_store_factory):
+    # Arrange
+    docs = [(f"table_{i}", f"テーブル{i}の説明") for i in range(20)]
+    with vector_store_factory(size=16) as repository:
+        repository.put_bulk(docs, table_name="table_embeddings")
+
+        # Act
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(
+                executor.map(
+                    lambda doc: repository.retrieve_relevant_docs(doc[1], "table_embeddings", k=1)[0],
+                    docs * 5,
+                )
+            )
+
+    # Assert
+    assert [result.metadata["doc_id"] for result in results] == [doc_id for doc_id, _ in docs * 5]
@@ -0,0 +1,97 @@
+from pathlib import Path
+
+import boto3
+import duckdb
+import pytest
+from moto import mock_aws
+
+from my_text_to_sql_poc.service.repository import DuckDBTableMetadataRepository
+from my_text_to_sql_poc.service.s3_range_read import S3RangeReadFileSystem, open_range_read_store
+
+BUCKET = "text2sql-test-bucket"
+
+
+@pytest.fixture
+def s3_client():
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def _upload_store(tmp_path: Path, s3_client, key: str) -> str:
+    """テーブルメタデータと、それより大きい無関係なテーブルを持つストアを作ってS3に置く"""
+    db_path = tmp_path / "store.duckdb"
+    with duckdb.connect(str(db_path)) as conn:
+        conn.execute("CREATE TABLE table_metadata (table_name TEXT PRIMARY KEY, metadata TEXT)")
+        conn.execute("INSERT INTO table_metadata VALUES ('schema.users', 'ユーザーのテーブル')")
+        conn.execute(
+            "CREATE TABLE other_table AS SELECT range AS id, repeat(md5(range::VARCHAR), 20) AS body FROM range(20000)"
+        )
+    s3_client.upload_file(str(db_path), BUCKET, key)
+    return f"s3://{BUCKET}/{key}"
+
+
+def test_ファイル全体をダウンロードせずに必要な部分だけ読み込む(tmp_path: Path, s3_client):
+    # Arrange
+    s3_uri = _upload_store(tmp_path, s3_client, "stores/table_metadata_store.duckdb")
+    filesystem = S3RangeReadFileSystem(s3_client=s3_client, block_size=64 * 1024, cache_dir=None)
+    connections = open_range_read_store(s3_uri, filesystem=filesystem)
+
+    # Act
+    repository = DuckDBTableMetadataRepository(s3_uri, connection_manager=connections, access_mode="range_read")
+    result = repository.get(["schema.users"])
+
+    # Assert
+    assert result == {"schema.users": "ユーザーのテーブル"}
+    assert 0 < filesystem.stats.transfer_ratio < 0.5, "参照しないテーブルのページは取得しないこと"
+    connections.close()
+
+
+def test_取得したブロックはディスクにキャッシュされ再利用される(tmp_path: Path, s3_client):
+    # Arrange
+    s3_uri = _upload_store(tmp_path, s3_client, "store.duckdb")
+    first_fs = S3RangeReadFileSystem(s3_client=s3_client, block_size=64 * 1024, cache_dir=tmp_path / "blocks")
+    with open_range_read_store(s3_uri, filesystem=first_fs) as connections, connections.read_cursor() as cursor:
+        cursor.execute("SELECT count(*) FROM table_metadata").fetchall()
+    second_fs = S3RangeReadFileSystem(s3_client=s3_client, block_size=64 * 1024, cache_dir=tmp_path / "blocks")
+
+    # Act
+    with open_range_read_store(s3_uri, filesystem=second_fs) as connections, connections.read_cursor() as cursor:
+        count = cursor.execute("SELECT count(*) FROM table_metadata").fetchone()[0]
+
+    # Assert
+    assert count == 1
+    assert second_fs.stats.bytes_transferred == 0, "2回目はS3から取得しないこと"
+    assert second_fs.stats.block_cache_hits > 0
+
+
+def test_レンジリードモードでは書き込めない(tmp_path: Path, s3_client):
+    # Arrange
+    s3_uri = _upload_store(tmp_path, s3_client, "store.duckdb")
+    filesystem = S3RangeReadFileSystem(s3_client=s3_client, cache_dir=None)
+    repository = DuckDBTableMetadataRepository(
+        s3_uri, connection_manager=open_range_read_store(s3_uri, filesystem=filesystem), access_mode="range_read"
+    )
+
+    # Act & Assert
+    with pytest.raises(PermissionError):
+        repository.put("schema.orders", "注文のテーブル")
+
+
+def test_読み込み中にS3上のストアが置き換えられたら付け直すよう促すエラーにする(tmp_path: Path, s3_client):
+    # Arrange
+    s3_uri = _upload_store(tmp_path, s3_client, "store.duckdb")
+    filesystem = S3RangeReadFileSystem(s3_client=s3_client, block_size=64 * 1024, cache_dir=None)
+    connections = open_range_read_store(s3_uri, filesystem=filesystem)
+    s3_client.put_object(Bucket=BUCKET, Key="store.duckdb", Body=(tmp_path / "store.duckdb").read_bytes() + b"\0")
+
+    # Act
+    with pytest.raises(duckdb.Error, match="Re-attach the store"), connections.read_cursor() as cursor:
+        cursor.execute("SELECT count(*) FROM other_table WHERE body LIKE '%x%'").fetchall()
+    connections.close()
+    with open_range_read_store(s3_uri, filesystem=filesystem) as connections, connections.read_cursor() as cursor:
+        count = cursor.execute("SELECT count(*) FROM table_metadata").fetchone()[0]
+
+    # Assert
+    assert count == 1, "付け直せば新しい内容を読めること"
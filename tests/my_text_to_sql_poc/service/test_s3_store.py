@@ -0,0 +1,106 @@
+from pathlib import Path
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from my_text_to_sql_poc.service.s3_store import CONTENT_SHA256_METADATA_KEY, S3StoreCache, upload_file_if_changed
+
+BUCKET = "text2sql-test-bucket"
+
+
+@pytest.fixture
+def s3_client():
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def test_S3側が更新されていなければダウンロードしない(tmp_path: Path, s3_client, mocker):
+    # Arrange
+    s3_client.put_object(Bucket=BUCKET, Key="stores/table_metadata_store.duckdb", Body=b"version-1")
+    store_cache = S3StoreCache(tmp_path, s3_client=s3_client)
+    s3_uri = f"s3://{BUCKET}/stores/table_metadata_store.duckdb"
+    first_path = store_cache.fetch(s3_uri)
+    spy = mocker.spy(s3_client, "get_object")
+
+    # Act
+    second_path = store_cache.fetch(s3_uri)
+
+    # Assert
+    assert first_path == second_path == tmp_path / BUCKET / "stores/table_metadata_store.duckdb"
+    assert second_path.read_bytes() == b"version-1"
+    assert "IfNoneMatch" in spy.call_args.kwargs, "ETagによる条件付きGETが行われること"
+
+
+def test_S3側が更新されていれば再ダウンロードする(tmp_path: Path, s3_client):
+    # Arrange
+    s3_client.put_object(Bucket=BUCKET, Key="store.duckdb", Body=b"version-1")
+    store_cache = S3StoreCache(tmp_path, s3_client=s3_client)
+    store_cache.fetch(f"s3://{BUCKET}/store.duckdb")
+    s3_client.put_object(Bucket=BUCKET, Key="store.duckdb", Body=b"version-2")
+
+    # Act
+    local_path = store_cache.fetch(f"s3://{BUCKET}/store.duckdb")
+
+    # Assert
+    assert local_path.read_bytes() == b"version-2"
+    assert [p.name for p in local_path.parent.iterdir() if p.name.endswith(".tmp")] == [], "一時ファイルが残らないこと"
+
+
+def test_複数のストアを並行に取得できる(tmp_path: Path, s3_client):
+    # Arrange
+    s3_uris = []
+    for name in ["table_metadata_store", "sample_query_store", "sample_vectorstore"]:
+        s3_client.put_object(Bucket=BUCKET, Key=f"{name}.duckdb", Body=name.encode())
+        s3_uris.append(f"s3://{BUCKET}/{name}.duckdb")
+    store_cache = S3StoreCache(tmp_path, s3_client=s3_client)
+
+    # Act
+    local_path_by_uri = store_cache.fetch_many(s3_uris, max_workers=3)
+
+    # Assert
+    assert list(local_path_by_uri) == s3_uris
+    assert [path.read_bytes() for path in local_path_by_uri.values()] == [
+        b"table_metadata_store",
+        b"sample_query_store",
+        b"sample_vectorstore",
+    ]
+
+
+def test_内容が変わっていなければアップロードしない(tmp_path: Path, s3_client, mocker):
+    # Arrange
+    local_path = tmp_path / "store.duckdb"
+    local_path.write_bytes(b"version-1")
+    s3_uri = f"s3://{BUCKET}/store.duckdb"
+    first = upload_file_if_changed(local_path, s3_uri, s3_client=s3_client)
+    spy = mocker.spy(s3_client, "upload_file")
+
+    # Act
+    second = upload_file_if_changed(local_path, s3_uri, s3_client=s3_client)
+
+    # Assert
+    assert first.uploaded is True
+    assert second.uploaded is False
+    assert spy.call_count == 0, "S3上のオブジェクトと同じ内容ならアップロードしないこと"
+
+
+def test_内容が変わっていればマルチパートでアップロードする(tmp_path: Path, s3_client):
+    # Arrange
+    local_path = tmp_path / "store.duckdb"
+    local_path.write_bytes(b"version-1")
+    s3_uri = f"s3://{BUCKET}/store.duckdb"
+    upload_file_if_changed(local_path, s3_uri, s3_client=s3_client)
+    new_content = b"x" * (12 * 1024 * 1024)
+    local_path.write_bytes(new_content)
+
+    # Act
+    result = upload_file_if_changed(local_path, s3_uri, s3_client=s3_client, part_size=5 * 1024 * 1024)
+
+    # Assert
+    assert result.uploaded is True
+    response = s3_client.get_object(Bucket=BUCKET, Key="store.duckdb")
+    assert response["Body"].read() == new_content
+    assert response["ETag"].strip('"').endswith("-3"), "5MiBごとの3パートに分けてアップロードされること"
+    assert response["Metadata"][CONTENT_SHA256_METADATA_KEY] == result.content_sha256
@@ -0,0 +1,71 @@
+import pytest
+
+from my_text_to_sql_poc.service.faiss_vector_store import FaissVectorStoreRepository
+from my_text_to_sql_poc.service.hybrid_vector_store import HybridVectorStoreRepository
+from my_text_to_sql_poc.service.numpy_vector_store import NumpyVectorStoreRepository
+from my_text_to_sql_poc.service.quantized_vector_store import QuantizedVectorStoreRepository
+from my_text_to_sql_poc.service.vector_filter import DocumentAttributes, VectorSearchFilter
+
+REPOSITORY_FACTORIES = {
+    "duckdb": lambda repository: repository,
+    "numpy": NumpyVectorStoreRepository,
+    "hybrid": HybridVectorStoreRepository,
+    "faiss": lambda repository: FaissVectorStoreRepository(repository, index_type="flat"),
+    "quantized": QuantizedVectorStoreRepository,
+}
+
+
+@pytest.mark.parametrize("vector_index", REPOSITORY_FACTORIES)
+def test_属性で絞り込んだドキュメントだけから検索する(vector_index: str, vector_store_factory):
+    # Arrange
+    duckdb_repository = vector_store_factory(size=16)
+    repository = REPOSITORY_FACTORIES[vector_index](duckdb_repository)
+    docs = [(f"{schema}.table_{i}", f"{schema}のテーブル{i}") for schema in ["sales", "hr"] for i in range(5)]
+    attributes_by_doc_id = {
+        doc_id: DocumentAttributes.from_table_name(
+            doc_id, dialect="Redshift", tags=["pii"] if doc_id.endswith("_0") else []
+        )
+        for doc_id, _ in docs
+    }
+    repository.put_bulk(docs, "table_embeddings", attributes_by_doc_id)
+
+    # Act
+    by_schema = repository.retrieve_relevant_docs(
+        "salesのテーブル3", "table_embeddings", k=10, search_filter=VectorSearchFilter(schema_name="hr")
+    )
+    by_tags = repository.retrieve_relevant_docs(
+        "テーブル", "table_embeddings", k=10, search_filter=VectorSearchFilter(dialect="Redshift", tags=["pii"])
+    )
+    unmatched = repository.retrieve_relevant_docs(
+        "テーブル", "table_embeddings", k=10, search_filter=VectorSearchFilter(dialect="SQLite")
+    )
+
+    # Assert
+    assert {doc.metadata["doc_id"] for doc in by_schema} == {f"hr.table_{i}" for i in range(5)}
+    assert {doc.metadata["doc_id"] for doc in by_tags} == {"sales.table_0", "hr.table_0"}
+    assert unmatched == []
+
+
+def test_属性の列が無い既存のテーブルは絞り込むと空になり書き込み時に列が追加される(vector_store_factory):
+    # Arrange
+    repository = vector_store_factory()
+    with repository._connections.write_cursor() as cursor:
+        cursor.execute(
+            """
+            CREATE TABLE table_embeddings AS
+            SELECT 'id_0' AS id, '注文' AS text, [1.0, 0, 0, 0, 0, 0, 0, 0]::FLOAT[] AS embedding,
+                '{"doc_id": "schema.orders"}' AS metadata
+            """
+        )
+    embedding = repository.embed_query("注文")
+    search_filter = VectorSearchFilter(schema_name="schema")
+
+    # Act
+    before = repository.retrieve_relevant_docs_by_vector(embedding, "table_embeddings", search_filter=search_filter)
+    repository.put("schema.users", "ユーザー", "table_embeddings", DocumentAttributes(schema_name="schema"))
+    after = repository.retrieve_relevant_docs_by_vector(embedding, "table_embeddings", search_filter=search_filter)
+
+    # Assert
+    assert before == []
+    assert [doc.metadata["doc_id"] for doc in after] == ["schema.users"]
+    assert len(repository.retrieve_relevant_docs_by_vector(embedding, "table_embeddings")) == 2
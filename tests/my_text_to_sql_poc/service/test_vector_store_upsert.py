@@ -0,0 +1,155 @@
+import numpy as np
+from langchain_core.embeddings import DeterministicFakeEmbedding, Embeddings
+
+from my_text_to_sql_poc.service import repository as repository_module
+from my_text_to_sql_poc.service.faiss_vector_store import FaissVectorStoreRepository
+from my_text_to_sql_poc.service.repository import DuckDBVectorStoreRepository
+from my_text_to_sql_poc.service.vector_filter import DocumentAttributes
+
+
+class CountingEmbeddings(Embeddings):
+    """埋め込んだテキストを記録する埋め込み"""
+
+    def __init__(self) -> None:
+        self.embedded_texts: list[str] = []
+        self._embeddings = DeterministicFakeEmbedding(size=8)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        self.embedded_texts.extend(texts)
+        return self._embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embeddings.embed_query(text)
+
+
+def _doc_ids(repository: DuckDBVectorStoreRepository, table_name: str) -> list[str]:
+    with repository._connections.read_cursor() as cursor:
+        return [doc_id for (doc_id,) in cursor.execute(f"SELECT doc_id FROM {table_name} ORDER BY doc_id").fetchall()]
+
+
+def test_同じdoc_idは上書きし変更の無いドキュメントは埋め込まない(vector_store_factory):
+    # Arrange
+    embeddings = CountingEmbeddings()
+    repository = vector_store_factory(embeddings=embeddings)
+    repository.put_bulk([("schema.users", "ユーザー"), ("schema.orders", "注文")], "table_embeddings")
+    embeddings.embedded_texts.clear()
+
+    # Act
+    repository.put_bulk([("schema.users", "ユーザー"), ("schema.orders", "注文の明細")], "table_embeddings")
+    repository.put("schema.users", "ユーザー", "table_embeddings", DocumentAttributes(schema_name="schema"))
+
+    # Assert
+    assert embeddings.embedded_texts == ["注文の明細", "ユーザー"], "本文か属性が変わったドキュメントだけを埋め込むこと"
+    assert _doc_ids(repository, "table_embeddings") == ["schema.orders", "schema.users"]
+    docs = repository.retrieve_relevant_docs("注文", "table_embeddings", k=5)
+    assert {doc.page_content for doc in docs} == {"ユーザー", "注文の明細"}
+
+
+def test_埋め込み済みのドキュメントは埋め込みモデルを呼ばずにupsertする(vector_store_factory):
+    # Arrange
+    embeddings = CountingEmbeddings()
+    repository = vector_store_factory(embeddings=embeddings)
+    repository.put_embeddings(
+        [("schema.users", "ユーザー"), ("schema.orders", "注文")], np.eye(2, 8, dtype=np.float32), "table_embeddings"
+    )
+
+    # Act
+    repository.put_embeddings([("schema.orders", "注文の明細")], np.eye(1, 8, 1, dtype=np.float32), "table_embeddings")
+    docs = repository.retrieve_relevant_docs_by_vector(np.eye(1, 8, 1)[0].tolist(), "table_embeddings", k=1)
+
+    # Assert
+    assert embeddings.embedded_texts == [], "埋め込みモデルを呼ばないこと"
+    assert _doc_ids(repository, "table_embeddings") == ["schema.orders", "schema.users"]
+    assert [doc.page_content for doc in docs] == ["注文の明細"]
+    repository.put_bulk([("schema.orders", "注文の明細")], "table_embeddings")
+    assert embeddings.embedded_texts == [], "put_bulk でも変更の無いドキュメントとして扱うこと"
+
+
+def test_重複した行を最後に登録された行だけ残して削除する(vector_store_factory):
+    # Arrange
+    repository = vector_store_factory()
+    with repository._connections.write_cursor() as cursor:
+        # upsert導入前のストアと同じく、doc_idをメタデータにだけ持つ行を重複して登録しておく
+        cursor.execute(
+            """
+            CREATE TABLE table_embeddings AS
+            SELECT
+                'id_' || range AS id,
+                '注文' || range AS text,
+                [1.0, 0, 0, 0, 0, 0, 0, 0]::FLOAT[] AS embedding,
+                json_object('doc_id', CASE WHEN range < 3 THEN 'schema.orders' ELSE 'schema.users' END)::VARCHAR
+                    AS metadata
+            FROM range(4)
+            """
+        )
+
+    # Act
+    result = repository.compact("table_embeddings")
+
+    # Assert
+    assert (result.rows_before, result.rows_removed) == (4, 2)
+    assert result.embedding_bytes_removed == 2 * 8 * 4
+    assert _doc_ids(repository, "table_embeddings") == ["schema.orders", "schema.users"]
+    texts = {doc.page_content for doc in repository.retrieve_relevant_docs("注文", "table_embeddings", k=5)}
+    assert texts == {"注文2", "注文3"}
+
+
+def test_重複した行はrowidではなく登録時刻で最後の行を残す(vector_store_factory):
+    # Arrange
+    repository = vector_store_factory()
+    repository.put("schema.users", "ユーザー", "table_embeddings")
+    with repository._connections.write_cursor() as cursor:
+        # 後の位置にある行の方が先に登録された重複
+        cursor.execute(
+            """
+            INSERT INTO table_embeddings (id, text, embedding, metadata, doc_id, created_at)
+            SELECT
+                'id_' || range,
+                '注文' || range,
+                [1.0, 0, 0, 0, 0, 0, 0, 0]::FLOAT[],
+                '{"doc_id": "schema.orders"}',
+                'schema.orders',
+                TIMESTAMP '2024-01-02' - to_days(range::INTEGER)
+            FROM range(3)
+            """
+        )
+
+    # Act
+    result = repository.compact("table_embeddings")
+
+    # Assert
+    assert result.rows_removed == 2
+    texts = {doc.page_content for doc in repository.retrieve_relevant_docs("注文", "table_embeddings", k=5)}
+    assert texts == {"ユーザー", "注文0"}, "created_at が最も新しい行を残すこと"
+
+
+def test_ベクトルテーブルの列の追加はテーブルごとに1回だけ行う(vector_store_factory, mocker):
+    # Arrange
+    ensure_vector_table = mocker.spy(repository_module, "_ensure_vector_table")
+    repository = vector_store_factory()
+
+    # Act
+    repository.put_bulk([("schema.users", "ユーザー")], "table_embeddings")
+    repository.put_bulk([("schema.orders", "注文")], "table_embeddings")
+    repository.put("schema.orders", "注文の明細", "table_embeddings")
+    repository.put_bulk([("select_1", "SELECT 1")], "query_embeddings")
+
+    # Assert
+    assert [call.args[1] for call in ensure_vector_table.call_args_list] == ["table_embeddings", "query_embeddings"]
+
+
+def test_上書きされたドキュメントはFAISSの索引からも消える(vector_store_factory):
+    # Arrange
+    repository = FaissVectorStoreRepository(
+        vector_store_factory(embeddings=CountingEmbeddings()),
+        index_type="flat",
+    )
+    repository.put_bulk([("schema.users", "ユーザー"), ("schema.orders", "注文")], "table_embeddings")
+    repository.retrieve_relevant_docs("注文", "table_embeddings")
+
+    # Act
+    repository.put("schema.orders", "注文の明細", "table_embeddings")
+
+    # Assert
+    docs = repository.retrieve_relevant_docs("注文", "table_embeddings", k=5)
+    assert sorted(doc.page_content for doc in docs) == ["ユーザー", "注文の明細"]